@@ -0,0 +1,213 @@
+from __future__ import print_function
+import sys, time, asyncio, threading, concurrent.futures
+
+# Compare two ways for an asyncio program to use wormhole:
+#
+#  "threaded": the usual workaround, with the Twisted reactor running in a
+#  second thread. Every call into wormhole goes over with
+#  reactor.callFromThread(), and every result comes back with
+#  loop.call_soon_threadsafe().
+#
+#  "aio": wormhole.aio, with Twisted driven by the asyncio loop itself.
+#
+# Both talk to a rendezvous server (and a transit relay) running in the same
+# process, exchange messages back and forth between two wormholes, then
+# push records through a transit connection. We count the cross-thread
+# handoffs per message and the threads in the process, and time each
+# message round trip and the transit throughput.
+#
+# run like: python misc/bench-aio.py [threaded|aio] [MESSAGES]
+# (with no mode, each runs in its own subprocess)
+
+APPID = u"lothar.com/bench-aio"
+RECORD = b"\x00" * 16384
+RECORDS = 2000
+
+class Hops:
+    count = 0
+
+def start_relay():
+    from twisted.application import service
+    from wormhole.transit import allocate_tcp_port
+    from wormhole.server.server import RelayServer
+    relayport, transitport = allocate_tcp_port(), allocate_tcp_port()
+    s = RelayServer("tcp:%d:interface=127.0.0.1" % relayport,
+                    "tcp:%d:interface=127.0.0.1" % transitport,
+                    advertise_version=None)
+    sp = service.MultiService()
+    s.setServiceParent(sp)
+    sp.startService()
+    return (u"ws://127.0.0.1:%d/v1" % relayport,
+            u"tcp:127.0.0.1:%d" % transitport)
+
+def transit_pair(transit_relay, reactor):
+    from wormhole import transit
+    key = b"k" * 32
+    ts = transit.TransitSender(transit_relay, no_listen=True,
+                               reactor=reactor)
+    tr = transit.TransitReceiver(transit_relay, no_listen=True,
+                                 reactor=reactor)
+    return ts, tr, key
+
+def report(mode, messages, elapsed, transit_elapsed):
+    print("%-9s %5d round trips: %7.3f ms each, %5.2f hops each,"
+          " %d threads; transit %6.1f MB/s"
+          % (mode, messages, 1000.0 * elapsed / messages,
+             float(Hops.count) / messages, threading.active_count(),
+             len(RECORD) * RECORDS / transit_elapsed / 1e6))
+
+# the aio side
+
+async def aio_main(messages):
+    import wormhole.aio
+    loop = asyncio.get_event_loop()
+    reactor = wormhole.aio.install(loop)
+    real = loop.call_soon_threadsafe
+    def counted(*args, **kwargs):
+        Hops.count += 1
+        return real(*args, **kwargs)
+    loop.call_soon_threadsafe = counted
+    relay_url, transit_relay = start_relay()
+
+    w1 = wormhole.aio.create(APPID, relay_url)
+    w2 = wormhole.aio.create(APPID, relay_url)
+    w1.allocate_code()
+    w2.set_code(await w1.get_code())
+    await w1.get_verifier()
+    await w2.get_verifier()
+    w1.send_message(b"warm up")
+    await w2.get_message()
+
+    Hops.count = 0
+    start = time.time()
+    for i in range(messages):
+        w1.send_message(b"ping")
+        await w2.get_message()
+        w2.send_message(b"pong")
+        await w1.get_message()
+    elapsed = time.time() - start
+    hops = Hops.count
+
+    ts, tr, key = transit_pair(transit_relay, reactor)
+    s = wormhole.aio.AsyncTransit(ts, loop)
+    r = wormhole.aio.AsyncTransit(tr, loop)
+    s.add_connection_hints(await r.get_connection_hints())
+    r.add_connection_hints(await s.get_connection_hints())
+    s.set_transit_key(key)
+    r.set_transit_key(key)
+    sender, receiver = await asyncio.gather(s.connect(), r.connect())
+    start = time.time()
+    count = 0
+    for i in range(RECORDS):
+        sender.send(RECORD)
+    async for record in receiver:
+        count += 1
+        if count == RECORDS:
+            break
+    transit_elapsed = time.time() - start
+    sender.close()
+    receiver.close()
+
+    await w1.close()
+    await w2.close()
+    Hops.count = hops
+    report("aio", messages, elapsed, transit_elapsed)
+    await wormhole.aio.shutdown()
+
+def run_aio(messages):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    asyncio.get_event_loop().run_until_complete(aio_main(messages))
+
+# the threaded side
+
+def run_threaded(messages):
+    from twisted.internet import reactor
+    import wormhole
+    t = threading.Thread(target=reactor.run,
+                         kwargs={"installSignalHandlers": False})
+    t.daemon = True
+    t.start()
+    loop = asyncio.new_event_loop()
+
+    def call(f, *args):
+        # run f in the reactor thread, give its result to asyncio
+        future = loop.create_future()
+        def done(result):
+            Hops.count += 1
+            loop.call_soon_threadsafe(future.set_result, result)
+        def start():
+            r = f(*args)
+            if hasattr(r, "addCallback"):
+                r.addCallback(done)
+            else:
+                done(r)
+        Hops.count += 1
+        reactor.callFromThread(start)
+        return future
+
+    async def main():
+        f = concurrent.futures.Future()
+        def start_relay_in_thread():
+            f.set_result(start_relay())
+        reactor.callFromThread(start_relay_in_thread)
+        relay_url, transit_relay = await asyncio.wrap_future(f)
+        w1 = await call(wormhole.create, APPID, relay_url, reactor)
+        w2 = await call(wormhole.create, APPID, relay_url, reactor)
+        await call(w1.allocate_code)
+        code = await call(w1.get_code)
+        await call(w2.set_code, code)
+        await call(w1.get_verifier)
+        await call(w2.get_verifier)
+
+        Hops.count = 0
+        start = time.time()
+        for i in range(messages):
+            await call(w1.send_message, b"ping")
+            await call(w2.get_message)
+            await call(w2.send_message, b"pong")
+            await call(w1.get_message)
+        elapsed = time.time() - start
+        hops = Hops.count
+
+        ts, tr, key = await call(transit_pair, transit_relay, reactor)
+        r_hints = await call(tr.get_connection_hints)
+        s_hints = await call(ts.get_connection_hints)
+        await call(ts.add_connection_hints, r_hints)
+        await call(tr.add_connection_hints, s_hints)
+        await call(ts.set_transit_key, key)
+        await call(tr.set_transit_key, key)
+        sender, receiver = await asyncio.gather(call(ts.connect),
+                                                call(tr.connect))
+        start = time.time()
+        for i in range(RECORDS):
+            await call(sender.send_record, RECORD)
+        for i in range(RECORDS):
+            await call(receiver.receive_record)
+        transit_elapsed = time.time() - start
+        await call(sender.close)
+        await call(receiver.close)
+
+        await call(w1.close)
+        await call(w2.close)
+        Hops.count = hops
+        report("threaded", messages, elapsed, transit_elapsed)
+    loop.run_until_complete(main())
+    reactor.callFromThread(reactor.stop)
+    t.join()
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else None
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    if mode == "aio":
+        run_aio(messages)
+    elif mode == "threaded":
+        run_threaded(messages)
+    else:
+        # each mode needs a different reactor, so each gets its own process
+        import subprocess
+        for mode in ["threaded", "aio"]:
+            subprocess.check_call([sys.executable, __file__, mode,
+                                   str(messages)])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+from __future__ import print_function, unicode_literals
+import sys, time, random
+from wormhole.server.database import get_db
+from wormhole.server.rendezvous import Rendezvous
+from wormhole.server.rendezvous_memory import MemoryRendezvous
+
+# How long allocate_nameplate() takes when many nameplates are already
+# claimed. We claim ACTIVE nameplates first (all of 1-999, and then random
+# longer ones), then time allocate+release pairs, which leave the number of
+# claimed nameplates unchanged. The "scan" rows use the old allocator, which
+# looked at every claimed nameplate and every short id on each allocation.
+#
+# run like: python misc/bench-allocate.py [ACTIVE]
+
+def scan_allocate(app):
+    claimed = app._get_nameplate_ids()
+    for size in range(1,4):
+        available = set()
+        for id_int in range(10**(size-1), 10**size):
+            id = "%d" % id_int
+            if id not in claimed:
+                available.add(id)
+        if available:
+            return random.choice(list(available))
+    for tries in range(1000):
+        id = "%d" % random.randrange(1000, 1000*1000)
+        if id not in claimed:
+            return id
+    raise ValueError("unable to find a free nameplate-id")
+
+def run(name, rv, active, allocations, scan=False):
+    app = rv.get_app("appid")
+    for i in range(active):
+        app.allocate_nameplate("side%d" % i, 0)
+    if scan:
+        app._find_available_nameplate_id = lambda: scan_allocate(app)
+    start = time.time()
+    for i in range(allocations):
+        nameplate = app.allocate_nameplate("new%d" % i, 1)
+        app.release_nameplate(nameplate, "new%d" % i, 1)
+    elapsed = time.time() - start
+    print("%-16s %6d active: %8.0f allocations/s"
+          % (name, active, allocations / elapsed))
+
+def main():
+    active = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    run("sqlite, scan", Rendezvous(get_db(":memory:"), None, None, True),
+        active, 100, scan=True)
+    run("sqlite", Rendezvous(get_db(":memory:"), None, None, True),
+        active, 1000)
+    run("memory, scan", MemoryRendezvous(get_db(":memory:"), None, None, True),
+        active, 100, scan=True)
+    run("memory", MemoryRendezvous(get_db(":memory:"), None, None, True),
+        active, 10000)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+from __future__ import print_function
+import os, sys, time, random, shutil, tempfile, zipfile
+from multiprocessing import cpu_count
+from wormhole.cli import zipbuild
+
+# Compare zipfile.ZipFile (one thread, what "wormhole send" used to do) with
+# zipbuild.ZipBuilder at several compression levels and thread counts, on a
+# synthetic tree of many small files plus a few large ones. The file
+# contents are a mix of text-like (compressible) and random (incompressible)
+# data, roughly what a source tree with some build artifacts looks like.
+#
+# Thread counts beyond the number of cores won't help; on a single-core
+# host all the deflate rows will be about the same.
+#
+# run like: python misc/bench-compression.py [MB-per-large-file]
+
+WORDS = [b"wormhole", b"transit", b"rendezvous", b"mailbox", b"nameplate",
+         b"ponies", b"def", b"return", b"self", b"import", b"\n", b"    "]
+_rng = random.Random(1)
+POOL = b" ".join([_rng.choice(WORDS) for i in range(50000)])
+
+def text(rng, size):
+    # slices of a fixed pool of word salad, at random offsets. The pool is
+    # bigger than deflate's 32KiB window, so this doesn't compress unfairly
+    # well.
+    pieces = []
+    total = 0
+    while total < size:
+        start = rng.randrange(len(POOL) - 4096)
+        pieces.append(POOL[start:start+4096])
+        total += 4096
+    return b"".join(pieces)[:size]
+
+def make_tree(basedir, large_mb):
+    rng = random.Random(0)
+    total = 0
+    for i in range(2000):
+        sub = os.path.join(basedir, "small", "d%02d" % (i % 40))
+        if not os.path.isdir(sub):
+            os.makedirs(sub)
+        size = rng.randint(100, 20000)
+        with open(os.path.join(sub, "f%04d" % i), "wb") as f:
+            f.write(text(rng, size))
+        total += size
+    large = os.path.join(basedir, "large")
+    os.makedirs(large)
+    size = large_mb * 1000 * 1000
+    for i in range(3):
+        with open(os.path.join(large, "text%d" % i), "wb") as f:
+            f.write(text(rng, size))
+        total += size
+    with open(os.path.join(large, "random"), "wb") as f:
+        f.write(os.urandom(size))
+    total += size
+    return total
+
+def files_in(basedir):
+    for path, dirs, files in os.walk(basedir):
+        for fn in files:
+            localfilename = os.path.join(path, fn)
+            yield localfilename, os.path.relpath(localfilename, basedir)
+
+def bench_zipfile(basedir):
+    with tempfile.TemporaryFile() as out:
+        start = time.time()
+        with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as zf:
+            for localfilename, archivename in files_in(basedir):
+                zf.write(localfilename, archivename)
+        return time.time() - start, out.tell()
+
+def bench_zipbuild(basedir, level, threads):
+    with tempfile.TemporaryFile() as out:
+        start = time.time()
+        zb = zipbuild.ZipBuilder(out, *zipbuild.parse_level(level),
+                                 threads=threads)
+        for localfilename, archivename in files_in(basedir):
+            zb.add(localfilename, archivename)
+        zb.close()
+        return time.time() - start, out.tell()
+
+def main():
+    large_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    basedir = tempfile.mkdtemp()
+    try:
+        total = make_tree(basedir, large_mb)
+        print("tree: 2000 small files + 4 x %dMB, %.1fMB total, %d cores"
+              % (large_mb, total / 1e6, cpu_count()))
+        def report(name, result):
+            elapsed, size = result
+            print("  %-22s: %7.1f MB/s, %5.1f%% of original"
+                  % (name, total / elapsed / 1e6, 100.0 * size / total))
+        report("zipfile (1 thread)", bench_zipfile(basedir))
+        report("store", bench_zipbuild(basedir, "store", None))
+        for level in ["1", "6", "9"]:
+            for threads in [1, 2, 4, 8]:
+                report("level %s, %d thread(s)" % (level, threads),
+                       bench_zipbuild(basedir, level, threads))
+    finally:
+        shutil.rmtree(basedir)
+
+if __name__ == "__main__":
+    main()
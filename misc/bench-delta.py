@@ -0,0 +1,83 @@
+from __future__ import print_function
+import os, sys, io, time, random, shutil, tempfile, hashlib
+from wormhole.cli import delta
+
+# Measure how much of a file "wormhole receive --output-file" saves by
+# asking for just the changes, when the old copy differs from the new one
+# by a few small edits. For each kind of edit we report the bytes that go
+# over the wire (signatures plus the delta) against the size of the file,
+# and how long each side spends: the receiver hashing its old copy, the
+# sender searching the new one, and the receiver rebuilding it.
+#
+# run like: python misc/bench-delta.py [MB]
+
+def edit(rng, old, kind, count):
+    new = bytearray(old)
+    for i in range(count):
+        where = rng.randrange(len(new))
+        if kind == "overwrite":
+            new[where:where+10] = os.urandom(10)
+        elif kind == "insert":
+            new[where:where] = os.urandom(rng.randint(1, 500))
+        elif kind == "delete":
+            del new[where:where+rng.randint(1, 500)]
+    if kind == "append":
+        new += os.urandom(count * 1000)
+    return bytes(new)
+
+def run(old_fn, new, out_fn):
+    block_size = delta.choose_block_size(os.stat(old_fn).st_size)
+    start = time.time()
+    signatures = delta.file_signatures(old_fn, block_size)
+    sign_time = time.time() - start
+    wire = sum([len(r) for r in
+                delta.signature_records(signatures, block_size)])
+
+    start = time.time()
+    new_f = io.BytesIO(new)
+    hasher = hashlib.sha256()
+    plan = delta.compute_delta(new_f, block_size, signatures, hasher)
+    stream = delta.DeltaStream(new_f, plan)
+    with open(out_fn, "wb") as out:
+        applier = delta.DeltaApplier(old_fn, out, block_size,
+                                     len(signatures))
+        while True:
+            data = stream.read(1024*1024)
+            if not data:
+                break
+            applier.write(data)
+        applier.close()
+    delta_time = time.time() - start
+    assert applier.finished
+    assert applier.hasher.digest() == hasher.digest()
+    wire += stream.size
+    return block_size, wire, sign_time, delta_time
+
+def main():
+    mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    size = mb * 1000 * 1000
+    rng = random.Random(0)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        old = os.urandom(size)
+        old_fn = os.path.join(tmpdir, "old")
+        with open(old_fn, "wb") as f:
+            f.write(old)
+        out_fn = os.path.join(tmpdir, "out")
+        print("%d MB file" % mb)
+        print("%-18s %8s %10s %8s %8s %8s" % ("edits", "block", "on wire",
+                                             "saved", "sign", "delta"))
+        for kind, count in [("none", 0), ("overwrite", 10),
+                            ("insert", 10), ("delete", 10),
+                            ("append", 100), ("insert", 1000)]:
+            new = edit(rng, old, kind, count)
+            block_size, wire, sign_time, delta_time = run(old_fn, new, out_fn)
+            print("%-18s %7dK %9.2fM %7.1f%% %7.2fs %7.2fs"
+                  % ("%s x%d" % (kind, count), block_size // 1024,
+                     wire / 1e6, 100.0 * (1 - float(wire) / len(new)),
+                     sign_time, delta_time))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
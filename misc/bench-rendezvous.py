@@ -0,0 +1,107 @@
+from __future__ import print_function, unicode_literals
+import os, sys, time, shutil, tempfile
+from twisted.internet import task
+from wormhole.server.database import get_db, GroupCommitter
+from wormhole.server.rendezvous import Rendezvous, SidedMessage
+from wormhole.server.rendezvous_memory import MemoryRendezvous, FLUSH_INTERVAL
+
+# Rough rendezvous-server throughput for each kind of storage. Each
+# "wormhole" here is what a pair of clients does to the server: allocate a
+# nameplate, claim it from the other side, open the mailbox from both sides,
+# add four messages (pake and version from each side), release the nameplate
+# from both sides, and close the mailbox from both sides. That's 13
+# operations, and we report them per second.
+#
+# This drives the AppNamespace and Mailbox objects directly (no WebSockets),
+# with a real database file, since the cost of committing to disk is what
+# we're measuring. The memory storage flushes its write-behind every
+# FLUSH_INTERVAL seconds, like the server would.
+#
+# The group-commit rows pretend that the commands of CONCURRENT wormholes
+# arrive together, and so are handled in one reactor turn (and share one
+# commit). A busy server sees that, an idle one doesn't.
+#
+# run like: python misc/bench-rendezvous.py [WORMHOLES]
+
+OPS_PER_WORMHOLE = 13
+CONCURRENT = 10
+
+class CountingDB:
+    # counts the commits of a plain connection
+    def __init__(self, db):
+        self._db = db
+        self.commits = 0
+    def execute(self, *args):
+        return self._db.execute(*args)
+    def commit(self):
+        self._db.commit()
+        self.commits += 1
+
+def one_wormhole(app, i, now):
+    nameplate = app.allocate_nameplate("a%d" % i, now)
+    mailbox_id = app.claim_nameplate(nameplate, "b%d" % i, now)
+    mb = app.open_mailbox(mailbox_id, "a%d" % i, now)
+    app.open_mailbox(mailbox_id, "b%d" % i, now)
+    for side in ["a%d" % i, "b%d" % i]:
+        for phase in ["pake", "version"]:
+            mb.add_message(SidedMessage(side=side, phase=phase,
+                                        body="00"*64, server_rx=now,
+                                        msg_id="0000"))
+    app.release_nameplate(nameplate, "a%d" % i, now)
+    app.release_nameplate(nameplate, "b%d" % i, now)
+    mb.close("a%d" % i, "happy", now)
+    mb.close("b%d" % i, "happy", now)
+
+def run(name, make_rendezvous, wormholes, flush=False, group=False,
+        **db_options):
+    basedir = tempfile.mkdtemp()
+    try:
+        clock = task.Clock()
+        if group:
+            db = GroupCommitter(get_db(os.path.join(basedir, "relay.sqlite"),
+                                       **db_options), 0, clock)
+        else:
+            db = CountingDB(get_db(os.path.join(basedir, "relay.sqlite"),
+                                   **db_options))
+        rv = make_rendezvous(db)
+        app = rv.get_app("appid")
+        start = last_flush = time.time()
+        for i in range(wormholes):
+            now = time.time()
+            one_wormhole(app, i, now)
+            if flush and now - last_flush > FLUSH_INTERVAL:
+                rv.flush()
+                last_flush = now
+            if (i+1) % CONCURRENT == 0:
+                clock.advance(0) # the end of a reactor turn
+        rv.flush()
+        clock.advance(0)
+        elapsed = time.time() - start
+        usage = db.execute("SELECT COUNT() FROM `mailbox_usage`"
+                           ).fetchone()["COUNT()"]
+        assert usage == wormholes, (usage, wormholes)
+        print("%-30s %6d wormholes in %6.2fs: %8.0f ops/s, %6.0f commits/s"
+              % (name, wormholes, elapsed,
+                 wormholes * OPS_PER_WORMHOLE / elapsed,
+                 db.commits / elapsed))
+    finally:
+        shutil.rmtree(basedir)
+
+def main():
+    wormholes = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    sqlite = lambda db: Rendezvous(db, None, None, True)
+    run("sqlite", sqlite, wormholes)
+    run("sqlite, wal", sqlite, wormholes, wal=True)
+    run("sqlite, wal, sync=normal", sqlite, wormholes,
+        wal=True, synchronous="normal")
+    run("sqlite, group commit", sqlite, wormholes, group=True)
+    run("sqlite, wal, group commit", sqlite, wormholes, group=True, wal=True)
+    # these are quick enough to do more of
+    run("memory", lambda db: MemoryRendezvous(db, None, None, True),
+        wormholes*10, flush=True)
+    run("memory, no write-behind",
+        lambda db: MemoryRendezvous(db, None, None, True, write_behind=False),
+        wormholes*10, flush=True)
+
+if __name__ == "__main__":
+    main()
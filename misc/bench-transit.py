@@ -0,0 +1,148 @@
+from __future__ import print_function
+import io, sys, time
+from binascii import unhexlify
+from nacl.secret import SecretBox
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
+from twisted.protocols import basic
+from wormhole import transit
+
+# Rough throughput numbers for the transit record layer. This talks to a
+# Connection directly (no sockets), so it measures our own framing and
+# reassembly overhead plus the cost of SecretBox itself.
+#
+# The "striped" section runs a real TransitSender/TransitReceiver pair over
+# loopback with 1-4 parallel streams. On loopback the streams share one CPU,
+# so this mostly shows the striping overhead; the win comes on long fat
+# links where a single TCP window is the bottleneck.
+#
+# The "pooled crypto" section compares encrypting/decrypting on the reactor
+# thread with handing records to the thread pool (--crypto-threads). The
+# pool only helps when there are spare cores, and larger records amortize
+# the thread handoff better.
+#
+# run like: python misc/bench-transit.py [MB]
+
+class Owner:
+    def _receiver_record_key(self):
+        return b"r"*32
+    def _sender_record_key(self):
+        return b"s"*32
+
+class Transport:
+    def write(self, data):
+        pass
+    def writeSequence(self, data):
+        pass
+    def loseConnection(self):
+        pass
+
+def make_connection():
+    c = transit.Connection(Owner(), None, None, "bench")
+    c.transport = Transport()
+    c.state = "records"
+    c._send_key = c.owner._sender_record_key()
+    c.send_nonce = 0
+    c.receive_box = SecretBox(c.owner._receiver_record_key())
+    c.next_receive_nonce = 0
+    c.recordReceived = lambda record: None
+    return c
+
+def build_stream(total, record_size):
+    box = SecretBox(Owner()._receiver_record_key())
+    record = b"\x00" * record_size
+    pieces = []
+    for nonce in range(total // record_size):
+        encrypted = box.encrypt(record, unhexlify("%048x" % nonce))
+        pieces.append(unhexlify("%08x" % len(encrypted)) + encrypted)
+    return b"".join(pieces)
+
+def bench_reassembly(total):
+    stream = build_stream(total, 16*1024)
+    print("reassembly of %dMB in 16KiB records:" % (total // 1000000))
+    for chunksize in [1024, 16*1024, 64*1024, 256*1024, 1024*1024]:
+        c = make_connection()
+        start = time.time()
+        for i in range(0, len(stream), chunksize):
+            c.dataReceived(stream[i:i+chunksize])
+        elapsed = time.time() - start
+        print("  %8d-byte chunks: %7.1f MB/s"
+              % (chunksize, len(stream) / elapsed / 1e6))
+
+def legacy_send_record(c, record):
+    # the framing that send_record() used before it switched to struct
+    nonce = unhexlify("%048x" % c.send_nonce)
+    c.send_nonce += 1
+    encrypted = c.send_box.encrypt(record, nonce)
+    length = unhexlify("%08x" % len(encrypted))
+    c.transport.write(length)
+    c.transport.write(encrypted)
+
+def bench_framing(total):
+    print("send_record() framing:")
+    for record_size in [64, 1024, 16*1024]:
+        record = b"\x00" * record_size
+        count = max(1000, total // record_size // 10)
+        for name, send in [("legacy", legacy_send_record),
+                           ("current", transit.Connection.send_record)]:
+            c = make_connection()
+            c.send_box = SecretBox(c._send_key)
+            start = time.time()
+            for i in range(count):
+                send(c, record)
+            elapsed = time.time() - start
+            print("  %6d-byte records, %-7s: %9.0f records/s"
+                  % (record_size, name, count / elapsed))
+
+@inlineCallbacks
+def loopback_transfer(reactor, streams, total, record_size,
+                      pooled_crypto=False):
+    s = transit.TransitSender(None, reactor=reactor, streams=streams,
+                              pooled_crypto=pooled_crypto)
+    r = transit.TransitReceiver(None, reactor=reactor, streams=streams,
+                                pooled_crypto=pooled_crypto)
+    s.set_transit_key(b"k"*32)
+    r.set_transit_key(b"k"*32)
+    r.add_connection_hints((yield s.get_connection_hints()))
+    s.add_connection_hints((yield r.get_connection_hints()))
+    x, y = yield gatherResults([s.connect(), r.connect()])
+    f = io.BytesIO()
+    start = time.time()
+    d = y.writeToFile(f, total)
+    fs = basic.FileSender()
+    fs.CHUNK_SIZE = record_size
+    yield fs.beginFileTransfer(io.BytesIO(b"\x00" * total), x)
+    yield d
+    elapsed = time.time() - start
+    x.close()
+    y.close()
+    returnValue(elapsed)
+
+@inlineCallbacks
+def bench_striped(reactor, total):
+    print("loopback transfer of %dMB in 1MiB records:" % (total // 1000000))
+    for streams in [1, 2, 3, 4]:
+        elapsed = yield loopback_transfer(reactor, streams, total, 1024*1024)
+        print("  %d stream(s): %7.1f MB/s" % (streams, total / elapsed / 1e6))
+
+@inlineCallbacks
+def bench_crypto(reactor, total):
+    print("loopback transfer of %dMB, inline vs pooled crypto:"
+          % (total // 1000000))
+    for record_size in [16*1024, 256*1024, 1024*1024]:
+        for name, pooled in [("inline", False), ("pooled", True)]:
+            elapsed = yield loopback_transfer(reactor, 1, total, record_size,
+                                              pooled_crypto=pooled)
+            print("  %8d-byte records, %-6s: %7.1f MB/s"
+                  % (record_size, name, total / elapsed / 1e6))
+
+def main(reactor):
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    bench_reassembly(total * 1000000)
+    bench_framing(total * 1000000)
+    d = bench_striped(reactor, total * 1000000)
+    d.addCallback(lambda _: bench_crypto(reactor, total * 1000000))
+    return d
+
+if __name__ == "__main__":
+    task.react(main)
@@ -1,5 +1,5 @@
 from __future__ import print_function, absolute_import, unicode_literals
-import os
+import os, base64
 from six.moves.urllib_parse import urlparse
 from attr import attrs, attrib
 from attr.validators import provides, instance_of, optional
@@ -67,6 +67,7 @@ class RendezvousConnector(object):
     _journal = attrib(validator=provides(_interfaces.IJournal))
     _tor = attrib(validator=optional(provides(_interfaces.ITorManager)))
     _timing = attrib(validator=provides(_interfaces.ITiming))
+    _pool = attrib(default=None)
 
     def __attrs_post_init__(self):
         self._have_made_a_successful_connection = False
@@ -74,6 +75,19 @@ class RendezvousConnector(object):
 
         self._trace = None
         self._ws = None
+        self._debug_record_inbound_f = None
+        # message bodies go out as hex unless the server's welcome says it
+        # accepts base64, which is 2/3rds the size
+        self._encoding = "hex"
+        # WebSocket message bytes, and how much of them were message bodies
+        self._traffic = {"sent": 0, "received": 0,
+                         "body_sent": 0, "body_received": 0}
+        if self._pool:
+            # we share the pool's connection, as one session of many
+            self._session = bytes_to_hexstr(os.urandom(8))
+            self._connector = None
+            return
+        self._session = None
         f = WSFactory(self, self._url)
         f.setProtocolOptions(autoPingInterval=60, autoPingTimeout=600)
         p = urlparse(self._url)
@@ -85,7 +99,6 @@ class RendezvousConnector(object):
         # this in a different reactor turn to avoid some hazards
         d.addBoth(lambda res: task.deferLater(self._reactor, 0.0, lambda: res))
         d.addErrback(self._initial_connection_failed)
-        self._debug_record_inbound_f = None
 
     def set_trace(self, f):
         self._trace = f
@@ -109,6 +122,9 @@ class RendezvousConnector(object):
 
     # from Boss
     def start(self):
+        if self._pool:
+            self._pool.attach(self)
+            return
         self._connector.startService()
 
     # from Mailbox
@@ -121,7 +137,14 @@ class RendezvousConnector(object):
     def tx_add(self, phase, body):
         assert isinstance(phase, type("")), type(phase)
         assert isinstance(body, type(b"")), type(body)
-        self._tx("add", phase=phase, body=bytes_to_hexstr(body))
+        if self._encoding == "base64":
+            encoded = base64.b64encode(body).decode("ascii")
+            self._traffic["body_sent"] += len(encoded)
+            self._tx("add", phase=phase, body=encoded, encoding="base64")
+            return
+        encoded = bytes_to_hexstr(body)
+        self._traffic["body_sent"] += len(encoded)
+        self._tx("add", phase=phase, body=encoded)
 
     def tx_release(self, nameplate):
         self._tx("release", nameplate=nameplate)
@@ -133,6 +156,16 @@ class RendezvousConnector(object):
         # ClientService.stopService is defined to "Stop attempting to
         # reconnect and close any existing connections"
         self._stopping = True # to catch _initial_connection_failed error
+        self._timing.add("ws_traffic", _side=self._side,
+                         encoding=self._encoding, **self._traffic)
+        if self._pool:
+            if self._ws:
+                self._tx("unbind")
+            self._pool.detach(self)
+            self._ws = None
+            d = task.deferLater(self._reactor, 0.0, lambda: None)
+            d.addBoth(self._stopped)
+            return
         d = defer.maybeDeferred(self._connector.stopService)
         # ClientService.stopService always fires with None, even if the
         # initial connection failed, so log.err just in case
@@ -159,13 +192,24 @@ class RendezvousConnector(object):
             d.addErrback(log.err) # just in case something goes wrong
             d.addCallback(lambda _: self._B.error(sce))
 
-    # from our WSClient (the WebSocket protocol)
+    # from our RendezvousPool
+    def session(self):
+        return self._session
+
+    def pool_failed(self, error):
+        if not self._stopping:
+            self._B.error(error)
+
+    # from our WSClient (the WebSocket protocol), or our RendezvousPool
     def ws_open(self, proto):
         self._debug("R.connected")
         self._have_made_a_successful_connection = True
         self._ws = proto
         try:
-            self._tx("bind", appid=self._appid, side=self._side)
+            # we ask for base64 bodies. Servers that don't know about
+            # encodings will ignore this and send hex.
+            self._tx("bind", appid=self._appid, side=self._side,
+                     encoding="base64")
             self._N.connected()
             self._M.connected()
             self._L.connected()
@@ -176,7 +220,10 @@ class RendezvousConnector(object):
         self._debug("R.connected finished notifications")
 
     def ws_message(self, payload):
-        msg = bytes_to_dict(payload)
+        self.rx_message(bytes_to_dict(payload), len(payload))
+
+    def rx_message(self, msg, size=0):
+        self._traffic["received"] += size
         if msg["type"] != "ack":
                 self._debug("R.rx(%s %s%s)" %
                             (msg["type"], msg.get("phase",""),
@@ -203,6 +250,9 @@ class RendezvousConnector(object):
         self._debug("R.lost")
         was_open = bool(self._ws)
         self._ws = None
+        # the next connection might be to a different server, and we may
+        # need to re-send messages before its welcome arrives
+        self._encoding = "hex"
         # when Autobahn connects to a non-websocket server, it gets a
         # CLOSE_STATUS_CODE_ABNORMAL_CLOSE, and delivers onClose() without
         # ever calling onOpen first. This confuses our state machines, so
@@ -222,7 +272,7 @@ class RendezvousConnector(object):
         # restart the process if it fails. That would be useful here, so that
         # failAfterFailures=1 would do the right thing if the initial TCP
         # connection succeeds but the first WebSocket negotiation fails.
-        if not self._have_made_a_successful_connection:
+        if not self._have_made_a_successful_connection and not self._pool:
             # shut down the ClientService, which currently thinks it has a
             # valid connection
             sce = errors.ServerConnectionError(self._url, reason)
@@ -243,8 +293,11 @@ class RendezvousConnector(object):
         # are so few messages, 16 bits is enough to be mostly-unique.
         kwargs["id"] = bytes_to_hexstr(os.urandom(2))
         kwargs["type"] = mtype
+        if self._session:
+            kwargs["session"] = self._session
         self._debug("R.tx(%s %s)" % (mtype.upper(), kwargs.get("phase", "")))
         payload = dict_to_bytes(kwargs)
+        self._traffic["sent"] += len(payload)
         self._timing.add("ws_send", _side=self._side, **kwargs)
         self._ws.sendMessage(payload, False)
 
@@ -279,6 +332,8 @@ class RendezvousConnector(object):
         self._B.rx_error(err, orig)
 
     def _response_handle_welcome(self, msg):
+        if "base64" in msg.get("encodings", []):
+            self._encoding = "base64"
         self._B.rx_welcome(msg["welcome"])
 
     def _response_handle_claimed(self, msg):
@@ -290,7 +345,14 @@ class RendezvousConnector(object):
         side = msg["side"]
         phase = msg["phase"]
         assert isinstance(phase, type("")), type(phase)
-        body = hexstr_to_bytes(msg["body"]) # bytes
+        encoding = msg.get("encoding", "hex")
+        self._traffic["body_received"] += len(msg["body"])
+        if encoding == "base64":
+            body = base64.b64decode(msg["body"].encode("ascii"))
+        elif encoding == "hex":
+            body = hexstr_to_bytes(msg["body"]) # bytes
+        else:
+            raise ValueError("unknown message encoding %r" % (encoding,))
         self._M.rx_message(side, phase, body)
 
     def _response_handle_released(self, msg):
@@ -301,3 +363,116 @@ class RendezvousConnector(object):
 
 
     # record, message, payload, packet, bundle, ciphertext, plaintext
+
+class RendezvousPool(object):
+    """I hold a single WebSocket connection to the rendezvous server, which
+    any number of wormholes can share: pass me to wormhole.create() as
+    pool=. Each wormhole is bound as a separate session on the connection,
+    which saves a TCP and WebSocket handshake for each one. The server must
+    support sessions (those that do say so in their welcome message). I
+    reconnect if the connection is lost, and each wormhole then binds again.
+    Call close() when you are finished with me."""
+
+    def __init__(self, url, reactor, tor=None):
+        self._url = url
+        self._reactor = reactor
+        self._tor = tor
+        self._connectors = {} # session -> RendezvousConnector
+        self._ws = None
+        self._welcome = None # the welcome message, once this connection has one
+        self._have_made_a_successful_connection = False
+        self._started = False
+        self._stopping = False
+        self._error = None
+        f = WSFactory(self, self._url)
+        f.setProtocolOptions(autoPingInterval=60, autoPingTimeout=600)
+        p = urlparse(self._url)
+        if self._tor:
+            ep = self._tor.stream_via(p.hostname, p.port or 80)
+        else:
+            ep = endpoints.HostnameEndpoint(self._reactor, p.hostname,
+                                            p.port or 80)
+        self._connector = internet.ClientService(ep, f)
+
+    def get_url(self):
+        return self._url
+
+    def count_sessions(self):
+        return len(self._connectors)
+
+    # from RendezvousConnector
+    def attach(self, rc):
+        self._connectors[rc.session()] = rc
+        if self._error:
+            d = task.deferLater(self._reactor, 0.0, rc.pool_failed,
+                                self._error)
+            d.addErrback(log.err)
+            return
+        if not self._started:
+            self._started = True
+            self._connector.startService()
+            d = self._connector.whenConnected(failAfterFailures=1)
+            d.addBoth(lambda res: task.deferLater(self._reactor, 0.0,
+                                                  lambda: res))
+            d.addErrback(self._initial_connection_failed)
+        elif self._welcome:
+            rc.ws_open(self._ws)
+            rc.rx_message(self._welcome)
+
+    def detach(self, rc):
+        self._connectors.pop(rc.session(), None)
+
+    def close(self):
+        """Drop the connection. Any wormholes still using it will see it as
+        lost. Returns a Deferred that fires when it is closed."""
+        self._stopping = True
+        d = defer.maybeDeferred(self._connector.stopService)
+        d.addErrback(log.err)
+        return d
+
+    def _failed(self, error):
+        self._error = error
+        d = defer.maybeDeferred(self._connector.stopService)
+        d.addErrback(log.err) # just in case something goes wrong
+        def _tell(_):
+            for rc in list(self._connectors.values()):
+                rc.pool_failed(error)
+        d.addCallback(_tell)
+
+    # from our ClientService
+    def _initial_connection_failed(self, f):
+        if not self._stopping:
+            self._failed(errors.ServerConnectionError(self._url, f.value))
+
+    # from our WSClient
+    def ws_open(self, proto):
+        self._ws = proto
+        # we tell the wormholes about it when the welcome arrives
+
+    def ws_message(self, payload):
+        msg = bytes_to_dict(payload)
+        if msg["type"] == "welcome":
+            if not msg.get("sessions"):
+                self._failed(errors.ServerError("%s cannot share connections"
+                                                % self._url))
+                return
+            self._have_made_a_successful_connection = True
+            self._welcome = msg
+            for rc in list(self._connectors.values()):
+                rc.ws_open(self._ws)
+                rc.rx_message(msg)
+            return
+        rc = self._connectors.get(msg.get("session"))
+        if rc: # else it's for a session that has gone, or not for a session
+            rc.rx_message(msg, len(payload))
+
+    def ws_close(self, wasClean, code, reason):
+        was_open = bool(self._welcome)
+        self._ws = None
+        self._welcome = None
+        if was_open:
+            for rc in list(self._connectors.values()):
+                rc.ws_close(wasClean, code, reason)
+        if (not self._have_made_a_successful_connection
+            and not self._error and not self._stopping):
+            self._failed(errors.ServerConnectionError(self._url, reason))
@@ -0,0 +1,173 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import sys
+import asyncio
+from .wormhole import create as _create
+from .errors import WormholeError
+
+# An asyncio-facing API. Rather than run the Twisted reactor in a second
+# thread and marshal every call across to it, we install Twisted's asyncio
+# reactor, which drives Twisted's sockets and timers from the asyncio event
+# loop itself. Everything then happens on the loop's thread: each Deferred
+# is turned into an asyncio Future with Deferred.asFuture(), which resolves
+# the Future directly from the Deferred's callback.
+#
+#   reactor = wormhole.aio.install()
+#   w = wormhole.aio.create(appid, relay_url)
+#   w.allocate_code()
+#   code = await w.get_code()
+#   w.send_message(b"hello")
+#   reply = await w.get_message()
+#   await w.close()
+#   await wormhole.aio.shutdown()
+#
+# This module needs python3, and install() must be called before anything
+# imports twisted.internet.reactor (including wormhole.transit).
+
+class ReactorError(WormholeError):
+    """Some other reactor has already been installed, or the asyncio reactor
+    is running on a different event loop."""
+
+def install(loop=None):
+    """Run Twisted on 'loop' (the current event loop by default), and return
+    the reactor. It is safe to call this again with the same loop."""
+    from twisted.internet import asyncioreactor
+    if "twisted.internet.reactor" not in sys.modules:
+        asyncioreactor.install(loop or asyncio.get_event_loop())
+    from twisted.internet import reactor
+    if not isinstance(reactor, asyncioreactor.AsyncioSelectorReactor):
+        raise ReactorError("%r is already installed" % (reactor,))
+    if loop is not None and reactor._asyncioEventloop is not loop:
+        raise ReactorError("the reactor runs on a different event loop")
+    if not reactor.running:
+        # the asyncio loop is run by our caller, not by reactor.run(), so
+        # tell the reactor it has started (this lets things like the thread
+        # pool start up). The loop owns the signal handlers.
+        reactor.startRunning(installSignalHandlers=False)
+    return reactor
+
+def shutdown(reactor=None):
+    """Drop any remaining connections and stop the reactor's thread pool
+    (whose threads would otherwise keep the process alive). Returns a
+    Future that fires when that is done."""
+    if reactor is None:
+        from twisted.internet import reactor
+    f = _loop_of(reactor).create_future()
+    def _done():
+        if not f.done():
+            f.set_result(None)
+    reactor.addSystemEventTrigger("after", "shutdown", _done)
+    reactor.fireSystemEvent("shutdown")
+    return f
+
+def _loop_of(reactor):
+    return reactor._asyncioEventloop
+
+def create(appid, relay_url, reactor=None, **kwargs):
+    """Like wormhole.create(), but returns an AsyncWormhole. The reactor
+    defaults to the one that install() set up."""
+    reactor = reactor or install()
+    w = _create(appid, relay_url, reactor, **kwargs)
+    return AsyncWormhole(w, _loop_of(reactor))
+
+class AsyncWormhole:
+    """I wrap a Deferred-mode wormhole, and return asyncio Futures instead
+    of Deferreds."""
+
+    def __init__(self, wormhole, loop):
+        self._w = wormhole
+        self._loop = loop
+
+    def _future(self, d):
+        return d.asFuture(self._loop)
+
+    def get_welcome(self):
+        return self._future(self._w.get_welcome())
+    def get_code(self):
+        return self._future(self._w.get_code())
+    def get_unverified_key(self):
+        return self._future(self._w.get_unverified_key())
+    def get_verifier(self):
+        return self._future(self._w.get_verifier())
+    def get_versions(self):
+        return self._future(self._w.get_versions())
+    def get_message(self):
+        return self._future(self._w.get_message())
+    def close(self):
+        return self._future(self._w.close())
+
+    def allocate_code(self, code_length=2):
+        self._w.allocate_code(code_length)
+    def input_code(self):
+        return self._w.input_code()
+    def set_code(self, code):
+        self._w.set_code(code)
+    def send_message(self, plaintext):
+        self._w.send_message(plaintext)
+    def derive_key(self, purpose, length):
+        return self._w.derive_key(purpose, length)
+
+    def debug_set_trace(self, *args, **kwargs):
+        self._w.debug_set_trace(*args, **kwargs)
+
+class AsyncTransit:
+    """I wrap a TransitSender or TransitReceiver (which must have been given
+    the asyncio reactor). connect() returns a TransitStream."""
+
+    def __init__(self, transit, loop):
+        self._t = transit
+        self._loop = loop
+
+    def get_connection_abilities(self):
+        return self._t.get_connection_abilities()
+    def get_connection_hints(self):
+        return self._t.get_connection_hints().asFuture(self._loop)
+    def add_connection_hints(self, hints):
+        self._t.add_connection_hints(hints)
+    def set_transit_key(self, key):
+        self._t.set_transit_key(key)
+
+    def connect(self):
+        d = self._t.connect()
+        d.addCallback(TransitStream, self._loop)
+        return d.asFuture(self._loop)
+
+class TransitStream:
+    """I wrap an established transit connection. Records go out with send()
+    and come in with receive(), read_into(), or 'async for':
+
+        async for record in stream:
+            ...
+    """
+
+    def __init__(self, connection, loop):
+        self._c = connection
+        self._loop = loop
+        self._records = connection.records()
+
+    def describe(self):
+        return self._c.describe()
+
+    def send(self, record):
+        self._c.send_record(record)
+
+    def receive(self):
+        return self._c.receive_record().asFuture(self._loop)
+
+    def read_into(self, buffer):
+        return self._c.read_into(buffer).asFuture(self._loop)
+
+    def set_inbound_limit(self, limit):
+        self._c.set_inbound_limit(limit)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        r = self._records.__anext__()
+        if hasattr(r, "asFuture"):
+            # we have to wait for it
+            return r.asFuture(self._loop)
+        return r # already here: awaiting it costs nothing
+
+    def close(self):
+        self._c.close()
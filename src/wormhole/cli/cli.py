@@ -154,6 +154,9 @@ CommonArgs = _compose(
     click.option("--listen/--no-listen", default=True,
                  help="(debug) don't open a listening socket for Transit",
                  ),
+    click.option("--crypto-threads", is_flag=True, default=False,
+                 help="(experimental) encrypt and decrypt in a thread pool",
+                 ),
 )
 
 TorArgs = _compose(
@@ -184,6 +187,38 @@ TorArgs = _compose(
     "--ignore-unsendable-files", default=False, is_flag=True,
     help="Don't raise an error if a file can't be read."
 )
+@click.option(
+    "--stream-directory", default=False, is_flag=True,
+    help="(experimental) send directories without building a zipfile first"
+         " (the receiver must support this)",
+)
+@click.option(
+    "--compression", default="6", metavar="LEVEL",
+    type=click.Choice(["store"] + [str(i) for i in range(1, 10)]),
+    help="how hard to compress directories: 'store' (for data that is"
+         " already compressed), or 1 (fastest) to 9 (smallest). Default: 6",
+)
+@click.option(
+    "--compress-file", default=False, is_flag=True,
+    help="(experimental) also compress single files on the wire, if they"
+         " look compressible and the receiver supports it",
+)
+@click.option(
+    "--compression-threads", default=None, metavar="NUM",
+    type=click.IntRange(1, None),
+    help="compress directories with NUM threads (default: one per CPU)",
+)
+@click.option(
+    "--streams", default=1, metavar="NUM",
+    type=click.IntRange(1, 8), # transit.MAX_STREAMS
+    help="(experimental) send data over NUM parallel transit connections",
+)
+@click.option(
+    "--fan-out", default=1, metavar="NUM",
+    type=click.IntRange(1, None),
+    help="(experimental) send to NUM receivers at once, each with their own"
+         " code, reading the file only once",
+)
 @click.argument("what", required=False, type=click.Path(path_type=type(u"")))
 @click.pass_obj
 def send(cfg, **kwargs):
@@ -2,15 +2,16 @@ from __future__ import print_function
 import os, sys, six, tempfile, zipfile, hashlib, shutil
 from tqdm import tqdm
 from humanize import naturalsize
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.python import log
 from wormhole import create, input_with_completion, __version__
-from ..transit import TransitReceiver
+from ..transit import TransitReceiver, MAX_RECORD_SIZE, MAX_STREAMS
 from ..errors import TransferError, WormholeClosedError
 from ..util import (dict_to_bytes, bytes_to_dict, bytes_to_hexstr,
                     estimate_free_space)
 from .welcome import handle_welcome
+from . import dirstream, zipstream, zipbuild, compress, resume, delta
 
 APPID = u"lothar.com/wormhole/text-or-file-xfer"
 
@@ -47,6 +48,11 @@ class Receiver:
         self._reactor = reactor
         self._tor = None
         self._transit_receiver = None
+        self._file_compression = None
+        self._checkpoint = None
+        self._resume_segments = None
+        self._keep_existing = False
+        self._delta = False
 
     def _msg(self, *args, **kwargs):
         print(*args, file=self.args.stderr, **kwargs)
@@ -225,11 +231,15 @@ class Receiver:
 
     @inlineCallbacks
     def _build_transit(self, w, sender_transit):
+        # the sender decides whether to stripe the transfer across several
+        # connections, so we offer to accept as many as we're allowed to
         tr = TransitReceiver(self.args.transit_helper,
                              no_listen=(not self.args.listen),
                              tor=self._tor,
                              reactor=self._reactor,
-                             timing=self.args.timing)
+                             timing=self.args.timing,
+                             streams=MAX_STREAMS,
+                             pooled_crypto=self.args.crypto_threads)
         self._transit_receiver = tr
         transit_key = w.derive_key(APPID+u"/transit-key", tr.TRANSIT_KEY_LENGTH)
         tr.set_transit_key(transit_key)
@@ -252,16 +262,28 @@ class Receiver:
         if "file" in them_d:
             f = self._handle_file(them_d)
             self._send_permission(w)
+            if self._resume_segments:
+                yield self._get_resume_reply(w)
             rp = yield self._establish_transit()
+            if self._delta:
+                f = yield self._start_delta(rp, f)
             datahash = yield self._transfer_data(rp, f)
             self._write_file(f)
             yield self._close_transit(rp, datahash)
         elif "directory" in them_d:
             f = self._handle_directory(them_d)
-            self._send_permission(w)
-            rp = yield self._establish_transit()
-            datahash = yield self._transfer_data(rp, f)
-            self._write_directory(f)
+            try:
+                self._send_permission(w)
+                rp = yield self._establish_transit()
+                datahash = yield self._transfer_data(rp, f)
+                if isinstance(f, (dirstream.DirectoryUnpacker,
+                                  zipstream.ZipUnpacker)):
+                    self._finish_stream(f)
+                else:
+                    self._write_directory(f)
+            except:
+                self._discard_directory(f)
+                raise
             yield self._close_transit(rp, datahash)
         else:
             self._msg(u"I don't know what they're offering\n")
@@ -289,17 +311,63 @@ class Receiver:
                   (naturalsize(self.xfersize), os.path.basename(self.abs_destname)))
         self._ask_permission()
         tmp_destname = self.abs_destname + ".tmp"
-        return open(tmp_destname, "wb")
+        filesize = self.xfersize
+        segments = None
+        if file_data.get("resumable"):
+            segments = resume.load_segments(tmp_destname, filesize)
+        if segments:
+            # a previous attempt left part of this file behind. If the
+            # sender agrees that it matches, we only need the rest.
+            f = open(tmp_destname, "r+b")
+            self._resume_segments = segments
+            self._checkpoint = resume.Checkpoint(f, filesize, segments)
+            f.truncate(self._checkpoint.offset)
+            f.seek(self._checkpoint.offset)
+            self._msg(u"Found %s of it from an earlier attempt"
+                      % naturalsize(self._checkpoint.offset))
+            return f
+        resume.remove_checkpoint(tmp_destname)
+        f = open(tmp_destname, "wb")
+        offered_delta = file_data.get("delta")
+        if (self._keep_existing and isinstance(offered_delta, list)
+            and delta.MODE in offered_delta):
+            # we're overwriting an older copy: the sender can send just the
+            # blocks that changed, which we merge with the old ones into
+            # the .tmp file
+            self._delta = True
+            return f
+        if file_data.get("resumable"):
+            self._checkpoint = resume.Checkpoint(f, filesize)
+        # the sender can offer to deflate the file on the wire. If we say
+        # yes, it sends "compressed-size" bytes instead.
+        if (file_data.get("compression") == "deflate"
+            and isinstance(file_data.get("compressed-size"),
+                           six.integer_types)):
+            self._file_compression = "deflate"
+            # (offsets in the compressed stream don't map onto the file, so
+            # compressed transfers can't be resumed)
+            self._checkpoint = None
+            f = compress.InflatingFile(f, self.xfersize)
+            self.xfersize = file_data["compressed-size"]
+        return f
 
     def _handle_directory(self, them_d):
         file_data = them_d["directory"]
         zipmode = file_data["mode"]
-        if zipmode != "zipfile/deflated":
+        if zipmode not in ("zipfile/deflated", dirstream.MODE):
             self._msg(u"Error: unknown directory-transfer mode '%s'" % (zipmode,))
             raise RespondError("unknown mode")
+        compression = file_data.get("compression", "deflate")
+        if compression not in zipbuild.COMPRESSIONS:
+            self._msg(u"Error: unknown directory compression '%s'"
+                      % (compression,))
+            raise RespondError("unknown compression")
         self.abs_destname = self._decide_destname("directory",
                                                   file_data["dirname"])
-        self.xfersize = file_data["zipsize"]
+        if zipmode == dirstream.MODE:
+            self.xfersize = file_data["streamsize"]
+        else:
+            self.xfersize = file_data["zipsize"]
         free = estimate_free_space(self.abs_destname)
         if free is not None and free < file_data["numbytes"]:
             self._msg(u"Error: insufficient free space (%sB) for directory (%sB)"
@@ -311,7 +379,19 @@ class Receiver:
         self._msg(u"%d files, %s (uncompressed)" %
                   (file_data["numfiles"], naturalsize(file_data["numbytes"])))
         self._ask_permission()
-        return tempfile.SpooledTemporaryFile()
+        if zipmode != dirstream.MODE and not file_data.get("streamable"):
+            # other senders' zipfiles may need the central directory (at
+            # the very end) to find where each member stops, so spool it
+            # and unzip it afterwards
+            return tempfile.SpooledTemporaryFile()
+        # unpack as the data arrives (in the writer thread), into a
+        # temporary directory next to the target. Once it's all there, the
+        # directory is renamed into place.
+        parent, base = os.path.split(self.abs_destname)
+        tmpdir = tempfile.mkdtemp(prefix=base+".", suffix=".tmp", dir=parent)
+        if zipmode == dirstream.MODE:
+            return dirstream.DirectoryUnpacker(tmpdir)
+        return zipstream.ZipUnpacker(tmpdir)
 
     def _decide_destname(self, mode, destname):
         # the basename() is intended to protect us against
@@ -325,7 +405,11 @@ class Receiver:
         if os.path.exists(abs_destname):
             if self.args.output_file: # overwrite is intentional
                 self._msg(u"Overwriting '%s'" % destname)
-                if self.args.accept_file:
+                if mode == "file" and os.path.isfile(abs_destname):
+                    # keep it until the new one is complete, in case the
+                    # sender can send just the changes
+                    self._keep_existing = True
+                elif self.args.accept_file:
                     self._remove_existing(abs_destname)
             else:
                 self._msg(u"Error: refusing to overwrite existing '%s'" % destname)
@@ -341,7 +425,8 @@ class Receiver:
             while True and not self.args.accept_file:
                 ok = six.moves.input("ok? (y/N): ")
                 if ok.lower().startswith("y"):
-                    if os.path.exists(self.abs_destname):
+                    if (os.path.exists(self.abs_destname)
+                        and not self._keep_existing):
                         self._remove_existing(self.abs_destname)
                     break
                 print(u"transfer rejected", file=sys.stderr)
@@ -350,11 +435,63 @@ class Receiver:
             t.detail(answer="yes")
 
     def _send_permission(self, w):
-        self._send_data({"answer": { "file_ack": "ok" }}, w)
+        answer = { "file_ack": "ok",
+                   "max-record-size": MAX_RECORD_SIZE,
+                   }
+        if self._file_compression:
+            answer["compression"] = self._file_compression
+        if self._resume_segments:
+            answer["resume"] = {"segments": [list(s) for s in
+                                             self._resume_segments]}
+        if self._delta:
+            answer["delta"] = delta.MODE
+        self._send_data({"answer": answer}, w)
+
+    @inlineCallbacks
+    def _get_resume_reply(self, w):
+        # the sender checks our segments against its copy of the file, and
+        # tells us where it will start
+        while True:
+            them_d = yield self._get_data(w)
+            if u"resume" in them_d:
+                break
+            log.msg("unrecognized message %r" % (them_d,))
+        offset = them_d[u"resume"].get(u"offset")
+        if offset == self._checkpoint.offset:
+            self._msg(u"Resuming after %s" % naturalsize(offset))
+        else:
+            self._msg(u"Partial copy doesn't match, receiving all of it")
+            self._checkpoint.restart()
+        self.xfersize -= self._checkpoint.offset
+
+    @inlineCallbacks
+    def _start_delta(self, record_pipe, f):
+        # tell the sender which blocks we already have, and find out how
+        # big the delta will be
+        old_fn = self.abs_destname
+        block_size = delta.choose_block_size(os.stat(old_fn).st_size)
+        with self.args.timing.add("delta signatures",
+                                  block_size=block_size):
+            signatures = yield threads.deferToThreadPool(
+                self._reactor, self._reactor.getThreadPool(),
+                delta.file_signatures, old_fn, block_size)
+        for record in delta.signature_records(signatures, block_size):
+            record_pipe.send_record(record)
+        header = bytes_to_dict((yield record_pipe.receive_record()))
+        size = header.get("delta-size")
+        if not isinstance(size, six.integer_types) or size <= 0:
+            raise TransferError("bad delta header: %r" % (header,))
+        self.xfersize = size
+        self._msg(u"Receiving changes to the existing file (%s)"
+                  % naturalsize(size))
+        returnValue(delta.DeltaApplier(old_fn, f, block_size,
+                                       len(signatures)))
 
     @inlineCallbacks
     def _establish_transit(self):
         record_pipe = yield self._transit_receiver.connect()
+        # we told the sender how big its records may be
+        record_pipe.set_max_record_size(MAX_RECORD_SIZE)
         self.args.timing.add("transit connected")
         returnValue(record_pipe)
 
@@ -363,15 +500,50 @@ class Receiver:
         # now receive the rest of the owl
         self._msg(u"Receiving (%s).." % record_pipe.describe())
 
-        with self.args.timing.add("rx file"):
+        with self.args.timing.add("rx file") as t:
+            if self._file_compression:
+                t.detail(compression=self._file_compression)
             progress = tqdm(file=self.args.stderr,
                             disable=self.args.hide_progress,
                             unit="B", unit_scale=True, total=self.xfersize)
-            hasher = hashlib.sha256()
+            checkpoint = self._checkpoint
+            if checkpoint:
+                t.detail(offset=checkpoint.offset)
+                hasher = checkpoint.hasher
+                update = checkpoint.update
+            elif self._delta:
+                # it hashes the file it rebuilds
+                t.detail(delta=delta.MODE)
+                hasher = f.hasher
+                update = None
+            else:
+                hasher = hashlib.sha256()
+                update = hasher.update
             with progress:
-                received = yield record_pipe.writeToFile(f, self.xfersize,
-                                                         progress.update,
-                                                         hasher.update)
+                received = None
+                try:
+                    received = yield record_pipe.writeToFile(f, self.xfersize,
+                                                             progress.update,
+                                                             update,
+                                                             threaded=True)
+                except dirstream.BadStream as e:
+                    self._msg(u"Error unpacking directory: %s" % (e,))
+                    raise TransferError("bad directory stream: %s" % (e,))
+                except compress.BadCompressedData as e:
+                    self._msg(u"Error decompressing file: %s" % (e,))
+                    raise TransferError("bad compressed data: %s" % (e,))
+                except delta.BadDelta as e:
+                    self._msg(u"Error applying changes: %s" % (e,))
+                    raise TransferError("bad delta: %s" % (e,))
+                finally:
+                    if checkpoint:
+                        # the writer thread is done, so this records
+                        # everything that reached the disk
+                        checkpoint.save()
+                        if received is None:
+                            # the connection was lost (or the data was bad)
+                            self._msg()
+                            self._kept_partial_file()
             datahash = hasher.digest()
 
         # except TransitError
@@ -379,14 +551,28 @@ class Receiver:
             self._msg()
             self._msg(u"Connection dropped before full file received")
             self._msg(u"got %d bytes, wanted %d" % (received, self.xfersize))
+            if checkpoint:
+                self._kept_partial_file()
             raise TransferError("Connection dropped before full file received")
         assert received == self.xfersize
         returnValue(datahash)
 
+    def _kept_partial_file(self):
+        self._msg(u"Kept the partial file: receive it again to resume")
+
     def _write_file(self, f):
         tmp_name = f.name
         f.close()
+        if self._file_compression and not f.complete:
+            raise TransferError("compressed file ended early")
+        if self._delta and not f.finished:
+            raise TransferError("delta ended early")
+        if self._keep_existing:
+            # (os.rename won't replace it on windows)
+            self._remove_existing(self.abs_destname)
         os.rename(tmp_name, self.abs_destname)
+        if self._checkpoint:
+            self._checkpoint.remove()
         self._msg(u"Received file written to %s" %
                   os.path.basename(self.abs_destname))
 
@@ -419,6 +605,22 @@ class Receiver:
                       os.path.basename(self.abs_destname))
             f.close()
 
+    def _finish_stream(self, unpacker):
+        unpacker.close()
+        if not unpacker.finished:
+            raise TransferError("directory stream ended early")
+        os.rename(unpacker.extract_dir, self.abs_destname)
+        self._msg(u"Received files written to %s/" %
+                  os.path.basename(self.abs_destname))
+
+    def _discard_directory(self, f):
+        # the transfer failed or was cancelled: don't leave a partly
+        # unpacked directory behind
+        f.close()
+        extract_dir = getattr(f, "extract_dir", None)
+        if extract_dir and os.path.isdir(extract_dir):
+            shutil.rmtree(extract_dir)
+
     @inlineCallbacks
     def _close_transit(self, record_pipe, datahash):
         datahash_hex = bytes_to_hexstr(datahash)
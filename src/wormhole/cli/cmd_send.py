@@ -1,19 +1,28 @@
 from __future__ import print_function
-import os, sys, six, tempfile, zipfile, hashlib
+import os, sys, six, time, tempfile, hashlib
 from tqdm import tqdm
 from humanize import naturalsize
 from twisted.python import log
 from twisted.protocols import basic
-from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor, threads
+from twisted.internet.defer import inlineCallbacks, returnValue, DeferredList
 from ..errors import (TransferError, WormholeClosedError, UnsendableFileError)
-from wormhole import create, __version__
-from ..transit import TransitSender
+from wormhole import create, create_pool, __version__
+from ..transit import TransitSender, DEFAULT_RECORD_SIZE
 from ..util import dict_to_bytes, bytes_to_dict, bytes_to_hexstr
 from .welcome import handle_welcome
+from . import dirstream, zipbuild, compress, resume, delta, fanout
 
 APPID = u"lothar.com/wormhole/text-or-file-xfer"
 VERIFY_TIMER = 1
+# we read (and send) the file in blocks of this size, if the receiver will
+# accept records that large
+RECORD_SIZE = 1024*1024
+
+def _ratio(compressed, original):
+    if not original:
+        return None
+    return round(float(compressed) / original, 3)
 
 def send(args, reactor=reactor):
     """I implement 'wormhole send'. I return a Deferred that fires with None
@@ -24,6 +33,8 @@ def send(args, reactor=reactor):
                      permission not granted, ack not successful.
     * any other error: something unexpected happened
     """
+    if args.fan_out > 1:
+        return FanOutSender(args, reactor).go()
     return Sender(args, reactor).go()
 
 class Sender:
@@ -33,7 +44,13 @@ class Sender:
         self._tor = None
         self._timing = args.timing
         self._fd_to_send = None
+        self._compressed_fd = None
+        self._file_compression = None
+        self._resumable = False
+        self._offset = 0
+        self._delta = False
         self._transit_sender = None
+        self._record_size = DEFAULT_RECORD_SIZE
 
     @inlineCallbacks
     def go(self):
@@ -91,6 +108,8 @@ class Sender:
         # wormhole exchange happen in parallel
         offer, self._fd_to_send = self._build_offer()
         args = self._args
+        if args.compress_file and "file" in offer:
+            yield self._compress_file(self._fd_to_send, offer["file"])
 
         other_cmd = "wormhole receive"
         if args.verify:
@@ -149,7 +168,9 @@ class Sender:
                                no_listen=(not args.listen),
                                tor=self._tor,
                                reactor=self._reactor,
-                               timing=self._timing)
+                               timing=self._timing,
+                               streams=args.streams,
+                               pooled_crypto=args.crypto_threads)
             self._transit_sender = ts
 
             # for now, send this before the main offer
@@ -192,7 +213,7 @@ class Sender:
                 recognized = True
                 if not want_answer:
                     raise TransferError("duplicate answer")
-                yield self._handle_answer(them_d[u"answer"])
+                yield self._handle_answer(them_d[u"answer"], w)
                 done = True
                 returnValue(None)
             if not recognized:
@@ -255,13 +276,21 @@ class Sender:
             offer["file"] = {
                 "filename": basename,
                 "filesize": filesize,
+                # we can pick up where an earlier attempt left off
+                "resumable": True,
+                # or just send the changes, if they have an older copy
+                "delta": [delta.MODE],
                 }
+            self._resumable = True
             print(u"Sending %s file named '%s'"
                   % (naturalsize(filesize), basename),
                   file=args.stderr)
             fd_to_send = open(what, "rb")
             return offer, fd_to_send
 
+        if os.path.isdir(what) and args.stream_directory:
+            return self._build_stream_offer(what, basename)
+
         if os.path.isdir(what):
             print(u"Building zipfile..", file=args.stderr)
             # We're sending a directory. Create a zipfile in a tempdir and
@@ -270,37 +299,50 @@ class Sender:
             num_files = 0
             num_bytes = 0
             tostrip = len(what.split(os.sep))
-            with zipfile.ZipFile(fd_to_send, "w",
-                                 compression=zipfile.ZIP_DEFLATED,
-                                 allowZip64=True) as zf:
-                for path,dirs,files in os.walk(what):
-                    # path always starts with args.what, then sometimes might
-                    # have "/subdir" appended. We want the zipfile to contain
-                    # "" or "subdir"
-                    localpath = list(path.split(os.sep)[tostrip:])
-                    for fn in files:
-                        archivename = os.path.join(*tuple(localpath+[fn]))
-                        localfilename = os.path.join(path, fn)
-                        try:
-                            zf.write(localfilename, archivename)
-                            num_bytes += os.stat(localfilename).st_size
-                            num_files += 1
-                        except OSError as e:
-                            errmsg = u"{}: {}".format(fn, e.strerror)
-                            if self._args.ignore_unsendable_files:
-                                print(u"{} (ignoring error)".format(errmsg),
-                                      file=args.stderr)
-                            else:
-                                raise UnsendableFileError(errmsg)
+            compression, level = zipbuild.parse_level(args.compression)
+            zb = zipbuild.ZipBuilder(fd_to_send, compression, level,
+                                     args.compression_threads)
+            cpu = compress.cpu_seconds()
+            t = self._timing.add("compress", which="directory", level=level)
+            for path,dirs,files in os.walk(what):
+                # path always starts with args.what, then sometimes might
+                # have "/subdir" appended. We want the zipfile to contain
+                # "" or "subdir"
+                localpath = list(path.split(os.sep)[tostrip:])
+                for fn in files:
+                    archivename = "/".join(localpath+[fn])
+                    localfilename = os.path.join(path, fn)
+                    try:
+                        num_bytes += zb.add(localfilename, archivename)
+                        num_files += 1
+                    except zipbuild.UnreadableFile as e:
+                        errmsg = u"{}: {}".format(fn, e.reason)
+                        if e.partial:
+                            # part of it is already in the zipfile, so we
+                            # can't just leave it out
+                            raise UnsendableFileError(errmsg)
+                        if self._args.ignore_unsendable_files:
+                            print(u"{} (ignoring error)".format(errmsg),
+                                  file=args.stderr)
+                        else:
+                            raise UnsendableFileError(errmsg)
+            zb.close()
             fd_to_send.seek(0,2)
             filesize = fd_to_send.tell()
             fd_to_send.seek(0,0)
+            t.finish(bytes=zb.numbytes, compressed=zb.compressed_bytes,
+                     ratio=_ratio(zb.compressed_bytes, zb.numbytes),
+                     stored_files=zb.stored_files,
+                     cpu=compress.cpu_seconds() - cpu)
             offer["directory"] = {
                 "mode": "zipfile/deflated",
                 "dirname": basename,
                 "zipsize": filesize,
                 "numbytes": num_bytes,
                 "numfiles": num_files,
+                "compression": compression,
+                # ZipBuilder always writes sizes in the local headers
+                "streamable": True,
                 }
             print(u"Sending directory (%s compressed) named '%s'"
                   % (naturalsize(filesize), basename), file=args.stderr)
@@ -308,8 +350,89 @@ class Sender:
 
         raise TypeError("'%s' is neither file nor directory" % args.what)
 
+    def _build_stream_offer(self, what, basename):
+        # We only stat the files here. They're read as the transfer
+        # proceeds, so nothing is copied or compressed before we start.
+        args = self._args
+        entries = []
+        num_bytes = 0
+        tostrip = len(what.split(os.sep))
+        for path,dirs,files in os.walk(what):
+            localpath = list(path.split(os.sep)[tostrip:])
+            for fn in files:
+                archivename = "/".join(localpath+[fn])
+                localfilename = os.path.join(path, fn)
+                try:
+                    entry = dirstream.file_entry(localfilename, archivename)
+                except (OSError, IOError) as e:
+                    errmsg = u"{}: {}".format(fn, e.strerror)
+                    if self._args.ignore_unsendable_files:
+                        print(u"{} (ignoring error)".format(errmsg),
+                              file=args.stderr)
+                        continue
+                    raise UnsendableFileError(errmsg)
+                entries.append(entry)
+                num_bytes += entry.size
+        fd_to_send = dirstream.DirectoryStream(entries)
+        offer = {"directory": {
+            "mode": dirstream.MODE,
+            "dirname": basename,
+            "streamsize": fd_to_send.size,
+            "numbytes": num_bytes,
+            "numfiles": len(entries),
+            }}
+        print(u"Sending directory (%s, %d files) named '%s'"
+              % (naturalsize(num_bytes), len(entries), basename),
+              file=args.stderr)
+        return offer, fd_to_send
+
     @inlineCallbacks
-    def _handle_answer(self, them_answer):
+    def _compress_file(self, fd, file_offer):
+        # Offer to deflate a single file on the wire, if that looks like it
+        # will pay off. We can't know whether the receiver understands this
+        # until it answers, and the offer has to say how big the compressed
+        # copy is, so it goes into a temporary file first (in a thread, so
+        # the reactor keeps running), and we send whichever one they asked
+        # for.
+        args = self._args
+        compression, level = zipbuild.parse_level(args.compression)
+        if compression == zipbuild.STORE:
+            return
+        sample = fd.read(compress.SAMPLE_SIZE)
+        fd.seek(0)
+        if not compress.looks_compressible(sample):
+            print(u"File doesn't look compressible, sending it as-is",
+                  file=args.stderr)
+            return
+        print(u"Compressing file..", file=args.stderr)
+        compressed = tempfile.TemporaryFile()
+        cpu = compress.cpu_seconds()
+        with self._timing.add("compress", which="file", level=level) as t:
+            size = yield threads.deferToThreadPool(
+                self._reactor, self._reactor.getThreadPool(),
+                compress.compress_file, fd, compressed, level,
+                args.compression_threads)
+            compressed_size = compressed.tell()
+            t.detail(bytes=size, compressed=compressed_size,
+                     ratio=_ratio(compressed_size, size),
+                     cpu=compress.cpu_seconds() - cpu)
+        fd.seek(0)
+        if (size != file_offer["filesize"] # it changed under us
+            or compressed_size > size * (1 - compress.MIN_SAVINGS)):
+            compressed.close()
+            print(u"Compression didn't help, sending the file as-is",
+                  file=args.stderr)
+            return
+        compressed.seek(0)
+        self._compressed_fd = compressed
+        file_offer["compression"] = "deflate"
+        file_offer["compressed-size"] = compressed_size
+        print(u"Compressed to %s (%d%%)"
+              % (naturalsize(compressed_size), 100 * compressed_size // size),
+              file=args.stderr)
+
+    @inlineCallbacks
+    def _handle_answer(self, them_answer, w):
         if self._fd_to_send is None:
             if them_answer["message_ack"] == "ok":
                 print(u"text message sent", file=self._args.stderr)
@@ -320,16 +443,112 @@ class Sender:
             raise TransferError("ambiguous response from remote, "
                                 "transfer abandoned: %s" % (them_answer,))
 
+        if self._compressed_fd:
+            # older receivers don't answer this, and get the original
+            if them_answer.get("compression") == "deflate":
+                self._fd_to_send.close()
+                self._fd_to_send = self._compressed_fd
+                self._file_compression = "deflate"
+            else:
+                self._compressed_fd.close()
+            self._compressed_fd = None
+
+        resume_answer = them_answer.get("resume")
+        if self._resumable and isinstance(resume_answer, dict):
+            # the receiver has part of the file already, and waits for us
+            # to say whether we agree
+            offset = yield self._check_resume(resume_answer.get("segments"))
+            self._send_data({"resume": {"offset": offset}}, w)
+        elif self._resumable and them_answer.get("delta") == delta.MODE:
+            self._delta = True
+
+        self._record_size = self._choose_record_size(them_answer)
         yield self._send_file()
 
+    @inlineCallbacks
+    def _check_resume(self, segments):
+        stderr = self._args.stderr
+        segments = resume.parse_segments(segments)
+        fd = self._fd_to_send
+        fd.seek(0,2)
+        filesize = fd.tell()
+        fd.seek(0,0)
+        have = sum([length for (length, digest) in segments or []])
+        ok = False
+        if segments and have <= filesize:
+            print(u"Checking the %s that the receiver already has.."
+                  % naturalsize(have), file=stderr)
+            with self._timing.add("check resume", bytes=have) as t:
+                ok = yield threads.deferToThreadPool(
+                    self._reactor, self._reactor.getThreadPool(),
+                    resume.hash_segments, fd, segments)
+                t.detail(ok=ok)
+        if ok:
+            print(u"Resuming after %s" % naturalsize(have), file=stderr)
+            self._offset = have
+        else:
+            print(u"The receiver's partial copy doesn't match,"
+                  u" sending the whole file", file=stderr)
+            self._offset = 0
+        returnValue(self._offset)
+
+    def _choose_record_size(self, them_answer):
+        # older receivers don't tell us how big a record they'll take, so
+        # they get the same 16KiB records that we've always sent. Receivers
+        # that enforce a limit still accept that much, so it is our floor.
+        their_max = them_answer.get("max-record-size")
+        if not isinstance(their_max, six.integer_types):
+            return DEFAULT_RECORD_SIZE
+        return max(DEFAULT_RECORD_SIZE, min(RECORD_SIZE, their_max))
+
+
+    @inlineCallbacks
+    def _build_delta(self, record_pipe, hasher):
+        # the receiver sends signatures for the blocks of its old copy, we
+        # work out which of them it can reuse, and tell it how big the
+        # delta will be
+        header = bytes_to_dict((yield record_pipe.receive_record()))
+        block_size = header.get("block-size")
+        count = header.get("blocks")
+        if (not isinstance(block_size, six.integer_types)
+            or not isinstance(count, six.integer_types)
+            or not delta.MIN_BLOCK_SIZE <= block_size <= delta.MAX_BLOCK_SIZE
+            or count < 0):
+            raise TransferError("bad delta signatures: %r" % (header,))
+        records = []
+        received = 0
+        while received < count * delta.SIGNATURE.size:
+            record = yield record_pipe.receive_record()
+            records.append(record)
+            received += len(record)
+        try:
+            signatures = delta.parse_signatures(b"".join(records), count)
+        except delta.BadDelta as e:
+            raise TransferError("bad delta signatures: %s" % (e,))
+        with self._timing.add("delta", block_size=block_size) as t:
+            plan = yield threads.deferToThreadPool(
+                self._reactor, self._reactor.getThreadPool(),
+                delta.compute_delta, self._fd_to_send, block_size,
+                signatures, hasher)
+            t.detail(copied=plan.copied_bytes, literal=plan.literal_bytes)
+        stream = delta.DeltaStream(self._fd_to_send, plan)
+        record_pipe.send_record(dict_to_bytes({"delta-size": stream.size}))
+        print(u"The receiver has %s of it already, sending the other %s"
+              % (naturalsize(plan.copied_bytes),
+                 naturalsize(plan.literal_bytes)),
+              file=self._args.stderr)
+        returnValue(stream)
 
     @inlineCallbacks
     def _send_file(self):
         ts = self._transit_sender
 
-        self._fd_to_send.seek(0,2)
-        filesize = self._fd_to_send.tell()
-        self._fd_to_send.seek(0,0)
+        if isinstance(self._fd_to_send, dirstream.DirectoryStream):
+            filesize = self._fd_to_send.size
+        else:
+            self._fd_to_send.seek(0,2)
+            filesize = self._fd_to_send.tell() - self._offset
+            self._fd_to_send.seek(self._offset,0)
 
         record_pipe = yield ts.connect()
         self._timing.add("transit connected")
@@ -338,22 +557,39 @@ class Sender:
         print(u"Sending (%s).." % record_pipe.describe(), file=stderr)
 
         hasher = hashlib.sha256()
+        fd_to_send = self._fd_to_send
+        if self._delta:
+            # this hashes the whole file as it goes: the receiver hashes
+            # the file it rebuilds, not the delta
+            fd_to_send = yield self._build_delta(record_pipe, hasher)
+            filesize = fd_to_send.size
         progress = tqdm(file=stderr, disable=self._args.hide_progress,
                         unit="B", unit_scale=True,
                         total=filesize)
         def _count_and_hash(data):
-            hasher.update(data)
+            if not self._delta:
+                hasher.update(data)
             progress.update(len(data))
             return data
         fs = basic.FileSender()
+        # each chunk that FileSender reads becomes a single transit record
+        fs.CHUNK_SIZE = self._record_size
 
-        with self._timing.add("tx file"):
+        with self._timing.add("tx file", record_size=self._record_size) as t:
+            if self._file_compression:
+                t.detail(compression=self._file_compression)
             with progress:
                 if filesize:
                     # don't send zero-length files
-                    yield fs.beginFileTransfer(self._fd_to_send, record_pipe,
+                    yield fs.beginFileTransfer(fd_to_send, record_pipe,
                                                transform=_count_and_hash)
 
+        if isinstance(self._fd_to_send, dirstream.DirectoryStream):
+            self._fd_to_send.close()
+            for name in self._fd_to_send.changed:
+                print(u"Warning: %s changed while it was being sent" % name,
+                      file=stderr)
+
         expected_hash = hasher.digest()
         expected_hex = bytes_to_hexstr(expected_hash)
         print(u"File sent.. waiting for confirmation", file=stderr)
@@ -371,3 +607,174 @@ class Sender:
                     raise TransferError("Transfer failed (bad remote hash)")
             print(u"Confirmation received. Transfer complete.", file=stderr)
             t.detail(ack="ok")
+
+
+class FanOutSender(Sender):
+    """I implement 'wormhole send --fan-out N': I send one file or directory
+    to N receivers at the same time. Each receiver gets its own code,
+    wormhole, transit connection, and transit key, but the wormholes share
+    one connection to the rendezvous server, and the data is read (and
+    hashed) once for all of them, through a fanout.BlockCache."""
+
+    @inlineCallbacks
+    def go(self):
+        args = self._args
+        assert isinstance(args.relay_url, type(u""))
+        if (args.code or args.zeromode or args.verify or args.text is not None
+            or args.stream_directory or args.compress_file):
+            raise TransferError("--fan-out sends a file or a zipped directory"
+                                " with codes of its own, so it cannot be"
+                                " combined with --code, -0, --verify,"
+                                " --text, --stream-directory, or"
+                                " --compress-file")
+        offer, self._fd_to_send = self._build_offer()
+        # every receiver gets the same bytes, so they can't pick up where
+        # they left off, or ask for just the changes
+        offer.get("file", {}).pop("resumable", None)
+        offer.get("file", {}).pop("delta", None)
+        self._resumable = False
+        fd = self._fd_to_send
+        fd.seek(0, 2)
+        self._cache = fanout.BlockCache(fd, fd.tell(), RECORD_SIZE)
+        fd.seek(0, 0)
+
+        if args.tor:
+            with self._timing.add("import", which="tor_manager"):
+                from ..tor_manager import get_tor
+            self._tor = yield get_tor(reactor,
+                                      args.launch_tor,
+                                      args.tor_control_port,
+                                      timing=self._timing)
+        pool = create_pool(args.relay_url, self._reactor, self._tor)
+        try:
+            yield self._fan_out(offer, pool)
+        finally:
+            fd.close()
+            yield pool.close()
+
+    @inlineCallbacks
+    def _fan_out(self, offer, pool):
+        args = self._args
+        stderr = args.stderr
+        count = args.fan_out
+        wormholes = []
+        for i in range(count):
+            w = create(args.appid or APPID, args.relay_url, self._reactor,
+                       tor=self._tor, timing=self._timing, pool=pool)
+            w.allocate_code(args.code_length)
+            wormholes.append(w)
+        welcome = yield wormholes[0].get_welcome()
+        handle_welcome(welcome, args.relay_url, __version__, stderr)
+        codes = []
+        for w in wormholes:
+            code = yield w.get_code()
+            codes.append(code)
+        print(u"On each of the other %d computers, please run:"
+              u" wormhole receive" % count, file=stderr)
+        print(u"Wormhole codes are:", file=stderr)
+        for code in codes:
+            print(u"  %s" % code, file=stderr)
+        stderr.flush()
+        print(u"", file=stderr)
+
+        progress = tqdm(file=stderr, disable=args.hide_progress,
+                        unit="B", unit_scale=True,
+                        total=self._cache.size * count)
+        start = time.time()
+        with self._timing.add("fan-out", receivers=count) as t:
+            with progress:
+                results = yield DeferredList(
+                    [self._send_to(w, code, offer, progress)
+                     for (w, code) in zip(wormholes, codes)],
+                    consumeErrors=True)
+            elapsed = time.time() - start
+            failed = [code for (code, (ok, res)) in zip(codes, results)
+                      if not ok]
+            sent = sum([res for (ok, res) in results if ok])
+            t.detail(failed=len(failed), sent=sent,
+                     bytes_read=self._cache.bytes_read,
+                     rereads=self._cache.rereads)
+        for (code, (ok, res)) in zip(codes, results):
+            if not ok:
+                print(u"Receiver with code %s failed: %s"
+                      % (code, res.getErrorMessage()), file=stderr)
+        print(u"Sent %s to %d of %d receivers in %.1fs (%s/s in total)"
+              % (naturalsize(self._cache.size), count - len(failed), count,
+                 elapsed, naturalsize(sent / max(elapsed, 0.001))),
+              file=stderr)
+        if failed:
+            raise TransferError("%d of %d receivers failed"
+                                % (len(failed), count))
+
+    @inlineCallbacks
+    def _send_to(self, w, code, offer, progress):
+        # one receiver's worth of Sender._go(). Returns the number of bytes
+        # sent to them.
+        try:
+            sent = yield self._send_to_one(w, offer, progress)
+        except:
+            try:
+                yield w.close()
+            except:
+                pass
+            raise
+        yield w.close()
+        returnValue(sent)
+
+    @inlineCallbacks
+    def _send_to_one(self, w, offer, progress):
+        args = self._args
+        yield w.get_verifier() # might WrongPasswordError
+        ts = TransitSender(args.transit_helper,
+                           no_listen=(not args.listen),
+                           tor=self._tor,
+                           reactor=self._reactor,
+                           timing=self._timing,
+                           streams=args.streams,
+                           pooled_crypto=args.crypto_threads)
+        sender_hints = yield ts.get_connection_hints()
+        self._send_data({u"transit": {
+            "abilities-v1": ts.get_connection_abilities(),
+            "hints-v1": sender_hints,
+            }}, w)
+        ts.set_transit_key(w.derive_key(APPID+"/transit-key",
+                                        ts.TRANSIT_KEY_LENGTH))
+        self._send_data({"offer": offer}, w)
+
+        while True:
+            try:
+                them_d = bytes_to_dict((yield w.get_message()))
+            except WormholeClosedError:
+                raise TransferError("unexpected close")
+            if u"error" in them_d:
+                raise TransferError("remote error, transfer abandoned: %s"
+                                    % them_d["error"])
+            if u"transit" in them_d:
+                ts.add_connection_hints(them_d[u"transit"]
+                                        .get("hints-v1", []))
+            if u"answer" in them_d:
+                break
+        them_answer = them_d[u"answer"]
+        if them_answer.get("file_ack") != "ok":
+            raise TransferError("ambiguous response from remote, "
+                                "transfer abandoned: %s" % (them_answer,))
+
+        record_pipe = yield ts.connect()
+        sent = 0
+        if self._cache.size:
+            def _progress(data):
+                progress.update(len(data))
+                return data
+            sender = fanout.BlockSender(self._cache,
+                                        self._choose_record_size(them_answer))
+            sent = yield sender.beginTransfer(record_pipe,
+                                              transform=_progress)
+
+        ack = bytes_to_dict((yield record_pipe.receive_record()))
+        record_pipe.close()
+        if ack.get(u"ack", u"") != u"ok":
+            raise TransferError("Transfer failed (remote says: %r)" % ack)
+        if u"sha256" in ack:
+            if ack[u"sha256"] != bytes_to_hexstr(self._cache.digest()):
+                raise TransferError("Transfer failed (bad remote hash)")
+        returnValue(sent)
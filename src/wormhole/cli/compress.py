@@ -0,0 +1,148 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os, zlib
+from collections import deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+# Deflate in a thread pool (zlib releases the GIL while it works). The data
+# is cut into blocks that are compressed independently. Every block except
+# the last one of a stream is ended with a sync flush, which leaves the
+# output byte-aligned, so the compressed blocks can simply be concatenated
+# into one ordinary raw deflate stream (this is what pigz does).
+#
+# Deflating data that is already compressed (JPEGs, videos, archives) burns
+# CPU and gains nothing, so we first deflate a small sample at the fastest
+# level, and leave the data alone if that didn't shrink it noticeably.
+
+BLOCK_SIZE = 1024*1024
+SAMPLE_SIZE = 64*1024
+# anything that the sample says we can't shrink by this fraction is stored
+MIN_SAVINGS = 0.1
+
+class BadCompressedData(ValueError):
+    pass
+
+def looks_compressible(sample):
+    sample = sample[:SAMPLE_SIZE]
+    if not sample:
+        return False
+    compressed = zlib.compress(sample, 1)
+    return len(compressed) <= len(sample) * (1 - MIN_SAVINGS)
+
+def compress_block(data, level, last):
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    out = c.compress(data)
+    if last:
+        return out + c.flush(zlib.Z_FINISH)
+    return out + c.flush(zlib.Z_SYNC_FLUSH)
+
+def cpu_seconds():
+    # user+system time of the whole process, so it includes the pool threads
+    return sum(os.times()[:2])
+
+class _Done:
+    # looks enough like an AsyncResult for BlockDeflater
+    def __init__(self, data):
+        self._data = data
+    def get(self):
+        return self._data
+
+class BlockDeflater:
+    """I deflate blocks in a thread pool, and hand them back in the order
+    they were added. add() takes one block (plus an opaque 'tag', and
+    whether it's the last block of its stream), and returns a list of
+    (tag, data, last) tuples for the blocks that are done, holding back
+    enough of them to keep the pool busy. Blocks added with compress=False
+    are passed through untouched, in order. finish() returns the rest."""
+
+    def __init__(self, level, threads=None):
+        self._level = level
+        self._threads = threads or cpu_count()
+        self._pool = None # created when first needed
+        # enough to keep every thread busy while the oldest block is
+        # written out, without holding much of the data in memory
+        self._window = 4 * self._threads
+        self._pending = deque() # (tag, result, last)
+
+    def add(self, data, last, tag=None, compress=True):
+        if compress:
+            if not self._pool:
+                self._pool = ThreadPool(self._threads)
+            result = self._pool.apply_async(compress_block,
+                                            (data, self._level, last))
+        else:
+            result = _Done(data)
+        self._pending.append((tag, result, last))
+        return self._ready(self._window)
+
+    def finish(self):
+        ready = self._ready(0)
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        return ready
+
+    def _ready(self, keep):
+        ready = []
+        while len(self._pending) > keep:
+            tag, result, last = self._pending.popleft()
+            ready.append((tag, result.get(), last))
+        return ready
+
+def compress_file(f_in, f_out, level, threads=None):
+    """Deflate all of f_in into f_out (as a raw deflate stream). Returns the
+    number of bytes read."""
+    bd = BlockDeflater(level, threads)
+    size = 0
+    data = f_in.read(BLOCK_SIZE)
+    while True:
+        next_data = f_in.read(BLOCK_SIZE) if data else b""
+        last = not next_data
+        size += len(data)
+        for tag, out, _ in bd.add(data, last):
+            f_out.write(out)
+        if last:
+            break
+        data = next_data
+    for tag, out, _ in bd.finish():
+        f_out.write(out)
+    return size
+
+class InflatingFile:
+    """I wrap a file opened for writing, and inflate the raw deflate stream
+    written to me into it. Once the stream ends, .complete tells you whether
+    it produced exactly 'expected' bytes."""
+
+    def __init__(self, f, expected):
+        self._f = f
+        self.name = f.name
+        self._expected = expected
+        self._d = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.size = 0
+
+    def write(self, data):
+        if getattr(self._d, "eof", False):
+            raise BadCompressedData("data after the end of the stream")
+        while data:
+            # inflate a block at a time, so a small record can't expand
+            # into a huge string
+            try:
+                out = self._d.decompress(data, BLOCK_SIZE)
+            except zlib.error as e:
+                raise BadCompressedData(str(e))
+            if self._d.unused_data:
+                raise BadCompressedData("data after the end of the stream")
+            data = self._d.unconsumed_tail
+            self.size += len(out)
+            if self.size > self._expected:
+                raise BadCompressedData("too much data")
+            self._f.write(out)
+
+    @property
+    def complete(self):
+        # (py2's decompressobj has no .eof, so there we can only count)
+        return getattr(self._d, "eof", True) and self.size == self._expected
+
+    def close(self):
+        self._f.close()
@@ -0,0 +1,296 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import zlib, struct, hashlib
+from ..util import dict_to_bytes
+
+# Block-level delta transfers, in the style of rsync. When the receiver
+# already has an older version of the file it is about to overwrite, it cuts
+# that file into fixed-size blocks and sends a signature for each one (a
+# weak checksum plus a strong hash) over transit. The sender slides a
+# window over the new file looking for blocks the receiver has, and sends a
+# "delta" stream: instructions to copy runs of old blocks, and literal data
+# for everything else.
+#
+# The weak checksum is Adler-32, which zlib computes quickly for whole
+# blocks and which we can update one byte at a time when the window slides.
+# The sliding happens in Python, which only manages a few MB/s, so we only
+# search byte-by-byte for one block after each mismatch (that's enough to
+# find the new alignment after an insertion or deletion), and give up
+# searching altogether once SEARCH_BUDGET bytes have been scanned that way.
+#
+# The delta stream is a sequence of operations:
+#   "C" + first block (8 bytes) + count (8 bytes): copy old blocks
+#   "L" + length (8 bytes) + that many bytes: literal data
+#   "E": the end
+# all big-endian.
+
+MODE = "blocks-v1"
+MIN_BLOCK_SIZE = 4*1024
+MAX_BLOCK_SIZE = 1024*1024
+SIGNATURE = struct.Struct(">I16s")
+SIGNATURES_PER_RECORD = 3000
+COPY = struct.Struct(">cQQ")
+LITERAL = struct.Struct(">cQ")
+OP_COPY, OP_LITERAL, OP_END = b"C", b"L", b"E"
+ADLER_MOD = 65521
+READ_SIZE = 4*1024*1024
+SEARCH_BUDGET = 64*1024*1024
+
+class BadDelta(ValueError):
+    pass
+
+def choose_block_size(size):
+    # about the square root of the file size, like rsync
+    block_size = MIN_BLOCK_SIZE
+    while block_size * block_size < size and block_size < MAX_BLOCK_SIZE:
+        block_size *= 2
+    return block_size
+
+def weak_checksum(data):
+    return zlib.adler32(data) & 0xffffffff
+
+def strong_checksum(data):
+    return hashlib.sha256(data).digest()[:16]
+
+def file_signatures(fn, block_size):
+    """Return a (weak, strong) pair for each block of the file. This
+    blocks, so run it in a thread."""
+    signatures = []
+    with open(fn, "rb") as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            signatures.append((weak_checksum(data), strong_checksum(data)))
+    return signatures
+
+def signature_records(signatures, block_size):
+    """Yield the transit records that carry the signatures: a JSON header,
+    then packed signatures."""
+    yield dict_to_bytes({"block-size": block_size,
+                         "blocks": len(signatures)})
+    for i in range(0, len(signatures), SIGNATURES_PER_RECORD):
+        yield b"".join([SIGNATURE.pack(w, s) for (w, s)
+                        in signatures[i:i+SIGNATURES_PER_RECORD]])
+
+def parse_signatures(data, count):
+    if len(data) != count * SIGNATURE.size:
+        raise BadDelta("expected %d signatures, got %d bytes"
+                       % (count, len(data)))
+    return [SIGNATURE.unpack_from(data, i * SIGNATURE.size)
+            for i in range(count)]
+
+class DeltaPlan:
+    def __init__(self):
+        self.ops = [] # [OP_COPY, first, count] or [OP_LITERAL, offset, length]
+        self.copied_bytes = 0
+        self.literal_bytes = 0
+
+    def copy(self, index, length):
+        self.copied_bytes += length
+        last = self.ops[-1] if self.ops else None
+        if last and last[0] == OP_COPY and last[1] + last[2] == index:
+            last[2] += 1
+        else:
+            self.ops.append([OP_COPY, index, 1])
+
+    def literal(self, offset, length):
+        self.literal_bytes += length
+        last = self.ops[-1] if self.ops else None
+        if last and last[0] == OP_LITERAL and last[1] + last[2] == offset:
+            last[2] += length
+        else:
+            self.ops.append([OP_LITERAL, offset, length])
+
+def compute_delta(f, block_size, signatures, hasher=None):
+    """Read all of f and work out how to build it from the blocks described
+    by 'signatures'. Returns a DeltaPlan. If 'hasher' is given, it is fed
+    the whole file. This blocks, so run it in a thread."""
+    table = {}
+    for index, (weak, strong) in enumerate(signatures):
+        table.setdefault(weak, []).append((strong, index))
+
+    def find(window, weak):
+        for (strong, index) in table.get(weak, []):
+            if strong == strong_checksum(window):
+                return index
+        return None
+
+    plan = DeltaPlan()
+    budget = SEARCH_BUDGET
+    f.seek(0)
+    buf = b""
+    base = 0 # file offset of buf[0]
+    pos = 0
+    eof = False
+    while True:
+        # keep two blocks ahead, so a search can look one block further
+        if len(buf) - pos < 2 * block_size and not eof:
+            data = f.read(READ_SIZE)
+            eof = not data
+            base += pos
+            buf = buf[pos:] + data
+            pos = 0
+            continue
+        available = len(buf) - pos
+        if not available:
+            break
+        n = min(block_size, available)
+        window = buf[pos:pos+n]
+        weak = weak_checksum(window)
+        # (at the end, a short window can match the old file's last block)
+        index = find(window, weak)
+        if index is not None:
+            plan.copy(index, n)
+        else:
+            if budget > 0 and available > block_size:
+                budget -= block_size
+                shift = _search(buf, pos, block_size, weak, find, table)
+                if shift is not None:
+                    n = shift
+            plan.literal(base + pos, n)
+        if hasher:
+            hasher.update(buf[pos:pos+n])
+        pos += n
+    return plan
+
+def _search(buf, pos, block_size, weak, find, table):
+    # Slide the window forward one byte at a time, for up to one block,
+    # looking for a block the receiver has. Returns how far we slid, or
+    # None.
+    data = bytearray(buf[pos:pos + 2 * block_size])
+    a, b = weak & 0xffff, weak >> 16
+    for k in range(1, len(data) - block_size + 1):
+        out, new = data[k - 1], data[k - 1 + block_size]
+        a = (a - out + new) % ADLER_MOD
+        b = (b - block_size * out + a - 1) % ADLER_MOD
+        w = (b << 16) | a
+        if w in table:
+            start = pos + k
+            if find(buf[start:start+block_size], w) is not None:
+                return k
+    return None
+
+class DeltaStream:
+    """I am a read-only file-like object (enough for FileSender) whose
+    contents are the delta stream for a DeltaPlan. Literal data is read
+    from f as it is needed."""
+
+    def __init__(self, f, plan):
+        self._f = f
+        self._ops = list(reversed(plan.ops))
+        self.size = 1 # OP_END
+        for (op, a, b) in plan.ops:
+            if op == OP_COPY:
+                self.size += COPY.size
+            else:
+                self.size += LITERAL.size + b
+        self._pending = b""
+        self._literal_remaining = 0
+        self._finished = False
+
+    def read(self, size):
+        pieces = []
+        while size > 0:
+            if self._pending:
+                data, self._pending = self._pending[:size], self._pending[size:]
+            elif self._literal_remaining:
+                data = self._f.read(min(size, self._literal_remaining))
+                if not data:
+                    raise BadDelta("file shrank while it was being sent")
+                self._literal_remaining -= len(data)
+            elif self._ops:
+                (op, a, b) = self._ops.pop()
+                if op == OP_COPY:
+                    self._pending = COPY.pack(OP_COPY, a, b)
+                else:
+                    self._pending = LITERAL.pack(OP_LITERAL, b)
+                    self._f.seek(a)
+                    self._literal_remaining = b
+                continue
+            elif not self._finished:
+                self._pending = OP_END
+                self._finished = True
+                continue
+            else:
+                break
+            pieces.append(data)
+            size -= len(data)
+        return b"".join(pieces)
+
+class DeltaApplier:
+    """I accept a delta stream, in pieces of any size, and write the new
+    file into out_f, copying blocks from old_fn as instructed. .hasher sees
+    everything written to out_f. I raise BadDelta if the stream is
+    malformed."""
+
+    def __init__(self, old_fn, out_f, block_size, num_blocks):
+        self._old = open(old_fn, "rb")
+        self._out = out_f
+        self.name = out_f.name
+        self._block_size = block_size
+        self._num_blocks = num_blocks
+        self.hasher = hashlib.sha256()
+        self._buf = b""
+        self._literal_remaining = 0
+        self.finished = False
+        self.size = 0
+
+    def write(self, data):
+        # Walk through 'data' with an offset, like dirstream does: a delta
+        # of a file with many small changes has lots of operations in each
+        # record, and slicing each one off the front would re-copy the rest
+        # of the record every time. Only an operation that isn't complete
+        # yet is kept for the next write().
+        if self._buf:
+            data = self._buf + data
+            self._buf = b""
+        pos = 0
+        while pos < len(data):
+            if self.finished:
+                raise BadDelta("data after the end of the delta")
+            if self._literal_remaining:
+                chunk = data[pos:pos+self._literal_remaining]
+                pos += len(chunk)
+                self._literal_remaining -= len(chunk)
+                self._output(chunk)
+                continue
+            op = data[pos:pos+1]
+            if op == OP_END:
+                self.finished = True
+                pos += 1
+            elif op == OP_COPY:
+                if len(data) - pos < COPY.size:
+                    break
+                (_, first, count) = COPY.unpack_from(data, pos)
+                pos += COPY.size
+                self._copy(first, count)
+            elif op == OP_LITERAL:
+                if len(data) - pos < LITERAL.size:
+                    break
+                (_, length) = LITERAL.unpack_from(data, pos)
+                pos += LITERAL.size
+                self._literal_remaining = length
+            else:
+                raise BadDelta("unknown delta operation %r" % (op,))
+        self._buf = data[pos:]
+
+    def _copy(self, first, count):
+        if first + count > self._num_blocks:
+            raise BadDelta("no such block %d" % (first + count - 1))
+        self._old.seek(first * self._block_size)
+        remaining = count * self._block_size
+        while remaining:
+            data = self._old.read(min(remaining, READ_SIZE))
+            if not data:
+                break # the last block can be short
+            remaining -= len(data)
+            self._output(data)
+
+    def _output(self, data):
+        self._out.write(data)
+        self.hasher.update(data)
+        self.size += len(data)
+
+    def close(self):
+        self._old.close()
+        self._out.close()
@@ -0,0 +1,247 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os, stat, struct
+import six
+from collections import deque
+from ..util import dict_to_bytes, bytes_to_dict
+
+# The "stream-v1" directory-transfer mode. The zipfile mode has to build the
+# whole archive (in a temporary file) before the transfer can start, and the
+# receiver can only unpack it once the last byte has arrived. This format
+# can be generated while the files are being read, and unpacked while it
+# arrives.
+#
+# The stream is a sequence of entries. Each one is a 4-byte big-endian
+# length, that many bytes of JSON header, and then (for files) 'size' bytes
+# of file contents:
+#
+#  {"type": "file", "path": "subdir/name", "size": 1234, "mode": 420}
+#  {"type": "end"}
+#
+# 'path' is relative to the directory being sent, and always uses "/" as
+# the separator. 'mode' holds the permission bits, of which the receiver
+# only honours the ordinary ones (see safe_mode). The "end" entry must come
+# last.
+
+MODE = "stream-v1"
+HEADER_LENGTH = struct.Struct(">L")
+MAX_HEADER_SIZE = 64*1024
+
+class BadStream(ValueError):
+    pass
+
+def build_header(header):
+    data = dict_to_bytes(header)
+    return HEADER_LENGTH.pack(len(data)) + data
+
+class FileEntry:
+    def __init__(self, localfilename, archivename, size, mode):
+        self.localfilename = localfilename
+        self.header = build_header({"type": "file",
+                                    "path": archivename,
+                                    "size": size,
+                                    "mode": mode,
+                                    })
+        self.archivename = archivename
+        self.size = size
+
+def file_entry(localfilename, archivename):
+    """Return a FileEntry for the given file, or raise OSError if we can't
+    read it."""
+    s = os.stat(localfilename)
+    # make sure we'll be able to read it later, so problems show up before
+    # the transfer starts
+    open(localfilename, "rb").close()
+    return FileEntry(localfilename, archivename, s.st_size,
+                     stat.S_IMODE(s.st_mode))
+
+class DirectoryStream:
+    """I am a read-only file-like object (enough for FileSender) whose
+    contents are the stream-v1 encoding of a list of FileEntry objects. Each
+    file is only opened when read() reaches it.
+
+    If a file changes size after it was scanned, I send the size we
+    announced (truncating, or padding with zeros), and add its name to
+    .changed ."""
+
+    def __init__(self, entries):
+        self._entries = deque(entries)
+        self._end = build_header({"type": "end"})
+        self.size = sum([len(e.header) + e.size for e in self._entries])
+        self.size += len(self._end)
+        self.changed = []
+        self._pending = b"" # header bytes not yet returned
+        self._f = None
+        self._entry = None
+        self._remaining = 0
+        self._finished = False
+
+    def read(self, size):
+        pieces = []
+        while size > 0:
+            if self._pending:
+                data, self._pending = self._pending[:size], self._pending[size:]
+            elif self._entry:
+                data = self._read_file(min(size, self._remaining))
+            elif self._entries:
+                self._start_file(self._entries.popleft())
+                continue
+            elif not self._finished:
+                self._pending = self._end
+                self._finished = True
+                continue
+            else:
+                break
+            pieces.append(data)
+            size -= len(data)
+        return b"".join(pieces)
+
+    def _start_file(self, entry):
+        self._entry = entry
+        self._pending = entry.header
+        self._remaining = entry.size
+        self._f = open(entry.localfilename, "rb")
+        if not self._remaining:
+            self._finish_file()
+
+    def _read_file(self, size):
+        data = self._f.read(size)
+        if not data:
+            # it shrank
+            self._note_changed()
+            data = b"\x00" * size
+        self._remaining -= len(data)
+        if not self._remaining:
+            self._finish_file()
+        return data
+
+    def _finish_file(self):
+        if self._f.read(1):
+            # it grew
+            self._note_changed()
+        self._f.close()
+        self._f = None
+        self._entry = None
+
+    def _note_changed(self):
+        if self._entry.archivename not in self.changed:
+            self.changed.append(self._entry.archivename)
+
+    def close(self):
+        if self._f:
+            self._f.close()
+            self._f = None
+
+
+def safe_mode(mode):
+    """Return the permission bits to give a received file whose sender asked
+    for 'mode': no setuid, setgid or sticky bits, nothing world-writable,
+    and always readable and writable by us."""
+    return (mode & 0o775) | 0o600
+
+def safe_join(extract_dir, path):
+    """Return the local filename for archive path 'path' inside extract_dir,
+    or raise BadStream if it would land anywhere else."""
+    parts = path.split("/")
+    if (not path or any([p in ("", ".", "..") for p in parts])
+        or any([os.sep in p or (os.altsep and os.altsep in p)
+                for p in parts])):
+        raise BadStream("bad path %r" % (path,))
+    out_path = os.path.abspath(os.path.join(extract_dir, *parts))
+    if not out_path.startswith(os.path.join(extract_dir, "")):
+        raise BadStream("path %r is outside of %s" % (path, extract_dir))
+    return out_path
+
+class DirectoryUnpacker:
+    """I accept the bytes of a stream-v1 archive, in pieces of any size, and
+    write its files into extract_dir (which must already exist) as they
+    arrive. I raise BadStream if the data is malformed or tries to escape
+    from extract_dir."""
+
+    def __init__(self, extract_dir):
+        self.extract_dir = os.path.abspath(extract_dir)
+        self._buf = b""
+        self._f = None
+        self._path = None
+        self._mode = None
+        self._remaining = 0
+        self.finished = False
+        self.numfiles = 0
+        self.numbytes = 0
+
+    def write(self, data):
+        # Walk through 'data' with an offset instead of slicing off each
+        # piece we use: a large write holds many small files, and re-copying
+        # the rest of it for each one would be quadratic. Only the start of
+        # a header that isn't complete yet is kept for the next write().
+        if self._buf:
+            data = self._buf + data
+            self._buf = b""
+        pos = 0
+        while pos < len(data):
+            if self.finished:
+                raise BadStream("data after the end of the stream")
+            if self._f:
+                chunk = data[pos:pos+self._remaining]
+                pos += len(chunk)
+                self._f.write(chunk)
+                self._remaining -= len(chunk)
+                self.numbytes += len(chunk)
+                if not self._remaining:
+                    self._finish_file()
+                continue
+            if len(data) - pos < HEADER_LENGTH.size:
+                break
+            (length,) = HEADER_LENGTH.unpack_from(data, pos)
+            if length > MAX_HEADER_SIZE:
+                raise BadStream("header too large (%d bytes)" % length)
+            end = pos + HEADER_LENGTH.size + length
+            if len(data) < end:
+                break
+            header = data[pos+HEADER_LENGTH.size:end]
+            pos = end
+            self._handle_header(header)
+        self._buf = data[pos:]
+
+    def _handle_header(self, header_bytes):
+        try:
+            header = bytes_to_dict(header_bytes)
+        except (ValueError, AssertionError):
+            raise BadStream("unparseable header")
+        kind = header.get("type")
+        if kind == "end":
+            self.finished = True
+            return
+        if kind != "file":
+            raise BadStream("unknown entry type %r" % (kind,))
+        path, size, mode = (header.get("path"), header.get("size"),
+                            header.get("mode"))
+        if (not isinstance(path, type(""))
+            or not isinstance(size, six.integer_types)
+            or not isinstance(mode, six.integer_types) or size < 0):
+            raise BadStream("bad file header %r" % (header,))
+        out_path = safe_join(self.extract_dir, path)
+        parent = os.path.dirname(out_path)
+        try:
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            self._f = open(out_path, "wb")
+        except (OSError, IOError) as e:
+            # e.g. a file where a directory needs to be, or the other way
+            # around
+            raise BadStream("unable to create %r: %s" % (path, e.strerror))
+        self._path = out_path
+        self._mode = safe_mode(stat.S_IMODE(mode))
+        self._remaining = size
+        if not size:
+            self._finish_file()
+
+    def _finish_file(self):
+        self._f.close()
+        self._f = None
+        os.chmod(self._path, self._mode)
+        self.numfiles += 1
+
+    def close(self):
+        if self._f:
+            self._f.close()
+            self._f = None
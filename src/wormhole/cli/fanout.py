@@ -0,0 +1,148 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import hashlib
+from zope.interface import implementer
+from twisted.internet import defer, interfaces
+
+# 'wormhole send --fan-out N' sends the same file to N receivers at once.
+# Each receiver has its own transit connection (and its own transit key, so
+# every record is encrypted separately for each of them), but the file
+# itself is only read once: each connection pulls blocks through a shared
+# BlockCache, which keeps a block in memory until every connection has sent
+# it.
+#
+# The connections don't all go at the same speed, so the cache is bounded.
+# Once it holds more than CACHE_LIMIT bytes, the oldest blocks (which only
+# the slowest connections still need) are dropped, and those connections
+# read them from the file again. The operating system's page cache usually
+# makes those re-reads cheap, and a slow receiver can't make us hold the
+# whole file in memory.
+
+BLOCK_SIZE = 1024*1024
+CACHE_LIMIT = 64*1024*1024
+
+class BlockCache:
+    """I read a file of known size, in blocks, for any number of readers
+    that each go through it from start to end at their own pace. I also
+    hash the file as it is read for the first time."""
+
+    def __init__(self, f, size, block_size=BLOCK_SIZE, limit=CACHE_LIMIT):
+        self._f = f
+        self.size = size
+        self._block_size = block_size
+        self._limit = limit
+        self.num_blocks = (size + block_size - 1) // block_size
+        self._blocks = {} # index -> data
+        self._cached_bytes = 0
+        self._positions = {} # reader -> index of the next block it wants
+        self._hasher = hashlib.sha256()
+        self._hashed = 0 # blocks, from the start of the file
+        self.bytes_read = 0
+        self.rereads = 0 # blocks read again, for slow readers
+
+    def add_reader(self, reader):
+        self._positions[reader] = 0
+
+    def remove_reader(self, reader):
+        self._positions.pop(reader, None)
+        self._evict()
+
+    def get(self, reader, index):
+        """Return block 'index' for 'reader', which must have finished with
+        all earlier blocks."""
+        assert 0 <= index < self.num_blocks, index
+        data = self._blocks.get(index)
+        if data is None:
+            # readers go in order, so the first reader to get here is
+            # reading the next block of the file
+            assert index <= self._hashed, (index, self._hashed)
+            self._f.seek(index * self._block_size)
+            data = self._f.read(self._block_size)
+            self.bytes_read += len(data)
+            if index == self._hashed:
+                self._hasher.update(data)
+                self._hashed += 1
+            else:
+                self.rereads += 1
+            self._blocks[index] = data
+            self._cached_bytes += len(data)
+        self._positions[reader] = index + 1
+        self._evict()
+        return data
+
+    def _evict(self):
+        if not self._blocks:
+            return
+        if self._positions:
+            needed = min(self._positions.values())
+        else:
+            needed = self.num_blocks
+        for index in sorted(self._blocks):
+            if index >= needed and self._cached_bytes <= self._limit:
+                break
+            self._cached_bytes -= len(self._blocks.pop(index))
+
+    def digest(self):
+        """The SHA256 hash of the whole file, once a reader has been through
+        it."""
+        assert self._hashed == self.num_blocks
+        return self._hasher.digest()
+
+@implementer(interfaces.IPullProducer)
+class BlockSender:
+    """I am like twisted.protocols.basic.FileSender, but read through a
+    BlockCache, and write records of 'record_size' bytes (which must divide
+    the cache's block size, or be bigger than it) to the consumer."""
+
+    def __init__(self, cache, record_size):
+        self._cache = cache
+        self._record_size = record_size
+        self._index = 0
+        self._block = b""
+        self._offset = 0
+        self._consumer = None
+        self._deferred = None
+        self._transform = None
+
+    def beginTransfer(self, consumer, transform=None):
+        """Returns a Deferred that fires with the number of bytes sent (after
+        any transform), once the consumer has been given the whole file."""
+        self._consumer = consumer
+        self._transform = transform
+        self._sent = 0
+        self._deferred = d = defer.Deferred()
+        self._cache.add_reader(self)
+        consumer.registerProducer(self, False)
+        return d
+
+    def resumeProducing(self):
+        if not self._consumer:
+            return
+        if self._offset >= len(self._block):
+            if self._index >= self._cache.num_blocks:
+                self._finish()
+                self._deferred.callback(self._sent)
+                return
+            self._block = self._cache.get(self, self._index)
+            self._index += 1
+            self._offset = 0
+        data = self._block[self._offset:self._offset+self._record_size]
+        self._offset += len(data)
+        if self._transform:
+            data = self._transform(data)
+        self._sent += len(data)
+        self._consumer.write(data)
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        if self._deferred and not self._deferred.called:
+            self._finish()
+            self._deferred.errback(
+                Exception("Consumer asked us to stop producing"))
+
+    def _finish(self):
+        self._consumer.unregisterProducer()
+        self._consumer = None
+        self._block = b""
+        self._cache.remove_reader(self)
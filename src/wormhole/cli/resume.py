@@ -0,0 +1,126 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os, json, hashlib
+import six
+
+# Resuming an interrupted file transfer. While a file arrives, the receiver
+# keeps a checkpoint next to its .tmp file that says how many bytes have
+# safely reached the .tmp, and their sha256. If the connection drops, both
+# are left behind. The next time the same file is offered, the receiver
+# tells the sender what it already has, the sender checks that against its
+# own copy, and only the rest is sent.
+#
+# We can't restore a sha256 object from its digest, so rather than hashing
+# the whole prefix again at every resume, the checkpoint holds a list of
+# segments, one per attempt: [[length, sha256-hex], ..]. The sender hashes
+# its file in the same pieces.
+
+CHECKPOINT_INTERVAL = 64*1024*1024
+SUFFIX = ".checkpoint"
+
+def checkpoint_name(tmp_destname):
+    return tmp_destname + SUFFIX
+
+def load_segments(tmp_destname, filesize):
+    """Return the segment list for a usable partial copy of a
+    'filesize'-byte file in tmp_destname, or None if there isn't one."""
+    try:
+        with open(checkpoint_name(tmp_destname), "r") as f:
+            cp = json.load(f)
+        have = os.stat(tmp_destname).st_size
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(cp, dict) or cp.get("filesize") != filesize:
+        return None
+    segments = parse_segments(cp.get("segments"))
+    if not segments:
+        return None
+    offset = sum([length for (length, digest) in segments])
+    if offset > filesize or offset > have:
+        return None
+    return segments
+
+def parse_segments(segments):
+    """Check that 'segments' (from a checkpoint, or the other side) is a
+    list of [length, sha256-hex] pairs, and return it as a list of tuples,
+    or None if it isn't."""
+    if not isinstance(segments, list):
+        return None
+    parsed = []
+    for s in segments:
+        if (not isinstance(s, list) or len(s) != 2
+            or not isinstance(s[0], six.integer_types) or s[0] <= 0
+            or not isinstance(s[1], six.string_types)):
+            return None
+        parsed.append((s[0], s[1]))
+    return parsed
+
+def remove_checkpoint(tmp_destname):
+    try:
+        os.unlink(checkpoint_name(tmp_destname))
+    except OSError:
+        pass
+
+def hash_segments(f, segments):
+    """Read f (from its current position) in the given segments, and return
+    True if every one of them matches. This blocks, so run it in a
+    thread."""
+    for (length, digest) in segments:
+        hasher = hashlib.sha256()
+        remaining = length
+        while remaining:
+            data = f.read(min(remaining, 1024*1024))
+            if not data:
+                return False
+            hasher.update(data)
+            remaining -= len(data)
+        if hasher.hexdigest() != digest:
+            return False
+    return True
+
+class Checkpoint:
+    """I track the bytes written to the open .tmp file 'f', which already
+    holds the data described by 'segments'. Use update() as the
+    writeToFile() hasher: every CHECKPOINT_INTERVAL bytes (and whenever
+    save() is called) I flush f and record what it holds. .hasher covers
+    just the bytes written during this attempt."""
+
+    def __init__(self, f, filesize, segments=()):
+        self._f = f
+        self._filename = checkpoint_name(f.name)
+        self._filesize = filesize
+        self._segments = [list(s) for s in segments]
+        self.offset = sum([length for (length, digest) in segments])
+        self.hasher = hashlib.sha256()
+        self._length = 0
+        self._unsaved = 0
+
+    def restart(self):
+        """Forget the old data, because the sender is starting over."""
+        self._f.seek(0)
+        self._f.truncate()
+        remove_checkpoint(self._f.name)
+        self._segments = []
+        self.offset = 0
+        self.hasher = hashlib.sha256()
+        self._length = 0
+        self._unsaved = 0
+
+    def update(self, data):
+        # this runs in the writer thread, after f.write(data)
+        self.hasher.update(data)
+        self._length += len(data)
+        self._unsaved += len(data)
+        if self._unsaved >= CHECKPOINT_INTERVAL:
+            self.save()
+
+    def save(self):
+        self._unsaved = 0
+        self._f.flush()
+        segments = list(self._segments)
+        if self._length:
+            segments.append([self._length, self.hasher.hexdigest()])
+        with open(self._filename, "w") as f:
+            json.dump({"filesize": self._filesize, "segments": segments}, f)
+
+    def remove(self):
+        remove_checkpoint(self._f.name)
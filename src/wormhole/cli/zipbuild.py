@@ -0,0 +1,220 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os, struct, time, zlib
+from .compress import BlockDeflater, looks_compressible, BLOCK_SIZE
+from .zipstream import (LOCAL_HEADER, CENTRAL_HEADER, END_RECORD,
+                        EXTRA_HEADER, LOCAL_SIG, CENTRAL_SIG, END_SIG,
+                        ZIP64_END_SIG, ZIP64_LOCATOR_SIG, FLAG_UTF8,
+                        STORED, DEFLATED, ZIP64_EXTRA, ZIP64_MARKER)
+
+# Build the zipfile for a "zipfile/deflated" directory transfer, compressing
+# on several cores at once. zipfile.ZipFile deflates everything in the
+# calling thread, which tops out at a few tens of MB/s. Instead each file is
+# cut into blocks that compress.BlockDeflater deflates in a thread pool, and
+# the resulting deflate stream is an ordinary zipfile member that any unzip
+# tool can read. Files whose first block doesn't compress are stored.
+
+ZIP64_LIMIT = (1 << 31) - 1 # what zipfile uses
+ZIP64_END = struct.Struct("<IQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<IIQI")
+VERSION = 20
+VERSION_ZIP64 = 45
+UNIX = 3
+
+STORE = "store"
+COMPRESSIONS = ("store", "deflate")
+
+class UnreadableFile(Exception):
+    """ZipBuilder.add() couldn't add a file. .reason says why. If .partial
+    is False, nothing of it went into the archive, which is still usable
+    without it. If it is True, some of it was already written, and the
+    archive can't be finished."""
+    def __init__(self, filename, reason, partial):
+        Exception.__init__(self, "%s: %s" % (filename, reason))
+        self.filename = filename
+        self.reason = reason
+        self.partial = partial
+
+def parse_level(level):
+    """Turn a --compression value ('store', or a zlib level from 1 to 9)
+    into the (compression, level) pair that goes into the offer."""
+    if level == STORE:
+        return (STORE, 0)
+    return ("deflate", int(level))
+
+class _Member:
+    def __init__(self, name, method, mtime, mode, zip64):
+        self.name = name
+        self.method = method
+        self.mtime = mtime
+        self.external_attr = (mode & 0xFFFF) << 16
+        self.zip64 = zip64
+        self.flags = 0
+        try:
+            self.encoded_name = name.encode("ascii")
+        except UnicodeEncodeError:
+            self.encoded_name = name.encode("utf-8")
+            self.flags |= FLAG_UTF8
+        self.crc = 0
+        self.usize = 0
+        self.csize = 0
+        self.offset = None
+
+    def version(self):
+        return VERSION_ZIP64 if self.zip64 else VERSION
+
+    def dostime(self):
+        t = time.localtime(self.mtime)
+        year = max(t.tm_year, 1980)
+        return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+                ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+class ZipBuilder:
+    """I write a zipfile to 'f' (which must be seekable), with each file
+    either stored, or deflated at 'level' using 'threads' threads. Call
+    add() for each file, then close(). Afterwards, .numbytes and
+    .compressed_bytes say how much went in and came out, and .stored_files
+    counts the files that were stored because they didn't look
+    compressible."""
+
+    def __init__(self, f, compression="deflate", level=6, threads=None):
+        if compression not in COMPRESSIONS:
+            raise ValueError("unknown compression %r" % (compression,))
+        self._f = f
+        self._method = STORED if compression == STORE else DEFLATED
+        self._deflater = BlockDeflater(level, threads)
+        self._members = []
+        self._start = f.tell()
+        self.numbytes = 0
+        self.compressed_bytes = 0
+        self.stored_files = 0
+
+    def add(self, localfilename, archivename):
+        """Add one file, and return the number of bytes read. Raises
+        UnreadableFile if it can't be read, or if it grew past the zip64
+        limit while it was being read."""
+        member = None
+        try:
+            s = os.stat(localfilename)
+            with open(localfilename, "rb") as f:
+                data = f.read(BLOCK_SIZE)
+                method = self._method
+                if method == DEFLATED and not looks_compressible(data):
+                    method = STORED
+                # zipfile's rule: allow some room for the file to grow
+                zip64 = s.st_size * 1.05 > ZIP64_LIMIT
+                while True:
+                    next_data = f.read(BLOCK_SIZE) if data else b""
+                    last = not next_data
+                    if member is None:
+                        # the first block is only handed to the deflater
+                        # once the second one has been read, so a file we
+                        # can't read at all leaves no trace in the archive
+                        member = _Member(archivename, method, s.st_mtime,
+                                         s.st_mode, zip64)
+                        self._members.append(member)
+                    member.crc = zlib.crc32(data, member.crc)
+                    member.usize += len(data)
+                    self._write(self._deflater.add(
+                        data, last, member, compress=(method == DEFLATED)))
+                    if last:
+                        break
+                    data = next_data
+        except (OSError, IOError) as e:
+            raise UnreadableFile(localfilename, e.strerror or str(e),
+                                 member is not None)
+        if member.usize > ZIP64_LIMIT and not member.zip64:
+            raise UnreadableFile(localfilename,
+                                 "grew too large while it was being added",
+                                 True)
+        if method != self._method:
+            self.stored_files += 1
+        self.numbytes += member.usize
+        return member.usize
+
+    def _write(self, ready):
+        for member, data, last in ready:
+            if member.offset is None:
+                member.offset = self._f.tell() - self._start
+                self._f.write(self._local_header(member))
+            self._f.write(data)
+            member.csize += len(data)
+            self.compressed_bytes += len(data)
+            if last:
+                self._finish(member)
+
+    def _local_header(self, member):
+        (dostime, dosdate) = member.dostime()
+        extra = b""
+        csize = usize = 0 # filled in by _finish
+        if member.zip64:
+            extra = (EXTRA_HEADER.pack(ZIP64_EXTRA, 16)
+                     + struct.pack("<QQ", 0, 0))
+            csize = usize = ZIP64_MARKER
+        return (LOCAL_HEADER.pack(LOCAL_SIG, member.version(), member.flags,
+                                  member.method, dostime, dosdate, 0, csize,
+                                  usize, len(member.encoded_name), len(extra))
+                + member.encoded_name + extra)
+
+    def _finish(self, member):
+        # go back and fill in the CRC and sizes
+        end = self._f.tell()
+        member.crc &= 0xffffffff
+        header_start = self._start + member.offset
+        self._f.seek(header_start + 14)
+        if member.zip64:
+            self._f.write(struct.pack("<I", member.crc))
+            self._f.seek(header_start + LOCAL_HEADER.size
+                         + len(member.encoded_name) + EXTRA_HEADER.size)
+            self._f.write(struct.pack("<QQ", member.usize, member.csize))
+        else:
+            self._f.write(struct.pack("<III", member.crc, member.csize,
+                                      member.usize))
+        self._f.seek(end)
+
+    def close(self):
+        self._write(self._deflater.finish())
+        cd_start = self._f.tell() - self._start
+        for member in self._members:
+            self._f.write(self._central_header(member))
+        cd_size = self._f.tell() - self._start - cd_start
+        count = len(self._members)
+        if (count >= 0xffff or cd_start > ZIP64_LIMIT
+            or cd_size > ZIP64_LIMIT):
+            zip64_end = self._f.tell() - self._start
+            self._f.write(ZIP64_END.pack(ZIP64_END_SIG, ZIP64_END.size - 12,
+                                         VERSION_ZIP64, VERSION_ZIP64, 0, 0,
+                                         count, count, cd_size, cd_start))
+            self._f.write(ZIP64_LOCATOR.pack(ZIP64_LOCATOR_SIG, 0, zip64_end,
+                                             1))
+            count = min(count, 0xffff)
+            cd_start = min(cd_start, ZIP64_MARKER)
+            cd_size = min(cd_size, ZIP64_MARKER)
+        self._f.write(END_RECORD.pack(END_SIG, 0, 0, count, count, cd_size,
+                                      cd_start, 0))
+
+    def _central_header(self, member):
+        (dostime, dosdate) = member.dostime()
+        # only the fields that overflowed go in the extra, in this order
+        fields = []
+        usize, csize, offset = member.usize, member.csize, member.offset
+        if usize > ZIP64_LIMIT:
+            fields.append(usize)
+            usize = ZIP64_MARKER
+        if csize > ZIP64_LIMIT:
+            fields.append(csize)
+            csize = ZIP64_MARKER
+        if offset > ZIP64_LIMIT:
+            fields.append(offset)
+            offset = ZIP64_MARKER
+        extra = b""
+        if fields:
+            extra = (EXTRA_HEADER.pack(ZIP64_EXTRA, 8*len(fields))
+                     + struct.pack("<%dQ" % len(fields), *fields))
+        return (CENTRAL_HEADER.pack(CENTRAL_SIG,
+                                    (UNIX << 8) | member.version(),
+                                    member.version(), member.flags,
+                                    member.method, dostime, dosdate,
+                                    member.crc, csize, usize,
+                                    len(member.encoded_name), len(extra),
+                                    0, 0, 0, member.external_attr, offset)
+                + member.encoded_name + extra)
@@ -0,0 +1,316 @@
+from __future__ import print_function, absolute_import, unicode_literals
+import os, struct, zlib
+from .dirstream import BadStream, safe_mode
+
+# Unpack a "zipfile/deflated" directory transfer while it arrives, instead of
+# spooling the whole archive to a temporary file and unzipping it afterwards.
+# Every member of a zipfile is preceded by a "local file header" that says
+# how it is stored (and usually how big it is), so the members can be
+# extracted in order. The central directory at the end only adds the
+# permission bits, which we apply once we get there.
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<IHHHHIIH")
+SIGNATURE = struct.Struct("<I")
+DESCRIPTOR = struct.Struct("<III")
+DESCRIPTOR64 = struct.Struct("<IQQ")
+EXTRA_HEADER = struct.Struct("<HH")
+
+LOCAL_SIG = 0x04034b50
+CENTRAL_SIG = 0x02014b50
+END_SIG = 0x06054b50
+ZIP64_END_SIG = 0x06064b50
+ZIP64_LOCATOR_SIG = 0x07064b50
+DESCRIPTOR_SIG = 0x08074b50
+HEADER_SIGS = (LOCAL_SIG, CENTRAL_SIG, END_SIG, ZIP64_END_SIG)
+
+FLAG_ENCRYPTED = 0x01
+FLAG_DESCRIPTOR = 0x08 # sizes and CRC come after the data
+FLAG_UTF8 = 0x800
+STORED, DEFLATED = 0, 8
+ZIP64_EXTRA = 0x0001
+ZIP64_MARKER = 0xffffffff
+
+def zip_path(extract_dir, filename):
+    """Return where zipfile member 'filename' belongs inside extract_dir, or
+    raise BadStream if that would be outside it."""
+    out_path = os.path.abspath(os.path.join(extract_dir, filename))
+    if not out_path.startswith(os.path.join(extract_dir, "")):
+        raise BadStream("malicious zipfile, %s outside of extract_dir %s"
+                        % (filename, extract_dir))
+    return out_path
+
+class ZipUnpacker:
+    """I accept the bytes of a zipfile, in pieces of any size, and extract
+    its members into extract_dir (which must already exist) as they arrive.
+    I raise BadStream if the data is malformed, uses a feature that can't be
+    unpacked on the fly, or tries to escape from extract_dir."""
+
+    def __init__(self, extract_dir):
+        self.extract_dir = os.path.abspath(extract_dir)
+        self.finished = False
+        self._buf = b""
+        self._pos = 0
+        self._state = self._signature
+        self._f = None
+        self._extracted = {} # member name -> local path
+        self.numfiles = 0
+        self.numbytes = 0
+
+    def write(self, data):
+        if self._pos:
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+        self._buf += data
+        while self._state():
+            pass
+
+    def close(self):
+        if self._f:
+            self._f.close()
+            self._f = None
+
+    def _available(self):
+        return len(self._buf) - self._pos
+
+    def _peek(self, count, offset=0):
+        start = self._pos + offset
+        return self._buf[start:start+count]
+
+    def _take(self, count):
+        data = self._buf[self._pos:self._pos+count]
+        self._pos += count
+        return data
+
+    # Each state returns True if it made progress, False if it needs more
+    # data.
+
+    def _signature(self):
+        if self._available() < SIGNATURE.size:
+            return False
+        (sig,) = SIGNATURE.unpack(self._peek(SIGNATURE.size))
+        if sig == LOCAL_SIG:
+            self._state = self._local_header
+        elif sig == CENTRAL_SIG:
+            self._state = self._central_header
+        elif sig == ZIP64_END_SIG:
+            self._state = self._zip64_end
+        elif sig == ZIP64_LOCATOR_SIG:
+            self._state = self._zip64_locator
+        elif sig == END_SIG:
+            self._state = self._end
+        else:
+            raise BadStream("unrecognized zipfile record 0x%08x" % sig)
+        return True
+
+    def _local_header(self):
+        if self._available() < LOCAL_HEADER.size:
+            return False
+        (sig, version, flags, method, mtime, mdate, crc, csize, usize,
+         namelen, extralen) = LOCAL_HEADER.unpack(self._peek(LOCAL_HEADER.size))
+        if self._available() < LOCAL_HEADER.size + namelen + extralen:
+            return False
+        self._take(LOCAL_HEADER.size)
+        name = self._decode_name(self._take(namelen), flags)
+        extra = self._take(extralen)
+        if flags & FLAG_ENCRYPTED:
+            raise BadStream("encrypted zipfile member %s" % name)
+        if method not in (STORED, DEFLATED):
+            raise BadStream("unsupported compression method %d for %s"
+                            % (method, name))
+        if (flags & FLAG_DESCRIPTOR and method == STORED
+            and not name.endswith("/")):
+            # we'd have no way to find the end of the data
+            raise BadStream("cannot unpack %s from a stream" % name)
+        if usize == ZIP64_MARKER or csize == ZIP64_MARKER:
+            (usize, csize) = self._zip64_sizes(extra, usize, csize)
+
+        self._name = name
+        self._flags = flags
+        self._crc = 0
+        self._expected_crc = crc
+        self._expected_size = usize
+        self._remaining = csize
+        self._decompressor = None
+        if method == DEFLATED:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        try:
+            if name.endswith("/"):
+                out_path = zip_path(self.extract_dir, name.rstrip("/"))
+                if not os.path.isdir(out_path):
+                    os.makedirs(out_path)
+            else:
+                out_path = zip_path(self.extract_dir, name)
+                parent = os.path.dirname(out_path)
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+                self._f = open(out_path, "wb")
+        except (OSError, IOError) as e:
+            raise BadStream("unable to create %s: %s" % (name, e.strerror))
+        self._extracted[name] = out_path
+        self._size = 0
+        self._state = self._data
+        if flags & FLAG_DESCRIPTOR and not self._decompressor:
+            # a directory: no data, just the descriptor
+            self._state = self._descriptor
+        return True
+
+    def _decode_name(self, name, flags):
+        if flags & FLAG_UTF8:
+            return name.decode("utf-8")
+        return name.decode("cp437") # what zipfile does
+
+    def _zip64_sizes(self, extra, usize, csize):
+        while len(extra) >= EXTRA_HEADER.size:
+            (tag, length) = EXTRA_HEADER.unpack(extra[:EXTRA_HEADER.size])
+            body = extra[EXTRA_HEADER.size:EXTRA_HEADER.size+length]
+            extra = extra[EXTRA_HEADER.size+length:]
+            if tag != ZIP64_EXTRA:
+                continue
+            # only the fields that overflowed are present, in this order
+            if usize == ZIP64_MARKER and len(body) >= 8:
+                (usize,) = struct.unpack("<Q", body[:8])
+                body = body[8:]
+            if csize == ZIP64_MARKER and len(body) >= 8:
+                (csize,) = struct.unpack("<Q", body[:8])
+            return (usize, csize)
+        raise BadStream("missing zip64 sizes")
+
+    def _data(self):
+        if self._flags & FLAG_DESCRIPTOR:
+            # deflate streams mark their own end
+            if not self._available():
+                return False
+            chunk = self._take(self._available())
+            self._output(self._decompressor.decompress(chunk))
+            # (py2's decompressobj has no .eof)
+            eof = getattr(self._decompressor, "eof",
+                          bool(self._decompressor.unused_data))
+            if eof:
+                # give back whatever followed the compressed data
+                self._pos -= len(self._decompressor.unused_data)
+                self._state = self._descriptor
+            return True
+        if self._remaining:
+            count = min(self._available(), self._remaining)
+            if not count:
+                return False
+            chunk = self._take(count)
+            self._remaining -= count
+            if self._decompressor:
+                chunk = self._decompressor.decompress(chunk)
+            self._output(chunk)
+            if self._remaining:
+                return True
+        if self._decompressor:
+            self._output(self._decompressor.flush())
+        self._finish_member()
+        return True
+
+    def _output(self, data):
+        if not data:
+            return
+        if not self._f:
+            raise BadStream("directory entry %s has contents" % self._name)
+        self._f.write(data)
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+
+    def _descriptor(self):
+        offset = 0
+        if self._available() < SIGNATURE.size:
+            return False
+        (sig,) = SIGNATURE.unpack(self._peek(SIGNATURE.size))
+        if sig == DESCRIPTOR_SIG:
+            offset = SIGNATURE.size # the signature is optional
+        # The descriptor uses 8-byte sizes for zip64 members, which the
+        # local header doesn't always announce. Look at what comes next
+        # to tell which one we've got.
+        for fmt in (DESCRIPTOR, DESCRIPTOR64):
+            end = offset + fmt.size
+            if self._available() < end + SIGNATURE.size:
+                return False
+            (next_sig,) = SIGNATURE.unpack(self._peek(SIGNATURE.size, end))
+            if next_sig in HEADER_SIGS:
+                (crc, csize, usize) = fmt.unpack(self._peek(fmt.size, offset))
+                self._take(end)
+                self._expected_crc = crc
+                self._expected_size = usize
+                self._finish_member()
+                return True
+        raise BadStream("unparseable data descriptor for %s" % self._name)
+
+    def _finish_member(self):
+        if self._f:
+            self._f.close()
+            self._f = None
+            self.numfiles += 1
+        self.numbytes += self._size
+        if (self._crc & 0xffffffff) != self._expected_crc:
+            raise BadStream("bad CRC for %s" % self._name)
+        if self._size != self._expected_size:
+            raise BadStream("wrong size for %s" % self._name)
+        self._state = self._signature
+
+    def _central_header(self):
+        if self._available() < CENTRAL_HEADER.size:
+            return False
+        fields = CENTRAL_HEADER.unpack(self._peek(CENTRAL_HEADER.size))
+        flags = fields[3]
+        (namelen, extralen, commentlen) = fields[10:13]
+        external_attr = fields[15]
+        total = CENTRAL_HEADER.size + namelen + extralen + commentlen
+        if self._available() < total:
+            return False
+        self._take(CENTRAL_HEADER.size)
+        name = self._decode_name(self._take(namelen), flags)
+        self._take(extralen + commentlen)
+        if name not in self._extracted:
+            raise BadStream("central directory lists unknown member %s"
+                            % name)
+        # not sure why zipfiles store the perms 16 bits away but they do.
+        # Archives from non-unix hosts have no permissions at all, so leave
+        # those files alone.
+        perm = external_attr >> 16
+        if perm:
+            perm = safe_mode(perm)
+            if name.endswith("/"):
+                perm |= 0o700
+            os.chmod(self._extracted[name], perm)
+        self._state = self._signature
+        return True
+
+    def _zip64_end(self):
+        if self._available() < 12:
+            return False
+        (size,) = struct.unpack("<Q", self._peek(8, 4))
+        if self._available() < 12 + size:
+            return False
+        self._take(12 + size)
+        self._state = self._signature
+        return True
+
+    def _zip64_locator(self):
+        if self._available() < 20:
+            return False
+        self._take(20)
+        self._state = self._signature
+        return True
+
+    def _end(self):
+        if self._available() < END_RECORD.size:
+            return False
+        fields = END_RECORD.unpack(self._peek(END_RECORD.size))
+        commentlen = fields[7]
+        if self._available() < END_RECORD.size + commentlen:
+            return False
+        self._take(END_RECORD.size + commentlen)
+        self.finished = True
+        self._state = self._done
+        return True
+
+    def _done(self):
+        if self._available():
+            raise BadStream("data after the end of the zipfile")
+        return False
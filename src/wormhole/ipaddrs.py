@@ -1,10 +1,18 @@
 # no unicode_literals
 # Find all of our ip addresses. From tahoe's src/allmydata/util/iputil.py
 
-import os, re, subprocess, errno
+import os, re, subprocess, errno, socket, struct, time, ctypes
 from sys import platform
 from twisted.python.procutils import which
 
+# We ask the C library (getifaddrs) first, which is much cheaper than
+# spawning a program and parsing what it says, and also finds IPv6
+# addresses. Where that isn't available (windows), we fall back to the
+# programs below. Either way, the answer is cached for CACHE_SECONDS, since
+# every transit listener asks.
+CACHE_SECONDS = 10.0
+_cache = None # (when, addresses)
+
 # Wow, I'm really amazed at home much mileage we've gotten out of calling
 # the external route.exe program on windows...  It appears to work on all
 # versions so far.  Still, the real system calls would much be preferred...
@@ -12,8 +20,11 @@ from twisted.python.procutils import which
 _win32_re = re.compile(r'^\s*\d+\.\d+\.\d+\.\d+\s.+\s(?P<address>\d+\.\d+\.\d+\.\d+)\s+(?P<metric>\d+)\s*$', flags=re.M|re.I|re.S)
 _win32_commands = (('route.exe', ('print',), _win32_re),)
 
-# These work in most Unices.
-_addr_re = re.compile(r'^\s*inet [a-zA-Z]*:?(?P<address>\d+\.\d+\.\d+\.\d+)[\s/].+$', flags=re.M|re.I|re.S)
+# These work in most Unices. The second half matches IPv6 addresses: "inet6
+# ADDR/64" from ip, "inet6 ADDR prefixlen 64" or "inet6 addr: ADDR/64"
+# from the various ifconfigs (which add "%IFACE" to link-local ones).
+_addr_re = re.compile(r'^\s*inet [a-zA-Z]*:?(?P<address>\d+\.\d+\.\d+\.\d+)[\s/].+$'
+                      r'|^\s*inet6 (?:addr:\s*)?(?P<address6>[0-9a-f]*:[0-9a-f:.]+)(?:%\S+)?[\s/].*$', flags=re.M|re.I|re.S)
 _unix_commands = (('/bin/ip', ('addr',), _addr_re),
                   ('/sbin/ip', ('addr',), _addr_re),
                   ('/sbin/ifconfig', ('-a',), _addr_re),
@@ -24,7 +35,107 @@ _unix_commands = (('/bin/ip', ('addr',), _addr_re),
                  )
 
 
-def find_addresses():
+def find_addresses(ipv6=False):
+    """Return a list of our IP addresses (as native strings), including
+    loopback ones. IPv6 addresses are only included if ipv6=True."""
+    global _cache
+    now = time.time()
+    if _cache is None or not (0 <= now - _cache[0] < CACHE_SECONDS):
+        addresses = _native_addresses()
+        if addresses is None:
+            addresses = _command_addresses()
+        _cache = (now, addresses)
+    addresses = _cache[1]
+    if not ipv6:
+        addresses = [a for a in addresses if ":" not in a]
+    return list(addresses) or ["127.0.0.1"]
+
+class _ifaddrs(ctypes.Structure):
+    pass
+_ifaddrs._fields_ = [("ifa_next", ctypes.POINTER(_ifaddrs)),
+                     ("ifa_name", ctypes.c_char_p),
+                     ("ifa_flags", ctypes.c_uint),
+                     ("ifa_addr", ctypes.c_void_p),
+                     ("ifa_netmask", ctypes.c_void_p),
+                     ("ifa_ifu", ctypes.c_void_p),
+                     ("ifa_data", ctypes.c_void_p)]
+IFF_UP = 0x1
+
+def _load_getifaddrs():
+    if platform == 'win32':
+        return None
+    try:
+        # (the C library is already loaded into this process, and
+        # find_library("c") might spawn a compiler to look for it)
+        libc = ctypes.CDLL(None, use_errno=True)
+        getifaddrs, freeifaddrs = libc.getifaddrs, libc.freeifaddrs
+    except (OSError, AttributeError):
+        return None
+    getifaddrs.argtypes = [ctypes.POINTER(ctypes.POINTER(_ifaddrs))]
+    getifaddrs.restype = ctypes.c_int
+    freeifaddrs.argtypes = [ctypes.POINTER(_ifaddrs)]
+    freeifaddrs.restype = None
+    return getifaddrs, freeifaddrs
+
+SOCKADDR_IN_SIZE = 16
+SOCKADDR_IN6_SIZE = 28
+
+def _sockaddr_to_address(sa):
+    # struct sockaddr starts with a 16-bit family on linux, and with an
+    # 8-bit length and an 8-bit family on the BSDs (including OS-X). Only
+    # read as much as the family says is there: other kinds of address
+    # (like AF_PACKET or AF_LINK) can be shorter.
+    raw = ctypes.string_at(sa, 2)
+    if platform.startswith('linux'):
+        (family,) = struct.unpack("=H", raw)
+    else:
+        family = bytearray(raw)[1]
+    if family == socket.AF_INET:
+        raw = ctypes.string_at(sa, SOCKADDR_IN_SIZE)
+        return socket.inet_ntop(socket.AF_INET, raw[4:8])
+    if family == getattr(socket, "AF_INET6", None):
+        raw = ctypes.string_at(sa, SOCKADDR_IN6_SIZE)
+        address = socket.inet_ntop(socket.AF_INET6, raw[8:24])
+        if _is_link_local(address):
+            return None
+        return address
+    return None
+
+def _is_link_local(address):
+    # link-local IPv6 addresses (fe80::/10) are useless without the
+    # interface name
+    first = address.split(":")[0].lower()
+    return len(first) == 4 and first[:3] in ("fe8", "fe9", "fea", "feb")
+
+def _native_addresses():
+    """Return the addresses of every interface that is up, IPv4 first, or
+    None if the C library can't tell us."""
+    functions = _load_getifaddrs()
+    if functions is None or not hasattr(socket, "inet_ntop"):
+        return None
+    getifaddrs, freeifaddrs = functions
+    head = ctypes.POINTER(_ifaddrs)()
+    if getifaddrs(ctypes.byref(head)) != 0:
+        return None
+    v4, v6 = [], []
+    try:
+        ifa = head
+        while ifa:
+            entry = ifa.contents
+            if entry.ifa_addr and entry.ifa_flags & IFF_UP:
+                addr = _sockaddr_to_address(entry.ifa_addr)
+                if addr:
+                    which_list = v6 if ":" in addr else v4
+                    if addr not in which_list:
+                        which_list.append(addr)
+            ifa = entry.ifa_next
+    finally:
+        freeifaddrs(head)
+    if not v4 and not v6:
+        return None
+    return v4 + v6
+
+def _command_addresses():
     # originally by Greg Smith, hacked by Zooko and then Daira
 
     # We don't reach here for cygwin.
@@ -52,7 +163,7 @@ def find_addresses():
             if addresses:
                 return addresses
 
-    return ["127.0.0.1"]
+    return []
 
 def _query(path, args, regex):
     env = {'LANG': 'en_US.UTF-8'}
@@ -77,7 +188,13 @@ def _query(path, args, regex):
         m = regex.match(outline)
         if m:
             addr = m.group('address')
+            if addr is None and 'address6' in regex.groupindex:
+                addr = m.group('address6')
+                if _is_link_local(addr):
+                    continue
             if addr not in addresses:
                 addresses.append(addr)
 
-    return addresses
+    # IPv4 first, like _native_addresses()
+    return ([a for a in addresses if ":" not in a]
+            + [a for a in addresses if ":" in a])
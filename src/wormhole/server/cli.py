@@ -58,6 +58,31 @@ LaunchArgs = _compose(
         "--stats-json-path", default="stats.json", metavar="PATH",
         help="location to write the relay stats file",
     ),
+    click.option(
+        "--storage", default="sqlite", type=click.Choice(["sqlite", "memory"]),
+        help="keep live nameplates and mailboxes in the database, or in memory",
+    ),
+    click.option(
+        "--write-behind/--no-write-behind", default=True,
+        help="with --storage=memory, save them to the database every second",
+    ),
+    click.option(
+        "--group-commit", default=None, type=click.FloatRange(0, None),
+        metavar="MS",
+        help="share one database commit between everything done within MS"
+        " milliseconds (0: within one reactor turn). With MS > 0, responses"
+        " are sent before the commit, so a crash can lose up to MS"
+        " milliseconds of acknowledged changes",
+    ),
+    click.option(
+        "--wal/--no-wal", default=False,
+        help="use SQLite's write-ahead log for the database",
+    ),
+    click.option(
+        "--synchronous", default=None,
+        type=click.Choice(["off", "normal", "full", "extra"]),
+        help="how hard SQLite works to get each commit onto the disk",
+    ),
 )
 
 
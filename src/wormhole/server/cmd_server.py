@@ -22,6 +22,11 @@ class MyPlugin(object):
             signal_error=self.args.signal_error,
             stats_file=self.args.stats_json_path,
             allow_list=self.args.allow_list,
+            storage=self.args.storage,
+            write_behind=self.args.write_behind,
+            group_commit=self.args.group_commit,
+            wal=self.args.wal,
+            synchronous=self.args.synchronous,
         )
 
 class MyTwistdConfig(twistd.ServerOptions):
@@ -17,7 +17,9 @@ def get_upgrader(new_version):
                                    "db-schemas/upgrade-to-v%d.sql" % new_version)
     return schema_bytes.decode("utf-8")
 
-TARGET_VERSION = 3
+TARGET_VERSION = 5
+
+SYNCHRONOUS = ["off", "normal", "full", "extra"]
 
 def dict_factory(cursor, row):
     d = {}
@@ -25,9 +27,16 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
-def get_db(dbfile, target_version=TARGET_VERSION):
+def get_db(dbfile, target_version=TARGET_VERSION, wal=False,
+           synchronous=None):
     """Open or create the given db file. The parent directory must exist.
     Returns the db connection object, or raises DBError.
+
+    With wal=True, the database uses SQLite's write-ahead log, which lets a
+    commit append to the log instead of rewriting pages in place. The
+    'synchronous' setting (one of SYNCHRONOUS) says how hard SQLite tries to
+    get each commit onto the disk: 'normal' with the WAL only risks losing
+    the latest commits (not corrupting the file) if the machine crashes.
     """
 
     must_create = (dbfile == ":memory:") or not os.path.exists(dbfile)
@@ -37,6 +46,13 @@ def get_db(dbfile, target_version=TARGET_VERSION):
         raise DBError("Unable to create/open db file %s: %s" % (dbfile, e))
     db.row_factory = dict_factory
     db.execute("PRAGMA foreign_keys = ON")
+    if wal:
+        # this is remembered in the file, and :memory: ignores it
+        db.execute("PRAGMA journal_mode = WAL")
+    if synchronous is not None:
+        if synchronous not in SYNCHRONOUS:
+            raise DBError("unknown synchronous= setting %r" % (synchronous,))
+        db.execute("PRAGMA synchronous = %s" % synchronous.upper())
     problems = db.execute("PRAGMA foreign_key_check").fetchall()
     if problems:
         raise DBError("failed foreign key check: %s" % (problems,))
@@ -74,6 +90,56 @@ def get_db(dbfile, target_version=TARGET_VERSION):
 
     return db
 
+class GroupCommitter:
+    """I stand in for a db connection, but my commit() only asks for a
+    commit: all the requests made within 'window' seconds share a single
+    real one. With a window of 0, that means everything done in the same
+    reactor turn: the commit runs before the responses queued in that turn
+    are written to their sockets, so they still go out after it. With a
+    longer window the responses don't wait, so a crash inside the window
+    loses changes that clients have already been told about.
+
+    Everything else is passed through to the real connection, so the server
+    reads its own uncommitted writes as usual."""
+
+    def __init__(self, db, window, reactor):
+        self._db = db
+        self._window = window
+        self._reactor = reactor
+        self._call = None
+        self.commit_requests = 0
+        self.commits = 0
+
+    def execute(self, *args):
+        return self._db.execute(*args)
+
+    def executescript(self, script):
+        return self._db.executescript(script)
+
+    def commit(self):
+        self.commit_requests += 1
+        if not self._call:
+            self._call = self._reactor.callLater(self._window, self._commit)
+
+    def _commit(self):
+        self._call = None
+        self._db.commit()
+        self.commits += 1
+
+    def flush(self):
+        """Commit now, if anything is waiting."""
+        if self._call:
+            self._call.cancel()
+            self._commit()
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+    def get_stats(self):
+        return {"commit_requests": self.commit_requests,
+                "commits": self.commits}
+
 def dump_db(db):
     # to let _iterdump work, we need to restore the original row factory
     orig = db.row_factory
@@ -0,0 +1,29 @@
+-- `nameplate_sides`.`nameplates_id` had no type, which stops SQLite from using
+-- an index on it to check the foreign key when a nameplate is deleted, so
+-- the table is rebuilt. The code only ever adds one row per side, but the
+-- tables didn't insist, so any duplicates are dropped on the way.
+CREATE TABLE `nameplate_sides_new`
+(
+ `nameplates_id` INTEGER REFERENCES `nameplates`(`id`),
+ `claimed` BOOLEAN, -- True after claim(), False after release()
+ `side` VARCHAR,
+ `added` INTEGER -- time when this side first claimed the nameplate
+);
+INSERT INTO `nameplate_sides_new`
+ SELECT `nameplates_id`, `claimed`, `side`, `added` FROM `nameplate_sides`
+ WHERE `rowid` IN (SELECT MIN(`rowid`) FROM `nameplate_sides`
+                   GROUP BY `nameplates_id`, `side`);
+DROP TABLE `nameplate_sides`;
+ALTER TABLE `nameplate_sides_new` RENAME TO `nameplate_sides`;
+CREATE UNIQUE INDEX `nameplate_sides_idx` ON `nameplate_sides`
+ (`nameplates_id`, `side`);
+
+DELETE FROM `mailbox_sides` WHERE `rowid` NOT IN
+ (SELECT MIN(`rowid`) FROM `mailbox_sides` GROUP BY `mailbox_id`, `side`);
+CREATE UNIQUE INDEX `mailbox_sides_idx` ON `mailbox_sides` (`mailbox_id`, `side`);
+
+-- for the foreign-key check when a mailbox is deleted
+CREATE INDEX `nameplates_mailbox_id_idx` ON `nameplates` (`mailbox_id`);
+
+DELETE FROM `version`;
+INSERT INTO `version` (`version`) VALUES (4);
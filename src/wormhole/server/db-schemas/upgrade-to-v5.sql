@@ -0,0 +1,5 @@
+-- pruning looks for the least-recently-updated mailboxes
+CREATE INDEX `mailboxes_updated_idx` ON `mailboxes` (`updated`);
+
+DELETE FROM `version`;
+INSERT INTO `version` (`version`) VALUES (5);
@@ -1,7 +1,8 @@
 from __future__ import print_function, unicode_literals
-import os, random, base64, collections
+import os, time, random, base64, collections
 from collections import namedtuple
-from twisted.python import log
+from twisted.python import log, failure
+from twisted.internet import defer
 from twisted.application import service
 
 def generate_mailbox_id():
@@ -20,6 +21,72 @@ TransitUsage = namedtuple("TransitUsage",
 SidedMessage = namedtuple("SidedMessage", ["side", "phase", "body",
                                            "server_rx", "msg_id"])
 
+class NameplateAllocator:
+    """I keep a pool of the free short nameplate ids (1-999, one pool per
+    number of digits), so allocate() can pick the shortest free id without
+    looking at every claimed one. The AppNamespace tells me about each
+    nameplate that is created (claimed()) or deleted (released()). Longer
+    ids, and names that aren't ids at all, are only remembered in a set, for
+    when all the short ones are taken."""
+
+    MAX_SIZE = 3 # stick to 1-999 for now
+
+    def __init__(self, claimed=()):
+        # each pool is a list of free ids, and a dict of their positions in
+        # that list, so we can remove any one of them in O(1)
+        self._pools = []
+        self._sizes = {} # every short id -> index into self._pools
+        for size in range(1, self.MAX_SIZE+1):
+            free = ["%d" % id_int for id_int in range(10**(size-1), 10**size)]
+            self._pools.append((free, dict((id, i)
+                                           for (i, id) in enumerate(free))))
+            self._sizes.update((id, size-1) for id in free)
+        self._others = set()
+        for name in claimed:
+            self.claimed(name)
+
+    def _pool(self, name):
+        index = self._sizes.get(name)
+        if index is None:
+            return None
+        return self._pools[index]
+
+    def claimed(self, name):
+        pool = self._pool(name)
+        if pool is None:
+            self._others.add(name)
+            return
+        free, positions = pool
+        i = positions.pop(name, None)
+        if i is None:
+            return # already claimed
+        last = free.pop()
+        if last != name:
+            free[i] = last
+            positions[last] = i
+
+    def released(self, name):
+        pool = self._pool(name)
+        if pool is None:
+            self._others.discard(name)
+            return
+        free, positions = pool
+        if name not in positions:
+            positions[name] = len(free)
+            free.append(name)
+
+    def allocate(self):
+        for (free, positions) in self._pools:
+            if free:
+                return random.choice(free)
+        # ouch, 999 currently claimed. Try random ones for a while.
+        for tries in range(1000):
+            id_int = random.randrange(1000, 1000*1000)
+            id = "%d" % id_int
+            if id not in self._others:
+                return id
+        raise ValueError("unable to find a free nameplate-id")
+
 class Mailbox:
     def __init__(self, app, db, app_id, mailbox_id):
         self._app = app
@@ -138,8 +205,9 @@ class Mailbox:
             return
 
         # nope. delete and summarize
-        db.execute("DELETE FROM `messages` WHERE `mailbox_id`=?",
-                   (self._mailbox_id,))
+        db.execute("DELETE FROM `messages`"
+                   " WHERE `app_id`=? AND `mailbox_id`=?",
+                   (self._app_id, self._mailbox_id))
         db.execute("DELETE FROM `mailbox_sides` WHERE `mailbox_id`=?",
                    (self._mailbox_id,))
         db.execute("DELETE FROM `mailboxes` WHERE `id`=?", (self._mailbox_id,))
@@ -171,6 +239,7 @@ class AppNamespace(object):
         self._nameplate_counts = collections.defaultdict(int)
         self._mailbox_counts = collections.defaultdict(int)
         self._allow_list = allow_list
+        self._allocator = None # built by the first allocate_nameplate()
 
     def get_nameplate_ids(self):
         if not self._allow_list:
@@ -185,22 +254,19 @@ class AppNamespace(object):
         return set([row["name"] for row in c.fetchall()])
 
     def _find_available_nameplate_id(self):
-        claimed = self._get_nameplate_ids()
-        for size in range(1,4): # stick to 1-999 for now
-            available = set()
-            for id_int in range(10**(size-1), 10**size):
-                id = "%d" % id_int
-                if id not in claimed:
-                    available.add(id)
-            if available:
-                return random.choice(list(available))
-        # ouch, 999 currently claimed. Try random ones for a while.
-        for tries in range(1000):
-            id_int = random.randrange(1000, 1000*1000)
-            id = "%d" % id_int
-            if id not in claimed:
-                return id
-        raise ValueError("unable to find a free nameplate-id")
+        if self._allocator is None:
+            # look at the claimed nameplates once, then keep the allocator
+            # up to date as they come and go
+            self._allocator = NameplateAllocator(self._get_nameplate_ids())
+        return self._allocator.allocate()
+
+    def _nameplate_created(self, name):
+        if self._allocator:
+            self._allocator.claimed(name)
+
+    def _nameplate_deleted(self, name):
+        if self._allocator:
+            self._allocator.released(name)
 
     def allocate_nameplate(self, side, when):
         nameplate_id = self._find_available_nameplate_id()
@@ -231,6 +297,7 @@ class AppNamespace(object):
                    " VALUES(?,?,?)")
             npid = db.execute(sql, (self._app_id, name, mailbox_id)
                               ).lastrowid
+            self._nameplate_created(name)
         else:
             npid = row["id"]
             mailbox_id = row["mailbox_id"]
@@ -295,6 +362,7 @@ class AppNamespace(object):
         db.execute("DELETE FROM `nameplate_sides` WHERE `nameplates_id`=?",
                    (npid,))
         db.execute("DELETE FROM `nameplates` WHERE `id`=?", (npid,))
+        self._nameplate_deleted(name)
         self._summarize_nameplate_and_store(side_rows, when, pruned=False)
         db.commit()
 
@@ -421,90 +489,41 @@ class AppNamespace(object):
         return Usage(started=started, waiting_time=waiting_time,
                      total_time=total_time, result=result)
 
-    def prune(self, now, old):
-        # The pruning check runs every 10 minutes, and "old" is defined to be
-        # 11 minutes ago (unit tests can use different values). The client is
-        # allowed to disconnect for up to 9 minutes without losing the
-        # channel (nameplate, mailbox, and messages).
-
-        # Each time a client does something, the mailbox.updated field is
-        # updated with the current timestamp. If a client is subscribed to
-        # the mailbox when pruning check runs, the "updated" field is also
-        # updated. After that check, if the "updated" field is "old", the
-        # channel is deleted.
-
-        # For now, pruning is logged even if log_requests is False, to debug
-        # the pruning process, and since pruning is triggered by a timer
-        # instead of by user action. It does reveal which mailboxes were
-        # present when the pruning process began, though, so in the log run
-        # it should do less logging.
-        log.msg(" prune begins (%s)" % self._app_id)
+    def prune_mailbox(self, mailbox_id, now):
+        # Rendezvous.prune_all_apps() has found that this mailbox is old:
+        # delete it, its messages, and any nameplates that point at it.
+        # Returns the number of nameplates deleted. Requires the caller to
+        # db.commit().
         db = self._db
-        modified = False
-
-        for mailbox in self._mailboxes.values():
-            if mailbox.has_listeners():
-                log.msg("touch %s because listeners" % mailbox._mailbox_id)
-                mailbox._touch(now)
-        db.commit() # make sure the updates are visible below
-
-        new_mailboxes = set()
-        old_mailboxes = set()
-        for row in db.execute("SELECT * FROM `mailboxes` WHERE `app_id`=?",
-                              (self._app_id,)).fetchall():
-            mailbox_id = row["id"]
-            log.msg("  1: age=%s, old=%s, %s" %
-                    (now - row["updated"], now - old, mailbox_id))
-            if row["updated"] > old:
-                new_mailboxes.add(mailbox_id)
-            else:
-                old_mailboxes.add(mailbox_id)
-        log.msg(" 2: mailboxes:", new_mailboxes, old_mailboxes)
-
-        old_nameplates = set()
-        for row in db.execute("SELECT * FROM `nameplates` WHERE `app_id`=?",
-                              (self._app_id,)).fetchall():
-            npid = row["id"]
-            mailbox_id = row["mailbox_id"]
-            if mailbox_id in old_mailboxes:
-                old_nameplates.add(npid)
-        log.msg(" 3: old_nameplates dbids", old_nameplates)
-
-        for npid in old_nameplates:
-            log.msg("  deleting nameplate with dbid", npid)
+        nameplates = db.execute("SELECT `id`, `name` FROM `nameplates`"
+                                " WHERE `app_id`=? AND `mailbox_id`=?",
+                                (self._app_id, mailbox_id)).fetchall()
+        for row in nameplates:
             side_rows = db.execute("SELECT * FROM `nameplate_sides`"
                                    " WHERE `nameplates_id`=?",
-                                   (npid,)).fetchall()
+                                   (row["id"],)).fetchall()
             db.execute("DELETE FROM `nameplate_sides` WHERE `nameplates_id`=?",
-                       (npid,))
-            db.execute("DELETE FROM `nameplates` WHERE `id`=?", (npid,))
+                       (row["id"],))
+            db.execute("DELETE FROM `nameplates` WHERE `id`=?", (row["id"],))
+            self._nameplate_deleted(row["name"])
             self._summarize_nameplate_and_store(side_rows, now, pruned=True)
-            modified = True
-
-        # delete all messages for old mailboxes
-        # delete all old mailboxes
-
-        for mailbox_id in old_mailboxes:
-            log.msg("  deleting mailbox", mailbox_id)
-            row = db.execute("SELECT * FROM `mailboxes`"
-                             " WHERE `id`=?", (mailbox_id,)).fetchone()
-            for_nameplate = row["for_nameplate"]
-            side_rows = db.execute("SELECT * FROM `mailbox_sides`"
-                                   " WHERE `mailbox_id`=?",
-                                   (mailbox_id,)).fetchall()
-            db.execute("DELETE FROM `messages` WHERE `mailbox_id`=?",
-                       (mailbox_id,))
-            db.execute("DELETE FROM `mailbox_sides` WHERE `mailbox_id`=?",
-                       (mailbox_id,))
-            db.execute("DELETE FROM `mailboxes` WHERE `id`=?",
-                       (mailbox_id,))
-            self._summarize_mailbox_and_store(for_nameplate, side_rows,
-                                              now, pruned=True)
-            modified = True
-
-        if modified:
-            db.commit()
-        log.msg("  prune complete, modified:", modified)
+
+        row = db.execute("SELECT * FROM `mailboxes`"
+                         " WHERE `id`=?", (mailbox_id,)).fetchone()
+        for_nameplate = row["for_nameplate"]
+        side_rows = db.execute("SELECT * FROM `mailbox_sides`"
+                               " WHERE `mailbox_id`=?",
+                               (mailbox_id,)).fetchall()
+        db.execute("DELETE FROM `messages`"
+                   " WHERE `app_id`=? AND `mailbox_id`=?",
+                   (self._app_id, mailbox_id))
+        db.execute("DELETE FROM `mailbox_sides` WHERE `mailbox_id`=?",
+                   (mailbox_id,))
+        db.execute("DELETE FROM `mailboxes` WHERE `id`=?", (mailbox_id,))
+        self._summarize_mailbox_and_store(for_nameplate, side_rows,
+                                          now, pruned=True)
+        self.free_mailbox(mailbox_id)
+        return len(nameplates)
 
     def get_counts(self):
         return (self._nameplate_counts, self._mailbox_counts)
@@ -514,6 +533,9 @@ class AppNamespace(object):
             channel._shutdown()
 
 
+# how many old mailboxes to delete in each reactor turn
+PRUNE_BATCH_SIZE = 100
+
 class Rendezvous(service.MultiService):
 
     def __init__(self, db, welcome, blur_usage, allow_list):
@@ -525,26 +547,39 @@ class Rendezvous(service.MultiService):
         self._log_requests = log_requests
         self._allow_list = allow_list
         self._apps = {}
+        # (direction, encoding) -> bytes, since we started. The "websocket"
+        # encoding counts whole WebSocket messages, the others just the
+        # message bodies in them.
+        self._traffic = collections.defaultdict(int)
+        self._last_prune = {}
+        self._prune_call = None
+        self._prune_d = None
 
     def get_welcome(self):
         return self._welcome
     def get_log_requests(self):
         return self._log_requests
 
+    def count_bytes(self, direction, size, encoding):
+        self._traffic[(direction, encoding)] += size
+
     def get_app(self, app_id):
         assert isinstance(app_id, type(""))
         if not app_id in self._apps:
             if self._log_requests:
                 log.msg("spawning app_id %s" % (app_id,))
-            self._apps[app_id] = AppNamespace(
-                self._db,
-                self._blur_usage,
-                self._log_requests,
-                app_id,
-                self._allow_list,
-            )
+            self._apps[app_id] = self._make_app(app_id)
         return self._apps[app_id]
 
+    def _make_app(self, app_id):
+        return AppNamespace(
+            self._db,
+            self._blur_usage,
+            self._log_requests,
+            app_id,
+            self._allow_list,
+        )
+
     def get_all_apps(self):
         apps = set()
         for row in self._db.execute("SELECT DISTINCT `app_id`"
@@ -559,32 +594,106 @@ class Rendezvous(service.MultiService):
         return apps
 
     def prune_all_apps(self, now, old):
-        # As with AppNamespace.prune_old_mailboxes, we log for now.
-        log.msg("beginning app prune")
-        for app_id in sorted(self.get_all_apps()):
-            log.msg(" app prune checking %r" % (app_id,))
-            app = self.get_app(app_id)
-            app.prune(now, old)
-        log.msg("app prune ends, %d apps" % len(self._apps))
+        """Delete everything that is old, right now."""
+        for _ in self._prune(now, old, PRUNE_BATCH_SIZE):
+            pass
+
+    def prune_incrementally(self, now, old, reactor,
+                            batch_size=PRUNE_BATCH_SIZE):
+        """Delete everything that is old, one batch per reactor turn, so a
+        large backlog doesn't keep clients waiting. Returns a Deferred that
+        fires when it is done, or when stopService() cuts it short."""
+        d = self._prune_d = defer.Deferred()
+        batches = self._prune(now, old, batch_size)
+        def _next():
+            self._prune_call = None
+            try:
+                next(batches)
+            except StopIteration:
+                self._prune_d = None
+                d.callback(None)
+                return
+            except Exception:
+                self._prune_d = None
+                d.errback(failure.Failure())
+                return
+            self._prune_call = reactor.callLater(0, _next)
+        _next()
+        return d
+
+    def _prune(self, now, old, batch_size):
+        # The pruning check runs every 10 minutes, and "old" is defined to be
+        # 11 minutes ago (unit tests can use different values). The client is
+        # allowed to disconnect for up to 9 minutes without losing the
+        # channel (nameplate, mailbox, and messages).
+
+        # Each time a client does something, the mailbox.updated field is
+        # updated with the current timestamp. If a client is subscribed to
+        # the mailbox when pruning reaches it, the "updated" field is updated
+        # instead. Otherwise, if the "updated" field is "old", the channel is
+        # deleted.
+
+        # This yields after each batch, and records what it did for
+        # get_stats().
+        log.msg("prune begins")
+        stats = {"started": now, "batches": 0, "mailboxes": 0,
+                 "nameplates": 0, "busy": 0.0, "longest_batch": 0.0}
+        start = time.time()
+        batches = self._prune_batches(now, old, batch_size)
+        while True:
+            batch_start = time.time()
+            try:
+                mailboxes, nameplates = next(batches)
+            except StopIteration:
+                break
+            took = time.time() - batch_start
+            stats["batches"] += 1
+            stats["mailboxes"] += mailboxes
+            stats["nameplates"] += nameplates
+            stats["busy"] += took
+            stats["longest_batch"] = max(stats["longest_batch"], took)
+            yield
+        stats["elapsed"] = time.time() - start
+        self._last_prune = stats
+        log.msg("prune complete: %d mailboxes and %d nameplates"
+                " in %d batches, %.3fs"
+                % (stats["mailboxes"], stats["nameplates"], stats["batches"],
+                   stats["busy"]))
+
+    def _prune_batches(self, now, old, batch_size):
+        # the index on `updated` finds the old mailboxes of every app, without
+        # looking at the rest. Yields (mailboxes, nameplates) deleted for
+        # each batch.
+        db = self._db
+        while True:
+            rows = db.execute("SELECT `app_id`, `id` FROM `mailboxes`"
+                              " WHERE `updated` <= ?"
+                              " ORDER BY `updated` LIMIT ?",
+                              (old, batch_size)).fetchall()
+            if not rows:
+                return
+            mailboxes = nameplates = 0
+            for row in rows:
+                app = self.get_app(row["app_id"])
+                mailbox = app._mailboxes.get(row["id"])
+                if mailbox and mailbox.has_listeners():
+                    mailbox._touch(now) # someone is still there
+                    continue
+                nameplates += app.prune_mailbox(row["id"], now)
+                mailboxes += 1
+            db.commit()
+            yield (mailboxes, nameplates)
 
     def get_stats(self):
         stats = {}
 
         # current status: expected to be zero most of the time
-        c = stats["active"] = {}
-        c["apps"] = len(self.get_all_apps())
+        stats["active"] = self._get_active_counts()
+        # the most recent pruning pass
+        stats["prune"] = self._last_prune
         def q(query, values=()):
             row = self._db.execute(query, values).fetchone()
             return list(row.values())[0]
-        c["nameplates_total"] = q("SELECT COUNT() FROM `nameplates`")
-        # TODO: nameplates with only one side (most of them)
-        # TODO: nameplates with two sides (very fleeting)
-        # TODO: nameplates with three or more sides (crowded, unlikely)
-        c["mailboxes_total"] = q("SELECT COUNT() FROM `mailboxes`")
-        # TODO: mailboxes with only one side (most of them)
-        # TODO: mailboxes with two sides (somewhat fleeting, in-transit)
-        # TODO: mailboxes with three or more sides (unlikely)
-        c["messages_total"] = q("SELECT COUNT() FROM `messages`")
 
         # usage since last reboot
         nameplate_counts = collections.defaultdict(int)
@@ -604,6 +713,11 @@ class Rendezvous(service.MultiService):
         for result, count in mailbox_counts.items():
             urb["mailbox_moods"][result] = count
         urb["mailboxes_total"] = sum(mailbox_counts.values())
+        urb["bytes"] = {}
+        for encoding in ["websocket", "hex", "base64"]:
+            urb["bytes"][encoding] = {
+                "rx": self._traffic[("rx", encoding)],
+                "tx": self._traffic[("tx", encoding)]}
 
         # historical usage (all-time)
         u = stats["all_time"] = {}
@@ -647,6 +761,27 @@ class Rendezvous(service.MultiService):
 
         return stats
 
+    def _get_active_counts(self):
+        c = {}
+        c["apps"] = len(self.get_all_apps())
+        def q(query, values=()):
+            row = self._db.execute(query, values).fetchone()
+            return list(row.values())[0]
+        c["nameplates_total"] = q("SELECT COUNT() FROM `nameplates`")
+        # TODO: nameplates with only one side (most of them)
+        # TODO: nameplates with two sides (very fleeting)
+        # TODO: nameplates with three or more sides (crowded, unlikely)
+        c["mailboxes_total"] = q("SELECT COUNT() FROM `mailboxes`")
+        # TODO: mailboxes with only one side (most of them)
+        # TODO: mailboxes with two sides (somewhat fleeting, in-transit)
+        # TODO: mailboxes with three or more sides (unlikely)
+        c["messages_total"] = q("SELECT COUNT() FROM `messages`")
+        return c
+
+    def flush(self):
+        # everything is already in the database
+        pass
+
     def stopService(self):
         # This forcibly boots any clients that are still connected, which
         # helps with unit tests that use threads for both clients. One client
@@ -656,4 +791,11 @@ class Rendezvous(service.MultiService):
         # other client gets an error, and exits promptly.
         for app in self._apps.values():
             app._shutdown()
+        if self._prune_call:
+            # the rest of the old mailboxes will wait for the next pass
+            self._prune_call.cancel()
+            self._prune_call = None
+            # the server's TimerService waits for this before it stops
+            d, self._prune_d = self._prune_d, None
+            d.callback(None)
         return service.MultiService.stopService(self)
@@ -0,0 +1,508 @@
+from __future__ import print_function, unicode_literals
+import collections
+from twisted.python import log
+from twisted.application import internet
+from .rendezvous import (Rendezvous, AppNamespace, Mailbox, SidedMessage,
+                         CrowdedError, ReclaimedError, generate_mailbox_id)
+
+# With --storage=memory, the rendezvous server keeps its live state (the
+# nameplates, the mailboxes, and the messages in them) in dictionaries
+# instead of in the database. With the sqlite storage, every claim, open,
+# add, release, and close does several queries and at least one commit, and
+# the commits (each an fsync) limit how many of those we can do per second.
+# Here they only touch memory.
+#
+# The database is still written, just later: a WriteBehind remembers which
+# nameplates, mailboxes, and sides have changed, and every FLUSH_INTERVAL
+# seconds it writes those changes (and any new usage records) to the usual
+# tables, in a single transaction. Messages are only ever appended, so each
+# flush inserts just the ones that arrived since the last one. When we start, we load whatever is in those tables, so a
+# restart loses at most the last FLUSH_INTERVAL of changes. With
+# write_behind=False, only the usage records are written, and the live state
+# does not survive a restart.
+
+FLUSH_INTERVAL = 1.0
+
+class MemoryMailbox(Mailbox):
+    def __init__(self, app, app_id, mailbox_id, for_nameplate, updated):
+        Mailbox.__init__(self, app, None, app_id, mailbox_id)
+        self._for_nameplate = for_nameplate
+        self._updated = updated
+        self._sides = {} # side -> dict with the `mailbox_sides` columns
+        self._messages = [] # SidedMessages, in the order they arrived
+        # whether the database has our rows, and how many of our messages
+        self._saved = False
+        self._saved_messages = 0
+
+    def open(self, side, when):
+        assert isinstance(side, type("")), type(side)
+        # like Mailbox.open, this does not re-open a side that has closed
+        if side not in self._sides:
+            self._sides[side] = {"side": side, "opened": True,
+                                 "added": when, "mood": None}
+            self._app._mailbox_changed(self, side)
+        self._touch(when)
+
+    def _touch(self, when):
+        self._updated = when
+        self._app._mailbox_changed(self)
+
+    def get_messages(self):
+        return list(self._messages)
+
+    def _add_message(self, sm):
+        self._messages.append(sm)
+        self._touch(sm.server_rx)
+
+    def close(self, side, mood, when):
+        assert isinstance(side, type("")), type(side)
+        if self._app._mailboxes.get(self._mailbox_id) is not self:
+            return # already deleted
+        row = self._sides.get(side)
+        if not row:
+            return
+        row["opened"] = False
+        row["mood"] = mood
+        self._app._mailbox_changed(self, side)
+
+        # are any sides still open?
+        side_rows = list(self._sides.values())
+        if any([sr["opened"] for sr in side_rows]):
+            return
+
+        # nope. delete and summarize
+        self._app._summarize_mailbox_and_store(self._for_nameplate, side_rows,
+                                               when, pruned=False)
+        for (send_f, stop_f) in self._listeners.values():
+            stop_f()
+        self._listeners = {}
+        self._app.free_mailbox(self._mailbox_id)
+
+class MemoryAppNamespace(AppNamespace):
+
+    def __init__(self, db, blur_usage, log_requests, app_id, allow_list,
+                 writer):
+        AppNamespace.__init__(self, db, blur_usage, log_requests, app_id,
+                              allow_list)
+        self._writer = writer
+        # name -> {"mailbox_id":, "sides": {side: `nameplate_sides` dict}}
+        self._nameplates = {}
+
+    def _get_nameplate_ids(self):
+        return set(self._nameplates)
+
+    def claim_nameplate(self, name, side, when):
+        assert isinstance(name, type("")), type(name)
+        assert isinstance(side, type("")), type(side)
+        np = self._nameplates.get(name)
+        if np is None:
+            if self._log_requests:
+                log.msg("creating nameplate#%s for app_id %s" %
+                        (name, self._app_id))
+            mailbox_id = generate_mailbox_id()
+            self._add_mailbox(mailbox_id, True, side, when)
+            np = self._nameplates[name] = {"mailbox_id": mailbox_id,
+                                           "sides": {}}
+            self._nameplate_created(name)
+        row = np["sides"].get(side)
+        if not row:
+            np["sides"][side] = {"side": side, "claimed": True,
+                                 "added": when}
+            self._writer.nameplate_changed(self, name, side)
+        elif not row["claimed"]:
+            raise ReclaimedError("you cannot re-claim a nameplate that your side previously released")
+
+        mailbox_id = np["mailbox_id"]
+        self.open_mailbox(mailbox_id, side, when) # may raise CrowdedError
+        if len(np["sides"]) > 2:
+            raise CrowdedError("too many sides have claimed this nameplate")
+        return mailbox_id
+
+    def release_nameplate(self, name, side, when):
+        assert isinstance(name, type("")), type(name)
+        assert isinstance(side, type("")), type(side)
+        np = self._nameplates.get(name)
+        if np is None:
+            return
+        row = np["sides"].get(side)
+        if not row:
+            return
+        row["claimed"] = False
+        self._writer.nameplate_changed(self, name, side)
+
+        # now, are there any remaining claims?
+        side_rows = list(np["sides"].values())
+        if any([sr["claimed"] for sr in side_rows]):
+            return
+        # delete and summarize
+        del self._nameplates[name]
+        self._nameplate_deleted(name)
+        self._summarize_nameplate_and_store(side_rows, when, pruned=False)
+
+    def _summarize_nameplate_and_store(self, side_rows, delete_time, pruned):
+        u = self._summarize_nameplate_usage(side_rows, delete_time, pruned)
+        self._writer.add_nameplate_usage(self._app_id, u)
+        self._nameplate_counts[u.result] += 1
+
+    def _add_mailbox(self, mailbox_id, for_nameplate, side, when):
+        assert isinstance(mailbox_id, type("")), type(mailbox_id)
+        if mailbox_id not in self._mailboxes:
+            if self._log_requests:
+                log.msg("spawning #%s for app_id %s" % (mailbox_id,
+                                                        self._app_id))
+            mailbox = MemoryMailbox(self, self._app_id, mailbox_id,
+                                    for_nameplate, when)
+            self._mailboxes[mailbox_id] = mailbox
+            self._mailbox_changed(mailbox)
+
+    def open_mailbox(self, mailbox_id, side, when):
+        assert isinstance(mailbox_id, type("")), type(mailbox_id)
+        self._add_mailbox(mailbox_id, False, side, when)
+        mailbox = self._mailboxes[mailbox_id]
+        mailbox.open(side, when)
+        if len(mailbox._sides) > 2:
+            raise CrowdedError("too many sides have opened this mailbox")
+        return mailbox
+
+    def free_mailbox(self, mailbox_id):
+        mailbox = self._mailboxes.pop(mailbox_id, None)
+        if mailbox:
+            self._mailbox_changed(mailbox)
+
+    def _mailbox_changed(self, mailbox, side=None):
+        self._writer.mailbox_changed(self, mailbox, side)
+
+    def _summarize_mailbox_and_store(self, for_nameplate, side_rows,
+                                     delete_time, pruned):
+        u = self._summarize_mailbox(side_rows, delete_time, pruned)
+        self._writer.add_mailbox_usage(self._app_id, for_nameplate, u)
+        self._mailbox_counts[u.result] += 1
+
+    def prune_mailbox(self, mailbox_id, now, nameplates=None):
+        # the same as AppNamespace.prune_mailbox. 'nameplates' is the names
+        # that pointed at this mailbox when the caller looked, to save
+        # looking at every nameplate again.
+        if nameplates is None:
+            nameplates = [name for (name, np) in self._nameplates.items()
+                          if np["mailbox_id"] == mailbox_id]
+        deleted = 0
+        for name in nameplates:
+            np = self._nameplates.get(name)
+            if np is None or np["mailbox_id"] != mailbox_id:
+                continue # released since then
+            del self._nameplates[name]
+            self._nameplate_deleted(name)
+            self._writer.nameplate_changed(self, name)
+            self._summarize_nameplate_and_store(list(np["sides"].values()),
+                                                now, pruned=True)
+            deleted += 1
+
+        mailbox = self._mailboxes.pop(mailbox_id)
+        self._mailbox_changed(mailbox)
+        self._summarize_mailbox_and_store(mailbox._for_nameplate,
+                                          list(mailbox._sides.values()),
+                                          now, pruned=True)
+        return deleted
+
+class WriteBehind:
+    """I remember which nameplates, mailboxes, and sides have changed, and
+    the usage records that are waiting to be written, until flush() writes
+    them all to the database in one transaction. If 'persist' is False, I
+    only write the usage records."""
+
+    def __init__(self, db, persist):
+        self._db = db
+        self._persist = persist
+        self._nameplates = {} # (app, name) -> set of changed sides
+        self._mailboxes = {} # (app, mailbox_id) -> set of changed sides
+        self._nameplate_usage = []
+        self._mailbox_usage = []
+        self.flushes = 0
+
+    def nameplate_changed(self, app, name, side=None):
+        if self._persist:
+            sides = self._nameplates.setdefault((app, name), set())
+            if side is not None:
+                sides.add(side)
+
+    def mailbox_changed(self, app, mailbox, side=None):
+        if self._persist:
+            sides = self._mailboxes.setdefault((app, mailbox._mailbox_id),
+                                               set())
+            if side is not None:
+                sides.add(side)
+
+    def add_nameplate_usage(self, app_id, u):
+        self._nameplate_usage.append((app_id, u.started, u.total_time,
+                                      u.waiting_time, u.result))
+
+    def add_mailbox_usage(self, app_id, for_nameplate, u):
+        self._mailbox_usage.append((app_id, for_nameplate, u.started,
+                                    u.total_time, u.waiting_time, u.result))
+
+    def is_dirty(self):
+        return bool(self._nameplates or self._mailboxes or
+                    self._nameplate_usage or self._mailbox_usage)
+
+    def flush(self):
+        if not self.is_dirty():
+            return
+        db = self._db
+        nameplates, self._nameplates = self._nameplates, {}
+        mailboxes, self._mailboxes = self._mailboxes, {}
+
+        # nameplates refer to mailboxes, so they go in after them
+        for (app, mailbox_id), sides in mailboxes.items():
+            mailbox = app._mailboxes.get(mailbox_id)
+            if mailbox is not None and mailbox._saved:
+                self._update_mailbox(app._app_id, mailbox, sides)
+            else:
+                # it's new, or it has been deleted (and maybe opened again
+                # since then, as a new one)
+                self._replace_mailbox(app._app_id, mailbox_id, mailbox)
+        for (app, name), sides in nameplates.items():
+            self._flush_nameplate(app, name, sides)
+
+        for values in self._nameplate_usage:
+            db.execute("INSERT INTO `nameplate_usage`"
+                       " (`app_id`,"
+                       " `started`, `total_time`, `waiting_time`, `result`)"
+                       " VALUES (?, ?,?,?,?)", values)
+        self._nameplate_usage = []
+        for values in self._mailbox_usage:
+            db.execute("INSERT INTO `mailbox_usage`"
+                       " (`app_id`, `for_nameplate`,"
+                       "  `started`, `total_time`, `waiting_time`, `result`)"
+                       " VALUES (?,?, ?,?,?,?)", values)
+        self._mailbox_usage = []
+        db.commit()
+        self.flushes += 1
+
+    def _flush_nameplate(self, app, name, sides):
+        db = self._db
+        np = app._nameplates.get(name)
+        row = db.execute("SELECT `id`, `mailbox_id` FROM `nameplates`"
+                         " WHERE `app_id`=? AND `name`=?",
+                         (app._app_id, name)).fetchone()
+        if np is None or np["mailbox_id"] not in app._mailboxes:
+            # it has been deleted. A nameplate can outlive its mailbox (if
+            # the mailbox is closed before the nameplate is released), but
+            # its row can't.
+            if row:
+                self._delete_nameplate(row["id"])
+            return
+        if row and row["mailbox_id"] == np["mailbox_id"]:
+            for side in sides:
+                self._write_nameplate_side(row["id"], np["sides"][side])
+            return
+        if row:
+            # an older nameplate of the same name
+            self._delete_nameplate(row["id"])
+        npid = db.execute("INSERT INTO `nameplates`"
+                          " (`app_id`, `name`, `mailbox_id`)"
+                          " VALUES(?,?,?)",
+                          (app._app_id, name, np["mailbox_id"])).lastrowid
+        for side_row in np["sides"].values():
+            self._write_nameplate_side(npid, side_row)
+
+    def _write_nameplate_side(self, npid, row):
+        self._db.execute("INSERT OR REPLACE INTO `nameplate_sides`"
+                         " (`nameplates_id`, `claimed`, `side`, `added`)"
+                         " VALUES(?,?,?,?)",
+                         (npid, row["claimed"], row["side"], row["added"]))
+
+    def _delete_nameplate(self, npid):
+        db = self._db
+        db.execute("DELETE FROM `nameplate_sides` WHERE `nameplates_id`=?",
+                   (npid,))
+        db.execute("DELETE FROM `nameplates` WHERE `id`=?", (npid,))
+
+    def _update_mailbox(self, app_id, mailbox, sides):
+        # the database already has the rest of it
+        self._db.execute("UPDATE `mailboxes` SET `updated`=? WHERE `id`=?",
+                         (mailbox._updated, mailbox._mailbox_id))
+        for side in sides:
+            self._write_mailbox_side(mailbox, mailbox._sides[side])
+        self._write_messages(app_id, mailbox)
+
+    def _replace_mailbox(self, app_id, mailbox_id, mailbox):
+        db = self._db
+        if db.execute("SELECT 1 FROM `mailboxes` WHERE `id`=?",
+                      (mailbox_id,)).fetchone():
+            db.execute("DELETE FROM `messages`"
+                       " WHERE `app_id`=? AND `mailbox_id`=?",
+                       (app_id, mailbox_id))
+            db.execute("DELETE FROM `mailbox_sides` WHERE `mailbox_id`=?",
+                       (mailbox_id,))
+            if mailbox is None:
+                for row in db.execute("SELECT `id` FROM `nameplates`"
+                                      " WHERE `app_id`=? AND `mailbox_id`=?",
+                                      (app_id, mailbox_id)).fetchall():
+                    self._delete_nameplate(row["id"])
+                db.execute("DELETE FROM `mailboxes` WHERE `id`=?",
+                           (mailbox_id,))
+        if mailbox is not None:
+            self._write_mailbox(app_id, mailbox)
+
+    def _write_mailbox(self, app_id, mailbox):
+        db = self._db
+        # nameplates may refer to this row, so we update it in place
+        c = db.execute("UPDATE `mailboxes` SET `updated`=? WHERE `id`=?",
+                       (mailbox._updated, mailbox._mailbox_id))
+        if not c.rowcount:
+            db.execute("INSERT INTO `mailboxes`"
+                       " (`app_id`, `id`, `for_nameplate`, `updated`)"
+                       " VALUES(?,?,?,?)",
+                       (app_id, mailbox._mailbox_id, mailbox._for_nameplate,
+                        mailbox._updated))
+        for row in mailbox._sides.values():
+            self._write_mailbox_side(mailbox, row)
+        mailbox._saved_messages = 0
+        self._write_messages(app_id, mailbox)
+        mailbox._saved = True
+
+    def _write_mailbox_side(self, mailbox, row):
+        self._db.execute("INSERT OR REPLACE INTO `mailbox_sides`"
+                         " (`mailbox_id`, `opened`, `side`, `added`, `mood`)"
+                         " VALUES(?,?,?,?,?)",
+                         (mailbox._mailbox_id, row["opened"], row["side"],
+                          row["added"], row["mood"]))
+
+    def _write_messages(self, app_id, mailbox):
+        # messages are only ever appended
+        for sm in mailbox._messages[mailbox._saved_messages:]:
+            self._db.execute("INSERT INTO `messages`"
+                             " (`app_id`, `mailbox_id`, `side`, `phase`,"
+                             "  `body`, `server_rx`, `msg_id`)"
+                             " VALUES (?,?,?,?,?, ?,?)",
+                             (app_id, mailbox._mailbox_id, sm.side, sm.phase,
+                              sm.body, sm.server_rx, sm.msg_id))
+        mailbox._saved_messages = len(mailbox._messages)
+
+class MemoryRendezvous(Rendezvous):
+    """I am a Rendezvous that keeps the live state in memory, and writes it
+    to the database every FLUSH_INTERVAL seconds (if write_behind is True)."""
+
+    def __init__(self, db, welcome, blur_usage, allow_list, write_behind=True):
+        Rendezvous.__init__(self, db, welcome, blur_usage, allow_list)
+        self._writer = WriteBehind(db, write_behind)
+        if write_behind:
+            self._load()
+        else:
+            self._forget()
+        t = internet.TimerService(FLUSH_INTERVAL, self.flush)
+        t.setServiceParent(self)
+
+    def _make_app(self, app_id):
+        return MemoryAppNamespace(
+            self._db,
+            self._blur_usage,
+            self._log_requests,
+            app_id,
+            self._allow_list,
+            self._writer,
+        )
+
+    def _load(self):
+        db = self._db
+        mailboxes = {}
+        for row in db.execute("SELECT * FROM `mailboxes`").fetchall():
+            app = self.get_app(row["app_id"])
+            mailbox = MemoryMailbox(app, row["app_id"], row["id"],
+                                    bool(row["for_nameplate"]), row["updated"])
+            mailbox._saved = True
+            app._mailboxes[row["id"]] = mailbox
+            mailboxes[row["id"]] = mailbox
+        for row in db.execute("SELECT * FROM `mailbox_sides`").fetchall():
+            mailbox = mailboxes.get(row["mailbox_id"])
+            if mailbox:
+                mailbox._sides[row["side"]] = {"side": row["side"],
+                                               "opened": bool(row["opened"]),
+                                               "added": row["added"],
+                                               "mood": row["mood"]}
+        for row in db.execute("SELECT * FROM `messages`"
+                              " ORDER BY `server_rx` ASC").fetchall():
+            mailbox = mailboxes.get(row["mailbox_id"])
+            if mailbox:
+                mailbox._messages.append(
+                    SidedMessage(side=row["side"], phase=row["phase"],
+                                 body=row["body"], server_rx=row["server_rx"],
+                                 msg_id=row["msg_id"]))
+        for mailbox in mailboxes.values():
+            mailbox._saved_messages = len(mailbox._messages)
+        nameplates = {}
+        for row in db.execute("SELECT * FROM `nameplates`").fetchall():
+            app = self.get_app(row["app_id"])
+            np = {"mailbox_id": row["mailbox_id"], "sides": {}}
+            app._nameplates[row["name"]] = np
+            nameplates[row["id"]] = np
+        for row in db.execute("SELECT * FROM `nameplate_sides`").fetchall():
+            np = nameplates.get(row["nameplates_id"])
+            if np:
+                np["sides"][row["side"]] = {"side": row["side"],
+                                            "claimed": bool(row["claimed"]),
+                                            "added": row["added"]}
+        log.msg("loaded %d nameplates and %d mailboxes"
+                % (len(nameplates), len(mailboxes)))
+
+    def _forget(self):
+        # without the write-behind, anything in these tables is stale
+        db = self._db
+        for table in ["messages", "mailbox_sides", "nameplate_sides",
+                      "nameplates", "mailboxes"]:
+            db.execute("DELETE FROM `%s`" % table)
+        db.commit()
+
+    def get_all_apps(self):
+        return set([app_id for (app_id, app) in self._apps.items()
+                    if app._nameplates or app._mailboxes])
+
+    def _prune_batches(self, now, old, batch_size):
+        # there's no index to ask, so look at everything once, and check
+        # each mailbox again when its batch comes up
+        old_mailboxes = []
+        for app in list(self._apps.values()):
+            nameplates = collections.defaultdict(list)
+            for name, np in app._nameplates.items():
+                nameplates[np["mailbox_id"]].append(name)
+            for mailbox_id, mailbox in app._mailboxes.items():
+                if mailbox._updated <= old:
+                    old_mailboxes.append((app, mailbox,
+                                          nameplates.get(mailbox_id, [])))
+        for i in range(0, len(old_mailboxes), batch_size):
+            mailboxes = nameplates = 0
+            for app, mailbox, names in old_mailboxes[i:i+batch_size]:
+                mailbox_id = mailbox._mailbox_id
+                if app._mailboxes.get(mailbox_id) is not mailbox:
+                    continue # closed since then
+                if mailbox.has_listeners():
+                    mailbox._touch(now) # someone is still there
+                    continue
+                if mailbox._updated > old:
+                    continue
+                nameplates += app.prune_mailbox(mailbox_id, now, names)
+                mailboxes += 1
+            yield (mailboxes, nameplates)
+
+    def get_stats(self):
+        # the all-time numbers come from the usage tables
+        self.flush()
+        return Rendezvous.get_stats(self)
+
+    def _get_active_counts(self):
+        c = {}
+        c["apps"] = len(self.get_all_apps())
+        apps = self._apps.values()
+        c["nameplates_total"] = sum([len(app._nameplates) for app in apps])
+        c["mailboxes_total"] = sum([len(app._mailboxes) for app in apps])
+        c["messages_total"] = sum([len(mailbox._messages)
+                                   for app in apps
+                                   for mailbox in app._mailboxes.values()])
+        return c
+
+    def flush(self):
+        self._writer.flush()
+
+    def stopService(self):
+        self.flush()
+        return Rendezvous.stopService(self)
@@ -1,5 +1,5 @@
 from __future__ import unicode_literals
-import time
+import time, base64, binascii
 from twisted.internet import reactor
 from twisted.python import log
 from autobahn.twisted import websocket
@@ -60,11 +60,13 @@ from ..util import dict_to_bytes, bytes_to_dict
 # to the socket.
 
 # connection -> welcome
-#  <- {type: "welcome", welcome: {}} # .welcome keys are all optional:
+#  <- {type: "welcome", welcome: {}, sessions: true, encodings: [str,..]}
+#        .welcome keys are all optional:
 #        current_cli_version: out-of-date clients display a warning
 #        motd: all clients display message, then continue normally
 #        error: all clients display mesage, then terminate with error
-# -> {type: "bind", appid:, side:}
+# -> {type: "bind", appid:, side:, encoding: str}
+#     .encoding is optional, see below
 #
 # -> {type: "list"} -> nameplates
 #  <- {type: "nameplates", nameplates: [{id: str,..},..]}
@@ -78,8 +80,10 @@ from ..util import dict_to_bytes, bytes_to_dict
 #
 # -> {type: "open", mailbox: str} -> message
 #     sends old messages now, and subscribes to deliver future messages
-#  <- {type: "message", side:, phase:, body:, msg_id:}} # body is hex
-# -> {type: "add", phase: str, body: hex} # will send echo in a "message"
+#  <- {type: "message", side:, phase:, body:, msg_id:, encoding:}
+#     body is hex, unless .encoding says otherwise
+# -> {type: "add", phase: str, body: str, encoding: str}
+#     .encoding is optional (default hex). Sends echo in a "message".
 #
 # -> {type: "close", mood: str} -> closed
 #     .mailbox is optional, but must match previous open()
@@ -87,6 +91,26 @@ from ..util import dict_to_bytes, bytes_to_dict
 #
 #  <- {type: "error", error: str, orig: {}} # in response to malformed msgs
 
+# A client can multiplex many bindings over one connection by adding a
+# "session" key (any string it likes) to each command. Each session is bound
+# separately, with its own appid, side, nameplate, and mailbox, and all the
+# responses to a session's commands carry the same "session" key. A session
+# is forgotten (and its mailbox unsubscribed) with "unbind", or when the
+# connection is lost. A connection that has been bound without a session
+# cannot also carry sessions. The welcome message has "sessions: true" when
+# the server supports this.
+#
+# -> {type: "bind", session: str, appid:, side:}
+# -> {type: "unbind", session: str}
+
+# Message bodies are hex by default, which doubles their size. The welcome
+# message lists the other encodings the server accepts in "add" (currently
+# just "base64"). A client that would rather receive bodies in one of them
+# asks for it with "encoding" in its "bind": it has not seen the welcome yet
+# when it sends that, so we ignore encodings we don't know and use hex. Every
+# "message" that isn't hex says what it is in its "encoding" key. Bodies are
+# stored as hex, whatever they arrived in.
+
 # for tests that need to know when a message has been processed:
 # -> {type: "ping", ping: int} -> pong (does not require bind/claim)
 #  <- {type: "pong", pong: int}
@@ -95,12 +119,22 @@ class Error(Exception):
     def __init__(self, explain):
         self._explain = explain
 
-class WebSocketRendezvous(websocket.WebSocketServerProtocol):
-    def __init__(self):
-        websocket.WebSocketServerProtocol.__init__(self)
+BODY_ENCODINGS = ["hex", "base64"]
+
+# A connection can carry at most this many sessions at once.
+MAX_SESSIONS = 1000
+
+class Binding:
+    """I hold the state of one (appid, side) binding: the nameplate and
+    mailbox it has claimed and opened. A plain connection has exactly one of
+    me, a multiplexed connection has one for each session."""
+
+    def __init__(self, protocol, session=None):
+        self._protocol = protocol
+        self._session = session
         self._app = None
         self._side = None
-        self._did_allocate = False # only one allocate() per websocket
+        self._did_allocate = False # only one allocate() per binding
         self._listening = False
         self._did_claim = False
         self._nameplate_id = None
@@ -109,57 +143,10 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
         self._mailbox = None
         self._mailbox_id = None
         self._did_close = False
+        self._encoding = "hex" # for the bodies we send
 
-    def onConnect(self, request):
-        rv = self.factory.rendezvous
-        if rv.get_log_requests():
-            log.msg("ws client connecting: %s" % (request.peer,))
-        self._reactor = self.factory.reactor
-
-    def onOpen(self):
-        rv = self.factory.rendezvous
-        self.send("welcome", welcome=rv.get_welcome())
-
-    def onMessage(self, payload, isBinary):
-        server_rx = time.time()
-        msg = bytes_to_dict(payload)
-        try:
-            if "type" not in msg:
-                raise Error("missing 'type'")
-            self.send("ack", id=msg.get("id"))
-
-            mtype = msg["type"]
-            if mtype == "ping":
-                return self.handle_ping(msg)
-            if mtype == "bind":
-                return self.handle_bind(msg)
-
-            if not self._app:
-                raise Error("must bind first")
-            if mtype == "list":
-                return self.handle_list()
-            if mtype == "allocate":
-                return self.handle_allocate(server_rx)
-            if mtype == "claim":
-                return self.handle_claim(msg, server_rx)
-            if mtype == "release":
-                return self.handle_release(msg, server_rx)
-
-            if mtype == "open":
-                return self.handle_open(msg, server_rx)
-            if mtype == "add":
-                return self.handle_add(msg, server_rx)
-            if mtype == "close":
-                return self.handle_close(msg, server_rx)
-
-            raise Error("unknown type")
-        except Error as e:
-            self.send("error", error=e._explain, orig=msg)
-
-    def handle_ping(self, msg):
-        if "ping" not in msg:
-            raise Error("ping requires 'ping'")
-        self.send("pong", pong=msg["ping"])
+    def is_bound(self):
+        return bool(self._app)
 
     def handle_bind(self, msg):
         if self._app or self._side:
@@ -168,8 +155,11 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
             raise Error("bind requires 'appid'")
         if "side" not in msg:
             raise Error("bind requires 'side'")
-        self._app = self.factory.rendezvous.get_app(msg["appid"])
+        rv = self._protocol.factory.rendezvous
+        self._app = rv.get_app(msg["appid"])
         self._side = msg["side"]
+        if msg.get("encoding") in BODY_ENCODINGS:
+            self._encoding = msg["encoding"]
 
 
     def handle_list(self):
@@ -237,8 +227,10 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
         except CrowdedError:
             raise Error("crowded")
         def _send(sm):
+            body, extra = self._encode_body(sm.body)
             self.send("message", side=sm.side, phase=sm.phase,
-                      body=sm.body, server_rx=sm.server_rx, id=sm.msg_id)
+                      body=body, server_rx=sm.server_rx, id=sm.msg_id,
+                      **extra)
         def _stop():
             pass
         self._listening = True
@@ -254,10 +246,40 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
             raise Error("missing 'body'")
         msg_id = msg.get("id") # optional
         sm = SidedMessage(side=self._side, phase=msg["phase"],
-                          body=msg["body"], server_rx=server_rx,
+                          body=self._decode_body(msg), server_rx=server_rx,
                           msg_id=msg_id)
         self._mailbox.add_message(sm)
 
+    def _decode_body(self, msg):
+        # returns the body as hex, which is how we store it
+        encoding = msg.get("encoding", "hex")
+        if encoding not in BODY_ENCODINGS:
+            raise Error("unknown encoding")
+        body = msg["body"]
+        self._protocol.count_bytes("rx", len(body), encoding)
+        if encoding == "base64":
+            try:
+                raw = binascii.a2b_base64(body.encode("ascii"))
+            except (binascii.Error, ValueError, UnicodeError):
+                raise Error("bad body")
+            body = binascii.hexlify(raw).decode("ascii")
+        return body
+
+    def _encode_body(self, body):
+        # returns (body, extra keys) for a "message"
+        if self._encoding == "base64":
+            try:
+                raw = binascii.unhexlify(body.encode("ascii"))
+            except (binascii.Error, TypeError, ValueError, UnicodeError):
+                # not really hex: pass it along unchanged
+                pass
+            else:
+                body = base64.b64encode(raw).decode("ascii")
+                self._protocol.count_bytes("tx", len(body), "base64")
+                return body, {"encoding": "base64"}
+        self._protocol.count_bytes("tx", len(body), "hex")
+        return body, {}
+
     def handle_close(self, msg, server_rx):
         if self._did_close:
             raise Error("only one close per connection")
@@ -284,16 +306,125 @@ class WebSocketRendezvous(websocket.WebSocketServerProtocol):
         self._mailbox = None
         self.send("closed")
 
+    def send(self, mtype, **kwargs):
+        if self._session is not None:
+            kwargs["session"] = self._session
+        self._protocol.send(mtype, **kwargs)
+
+    def unbind(self):
+        # the connection (or just this session) has gone away
+        if self._mailbox and self._listening:
+            self._mailbox.remove_listener(self)
+            self._listening = False
+
+class WebSocketRendezvous(websocket.WebSocketServerProtocol):
+    def __init__(self):
+        websocket.WebSocketServerProtocol.__init__(self)
+        self._binding = Binding(self)
+        self._sessions = {} # session -> Binding, for multiplexed clients
+
+    def onConnect(self, request):
+        rv = self.factory.rendezvous
+        if rv.get_log_requests():
+            log.msg("ws client connecting: %s" % (request.peer,))
+        self._reactor = self.factory.reactor
+
+    def onOpen(self):
+        rv = self.factory.rendezvous
+        # "sessions" tells clients that they may multiplex
+        # "encodings" are the message body encodings we accept
+        self.send("welcome", welcome=rv.get_welcome(), sessions=True,
+                  encodings=BODY_ENCODINGS)
+
+    def onMessage(self, payload, isBinary):
+        server_rx = time.time()
+        self.count_bytes("rx", len(payload))
+        msg = bytes_to_dict(payload)
+        session = msg.get("session")
+        # everything in response to a session's command is marked with it
+        extra = {} if session is None else {"session": session}
+        try:
+            if "type" not in msg:
+                raise Error("missing 'type'")
+            self.send("ack", id=msg.get("id"), **extra)
+
+            mtype = msg["type"]
+            if mtype == "ping":
+                return self.handle_ping(msg)
+
+            if session is None:
+                b = self._binding
+                if mtype == "bind":
+                    if self._sessions:
+                        raise Error("this connection carries sessions")
+                    return b.handle_bind(msg)
+            else:
+                if mtype == "bind":
+                    return self.handle_bind_session(session, msg)
+                if mtype == "unbind":
+                    return self.handle_unbind_session(session)
+                b = self._sessions.get(session)
+
+            if not b or not b.is_bound():
+                raise Error("must bind first")
+            if mtype == "list":
+                return b.handle_list()
+            if mtype == "allocate":
+                return b.handle_allocate(server_rx)
+            if mtype == "claim":
+                return b.handle_claim(msg, server_rx)
+            if mtype == "release":
+                return b.handle_release(msg, server_rx)
+
+            if mtype == "open":
+                return b.handle_open(msg, server_rx)
+            if mtype == "add":
+                return b.handle_add(msg, server_rx)
+            if mtype == "close":
+                return b.handle_close(msg, server_rx)
+
+            raise Error("unknown type")
+        except Error as e:
+            self.send("error", error=e._explain, orig=msg, **extra)
+
+    def handle_ping(self, msg):
+        if "ping" not in msg:
+            raise Error("ping requires 'ping'")
+        self.send("pong", pong=msg["ping"])
+
+    def handle_bind_session(self, session, msg):
+        if self._binding.is_bound():
+            raise Error("this connection is already bound")
+        if session in self._sessions:
+            raise Error("already bound")
+        if len(self._sessions) >= MAX_SESSIONS:
+            raise Error("too many sessions")
+        b = Binding(self, session)
+        b.handle_bind(msg)
+        self._sessions[session] = b
+
+    def handle_unbind_session(self, session):
+        b = self._sessions.pop(session, None)
+        if not b:
+            raise Error("must bind first")
+        b.unbind()
+
     def send(self, mtype, **kwargs):
         kwargs["type"] = mtype
         kwargs["server_tx"] = time.time()
         payload = dict_to_bytes(kwargs)
+        self.count_bytes("tx", len(payload))
         self.sendMessage(payload, False)
 
+    def count_bytes(self, direction, size, encoding="websocket"):
+        self.factory.rendezvous.count_bytes(direction, size, encoding)
+
     def onClose(self, wasClean, code, reason):
         #log.msg("onClose", self, self._mailbox, self._listening)
-        if self._mailbox and self._listening:
-            self._mailbox.remove_listener(self)
+        self._binding.unbind()
+        for b in self._sessions.values():
+            b.unbind()
+        self._sessions.clear()
 
 
 class WebSocketRendezvousFactory(websocket.WebSocketServerFactory):
@@ -7,8 +7,9 @@ from twisted.internet import reactor, endpoints
 from twisted.application import service, internet
 from twisted.web import server, static, resource
 from autobahn.twisted.resource import WebSocketResource
-from .database import get_db
+from .database import get_db, GroupCommitter
 from .rendezvous import Rendezvous
+from .rendezvous_memory import MemoryRendezvous
 from .rendezvous_websocket import WebSocketRendezvousFactory
 from .transit_server import Transit
 
@@ -34,13 +35,18 @@ class RelayServer(service.MultiService):
 
     def __init__(self, rendezvous_web_port, transit_port,
                  advertise_version, db_url=":memory:", blur_usage=None,
-                 signal_error=None, stats_file=None, allow_list=True):
+                 signal_error=None, stats_file=None, allow_list=True,
+                 storage="sqlite", write_behind=True,
+                 group_commit=None, wal=False, synchronous=None):
         service.MultiService.__init__(self)
         self._blur_usage = blur_usage
         self._allow_list = allow_list
         self._db_url = db_url
 
-        db = get_db(db_url)
+        db = get_db(db_url, wal=wal, synchronous=synchronous)
+        if group_commit is not None:
+            # in milliseconds
+            db = GroupCommitter(db, group_commit / 1000.0, reactor)
         welcome = {
             # adding .motd will cause all clients to display the message,
             # then keep running normally
@@ -59,7 +65,12 @@ class RelayServer(service.MultiService):
         if signal_error:
             welcome["error"] = signal_error
 
-        self._rendezvous = Rendezvous(db, welcome, blur_usage, self._allow_list)
+        if storage == "memory":
+            self._rendezvous = MemoryRendezvous(db, welcome, blur_usage,
+                                                self._allow_list, write_behind)
+        else:
+            self._rendezvous = Rendezvous(db, welcome, blur_usage,
+                                          self._allow_list)
         self._rendezvous.setServiceParent(self) # for the pruning timer
 
         root = Root()
@@ -111,12 +122,29 @@ class RelayServer(service.MultiService):
             log.msg("not blurring access times")
         if not self._allow_list:
             log.msg("listing of allocated nameplates disallowed")
+        if isinstance(self._rendezvous, MemoryRendezvous):
+            log.msg("keeping rendezvous state in memory")
+        if isinstance(self._db, GroupCommitter):
+            log.msg("grouping database commits")
+
+    def stopService(self):
+        d = service.MultiService.stopService(self)
+        def _flush(res):
+            # the services we just stopped may have asked for a commit
+            if isinstance(self._db, GroupCommitter):
+                self._db.flush()
+            return res
+        d.addBoth(_flush)
+        return d
 
     def timer(self):
         now = time.time()
         old = now - CHANNEL_EXPIRATION_TIME
-        self._rendezvous.prune_all_apps(now, old)
-        self.dump_stats(now, validity=EXPIRATION_CHECK_PERIOD+60)
+        # the TimerService waits for this before it schedules the next pass
+        d = self._rendezvous.prune_incrementally(now, old, reactor)
+        d.addCallback(lambda _: self.dump_stats(
+            now, validity=EXPIRATION_CHECK_PERIOD+60))
+        return d
 
     def dump_stats(self, now, validity):
         if not self._stats_file:
@@ -130,6 +158,8 @@ class RelayServer(service.MultiService):
         start = time.time()
         data["rendezvous"] = self._rendezvous.get_stats()
         data["transit"] = self._transit.get_stats()
+        if isinstance(self._db, GroupCommitter):
+            data["database"] = self._db.get_stats()
         log.msg("get_stats took:", time.time() - start)
 
         with open(tmpfn, "wb") as f:
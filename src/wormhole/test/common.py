@@ -9,6 +9,11 @@ from ..transit import allocate_tcp_port
 from ..server.server import RelayServer
 
 class ServerBase:
+    # where the relay keeps its rendezvous state: "sqlite" or "memory"
+    storage = "sqlite"
+    # milliseconds, or None to commit every change straight away
+    group_commit = None
+
     def setUp(self):
         self._setup_relay(None)
 
@@ -22,7 +27,9 @@ class ServerBase:
         s = RelayServer("tcp:%d:interface=127.0.0.1" % self.relayport,
                         "tcp:%s:interface=127.0.0.1" % self.transitport,
                         advertise_version=advertise_version,
-                        signal_error=error)
+                        signal_error=error,
+                        storage=self.storage,
+                        group_commit=self.group_commit)
         s.setServiceParent(self.sp)
         self._relay_server = s
         self._rendezvous = s._rendezvous
@@ -0,0 +1,166 @@
+from __future__ import print_function, unicode_literals
+import os, sys
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.utils import getProcessOutputAndValue
+from .. import wormhole, transit
+from ..errors import WrongPasswordError
+try:
+    import asyncio
+    from .. import aio
+except ImportError: # py2
+    asyncio = None
+
+class FakeBoss:
+    def __init__(self):
+        self.sent = []
+    def send(self, plaintext):
+        self.sent.append(plaintext)
+    def close(self):
+        pass
+
+class Records(transit._InboundRecords):
+    def __init__(self):
+        self._init_inbound_records()
+        self.paused = False
+    def pauseProducing(self):
+        self.paused = True
+    def resumeProducing(self):
+        self.paused = False
+    def send_record(self, record):
+        self.recordReceived(record)
+
+class Wrappers(unittest.TestCase):
+    def setUp(self):
+        if asyncio is None:
+            raise unittest.SkipTest("asyncio needs python3")
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def run_loop(self, awaitable):
+        f = asyncio.ensure_future(awaitable, loop=self.loop)
+        return self.loop.run_until_complete(f)
+
+    def test_wormhole(self):
+        w = wormhole._DeferredWormhole()
+        boss = FakeBoss()
+        w._set_boss(boss)
+        aw = aio.AsyncWormhole(w, self.loop)
+        f = aw.get_code()
+        self.assertIsInstance(f, asyncio.Future)
+        self.assertFalse(f.done())
+        self.loop.call_soon(w.got_code, "1-code")
+        self.assertEqual(self.run_loop(f), "1-code")
+        # results that are already here are ready straight away
+        self.assertTrue(aw.get_code().done())
+
+        aw.send_message(b"hi")
+        self.assertEqual(boss.sent, [b"hi"])
+        w.received(b"one")
+        w.received(b"two")
+        self.assertEqual(self.run_loop(aw.get_message()), b"one")
+        self.assertEqual(self.run_loop(aw.get_message()), b"two")
+
+        f = aw.get_message()
+        w.closed(WrongPasswordError())
+        self.assertRaises(WrongPasswordError, self.run_loop, f)
+        self.assertRaises(WrongPasswordError, self.run_loop, aw.close())
+
+    def test_stream(self):
+        c = Records()
+        stream = aio.TransitStream(c, self.loop)
+        c.recordReceived(b"r1")
+        # a record that has already arrived does not need a Future
+        first = stream.__anext__()
+        self.assertNotIsInstance(first, asyncio.Future)
+        self.assertEqual(self.run_loop(first), b"r1")
+
+        f = stream.__anext__()
+        self.assertIsInstance(f, asyncio.Future)
+        self.loop.call_soon(c.recordReceived, b"r2")
+        self.assertEqual(self.run_loop(f), b"r2")
+
+        stream.send(b"r3")
+        self.assertEqual(self.run_loop(stream.receive()), b"r3")
+
+        buf = bytearray(4)
+        c.recordReceived(b"abc")
+        c.recordReceived(b"def")
+        self.assertEqual(self.run_loop(stream.read_into(buf)), 4)
+        self.assertEqual(buf, b"abcd")
+
+        stream.set_inbound_limit(1)
+        c.recordReceived(b"ghi")
+        self.assertTrue(c.paused)
+        self.assertEqual(self.run_loop(stream.__anext__()), b"ef")
+        self.assertEqual(self.run_loop(stream.__anext__()), b"ghi")
+        self.assertFalse(c.paused)
+
+        f = stream.__anext__()
+        c._abandon_reads()
+        self.assertRaises(StopAsyncIteration, self.run_loop, f)
+
+    def test_wrong_reactor(self):
+        # trial is running some other reactor
+        self.assertRaises(aio.ReactorError, aio.install, self.loop)
+
+E2E = """
+import asyncio
+from twisted.application import service
+import wormhole.aio
+async def main():
+    wormhole.aio.install(asyncio.get_event_loop())
+    from wormhole.transit import (allocate_tcp_port, TransitSender,
+                                  TransitReceiver)
+    from wormhole.server.server import RelayServer
+    relayport, transitport = allocate_tcp_port(), allocate_tcp_port()
+    sp = service.MultiService()
+    RelayServer("tcp:%d:interface=127.0.0.1" % relayport,
+                "tcp:%d:interface=127.0.0.1" % transitport,
+                advertise_version=None).setServiceParent(sp)
+    sp.startService()
+    relay = "ws://127.0.0.1:%d/v1" % relayport
+    w1 = wormhole.aio.create("appid", relay)
+    w2 = wormhole.aio.create("appid", relay)
+    w1.allocate_code()
+    w2.set_code(await w1.get_code())
+    w1.send_message(b"data1")
+    print((await w2.get_message()).decode())
+
+    loop = asyncio.get_event_loop()
+    t = "tcp:127.0.0.1:%d" % transitport
+    s = wormhole.aio.AsyncTransit(TransitSender(t, no_listen=True), loop)
+    r = wormhole.aio.AsyncTransit(TransitReceiver(t, no_listen=True), loop)
+    s.add_connection_hints(await r.get_connection_hints())
+    r.add_connection_hints(await s.get_connection_hints())
+    key = w1.derive_key("transit", 32)
+    s.set_transit_key(key)
+    r.set_transit_key(key)
+    sender, receiver = await asyncio.gather(s.connect(), r.connect())
+    sender.send(b"record1")
+    sender.send(b"record2")
+    sender.close()
+    async for record in receiver:
+        print(record.decode())
+    await w1.close()
+    await w2.close()
+    await wormhole.aio.shutdown()
+asyncio.set_event_loop(asyncio.new_event_loop())
+asyncio.get_event_loop().run_until_complete(main())
+"""
+
+class EndToEnd(unittest.TestCase):
+    def test_e2e(self):
+        if asyncio is None:
+            raise unittest.SkipTest("asyncio needs python3")
+        # the asyncio reactor has to be installed before anything imports
+        # twisted.internet.reactor, so this runs in a fresh process
+        d = getProcessOutputAndValue(sys.executable, ["-c", E2E],
+                                     env=os.environ, reactor=reactor)
+        def _check(res):
+            out, err, code = res
+            self.assertEqual(code, 0, err)
+            self.assertEqual(out.decode("utf-8").splitlines(),
+                             ["data1", "record1", "record2"])
+        d.addCallback(_check)
+        return d
@@ -71,6 +71,39 @@ class Send(unittest.TestCase):
         cfg = config("send", "-0", "fn")
         self.assertEqual(cfg.zeromode, True)
 
+    def test_streams(self):
+        cfg = config("send", "fn")
+        self.assertEqual(cfg.streams, 1)
+        cfg = config("send", "--streams", "4", "fn")
+        self.assertEqual(cfg.streams, 4)
+
+    def test_stream_directory(self):
+        cfg = config("send", "fn")
+        self.assertEqual(cfg.stream_directory, False)
+        cfg = config("send", "--stream-directory", "fn")
+        self.assertEqual(cfg.stream_directory, True)
+
+    def test_compression(self):
+        cfg = config("send", "fn")
+        self.assertEqual(cfg.compression, "6")
+        self.assertEqual(cfg.compression_threads, None)
+        cfg = config("send", "--compression", "store",
+                     "--compression-threads", "2", "fn")
+        self.assertEqual(cfg.compression, "store")
+        self.assertEqual(cfg.compression_threads, 2)
+
+    def test_compress_file(self):
+        cfg = config("send", "fn")
+        self.assertEqual(cfg.compress_file, False)
+        cfg = config("send", "--compress-file", "fn")
+        self.assertEqual(cfg.compress_file, True)
+
+    def test_crypto_threads(self):
+        cfg = config("send", "fn")
+        self.assertEqual(cfg.crypto_threads, False)
+        cfg = config("send", "--crypto-threads", "fn")
+        self.assertEqual(cfg.crypto_threads, True)
+
 class Receive(unittest.TestCase):
     def test_baseline(self):
         cfg = config("receive")
@@ -100,6 +133,10 @@ class Receive(unittest.TestCase):
         cfg = config("receive", "--no-listen")
         self.assertEqual(cfg.listen, False)
 
+    def test_crypto_threads(self):
+        cfg = config("receive", "--crypto-threads")
+        self.assertEqual(cfg.crypto_threads, True)
+
     def test_code(self):
         cfg = config("receive", "1-abc")
         self.assertEqual(cfg.code, u"1-abc")
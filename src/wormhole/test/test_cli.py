@@ -1,5 +1,5 @@
 from __future__ import print_function, unicode_literals
-import os, sys, re, io, zipfile, six, stat
+import os, sys, re, io, zipfile, zlib, six, stat, json, hashlib
 from textwrap import fill, dedent
 from humanize import naturalsize
 import mock
@@ -9,11 +9,15 @@ from twisted.trial import unittest
 from twisted.python import procutils, log
 from twisted.internet import endpoints, reactor
 from twisted.internet.utils import getProcessOutputAndValue
-from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
-from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.defer import (gatherResults, inlineCallbacks, returnValue,
+                                    Deferred, CancelledError, succeed, fail)
+from twisted.internet.error import ConnectionRefusedError, ConnectionLost
 from .. import __version__
-from .common import ServerBase, config
-from ..cli import cmd_send, cmd_receive, welcome, cli
+from .common import ServerBase, config, poll_until
+from .test_zipstream import Unstreamable, BrokenFile
+from ..cli import (cmd_send, cmd_receive, welcome, cli, dirstream, zipstream,
+                   resume, compress)
+from .. import transit
 from ..errors import (TransferError, WrongPasswordError, WelcomeError,
                       UnsendableFileError, ServerConnectionError)
 from .._interfaces import ITorManager
@@ -103,6 +107,24 @@ class OfferData(unittest.TestCase):
         self.assertEqual(d['directory']['numfiles'], 0)
         self.assertEqual(d['directory']['numbytes'], 0)
 
+    def test_read_error_is_not_ignored(self):
+        # once part of a file is in the zipfile, leaving the rest out would
+        # send a broken archive, so give up even with
+        # --ignore-unsendable-files
+        parent_dir = self.mktemp()
+        os.makedirs(os.path.join(parent_dir, "dirname"))
+        size = 3*compress.BLOCK_SIZE
+        with open(os.path.join(parent_dir, "dirname", "big"), "wb") as f:
+            f.write(b"x" * size)
+        self.cfg.what = "dirname"
+        self.cfg.cwd = parent_dir
+        self.cfg.ignore_unsendable_files = True
+        broken = BrokenFile(b"x" * size, 2*compress.BLOCK_SIZE)
+        with mock.patch("wormhole.cli.zipbuild.open", create=True,
+                        return_value=broken):
+            e = self.assertRaises(UnsendableFileError, build_offer, self.cfg)
+        self.assertEqual(str(e), "big: Input/output error")
+
     def test_missing_file(self):
         self.cfg.what = filename = "missing"
         send_dir = self.mktemp()
@@ -158,6 +180,129 @@ class OfferData(unittest.TestCase):
     def test_directory_addslash(self):
         return self._do_test_directory(addslash=True)
 
+    @inlineCallbacks
+    def _do_test_compress_file(self, data):
+        self.cfg.what = filename = "my file"
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        with open(os.path.join(send_dir, filename), "wb") as f:
+            f.write(data)
+        self.cfg.cwd = send_dir
+        self.cfg.compress_file = True
+        s = cmd_send.Sender(self.cfg, reactor)
+        d, fd_to_send = s._build_offer()
+        # the compressed copy is made in a thread
+        yield s._compress_file(fd_to_send, d["file"])
+        self.assertEqual(d["file"]["filesize"], len(data))
+        # the original is what gets sent unless the receiver says otherwise
+        self.assertEqual(fd_to_send.read(), data)
+        fd_to_send.close()
+        returnValue((d, s))
+
+    @inlineCallbacks
+    def test_compress_file(self):
+        data = b"ponies\n" * 10000
+        d, s = yield self._do_test_compress_file(data)
+        self.assertEqual(d["file"]["compression"], "deflate")
+        compressed = s._compressed_fd.read()
+        self.assertEqual(d["file"]["compressed-size"], len(compressed))
+        self.assertEqual(zlib.decompress(compressed, -zlib.MAX_WBITS), data)
+        self.assertIn("Compressed to ", self.cfg.stderr.getvalue())
+
+    @inlineCallbacks
+    def test_compress_file_incompressible(self):
+        d, s = yield self._do_test_compress_file(os.urandom(10000))
+        self.assertNotIn("compression", d["file"])
+        self.assertEqual(s._compressed_fd, None)
+        self.assertIn("doesn't look compressible", self.cfg.stderr.getvalue())
+
+    def _do_test_compression(self, level, compress_type):
+        parent_dir = self.mktemp()
+        os.makedirs(os.path.join(parent_dir, "dirname", "sub"))
+        contents = {"a": b"ponies\n" * 1000,
+                    "sub/b": b"",
+                    # several compression blocks
+                    "sub/c": b"unicorns\n" * 300000,
+                    }
+        for name, data in contents.items():
+            with open(os.path.join(parent_dir, "dirname", *name.split("/")),
+                      "wb") as f:
+                f.write(data)
+        self.cfg.what = "dirname"
+        self.cfg.cwd = parent_dir
+        self.cfg.compression = level
+        self.cfg.compression_threads = 3
+
+        d, fd_to_send = build_offer(self.cfg)
+
+        self.assertEqual(d["directory"]["mode"], "zipfile/deflated")
+        self.assertEqual(d["directory"]["numfiles"], 3)
+        self.assertEqual(d["directory"]["numbytes"],
+                         sum([len(data) for data in contents.values()]))
+        zdata = fd_to_send.read()
+        self.assertEqual(len(zdata), d["directory"]["zipsize"])
+        with zipfile.ZipFile(io.BytesIO(zdata), "r") as zf:
+            self.assertEqual(sorted(zf.namelist()), sorted(contents))
+            for name, data in contents.items():
+                if data:
+                    self.assertEqual(zf.getinfo(name).compress_type,
+                                     compress_type)
+                self.assertEqual(zf.read(name), data)
+        return d
+
+    def test_directory_store(self):
+        d = self._do_test_compression("store", zipfile.ZIP_STORED)
+        self.assertEqual(d["directory"]["compression"], "store")
+
+    def test_directory_deflate(self):
+        d = self._do_test_compression("9", zipfile.ZIP_DEFLATED)
+        self.assertEqual(d["directory"]["compression"], "deflate")
+        self.assertLess(d["directory"]["zipsize"], d["directory"]["numbytes"])
+
+    def test_directory_stream(self):
+        parent_dir = self.mktemp()
+        os.mkdir(parent_dir)
+        send_dir = "dirname"
+        os.makedirs(os.path.join(parent_dir, send_dir, "sub"))
+        ponies = ["0", "1", "sub/2"]
+        for p in ponies:
+            with open(os.path.join(parent_dir, send_dir, *p.split("/")),
+                      "wb") as f:
+                f.write(("%s ponies\n" % p).encode("ascii"))
+        self.cfg.what = send_dir
+        self.cfg.cwd = parent_dir
+        self.cfg.stream_directory = True
+
+        d, fd_to_send = build_offer(self.cfg)
+
+        self.assertEqual(d["directory"]["dirname"], send_dir)
+        self.assertEqual(d["directory"]["mode"], "stream-v1")
+        self.assertEqual(d["directory"]["numfiles"], 3)
+        self.assertEqual(d["directory"]["numbytes"],
+                         sum([len("%s ponies\n" % p) for p in ponies]))
+        data = fd_to_send.read(10*1000*1000)
+        self.assertEqual(len(data), d["directory"]["streamsize"])
+        self.assertEqual(fd_to_send.read(1000), b"")
+
+        outdir = self.mktemp()
+        os.mkdir(outdir)
+        u = dirstream.DirectoryUnpacker(outdir)
+        u.write(data)
+        self.assertTrue(u.finished)
+        for p in ponies:
+            with open(os.path.join(outdir, *p.split("/")), "rb") as f:
+                self.assertEqual(f.read(), ("%s ponies\n" % p).encode("ascii"))
+
+    def test_directory_stream_broken_symlink(self):
+        self._create_broken_symlink()
+        self.cfg.stream_directory = True
+        self.cfg.ignore_unsendable_files = False
+        e = self.assertRaises(UnsendableFileError, build_offer, self.cfg)
+        self.assertIn("linky: ", str(e))
+        self.cfg.ignore_unsendable_files = True
+        d, fd_to_send = build_offer(self.cfg)
+        self.assertEqual(d['directory']['numfiles'], 0)
+
     def test_unknown(self):
         self.cfg.what = filename = "unknown"
         send_dir = self.mktemp()
@@ -183,6 +328,78 @@ class OfferData(unittest.TestCase):
         self.assertEqual(str(e),
                          "'%s' is neither file nor directory" % filename)
 
+class RecordSize(unittest.TestCase):
+    def choose(self, answer):
+        s = cmd_send.Sender(config("send"), None)
+        return s._choose_record_size(answer)
+
+    def test_old_receiver(self):
+        self.assertEqual(self.choose({"file_ack": "ok"}),
+                         transit.DEFAULT_RECORD_SIZE)
+
+    def test_large(self):
+        answer = {"file_ack": "ok", "max-record-size": 4*1024*1024}
+        self.assertEqual(self.choose(answer), cmd_send.RECORD_SIZE)
+        answer = {"file_ack": "ok", "max-record-size": 256*1024}
+        self.assertEqual(self.choose(answer), 256*1024)
+
+    def test_never_smaller_than_default(self):
+        answer = {"file_ack": "ok", "max-record-size": 100}
+        self.assertEqual(self.choose(answer), transit.DEFAULT_RECORD_SIZE)
+
+    def test_bad_value(self):
+        answer = {"file_ack": "ok", "max-record-size": "lots"}
+        self.assertEqual(self.choose(answer), transit.DEFAULT_RECORD_SIZE)
+
+    def test_receiver_advertises(self):
+        r = cmd_receive.Receiver(config("receive"))
+        sent = []
+        r._send_data = lambda data, w: sent.append(data)
+        r._send_permission(None)
+        self.assertEqual(sent, [{"answer": {
+            "file_ack": "ok",
+            "max-record-size": transit.MAX_RECORD_SIZE}}])
+
+class KeptPartialFile(unittest.TestCase):
+    class Pipe:
+        def __init__(self, result):
+            self._result = result
+        def describe(self):
+            return "pipe"
+        def writeToFile(self, f, expected, progress=None, hasher=None,
+                        threaded=False):
+            f.write(b"partial")
+            hasher(b"partial")
+            return self._result
+
+    def receive(self, result):
+        cfg = config("receive", "--hide-progress")
+        cfg.stderr = io.StringIO()
+        r = cmd_receive.Receiver(cfg)
+        r.xfersize = 100
+        tmp_fn = os.path.abspath(self.mktemp()) + ".tmp"
+        f = open(tmp_fn, "wb")
+        self.addCleanup(f.close)
+        r._checkpoint = resume.Checkpoint(f, 100)
+        d = r._transfer_data(self.Pipe(result), f)
+        return r, d, tmp_fn
+
+    def test_short(self):
+        r, d, tmp_fn = self.receive(succeed(50))
+        self.failureResultOf(d, TransferError)
+        self.assertIn("Kept the partial file", r.args.stderr.getvalue())
+        self.assertEqual(resume.load_segments(tmp_fn, 100),
+                         [(7, hashlib.sha256(b"partial").hexdigest())])
+
+    def test_connection_lost(self):
+        # a dropped connection makes writeToFile() fail, rather than
+        # return a short count
+        r, d, tmp_fn = self.receive(fail(ConnectionLost()))
+        self.failureResultOf(d, ConnectionLost)
+        self.assertIn("Kept the partial file", r.args.stderr.getvalue())
+        self.assertEqual(resume.load_segments(tmp_fn, 100),
+                         [(7, hashlib.sha256(b"partial").hexdigest())])
+
 class LocaleFinder:
     def __init__(self):
         self._run_once = False
@@ -321,7 +538,10 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
     @inlineCallbacks
     def _do_test(self, as_subprocess=False,
                  mode="text", addslash=False, override_filename=False,
-                 fake_tor=False, overwrite=False, mock_accept=False):
+                 fake_tor=False, overwrite=False, mock_accept=False,
+                 streams=1, crypto_threads=False, stream_directory=False,
+                 compression="6", compress_file=False, partial=None,
+                 delta=False):
         assert mode in ("text", "file", "empty-file", "directory",
                         "slow-text", "slow-sender-text")
         if fake_tor:
@@ -329,8 +549,20 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
         send_cfg = config("send")
         recv_cfg = config("receive")
         message = "blah blah blah ponies"
-
+        if compress_file:
+            # enough that compressing it pays off
+            message = "blah blah blah ponies\n" * 1000
+        if delta:
+            # several blocks, one of which the receiver has a different
+            # version of
+            message = "".join(["line %d\n" % i for i in range(4000)])
+
+        send_cfg.streams = streams
+        send_cfg.stream_directory = stream_directory
+        send_cfg.compression = compression
+        send_cfg.compress_file = compress_file
         for cfg in [send_cfg, recv_cfg]:
+            cfg.crypto_threads = crypto_threads
             cfg.hide_progress = True
             cfg.relay_url = self.relayurl
             cfg.transit_helper = ""
@@ -363,7 +595,23 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
                 recv_cfg.output_file = receive_filename
                 existing_file = os.path.join(receive_dir, receive_filename)
                 with open(existing_file, 'w') as f:
-                    f.write('pls overwrite me')
+                    if delta:
+                        f.write(message.replace("line 2000", "line two"))
+                    else:
+                        f.write('pls overwrite me')
+            if partial:
+                # an earlier attempt got this far (plus some bytes that
+                # didn't make it into the checkpoint)
+                tmp_fn = os.path.join(receive_dir, receive_filename) + ".tmp"
+                prefix = message[:10].encode("ascii")
+                if partial == "bad":
+                    prefix = b"wrong data"
+                with open(tmp_fn, "wb") as f:
+                    f.write(prefix + b"unrecorded")
+                with open(resume.checkpoint_name(tmp_fn), "w") as f:
+                    json.dump({"filesize": len(message),
+                               "segments": [[10, hashlib.sha256(prefix)
+                                             .hexdigest()]]}, f)
 
         elif mode == "directory":
             # $send_dir/
@@ -551,6 +799,8 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
             self.failUnlessIn("File sent.. waiting for confirmation{NL}"
                               "Confirmation received. Transfer complete.{NL}"
                               .format(NL=NL), send_stderr)
+            if compress_file:
+                self.failUnlessIn("Compressed to ", send_stderr)
         elif mode == "directory":
             self.failUnlessIn("Sending directory", send_stderr)
             self.failUnlessIn("named 'testdir'", send_stderr)
@@ -562,6 +812,10 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
                               "Confirmation received. Transfer complete.{NL}"
                               .format(NL=NL), send_stderr)
 
+        if streams > 1:
+            self.failUnlessIn("Sending (striped(", send_stderr)
+            self.failUnlessIn("Receiving (striped(", receive_stderr)
+
         # check receiver
         if mode in ("text", "slow-text", "slow-sender-text"):
             self.assertEqual(receive_stdout, message+NL)
@@ -581,6 +835,18 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
             self.failUnless(os.path.exists(fn))
             with open(fn, "r") as f:
                 self.failUnlessEqual(f.read(), message)
+            self.failIf(os.path.exists(resume.checkpoint_name(fn + ".tmp")))
+            if partial == "good":
+                self.failUnlessIn("Resuming after 10 Bytes", send_stderr)
+                self.failUnlessIn("Resuming after 10 Bytes", receive_stderr)
+            if partial == "bad":
+                self.failUnlessIn("partial copy doesn't match", send_stderr)
+                self.failUnlessIn("Partial copy doesn't match", receive_stderr)
+            if delta:
+                self.failUnlessIn("The receiver has 34.8 kB of it already",
+                                  send_stderr)
+                self.failUnlessIn("Receiving changes to the existing file",
+                                  receive_stderr)
         elif mode == "directory":
             self.failUnlessEqual(receive_stdout, "")
             want = (r"Receiving directory \(\d+ \w+\) into: {name}/"
@@ -616,10 +882,22 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
         return self._do_test(mode="file", overwrite=True)
     def test_file_overwrite_mock_accept(self):
         return self._do_test(mode="file", overwrite=True, mock_accept=True)
+    def test_file_delta(self):
+        return self._do_test(mode="file", overwrite=True, delta=True)
     def test_file_tor(self):
         return self._do_test(mode="file", fake_tor=True)
     def test_empty_file(self):
         return self._do_test(mode="empty-file")
+    def test_file_resume(self):
+        return self._do_test(mode="file", partial="good")
+    def test_file_resume_mismatch(self):
+        return self._do_test(mode="file", partial="bad")
+    def test_file_compressed(self):
+        return self._do_test(mode="file", compress_file=True)
+    def test_file_striped(self):
+        return self._do_test(mode="file", streams=3)
+    def test_file_crypto_threads(self):
+        return self._do_test(mode="file", crypto_threads=True)
 
     def test_directory(self):
         return self._do_test(mode="directory")
@@ -631,6 +909,25 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
         return self._do_test(mode="directory", overwrite=True)
     def test_directory_overwrite_mock_accept(self):
         return self._do_test(mode="directory", overwrite=True, mock_accept=True)
+    def test_directory_striped(self):
+        return self._do_test(mode="directory", streams=2)
+    def test_directory_crypto_threads(self):
+        return self._do_test(mode="directory", crypto_threads=True)
+    def test_directory_store(self):
+        return self._do_test(mode="directory", compression="store")
+    def test_directory_fast(self):
+        return self._do_test(mode="directory", compression="1")
+    def test_directory_stream(self):
+        return self._do_test(mode="directory", stream_directory=True)
+    def test_directory_stream_addslash(self):
+        return self._do_test(mode="directory", addslash=True,
+                             stream_directory=True)
+    def test_directory_stream_override(self):
+        return self._do_test(mode="directory", override_filename=True,
+                             stream_directory=True)
+    def test_directory_stream_overwrite(self):
+        return self._do_test(mode="directory", overwrite=True,
+                             stream_directory=True)
 
     def test_slow_text(self):
         return self._do_test(mode="slow-text")
@@ -847,6 +1144,102 @@ class ZeroMode(ServerBase, unittest.TestCase):
         # check server stats
         self._rendezvous.get_stats()
 
+class FanOut(ServerBase, unittest.TestCase):
+    def config(self, mode, stdin=None):
+        cfg = config(mode)
+        cfg.hide_progress = True
+        cfg.relay_url = self.relayurl
+        cfg.transit_helper = ""
+        cfg.listen = True
+        cfg.stdout = io.StringIO()
+        cfg.stderr = io.StringIO()
+        return cfg
+
+    @inlineCallbacks
+    def codes(self, send_cfg, count):
+        # the sender prints the codes it allocated
+        def _codes():
+            lines = send_cfg.stderr.getvalue().splitlines()
+            if "Wormhole codes are:" not in lines:
+                return None
+            start = lines.index("Wormhole codes are:") + 1
+            codes = [l.strip() for l in lines[start:start+count]]
+            if len(codes) == count and all(codes):
+                return codes
+        yield poll_until(lambda: _codes() is not None)
+        returnValue(_codes())
+
+    @inlineCallbacks
+    def test_file(self):
+        message = "".join(["line %d\n" % i for i in range(20000)])
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        with open(os.path.join(send_dir, "artifact"), "w") as f:
+            f.write(message)
+        send_cfg = self.config("send")
+        send_cfg.cwd = send_dir
+        send_cfg.what = "artifact"
+        send_cfg.fan_out = 3
+        send_d = cmd_send.send(send_cfg)
+        codes = yield self.codes(send_cfg, 3)
+        self.assertEqual(len(set(codes)), 3)
+
+        receive_ds = []
+        receive_dirs = []
+        for code in codes:
+            recv_cfg = self.config("receive")
+            recv_cfg.cwd = self.mktemp()
+            os.mkdir(recv_cfg.cwd)
+            recv_cfg.accept_file = True
+            recv_cfg.code = code
+            receive_dirs.append(recv_cfg.cwd)
+            receive_ds.append(cmd_receive.receive(recv_cfg))
+        yield gatherResults([send_d] + receive_ds, True)
+
+        for d in receive_dirs:
+            with open(os.path.join(d, "artifact"), "r") as f:
+                self.assertEqual(f.read(), message)
+        self.assertIn("Sent %s to 3 of 3 receivers in"
+                      % naturalsize(len(message)),
+                      send_cfg.stderr.getvalue())
+
+    @inlineCallbacks
+    def test_one_fails(self):
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        with open(os.path.join(send_dir, "artifact"), "w") as f:
+            f.write("data")
+        send_cfg = self.config("send")
+        send_cfg.cwd = send_dir
+        send_cfg.what = "artifact"
+        send_cfg.fan_out = 2
+        send_d = cmd_send.send(send_cfg)
+        codes = yield self.codes(send_cfg, 2)
+
+        recv_cfg = self.config("receive")
+        recv_cfg.cwd = self.mktemp()
+        os.mkdir(recv_cfg.cwd)
+        recv_cfg.accept_file = True
+        recv_cfg.code = codes[0]
+        yield cmd_receive.receive(recv_cfg)
+        # the second receiver has the wrong code
+        recv_cfg = self.config("receive")
+        recv_cfg.code = codes[1].split("-")[0] + "-wrong-code"
+        yield self.assertFailure(cmd_receive.receive(recv_cfg),
+                                 WrongPasswordError)
+        e = yield self.assertFailure(send_d, TransferError)
+        self.assertEqual(str(e), "1 of 2 receivers failed")
+        stderr = send_cfg.stderr.getvalue()
+        self.assertIn("Receiver with code %s failed" % codes[1], stderr)
+        self.assertIn("to 1 of 2 receivers", stderr)
+
+    def test_bad_args(self):
+        send_cfg = self.config("send")
+        send_cfg.fan_out = 2
+        send_cfg.text = "hi"
+        f = self.failureResultOf(cmd_send.send(send_cfg), TransferError)
+        self.assertIn("--fan-out", str(f.value))
+
 class NotWelcome(ServerBase, unittest.TestCase):
     def setUp(self):
         self._setup_relay(error="please upgrade XYZ")
@@ -1021,6 +1414,119 @@ class ExtractFile(unittest.TestCase):
         e = self.assertRaises(ValueError, ef, zf, zi, extract_dir)
         self.assertIn("malicious zipfile", str(e))
 
+    def test_zip_path(self):
+        extract_dir = os.path.abspath(self.mktemp())
+        zp = zipstream.zip_path
+
+        self.assertEqual(zp(extract_dir, "ok"),
+                         os.path.join(extract_dir, "ok"))
+
+        e = self.assertRaises(ValueError, zp, extract_dir, "../haha")
+        self.assertIn("malicious zipfile", str(e))
+
+        # abspath squashes this
+        self.assertEqual(zp(extract_dir, "haha//root"),
+                         os.path.join(extract_dir, "haha", "root"))
+
+        e = self.assertRaises(ValueError, zp, extract_dir, "/etc/passwd")
+        self.assertIn("malicious zipfile", str(e))
+
+    def test_permissions(self):
+        src = io.BytesIO()
+        with zipfile.ZipFile(src, "w", zipfile.ZIP_DEFLATED) as zf:
+            zi = zipfile.ZipInfo("ok")
+            zi.external_attr = 0o751 << 16
+            zf.writestr(zi, b"data")
+        extract_dir = self.mktemp()
+        os.mkdir(extract_dir)
+        u = zipstream.ZipUnpacker(extract_dir)
+        u.write(src.getvalue())
+        self.assertTrue(u.finished)
+        fn = os.path.join(extract_dir, "ok")
+        self.assertEqual(stat.S_IMODE(os.stat(fn).st_mode), 0o751)
+
+    def make_receiver(self):
+        cfg = config("receive", "--accept-file")
+        cfg.cwd = self.mktemp()
+        os.mkdir(cfg.cwd)
+        cfg.stderr = io.StringIO()
+        return cmd_receive.Receiver(cfg)
+
+    def offer(self, **kwargs):
+        d = {"mode": "zipfile/deflated", "dirname": "dir", "zipsize": 100,
+             "numbytes": 10, "numfiles": 1}
+        d.update(kwargs)
+        return {"directory": d}
+
+    def test_streamable(self):
+        r = self.make_receiver()
+        f = r._handle_directory(self.offer(streamable=True))
+        self.assertIsInstance(f, zipstream.ZipUnpacker)
+        f.close()
+
+    def test_unstreamable(self):
+        # zipfiles from other senders may use data descriptors, which the
+        # streaming unpacker can't handle for stored members, so they are
+        # spooled and unzipped at the end
+        r = self.make_receiver()
+        f = r._handle_directory(self.offer())
+        self.assertNotIsInstance(f, zipstream.ZipUnpacker)
+        self.assertEqual(os.listdir(r.args.cwd), [])
+
+        src = Unstreamable()
+        with zipfile.ZipFile(src, "w", zipfile.ZIP_STORED) as zf:
+            zi = zipfile.ZipInfo("sub/ok")
+            zi.external_attr = 0o640 << 16
+            zf.writestr(zi, b"data")
+        f.write(src.data.getvalue())
+        r._write_directory(f)
+        fn = os.path.join(r.args.cwd, "dir", "sub", "ok")
+        with open(fn, "rb") as f:
+            self.assertEqual(f.read(), b"data")
+        self.assertEqual(stat.S_IMODE(os.stat(fn).st_mode), 0o640)
+
+    def partial_zip(self):
+        src = io.BytesIO()
+        with zipfile.ZipFile(src, "w", zipfile.ZIP_STORED) as zf:
+            zf.writestr(zipfile.ZipInfo("a"), b"x"*100)
+        # the local header, and the start of the file's contents
+        return src.getvalue()[:60]
+
+    def start_transfer(self, them_d, partial, transfer):
+        # the transfer delivers part of the archive, and then 'transfer'
+        # decides how it ends
+        r = self.make_receiver()
+        r._send_data = lambda data, w: None
+        r._establish_transit = lambda: succeed(None)
+        def _transfer_data(rp, f):
+            f.write(partial)
+            return transfer
+        r._transfer_data = _transfer_data
+        return r, r._parse_offer(them_d, None)
+
+    def test_failed_transfer_removes_tmpdir(self):
+        stream = (dirstream.build_header({"type": "file", "path": "a",
+                                          "size": 100, "mode": 0o644})
+                  + b"x"*10)
+        for them_d, partial in [
+                (self.offer(streamable=True), self.partial_zip()),
+                (self.offer(mode=dirstream.MODE, streamsize=100), stream)]:
+            r, d = self.start_transfer(them_d, partial,
+                                       fail(TransferError("oops")))
+            self.failureResultOf(d, TransferError)
+            self.assertEqual(os.listdir(r.args.cwd), [])
+
+    def test_cancelled_transfer_removes_tmpdir(self):
+        r, d = self.start_transfer(self.offer(streamable=True),
+                                   self.partial_zip(), Deferred())
+        tmpdirs = os.listdir(r.args.cwd)
+        self.assertEqual(len(tmpdirs), 1)
+        self.assertEqual(os.listdir(os.path.join(r.args.cwd, tmpdirs[0])),
+                         ["a"])
+        d.cancel()
+        self.failureResultOf(d, CancelledError)
+        self.assertEqual(os.listdir(r.args.cwd), [])
+
 class AppID(ServerBase, unittest.TestCase):
     def setUp(self):
         d = super(AppID, self).setUp()
@@ -1182,6 +1688,11 @@ class FakeConfig(object):
     allow_list = False
     relay_database_path = "relay.sqlite"
     stats_json_path = "stats.json"
+    storage = "sqlite"
+    write_behind = True
+    group_commit = None
+    wal = False
+    synchronous = None
 
 
 class Server(unittest.TestCase):
@@ -1,7 +1,9 @@
 from __future__ import print_function, unicode_literals
-import os
+import os, sqlite3
 from twisted.trial import unittest
-from ..server.database import get_db, TARGET_VERSION, dump_db
+from twisted.internet import task
+from ..server.database import (get_db, TARGET_VERSION, dump_db, DBError,
+                               GroupCommitter)
 
 class DB(unittest.TestCase):
     def test_create_default(self):
@@ -50,3 +52,128 @@ class DB(unittest.TestCase):
             with open("new.sql","w") as f: f.write(latest_text)
             # check with "diff -u _trial_temp/up.sql _trial_temp/new.sql"
             self.assertEqual(dbA_text, latest_text)
+
+    def test_upgrade_from_v3(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "upgrade.db")
+        db = get_db(fn, 3)
+        db.execute("INSERT INTO `mailboxes` (`app_id`, `id`) VALUES (?,?)",
+                   ("appid", "mid"))
+        npid = db.execute("INSERT INTO `nameplates`"
+                          " (`app_id`, `name`, `mailbox_id`) VALUES (?,?,?)",
+                          ("appid", "1", "mid")).lastrowid
+        for i in range(2):
+            db.execute("INSERT INTO `nameplate_sides`"
+                       " (`nameplates_id`, `claimed`, `side`, `added`)"
+                       " VALUES (?,?,?,?)", (npid, True, "side1", i))
+            db.execute("INSERT INTO `mailbox_sides`"
+                       " (`mailbox_id`, `opened`, `side`, `added`)"
+                       " VALUES (?,?,?,?)", ("mid", True, "side1", i))
+        db.commit()
+        db.close()
+
+        db = get_db(fn, TARGET_VERSION)
+        # the duplicate sides are gone, and the first one is kept
+        rows = db.execute("SELECT * FROM `nameplate_sides`").fetchall()
+        self.assertEqual([(r["nameplates_id"], r["added"]) for r in rows],
+                         [(npid, 0)])
+        rows = db.execute("SELECT * FROM `mailbox_sides`").fetchall()
+        self.assertEqual([r["added"] for r in rows], [0])
+        QueryPlans.check_plans(self, db)
+
+    def test_wal(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "wal.db")
+        db = get_db(fn, wal=True, synchronous="normal")
+        mode = db.execute("PRAGMA journal_mode").fetchone()["journal_mode"]
+        self.assertEqual(mode, "wal")
+        sync = db.execute("PRAGMA synchronous").fetchone()["synchronous"]
+        self.assertEqual(sync, 1) # NORMAL
+        db.close()
+        self.assertRaises(DBError, get_db, ":memory:", synchronous="sometimes")
+
+class QueryPlans(unittest.TestCase):
+    # the queries that each client command makes, which should look rows up
+    # in an index rather than scanning the whole table (foreign-key checks
+    # show up in the plans for DELETE too)
+    QUERIES = [
+        "SELECT * FROM `nameplates` WHERE `app_id`=? AND `name`=?",
+        "SELECT * FROM `nameplate_sides` WHERE `nameplates_id`=? AND `side`=?",
+        "SELECT * FROM `nameplate_sides` WHERE `nameplates_id`=?",
+        "UPDATE `nameplate_sides` SET `claimed`=?"
+        " WHERE `nameplates_id`=? AND `side`=?",
+        "DELETE FROM `nameplate_sides` WHERE `nameplates_id`=?",
+        "DELETE FROM `nameplates` WHERE `id`=?",
+        "SELECT * FROM `mailboxes` WHERE `app_id`=? AND `id`=?",
+        "UPDATE `mailboxes` SET `updated`=? WHERE `id`=?",
+        "SELECT * FROM `mailbox_sides` WHERE `mailbox_id`=? AND `side`=?",
+        "SELECT * FROM `mailbox_sides` WHERE `mailbox_id`=?",
+        "UPDATE `mailbox_sides` SET `opened`=?, `mood`=?"
+        " WHERE `mailbox_id`=? AND `side`=?",
+        "SELECT * FROM `messages` WHERE `app_id`=? AND `mailbox_id`=?"
+        " ORDER BY `server_rx` ASC",
+        "DELETE FROM `messages` WHERE `app_id`=? AND `mailbox_id`=?",
+        "DELETE FROM `mailbox_sides` WHERE `mailbox_id`=?",
+        "DELETE FROM `mailboxes` WHERE `id`=?",
+        # and pruning
+        "SELECT `app_id`, `id` FROM `mailboxes` WHERE `updated` <= ?"
+        " ORDER BY `updated` LIMIT ?",
+        "SELECT `id`, `name` FROM `nameplates`"
+        " WHERE `app_id`=? AND `mailbox_id`=?",
+        ]
+
+    @staticmethod
+    def check_plans(testcase, db):
+        for query in QueryPlans.QUERIES:
+            args = ("x",) * query.count("?")
+            plan = [row["detail"] for row in
+                    db.execute("EXPLAIN QUERY PLAN " + query, args)]
+            testcase.assertNotEqual(plan, [], query)
+            for step in plan:
+                testcase.assertFalse(step.startswith("SCAN"), (query, plan))
+
+    def test_indexed(self):
+        self.check_plans(self, get_db(":memory:"))
+
+    def test_unique_sides(self):
+        db = get_db(":memory:")
+        db.execute("INSERT INTO `mailboxes` (`app_id`, `id`) VALUES (?,?)",
+                   ("appid", "mid"))
+        db.execute("INSERT INTO `mailbox_sides` (`mailbox_id`, `side`)"
+                   " VALUES (?,?)", ("mid", "side1"))
+        self.assertRaises(sqlite3.IntegrityError, db.execute,
+                          "INSERT INTO `mailbox_sides` (`mailbox_id`, `side`)"
+                          " VALUES (?,?)", ("mid", "side1"))
+
+class GroupCommit(unittest.TestCase):
+    def test_commit(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "group.db")
+        clock = task.Clock()
+        db = GroupCommitter(get_db(fn), 0.005, clock)
+        other = get_db(fn) # sees only what has been committed
+        def count():
+            return other.execute("SELECT COUNT() FROM `transit_usage`"
+                                 ).fetchone()["COUNT()"]
+        for i in range(3):
+            db.execute("INSERT INTO `transit_usage` (`started`) VALUES (?)",
+                       (i,))
+            db.commit()
+        # we see our own writes straight away
+        self.assertEqual(db.execute("SELECT COUNT() FROM `transit_usage`"
+                                    ).fetchone()["COUNT()"], 3)
+        self.assertEqual(count(), 0)
+        clock.advance(0.005)
+        self.assertEqual(count(), 3)
+        self.assertEqual(db.get_stats(), {"commit_requests": 3,
+                                          "commits": 1})
+
+        db.execute("INSERT INTO `transit_usage` (`started`) VALUES (3)")
+        db.commit()
+        db.close() # commits anything that is waiting
+        self.assertEqual(count(), 4)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertEqual(db.commits, 2)
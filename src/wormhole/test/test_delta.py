@@ -0,0 +1,132 @@
+from __future__ import print_function, unicode_literals
+import os, io, random, hashlib
+from twisted.trial import unittest
+from ..cli import delta
+from ..util import bytes_to_dict
+
+BLOCK = delta.MIN_BLOCK_SIZE
+
+class Delta(unittest.TestCase):
+    def transfer(self, old, new, chunksize=1000):
+        old_fn = self.mktemp()
+        with open(old_fn, "wb") as f:
+            f.write(old)
+        signatures = delta.file_signatures(old_fn, BLOCK)
+        # what goes over the wire
+        records = list(delta.signature_records(signatures, BLOCK))
+        header = bytes_to_dict(records[0])
+        self.assertEqual(header, {"block-size": BLOCK,
+                                  "blocks": len(signatures)})
+        signatures = delta.parse_signatures(b"".join(records[1:]),
+                                            header["blocks"])
+
+        hasher = hashlib.sha256()
+        new_f = io.BytesIO(new)
+        plan = delta.compute_delta(new_f, BLOCK, signatures, hasher)
+        self.assertEqual(hasher.digest(), hashlib.sha256(new).digest())
+        self.assertEqual(plan.copied_bytes + plan.literal_bytes, len(new))
+        stream = delta.DeltaStream(new_f, plan)
+        data = b""
+        while True:
+            chunk = stream.read(chunksize)
+            if not chunk:
+                break
+            data += chunk
+        self.assertEqual(len(data), stream.size)
+
+        out = io.BytesIO()
+        out.name = "out"
+        applier = delta.DeltaApplier(old_fn, out, BLOCK, len(signatures))
+        for i in range(0, len(data), chunksize):
+            applier.write(data[i:i+chunksize])
+        self.assertTrue(applier.finished)
+        self.assertEqual(out.getvalue(), new)
+        self.assertEqual(applier.hasher.digest(), hasher.digest())
+        applier.close()
+        return plan, data
+
+    def test_block_size(self):
+        self.assertEqual(delta.choose_block_size(0), delta.MIN_BLOCK_SIZE)
+        self.assertEqual(delta.choose_block_size(10**9), 32*1024)
+        self.assertEqual(delta.choose_block_size(10**15),
+                         delta.MAX_BLOCK_SIZE)
+
+    def test_unchanged(self):
+        old = os.urandom(10*BLOCK + 100)
+        plan, data = self.transfer(old, old)
+        self.assertEqual(plan.literal_bytes, 0)
+        # one run of copies, then the end
+        self.assertEqual(len(data), delta.COPY.size + 1)
+
+    def test_edits(self):
+        r = random.Random(1)
+        old = os.urandom(50*BLOCK + 1234)
+        new = bytearray(old)
+        new[3*BLOCK + 10] ^= 0xff # changed in place
+        new[20*BLOCK:20*BLOCK] = b"inserted" # shifts the rest
+        del new[40*BLOCK:40*BLOCK+100]
+        new += b"appended"
+        for chunksize in [1, 7, r.randint(100, 10000), 1024*1024]:
+            plan, data = self.transfer(old, bytes(new), chunksize)
+            # each edit costs about a block
+            self.assertLess(plan.literal_bytes, 4*BLOCK)
+            self.assertLess(len(data), 4*BLOCK + 1000)
+
+    def test_unrelated(self):
+        plan, data = self.transfer(os.urandom(5*BLOCK), os.urandom(5*BLOCK))
+        self.assertEqual(plan.copied_bytes, 0)
+
+    def test_empty(self):
+        self.transfer(b"", b"data")
+        self.transfer(b"data", b"")
+        self.transfer(b"", b"")
+
+    def test_search_budget(self):
+        self.patch(delta, "SEARCH_BUDGET", 0)
+        old = os.urandom(10*BLOCK)
+        plan, data = self.transfer(old, b"x" + old)
+        # without searching, nothing lines up again
+        self.assertEqual(plan.copied_bytes, 0)
+
+    def test_many_operations(self):
+        # a single write() holding lots of small operations, as a record of
+        # a delta with many scattered edits would
+        old_fn = self.mktemp()
+        old = os.urandom(BLOCK)
+        with open(old_fn, "wb") as f:
+            f.write(old)
+        ops = (delta.COPY.pack(delta.OP_COPY, 0, 1)
+               + delta.LITERAL.pack(delta.OP_LITERAL, 1) + b"x")
+        data = ops*10000 + delta.OP_END
+        for chunksize in [len(data), 1000, 7]:
+            out = io.BytesIO()
+            out.name = "out"
+            applier = delta.DeltaApplier(old_fn, out, BLOCK, 1)
+            for i in range(0, len(data), chunksize):
+                applier.write(data[i:i+chunksize])
+            self.assertTrue(applier.finished)
+            self.assertEqual(out.getvalue(), (old + b"x")*10000)
+            applier.close()
+
+    def test_bad_signatures(self):
+        self.assertRaises(delta.BadDelta, delta.parse_signatures, b"x"*19, 1)
+
+    def test_bad_delta(self):
+        old_fn = self.mktemp()
+        with open(old_fn, "wb") as f:
+            f.write(b"old")
+        def applier():
+            out = io.BytesIO()
+            out.name = "out"
+            return delta.DeltaApplier(old_fn, out, BLOCK, 1)
+        e = self.assertRaises(delta.BadDelta, applier().write, b"X")
+        self.assertIn("unknown delta operation", str(e))
+        e = self.assertRaises(delta.BadDelta, applier().write,
+                              delta.COPY.pack(delta.OP_COPY, 1, 1))
+        self.assertIn("no such block", str(e))
+        e = self.assertRaises(delta.BadDelta, applier().write,
+                              delta.OP_END + b"more")
+        self.assertIn("data after the end", str(e))
+        a = applier()
+        a.write(delta.LITERAL.pack(delta.OP_LITERAL, 10) + b"short")
+        self.assertFalse(a.finished)
@@ -0,0 +1,182 @@
+from __future__ import print_function, unicode_literals
+import os, stat
+from twisted.trial import unittest
+from ..cli import dirstream
+
+class Stream(unittest.TestCase):
+    def make_tree(self, files):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        entries = []
+        for name, data, mode in files:
+            fn = os.path.join(basedir, *name.split("/"))
+            if not os.path.isdir(os.path.dirname(fn)):
+                os.makedirs(os.path.dirname(fn))
+            with open(fn, "wb") as f:
+                f.write(data)
+            os.chmod(fn, mode)
+            entries.append(dirstream.file_entry(fn, name))
+        return entries
+
+    def unpack(self, data, chunksize):
+        outdir = self.mktemp()
+        os.mkdir(outdir)
+        u = dirstream.DirectoryUnpacker(outdir)
+        for i in range(0, len(data), chunksize):
+            u.write(data[i:i+chunksize])
+        u.close()
+        return outdir, u
+
+    def read_all(self, s, chunksize):
+        pieces = []
+        while True:
+            data = s.read(chunksize)
+            if not data:
+                break
+            pieces.append(data)
+        return b"".join(pieces)
+
+    def test_roundtrip(self):
+        files = [("a", b"first file", 0o644),
+                 ("empty", b"", 0o600),
+                 ("sub/dir/b", b"x"*100000, 0o755),
+                 ]
+        for chunksize in [1, 7, 1000, 1024*1024]:
+            s = dirstream.DirectoryStream(self.make_tree(files))
+            data = self.read_all(s, chunksize)
+            self.assertEqual(len(data), s.size)
+            self.assertEqual(s.changed, [])
+            outdir, u = self.unpack(data, chunksize)
+            self.assertTrue(u.finished)
+            self.assertEqual(u.numfiles, 3)
+            self.assertEqual(u.numbytes, 100010)
+            for name, contents, mode in files:
+                fn = os.path.join(outdir, *name.split("/"))
+                with open(fn, "rb") as f:
+                    self.assertEqual(f.read(), contents)
+                self.assertEqual(stat.S_IMODE(os.stat(fn).st_mode), mode)
+
+    def test_empty(self):
+        s = dirstream.DirectoryStream([])
+        data = self.read_all(s, 100)
+        self.assertEqual(len(data), s.size)
+        outdir, u = self.unpack(data, 100)
+        self.assertTrue(u.finished)
+        self.assertEqual(os.listdir(outdir), [])
+
+    def test_changed(self):
+        entries = self.make_tree([("shrinks", b"12345", 0o644),
+                                  ("grows", b"12345", 0o644),
+                                  ])
+        with open(entries[0].localfilename, "wb") as f:
+            f.write(b"12")
+        with open(entries[1].localfilename, "wb") as f:
+            f.write(b"123456789")
+        s = dirstream.DirectoryStream(entries)
+        data = self.read_all(s, 1000)
+        # we still send exactly what we promised
+        self.assertEqual(len(data), s.size)
+        self.assertEqual(s.changed, ["shrinks", "grows"])
+        outdir, u = self.unpack(data, 1000)
+        with open(os.path.join(outdir, "shrinks"), "rb") as f:
+            self.assertEqual(f.read(), b"12\x00\x00\x00")
+        with open(os.path.join(outdir, "grows"), "rb") as f:
+            self.assertEqual(f.read(), b"12345")
+
+    def test_unreadable(self):
+        self.assertRaises((OSError, IOError), dirstream.file_entry,
+                          os.path.join(self.mktemp(), "missing"), "missing")
+
+class Unpacker(unittest.TestCase):
+    def unpacker(self):
+        outdir = self.mktemp()
+        os.mkdir(outdir)
+        return dirstream.DirectoryUnpacker(outdir)
+
+    def file_header(self, path, size=0, mode=0o644):
+        return dirstream.build_header({"type": "file", "path": path,
+                                       "size": size, "mode": mode})
+
+    def test_safe_join(self):
+        base = os.path.abspath(self.mktemp())
+        self.assertEqual(dirstream.safe_join(base, "a/b"),
+                         os.path.join(base, "a", "b"))
+        for bad in ["", "../x", "a/../../x", "/etc/passwd", "a//b", "a/./b",
+                    "a/", ".."]:
+            self.assertRaises(dirstream.BadStream,
+                              dirstream.safe_join, base, bad)
+        if os.sep != "/":
+            self.assertRaises(dirstream.BadStream,
+                              dirstream.safe_join, base, "a%sb" % os.sep)
+
+    def test_escape(self):
+        u = self.unpacker()
+        e = self.assertRaises(dirstream.BadStream, u.write,
+                              self.file_header("../escaped"))
+        self.assertIn("bad path", str(e))
+        self.assertFalse(os.path.exists(os.path.join(u.extract_dir, "..",
+                                                     "escaped")))
+
+    def test_bad_headers(self):
+        for header in [dirstream.build_header({"type": "symlink"}),
+                       dirstream.build_header({"type": "file", "path": "a"}),
+                       dirstream.build_header({"type": "file", "path": "a",
+                                               "size": -1, "mode": 0}),
+                       dirstream.HEADER_LENGTH.pack(3) + b"{{{",
+                       dirstream.HEADER_LENGTH.pack(2**20),
+                       ]:
+            u = self.unpacker()
+            self.assertRaises(dirstream.BadStream, u.write, header)
+
+    def test_modes(self):
+        self.assertEqual(dirstream.safe_mode(0o644), 0o644)
+        self.assertEqual(dirstream.safe_mode(0o755), 0o755)
+        self.assertEqual(dirstream.safe_mode(0o000), 0o600)
+        self.assertEqual(dirstream.safe_mode(0o4755), 0o755) # setuid
+        self.assertEqual(dirstream.safe_mode(0o2755), 0o755) # setgid
+        self.assertEqual(dirstream.safe_mode(0o1777), 0o775) # sticky, o+w
+        u = self.unpacker()
+        u.write(self.file_header("suid", mode=0o6777)
+                + self.file_header("unreadable", mode=0))
+        for name, mode in [("suid", 0o775), ("unreadable", 0o600)]:
+            fn = os.path.join(u.extract_dir, name)
+            self.assertEqual(stat.S_IMODE(os.stat(fn).st_mode), mode)
+
+    def test_collision(self):
+        # a file where a directory has to go, or the other way around
+        for first, second in [("a", "a/b"), ("a/b", "a")]:
+            u = self.unpacker()
+            u.write(self.file_header(first))
+            e = self.assertRaises(dirstream.BadStream, u.write,
+                                  self.file_header(second))
+            self.assertIn("unable to create %r" % (second,), str(e))
+
+    def test_data_after_end(self):
+        u = self.unpacker()
+        end = dirstream.build_header({"type": "end"})
+        self.assertRaises(dirstream.BadStream, u.write, end + b"more")
+
+    def test_incomplete(self):
+        u = self.unpacker()
+        u.write(self.file_header("a", size=10) + b"12345")
+        u.close()
+        self.assertFalse(u.finished)
+
+    def test_many_files_in_one_write(self):
+        u = self.unpacker()
+        pieces = []
+        for i in range(500):
+            body = ("file %d" % i).encode("ascii")
+            pieces.append(self.file_header("f%d" % i, size=len(body)))
+            pieces.append(body)
+        data = b"".join(pieces)
+        # all but the last byte of the next header waits for more data
+        end = dirstream.build_header({"type": "end"})
+        u.write(data + end[:-1])
+        self.assertEqual(u.numfiles, 500)
+        self.assertEqual(u._buf, end[:-1])
+        u.write(end[-1:])
+        self.assertTrue(u.finished)
+        self.assertEqual(u._buf, b"")
+        with open(os.path.join(u.extract_dir, "f321"), "rb") as f:
+            self.assertEqual(f.read(), b"file 321")
@@ -0,0 +1,124 @@
+from __future__ import print_function, unicode_literals
+import os, io, hashlib
+from twisted.trial import unittest
+from ..cli import fanout
+
+class CountingFile(io.BytesIO):
+    def __init__(self, data):
+        io.BytesIO.__init__(self, data)
+        self.reads = 0
+    def read(self, size=-1):
+        self.reads += 1
+        return io.BytesIO.read(self, size)
+
+class Consumer:
+    def __init__(self):
+        self.records = []
+        self.producer = None
+    def registerProducer(self, producer, streaming):
+        assert not streaming
+        self.producer = producer
+    def unregisterProducer(self):
+        self.producer = None
+    def write(self, data):
+        self.records.append(data)
+    def pump(self, count=None):
+        while self.producer and count != 0:
+            self.producer.resumeProducing()
+            if count:
+                count -= 1
+
+class Cache(unittest.TestCase):
+    def test_read_once(self):
+        data = os.urandom(10*100 + 7)
+        f = CountingFile(data)
+        cache = fanout.BlockCache(f, len(data), 100)
+        self.assertEqual(cache.num_blocks, 11)
+        readers = ["r1", "r2", "r3"]
+        for r in readers:
+            cache.add_reader(r)
+        got = dict([(r, []) for r in readers])
+        for index in range(cache.num_blocks):
+            for r in readers:
+                got[r].append(cache.get(r, index))
+        for r in readers:
+            self.assertEqual(b"".join(got[r]), data)
+        self.assertEqual(f.reads, 11)
+        self.assertEqual(cache.rereads, 0)
+        self.assertEqual(cache.bytes_read, len(data))
+        self.assertEqual(cache.digest(), hashlib.sha256(data).digest())
+        # everyone has passed every block, so nothing is held
+        self.assertEqual(cache._blocks, {})
+
+    def test_holds_for_slowest(self):
+        data = os.urandom(1000)
+        cache = fanout.BlockCache(io.BytesIO(data), len(data), 100)
+        cache.add_reader("fast")
+        cache.add_reader("slow")
+        for index in range(5):
+            cache.get("fast", index)
+        self.assertEqual(sorted(cache._blocks), [0, 1, 2, 3, 4])
+        cache.get("slow", 0)
+        cache.get("slow", 1)
+        self.assertEqual(sorted(cache._blocks), [2, 3, 4])
+        cache.remove_reader("slow")
+        self.assertEqual(cache._blocks, {})
+
+    def test_limit(self):
+        data = os.urandom(1000)
+        f = CountingFile(data)
+        cache = fanout.BlockCache(f, len(data), 100, limit=300)
+        cache.add_reader("fast")
+        cache.add_reader("slow")
+        fast = [cache.get("fast", index) for index in range(10)]
+        self.assertEqual(b"".join(fast), data)
+        # the slow reader would need all of it, but we only keep 300 bytes
+        self.assertEqual(sorted(cache._blocks), [7, 8, 9])
+        slow = [cache.get("slow", index) for index in range(10)]
+        self.assertEqual(b"".join(slow), data)
+        self.assertEqual(cache.rereads, 7)
+        self.assertEqual(f.reads, 17)
+        self.assertEqual(cache.digest(), hashlib.sha256(data).digest())
+
+    def test_empty(self):
+        cache = fanout.BlockCache(io.BytesIO(b""), 0, 100)
+        self.assertEqual(cache.num_blocks, 0)
+        self.assertEqual(cache.digest(), hashlib.sha256(b"").digest())
+
+class Sender(unittest.TestCase):
+    def test_records(self):
+        data = os.urandom(1000)
+        cache = fanout.BlockCache(io.BytesIO(data), len(data), 400)
+        c1, c2 = Consumer(), Consumer()
+        d1 = fanout.BlockSender(cache, 400).beginTransfer(c1)
+        transformed = []
+        def transform(data):
+            transformed.append(data)
+            return data
+        d2 = fanout.BlockSender(cache, 150).beginTransfer(c2, transform)
+        c1.pump(1)
+        c2.pump()
+        c1.pump()
+        self.assertEqual(self.successResultOf(d1), 1000)
+        self.assertEqual(self.successResultOf(d2), 1000)
+        self.assertEqual([len(r) for r in c1.records], [400, 400, 200])
+        # records never span blocks
+        self.assertEqual([len(r) for r in c2.records],
+                         [150, 150, 100, 150, 150, 100, 150, 50])
+        self.assertEqual(b"".join(c1.records), data)
+        self.assertEqual(b"".join(c2.records), data)
+        self.assertEqual(c2.records, transformed)
+        self.assertEqual(cache.bytes_read, 1000)
+        self.assertEqual(cache._positions, {})
+
+    def test_stop(self):
+        data = os.urandom(1000)
+        cache = fanout.BlockCache(io.BytesIO(data), len(data), 100)
+        c = Consumer()
+        s = fanout.BlockSender(cache, 100)
+        d = s.beginTransfer(c)
+        c.pump(2)
+        s.stopProducing()
+        self.failureResultOf(d)
+        self.assertEqual(c.producer, None)
+        self.assertEqual(cache._positions, {})
@@ -0,0 +1,140 @@
+# no unicode_literals, ipaddrs uses native strings
+import ctypes, socket, struct
+import mock
+from twisted.trial import unittest
+from .. import ipaddrs
+
+IP_ADDR_OUTPUT = """\
+1: lo: <LOOPBACK,UP,LOWER_UP> mtu 65536 qdisc noqueue state UNKNOWN
+    link/loopback 00:00:00:00:00:00 brd 00:00:00:00:00:00
+    inet 127.0.0.1/8 scope host lo
+    inet6 ::1/128 scope host
+2: eth0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 state UP
+    link/ether 52:54:00:12:34:56 brd ff:ff:ff:ff:ff:ff
+    inet 192.168.1.10/24 brd 192.168.1.255 scope global eth0
+    inet6 2001:db8::10/64 scope global dynamic
+    inet6 fe80::5054:ff:fe12:3456/64 scope link
+"""
+
+IFCONFIG_OUTPUT = """\
+en0: flags=8863<UP,BROADCAST,SMART,RUNNING,SIMPLEX,MULTICAST> mtu 1500
+\tinet6 fe80::1c2b:3a4d:5e6f:7a8b%en0 prefixlen 64 secured scopeid 0x4
+\tinet 10.0.1.5 netmask 0xffffff00 broadcast 10.0.1.255
+\tinet6 2001:db8::5 prefixlen 64 autoconf secured
+eth1      Link encap:Ethernet  HWaddr 52:54:00:12:34:57
+          inet addr:10.0.2.15  Bcast:10.0.2.255  Mask:255.255.255.0
+          inet6 addr: fd00::15/64 Scope:Global
+"""
+
+class FindAddresses(unittest.TestCase):
+    def setUp(self):
+        self.patch(ipaddrs, "_cache", None)
+
+    def test_native(self):
+        addresses = ipaddrs._native_addresses()
+        if addresses is None:
+            raise unittest.SkipTest("no getifaddrs() here")
+        self.assertIn("127.0.0.1", addresses)
+        # IPv4 first
+        families = [":" in a for a in addresses]
+        self.assertEqual(families, sorted(families))
+        for a in addresses:
+            self.assertFalse(a.startswith("fe80:"), a)
+
+    def test_ipv6(self):
+        with mock.patch("wormhole.ipaddrs._native_addresses",
+                        return_value=["127.0.0.1", "10.0.0.1", "::1",
+                                      "fd00::1"]):
+            self.assertEqual(ipaddrs.find_addresses(),
+                             ["127.0.0.1", "10.0.0.1"])
+            self.assertEqual(ipaddrs.find_addresses(ipv6=True),
+                             ["127.0.0.1", "10.0.0.1", "::1", "fd00::1"])
+
+    def test_cache(self):
+        now = [1000.0]
+        self.patch(ipaddrs.time, "time", lambda: now[0])
+        native = mock.Mock(return_value=["10.0.0.1"])
+        with mock.patch("wormhole.ipaddrs._native_addresses", native):
+            self.assertEqual(ipaddrs.find_addresses(), ["10.0.0.1"])
+            native.return_value = ["10.0.0.2"]
+            now[0] += ipaddrs.CACHE_SECONDS - 1
+            self.assertEqual(ipaddrs.find_addresses(), ["10.0.0.1"])
+            now[0] += 2
+            self.assertEqual(ipaddrs.find_addresses(), ["10.0.0.2"])
+        self.assertEqual(len(native.mock_calls), 2)
+
+    def test_fallback(self):
+        with mock.patch("wormhole.ipaddrs._native_addresses",
+                        return_value=None):
+            with mock.patch("wormhole.ipaddrs._command_addresses",
+                            return_value=["10.0.0.3"]) as command:
+                self.assertEqual(ipaddrs.find_addresses(), ["10.0.0.3"])
+        self.assertEqual(len(command.mock_calls), 1)
+
+    def test_nothing(self):
+        with mock.patch("wormhole.ipaddrs._native_addresses",
+                        return_value=None):
+            with mock.patch("wormhole.ipaddrs._command_addresses",
+                            return_value=[]):
+                self.assertEqual(ipaddrs.find_addresses(), ["127.0.0.1"])
+
+    def query(self, output):
+        p = mock.Mock()
+        p.communicate.return_value = (output, "")
+        with mock.patch("subprocess.Popen", return_value=p):
+            return ipaddrs._query("/bin/ip", ("addr",), ipaddrs._addr_re)
+
+    def test_parse_ip_addr(self):
+        self.assertEqual(self.query(IP_ADDR_OUTPUT),
+                         ["127.0.0.1", "192.168.1.10", "::1", "2001:db8::10"])
+
+    def test_parse_ifconfig(self):
+        self.assertEqual(self.query(IFCONFIG_OUTPUT),
+                         ["10.0.1.5", "10.0.2.15", "2001:db8::5", "fd00::15"])
+
+    def test_link_local(self):
+        self.assertTrue(ipaddrs._is_link_local("fe80::1"))
+        self.assertTrue(ipaddrs._is_link_local("FEBF::1"))
+        self.assertFalse(ipaddrs._is_link_local("fec0::1"))
+        self.assertFalse(ipaddrs._is_link_local("fe8::1"))
+        self.assertFalse(ipaddrs._is_link_local("10.0.0.1"))
+
+    def sockaddr(self, family, rest):
+        if ipaddrs.platform.startswith("linux"):
+            head = struct.pack("=H", family)
+        else:
+            head = struct.pack("=BB", 2+len(rest), family)
+        return ctypes.create_string_buffer(head + rest, 2+len(rest))
+
+    def test_sockaddr_sizes(self):
+        # only read as many bytes as that kind of sockaddr has
+        sizes = []
+        string_at = ctypes.string_at
+        def _string_at(addr, size):
+            sizes.append(size)
+            return string_at(addr, size)
+        self.patch(ipaddrs.ctypes, "string_at", _string_at)
+
+        sa = self.sockaddr(socket.AF_INET,
+                           b"\x00\x00" + socket.inet_aton("10.0.0.1")
+                           + b"\x00"*8)
+        self.assertEqual(ipaddrs._sockaddr_to_address(ctypes.addressof(sa)),
+                         "10.0.0.1")
+        self.assertEqual(sizes, [2, 16])
+
+        if hasattr(socket, "inet_pton") and hasattr(socket, "AF_INET6"):
+            del sizes[:]
+            sa = self.sockaddr(socket.AF_INET6,
+                               b"\x00"*6
+                               + socket.inet_pton(socket.AF_INET6, "fd00::1")
+                               + b"\x00"*4)
+            self.assertEqual(
+                ipaddrs._sockaddr_to_address(ctypes.addressof(sa)), "fd00::1")
+            self.assertEqual(sizes, [2, 28])
+
+        # a short address of some other family
+        del sizes[:]
+        sa = self.sockaddr(255, b"")
+        self.assertEqual(ipaddrs._sockaddr_to_address(ctypes.addressof(sa)),
+                         None)
+        self.assertEqual(sizes, [2])
@@ -1392,12 +1392,12 @@ class Rendezvous(unittest.TestCase):
                                              "side", reactor,
                                              journal, tor_manager,
                                              timing.DebugTiming())
-        b = Dummy("b", events, IBoss, "error")
+        b = Dummy("b", events, IBoss, "error", "rx_welcome")
         n = Dummy("n", events, INameplate, "connected", "lost")
-        m = Dummy("m", events, IMailbox, "connected", "lost")
+        m = Dummy("m", events, IMailbox, "connected", "lost", "rx_message")
         a = Dummy("a", events, IAllocator, "connected", "lost")
         l = Dummy("l", events, ILister, "connected", "lost")
-        t = Dummy("t", events, ITerminator)
+        t = Dummy("t", events, ITerminator, "stopped")
         rc.wire(b, n, m, a, l, t)
         return rc, events
 
@@ -1441,7 +1441,7 @@ class Rendezvous(unittest.TestCase):
                 yield bytes_to_dict(c[1][0])
         self.assertEqual(list(sent_messages(ws)),
                          [dict(appid="appid", side="side", id="0000",
-                               type="bind"),
+                               encoding="base64", type="bind"),
                           ])
 
         rc.ws_close(True, None, None)
@@ -1451,6 +1451,48 @@ class Rendezvous(unittest.TestCase):
                                   ("a.lost", ),
                                   ])
 
+    def test_encoding(self):
+        rc, events = self.build()
+        ws = mock.Mock()
+        rc.ws_open(ws)
+        def last_sent():
+            return bytes_to_dict(ws.mock_calls[-1][1][0])
+        # until the welcome says otherwise, bodies go out as hex
+        rc.tx_add("phase", b"\xff\x00")
+        self.assertEqual(last_sent()["body"], "ff00")
+        self.assertNotIn("encoding", last_sent())
+        rc.ws_message(dict_to_bytes(dict(type="welcome", welcome={},
+                                         encodings=["hex", "base64"])))
+        rc.tx_add("phase", b"\xff\x00")
+        self.assertEqual(last_sent()["body"], "/wA=")
+        self.assertEqual(last_sent()["encoding"], "base64")
+
+        events[:] = []
+        rc.ws_message(dict_to_bytes(dict(type="message", side="side2",
+                                         phase="1", body="/wA=",
+                                         encoding="base64")))
+        rc.ws_message(dict_to_bytes(dict(type="message", side="side2",
+                                         phase="2", body="ff00")))
+        self.assertEqual(events, [("m.rx_message", "side2", "1", b"\xff\x00"),
+                                  ("m.rx_message", "side2", "2", b"\xff\x00"),
+                                  ])
+
+        # a new connection starts with hex again
+        rc.ws_close(True, None, None)
+        rc.ws_open(ws)
+        rc.tx_add("phase", b"\xff\x00")
+        self.assertEqual(last_sent()["body"], "ff00")
+
+        rc.stop()
+        traffic = [e for e in rc._timing._events if e._name == "ws_traffic"]
+        self.assertEqual(len(traffic), 1)
+        d = traffic[0]._details
+        self.assertEqual(d["body_sent"], 4+4+4)
+        self.assertEqual(d["body_received"], 4+4)
+        self.assertEqual(d["sent"], sum([len(c[1][0]) for c in ws.mock_calls
+                                         if c[0] == "sendMessage"]))
+        self.assertTrue(d["received"] > d["body_received"])
+
 
 
 # TODO
@@ -0,0 +1,174 @@
+from __future__ import print_function, unicode_literals
+import os
+from twisted.trial import unittest
+from ..server.rendezvous_memory import MemoryRendezvous
+from ..server.rendezvous import SidedMessage, CrowdedError
+from ..server.database import get_db
+from . import test_server
+
+# the sqlite tests look at the database, so the memory storage runs them too,
+# with a flush first
+
+class _Flush:
+    def _nameplate(self, app, name):
+        app._writer.flush()
+        return test_server._Util._nameplate(self, app, name)
+
+    def _mailbox(self, app, mailbox_id):
+        app._writer.flush()
+        return test_server._Util._mailbox(self, app, mailbox_id)
+
+    def _messages(self, app):
+        app._writer.flush()
+        return test_server._Util._messages(self, app)
+
+class MemoryServer(_Flush, test_server.Server):
+    storage = "memory"
+
+class MemoryWebSocketAPI(_Flush, test_server.WebSocketAPI):
+    storage = "memory"
+
+class MemoryPrune(test_server.Prune):
+    def make_rendezvous(self, db, blur_usage):
+        return MemoryRendezvous(db, None, blur_usage, True)
+
+    def _get_mailbox_updated(self, app, mbox_id):
+        app._writer.flush()
+        return test_server.Prune._get_mailbox_updated(self, app, mbox_id)
+
+class WriteBehind(unittest.TestCase):
+    def _count(self, db, table):
+        return db.execute("SELECT COUNT() FROM `%s`" % table
+                          ).fetchone()["COUNT()"]
+
+    def test_restart(self):
+        basedir = self.mktemp()
+        os.mkdir(basedir)
+        fn = os.path.join(basedir, "relay.sqlite")
+        db = get_db(fn)
+        rv = MemoryRendezvous(db, None, None, True)
+        app = rv.get_app("appid")
+        mailbox_id = app.claim_nameplate("1", "side1", 1)
+        mb = app.open_mailbox(mailbox_id, "side1", 1)
+        mb.add_message(SidedMessage("side1", "pake", "body1", 2, "msg1"))
+        mb.add_message(SidedMessage("side1", "version", "body2", 3, "msg2"))
+        # this leaves its mailbox open
+        app.claim_nameplate("2", "side1", 4)
+        app.release_nameplate("2", "side1", 5)
+        app.open_mailbox("standalone", "side1", 6).close("side1", "lonely", 7)
+        # nothing is written until we flush
+        self.assertEqual(self._count(db, "nameplates"), 0)
+        self.assertEqual(self._count(db, "messages"), 0)
+        rv.flush()
+        self.assertEqual(self._count(db, "nameplates"), 1)
+        self.assertEqual(self._count(db, "messages"), 2)
+        self.assertEqual(self._count(db, "nameplate_usage"), 1)
+        self.assertEqual(self._count(db, "mailbox_usage"), 1)
+        self.assertEqual(rv._writer.flushes, 1)
+        rv.flush() # nothing has changed
+        self.assertEqual(rv._writer.flushes, 1)
+        db.close()
+
+        db = get_db(fn)
+        rv = MemoryRendezvous(db, None, None, True)
+        app = rv.get_app("appid")
+        self.assertEqual(app.get_nameplate_ids(), set(["1"]))
+        self.assertEqual(rv.get_all_apps(), set(["appid"]))
+        self.assertEqual(app.claim_nameplate("1", "side2", 8), mailbox_id)
+        mb = app.open_mailbox(mailbox_id, "side2", 8)
+        self.assertEqual([sm.msg_id for sm in mb.get_messages()],
+                         ["msg1", "msg2"])
+        self.assertEqual(mb._sides["side1"]["added"], 1)
+        # side1 had claimed it before the restart
+        self.assertRaises(CrowdedError, app.claim_nameplate, "1",
+                          "side3", 9)
+        stats = rv.get_stats()
+        self.assertEqual(stats["active"], {"apps": 1,
+                                           "nameplates_total": 1,
+                                           "mailboxes_total": 2,
+                                           "messages_total": 2})
+
+    def test_incremental(self):
+        db = get_db(":memory:")
+        rv = MemoryRendezvous(db, None, None, True)
+        app = rv.get_app("appid")
+        mailbox_id = app.claim_nameplate("1", "side1", 1)
+        mb = app.open_mailbox(mailbox_id, "side1", 1)
+        mb.add_message(SidedMessage("side1", "pake", "body1", 2, "msg1"))
+        rv.flush()
+        def ids(table):
+            return [row["rowid"] for row in
+                    db.execute("SELECT `rowid` FROM `%s` ORDER BY `rowid`"
+                               % table).fetchall()]
+        messages = ids("messages")
+        mailbox_sides = ids("mailbox_sides")
+        nameplate_sides = ids("nameplate_sides")
+        self.assertEqual(len(messages), 1)
+
+        # a flush only adds what is new, and leaves the rest alone
+        app.claim_nameplate("1", "side2", 3)
+        mb.add_message(SidedMessage("side2", "pake", "body2", 4, "msg2"))
+        rv.flush()
+        self.assertEqual(ids("messages")[:1], messages)
+        self.assertEqual(self._count(db, "messages"), 2)
+        self.assertEqual(ids("mailbox_sides")[:1], mailbox_sides)
+        self.assertEqual(self._count(db, "mailbox_sides"), 2)
+        self.assertEqual(ids("nameplate_sides")[:1], nameplate_sides)
+        self.assertEqual(self._count(db, "nameplate_sides"), 2)
+        row = db.execute("SELECT `updated` FROM `mailboxes`").fetchone()
+        self.assertEqual(row["updated"], 4)
+
+        app.release_nameplate("1", "side1", 5)
+        mb.close("side1", "happy", 5)
+        rv.flush()
+        self.assertEqual(self._count(db, "messages"), 2)
+        row = db.execute("SELECT `opened`, `mood` FROM `mailbox_sides`"
+                         " WHERE `side`='side1'").fetchone()
+        self.assertEqual((row["opened"], row["mood"]), (0, "happy"))
+        row = db.execute("SELECT `claimed` FROM `nameplate_sides`"
+                         " WHERE `side`='side1'").fetchone()
+        self.assertEqual(row["claimed"], 0)
+
+        # pruning deletes the rows
+        app.prune_mailbox(mailbox_id, 10)
+        rv.flush()
+        for table in ["nameplates", "nameplate_sides", "mailboxes",
+                      "mailbox_sides", "messages"]:
+            self.assertEqual(self._count(db, table), 0, table)
+
+    def test_closed_before_released(self):
+        db = get_db(":memory:")
+        rv = MemoryRendezvous(db, None, None, True)
+        app = rv.get_app("appid")
+        mailbox_id = app.claim_nameplate("1", "side1", 1)
+        rv.flush()
+        # the mailbox goes, but the nameplate is still claimed
+        app.open_mailbox(mailbox_id, "side1", 2).close("side1", "happy", 3)
+        rv.flush()
+        self.assertEqual(self._count(db, "mailboxes"), 0)
+        self.assertEqual(self._count(db, "nameplates"), 0)
+        self.assertEqual(app.get_nameplate_ids(), set(["1"]))
+        app.release_nameplate("1", "side1", 4)
+        rv.flush()
+        self.assertEqual(self._count(db, "nameplate_usage"), 1)
+
+    def test_no_write_behind(self):
+        db = get_db(":memory:")
+        rv = MemoryRendezvous(db, None, None, True)
+        rv.get_app("appid").claim_nameplate("1", "side1", 1)
+        rv.flush()
+        self.assertEqual(self._count(db, "nameplates"), 1)
+
+        # without the write-behind, old state is stale, so it is dropped
+        rv = MemoryRendezvous(db, None, None, True, write_behind=False)
+        self.assertEqual(self._count(db, "nameplates"), 0)
+        self.assertEqual(self._count(db, "mailboxes"), 0)
+        app = rv.get_app("appid")
+        self.assertEqual(app.get_nameplate_ids(), set())
+        app.claim_nameplate("2", "side1", 2)
+        app.claim_nameplate("3", "side1", 3)
+        app.release_nameplate("3", "side1", 4)
+        rv.flush()
+        # usage records are still written
+        self.assertEqual(self._count(db, "nameplates"), 0)
+        self.assertEqual(self._count(db, "nameplate_usage"), 1)
@@ -0,0 +1,126 @@
+from __future__ import print_function, unicode_literals
+import os, io, json, hashlib
+from twisted.trial import unittest
+from ..cli import resume
+
+def sha(data):
+    return hashlib.sha256(data).hexdigest()
+
+class Checkpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmp_fn = os.path.abspath(self.mktemp()) + ".tmp"
+
+    def write(self, f, cp, data):
+        # what ThreadedFileConsumer does
+        f.write(data)
+        cp.update(data)
+
+    def test_roundtrip(self):
+        with open(self.tmp_fn, "wb") as f:
+            cp = resume.Checkpoint(f, 100)
+            self.write(f, cp, b"a"*30)
+            cp.save()
+        self.assertEqual(resume.load_segments(self.tmp_fn, 100),
+                         [(30, sha(b"a"*30))])
+        # the offered file must be the same size
+        self.assertEqual(resume.load_segments(self.tmp_fn, 99), None)
+
+        # a second attempt adds a segment
+        segments = resume.load_segments(self.tmp_fn, 100)
+        with open(self.tmp_fn, "r+b") as f:
+            f.seek(30)
+            cp = resume.Checkpoint(f, 100, segments)
+            self.assertEqual(cp.offset, 30)
+            self.write(f, cp, b"b"*20)
+            self.assertEqual(cp.hasher.hexdigest(), sha(b"b"*20))
+            cp.save()
+        self.assertEqual(resume.load_segments(self.tmp_fn, 100),
+                         [(30, sha(b"a"*30)), (20, sha(b"b"*20))])
+        with open(self.tmp_fn, "rb") as f:
+            self.assertTrue(resume.hash_segments(
+                f, resume.load_segments(self.tmp_fn, 100)))
+
+        cp.remove()
+        self.assertFalse(os.path.exists(resume.checkpoint_name(self.tmp_fn)))
+        self.assertEqual(resume.load_segments(self.tmp_fn, 100), None)
+
+    def test_interval(self):
+        self.patch(resume, "CHECKPOINT_INTERVAL", 10)
+        with open(self.tmp_fn, "wb") as f:
+            cp = resume.Checkpoint(f, 100)
+            self.write(f, cp, b"a"*5)
+            self.assertEqual(resume.load_segments(self.tmp_fn, 100), None)
+            self.write(f, cp, b"a"*5)
+            # saved without being asked, and the data was flushed first
+            self.assertEqual(resume.load_segments(self.tmp_fn, 100),
+                             [(10, sha(b"a"*10))])
+
+    def test_restart(self):
+        with open(self.tmp_fn, "wb") as f:
+            f.write(b"old")
+        with open(self.tmp_fn, "r+b") as f:
+            f.seek(3)
+            cp = resume.Checkpoint(f, 100, [(3, sha(b"old"))])
+            cp.restart()
+            self.assertEqual(cp.offset, 0)
+            self.write(f, cp, b"new!")
+            cp.save()
+        with open(self.tmp_fn, "rb") as f:
+            self.assertEqual(f.read(), b"new!")
+        self.assertEqual(resume.load_segments(self.tmp_fn, 100),
+                         [(4, sha(b"new!"))])
+
+    def test_restart_then_save(self):
+        # bytes written before a restart don't count towards the next
+        # automatic save
+        self.patch(resume, "CHECKPOINT_INTERVAL", 10)
+        with open(self.tmp_fn, "wb") as f:
+            cp = resume.Checkpoint(f, 100)
+            self.write(f, cp, b"a"*8)
+            cp.save()
+            cp.restart()
+            # the old checkpoint no longer describes the file
+            self.assertEqual(resume.load_segments(self.tmp_fn, 100), None)
+            self.write(f, cp, b"b"*5)
+            self.assertEqual(resume.load_segments(self.tmp_fn, 100), None)
+            self.write(f, cp, b"b"*5)
+            self.assertEqual(resume.load_segments(self.tmp_fn, 100),
+                             [(10, sha(b"b"*10))])
+
+    def test_unusable(self):
+        with open(self.tmp_fn, "wb") as f:
+            f.write(b"short")
+        cp_fn = resume.checkpoint_name(self.tmp_fn)
+        for cp in [b"not json",
+                   json.dumps([]).encode("ascii"),
+                   json.dumps({"filesize": 100}).encode("ascii"),
+                   json.dumps({"filesize": 100, "segments": []})
+                   .encode("ascii"),
+                   json.dumps({"filesize": 100, "segments": [[0, "x"]]})
+                   .encode("ascii"),
+                   # claims more than the .tmp holds
+                   json.dumps({"filesize": 100, "segments": [[6, "x"]]})
+                   .encode("ascii"),
+                   # more than the whole file
+                   json.dumps({"filesize": 3, "segments": [[4, "x"]]})
+                   .encode("ascii"),
+                   ]:
+            with open(cp_fn, "wb") as f:
+                f.write(cp)
+            self.assertEqual(resume.load_segments(self.tmp_fn, 100), None)
+        os.unlink(self.tmp_fn)
+        self.assertEqual(resume.load_segments(self.tmp_fn, 100), None)
+
+    def test_hash_segments(self):
+        data = b"a"*10 + b"b"*10
+        good = [(10, sha(b"a"*10)), (10, sha(b"b"*10))]
+        self.assertTrue(resume.hash_segments(io.BytesIO(data), good))
+        self.assertFalse(resume.hash_segments(io.BytesIO(data[:15]), good))
+        bad = [(10, sha(b"a"*10)), (10, sha(b"c"*10))]
+        self.assertFalse(resume.hash_segments(io.BytesIO(data), bad))
+
+    def test_parse_segments(self):
+        self.assertEqual(resume.parse_segments([[1, "ab"]]), [(1, "ab")])
+        for bad in [None, "x", [[1]], [["1", "ab"]], [[-1, "ab"]],
+                    [[1, 2]]]:
+            self.assertEqual(resume.parse_segments(bad), None)
@@ -3,11 +3,12 @@ import os, json, itertools, time
 import mock
 from twisted.trial import unittest
 from twisted.python import log
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, task
+from twisted.application import service, internet
 from twisted.internet.defer import inlineCallbacks, returnValue
 from autobahn.twisted import websocket
 from .common import ServerBase
-from ..server import server, rendezvous
+from ..server import server, rendezvous, rendezvous_websocket, database
 from ..server.rendezvous import Usage, SidedMessage
 from ..server.database import get_db
 
@@ -73,6 +74,20 @@ class Server(_Util, ServerBase, unittest.TestCase):
         biggest = max(nids)
         self.assert_(1000 <= biggest < 1000000, biggest)
 
+    def test_nameplate_reuse(self):
+        app = self._rendezvous.get_app("appid")
+        # someone else claims "3" before the allocator has been built
+        app.claim_nameplate("3", "other", 0)
+        names = [app.allocate_nameplate("side%d" % i, 0) for i in range(8)]
+        self.assertEqual(set(names + ["3"]), set(["%d" % i
+                                                  for i in range(1,10)]))
+        # a released nameplate goes back into the pool
+        app.release_nameplate(names[0], "side0", 1)
+        self.assertEqual(app.allocate_nameplate("side0b", 2), names[0])
+        self.assertEqual(len(app.allocate_nameplate("side9", 3)), 2)
+        app.release_nameplate("3", "other", 4)
+        self.assertEqual(app.allocate_nameplate("other2", 5), "3")
+
     def test_nameplate(self):
         app = self._rendezvous.get_app("appid")
         name = app.allocate_nameplate("side1", 0)
@@ -290,8 +305,37 @@ class Server(_Util, ServerBase, unittest.TestCase):
         self.assertEqual(len(msgs), 5)
         self.assertEqual(msgs[-1]["body"], "body")
 
+class NameplateAllocator(unittest.TestCase):
+    def test_allocate(self):
+        a = rendezvous.NameplateAllocator(["1", "2", "4", "hello", "0"])
+        self.assertIn(a.allocate(), set(["3", "5", "6", "7", "8", "9"]))
+        for name in ["3", "5", "6", "7", "8"]:
+            a.claimed(name)
+        self.assertEqual(a.allocate(), "9")
+        a.claimed("9")
+        self.assertEqual(len(a.allocate()), 2)
+        # released twice, or never claimed: no harm done
+        a.released("4")
+        a.released("4")
+        a.released("007")
+        self.assertEqual(a.allocate(), "4")
+        a.claimed("4")
+        a.claimed("4")
+        a.released("4")
+        self.assertEqual(a.allocate(), "4")
+
+    def test_full(self):
+        a = rendezvous.NameplateAllocator(["%d" % i for i in range(1,1000)])
+        name = a.allocate()
+        self.assert_(1000 <= int(name) < 1000000, name)
+        a.released("123")
+        self.assertEqual(a.allocate(), "123")
+
 class Prune(unittest.TestCase):
 
+    def make_rendezvous(self, db, blur_usage):
+        return rendezvous.Rendezvous(db, None, blur_usage, True)
+
     def _get_mailbox_updated(self, app, mbox_id):
         row = app._db.execute("SELECT * FROM `mailboxes` WHERE"
                               " `app_id`=? AND `id`=?",
@@ -300,7 +344,7 @@ class Prune(unittest.TestCase):
 
     def test_update(self):
         db = get_db(":memory:")
-        rv = rendezvous.Rendezvous(db, None, None, True)
+        rv = self.make_rendezvous(db, None)
         app = rv.get_app("appid")
         mbox_id = "mbox1"
         app.open_mailbox(mbox_id, "side1", 1)
@@ -314,16 +358,79 @@ class Prune(unittest.TestCase):
         self.assertEqual(self._get_mailbox_updated(app, mbox_id), 3)
 
     def test_apps(self):
-        rv = rendezvous.Rendezvous(get_db(":memory:"), None, None, True)
-        app = rv.get_app("appid")
-        app.allocate_nameplate("side", 121)
-        app.prune = mock.Mock()
+        db = get_db(":memory:")
+        rv = self.make_rendezvous(db, None)
+        rv.get_app("appid1").allocate_nameplate("side", 121)
+        rv.get_app("appid2").open_mailbox("mbid", "side", 121)
+        rv.flush()
+        # a new server, which hasn't seen these apps yet, prunes them too
+        rv = self.make_rendezvous(db, None)
         rv.prune_all_apps(now=123, old=122)
-        self.assertEqual(app.prune.mock_calls, [mock.call(123, 122)])
+        rv.flush()
+        self.assertEqual(db.execute("SELECT * FROM `mailboxes`").fetchall(),
+                         [])
+        self.assertEqual(db.execute("SELECT * FROM `nameplates`").fetchall(),
+                         [])
+        stats = rv.get_stats()["prune"]
+        self.assertEqual((stats["mailboxes"], stats["nameplates"]), (2, 1))
+
+    def test_incremental(self):
+        db = get_db(":memory:")
+        rv = self.make_rendezvous(db, None)
+        app = rv.get_app("appid")
+        for i in range(5):
+            app.claim_nameplate("np-%d" % i, "side1", 1)
+        app.open_mailbox("new", "side1", 60)
+        listened = app.open_mailbox("listened", "side1", 1)
+        listened.add_listener("handle", None, None)
+
+        clock = task.Clock()
+        d = rv.prune_incrementally(123, 50, clock, batch_size=2)
+        # the first batch happens right away, the rest on later turns
+        self.assertNoResult(d)
+        rv.flush()
+        self.assertEqual(len(app.get_nameplate_ids()), 3)
+        while clock.getDelayedCalls():
+            clock.advance(0)
+        self.successResultOf(d)
+        rv.flush()
+        self.assertEqual(app.get_nameplate_ids(), set())
+        mailboxes = set([row["id"] for row in
+                         db.execute("SELECT * FROM `mailboxes`").fetchall()])
+        self.assertEqual(mailboxes, set(["new", "listened"]))
+
+        stats = rv.get_stats()["prune"]
+        self.assertEqual(stats["started"], 123)
+        self.assertEqual((stats["mailboxes"], stats["nameplates"]), (5, 5))
+        self.assert_(stats["batches"] >= 3, stats["batches"])
+
+    def test_stop_during_pass(self):
+        db = get_db(":memory:")
+        rv = self.make_rendezvous(db, None)
+        app = rv.get_app("appid")
+        for i in range(10):
+            app.open_mailbox("mb-%d" % i, "side1", 1)
+        # like RelayServer, whose timer returns the pass's Deferred
+        clock = task.Clock()
+        parent = service.MultiService()
+        rv.setServiceParent(parent)
+        t = internet.TimerService(600, rv.prune_incrementally, 123, 50,
+                                  clock, batch_size=2)
+        t.clock = clock
+        t.setServiceParent(parent)
+        parent.startService()
+        pending = [c for c in clock.getDelayedCalls() if c.getTime() == 0]
+        self.assertEqual(len(pending), 1) # the next batch
+        self.successResultOf(parent.stopService())
+        self.assertEqual(clock.getDelayedCalls(), [])
+        # the rest are left for the next pass
+        rv.flush()
+        self.assertEqual(len(db.execute("SELECT * FROM `mailboxes`"
+                                        ).fetchall()), 8)
 
     def test_nameplates(self):
         db = get_db(":memory:")
-        rv = rendezvous.Rendezvous(db, None, 3600, True)
+        rv = self.make_rendezvous(db, 3600)
 
         # timestamps <=50 are "old", >=51 are "new"
         #OLD = "old"; NEW = "new"
@@ -347,6 +454,7 @@ class Prune(unittest.TestCase):
         new_nameplates.add("np-5")
 
         rv.prune_all_apps(now=123, old=50)
+        rv.flush()
 
         nameplates = set([row["name"] for row in
                           db.execute("SELECT * FROM `nameplates`").fetchall()])
@@ -357,7 +465,7 @@ class Prune(unittest.TestCase):
 
     def test_mailboxes(self):
         db = get_db(":memory:")
-        rv = rendezvous.Rendezvous(db, None, 3600, True)
+        rv = self.make_rendezvous(db, 3600)
 
         # timestamps <=50 are "old", >=51 are "new"
         #OLD = "old"; NEW = "new"
@@ -381,6 +489,7 @@ class Prune(unittest.TestCase):
         new_mailboxes.add("mb-15")
 
         rv.prune_all_apps(now=123, old=50)
+        rv.flush()
 
         mailboxes = set([row["id"] for row in
                          db.execute("SELECT * FROM `mailboxes`").fetchall()])
@@ -403,7 +512,7 @@ class Prune(unittest.TestCase):
         log.msg(desc)
 
         db = get_db(":memory:")
-        rv = rendezvous.Rendezvous(db, None, 3600, True)
+        rv = self.make_rendezvous(db, 3600)
         APPID = "appid"
         app = rv.get_app(APPID)
 
@@ -434,6 +543,7 @@ class Prune(unittest.TestCase):
         messages_survive = mailbox_survives
 
         rv.prune_all_apps(now=123, old=50)
+        rv.flush()
 
         nameplates = set([row["name"] for row in
                           db.execute("SELECT * FROM `nameplates`").fetchall()])
@@ -1203,6 +1313,156 @@ class WebSocketAPI(_Util, ServerBase, unittest.TestCase):
         yield c.d
 
 
+    @inlineCallbacks
+    def test_sessions(self):
+        c = yield self.make_client()
+        welcome = yield c.next_non_ack()
+        self.assertEqual(welcome["sessions"], True)
+        app = self._rendezvous.get_app("appid")
+
+        # two wormholes, one connection
+        c.send("bind", session="s1", appid="appid", side="side1")
+        c.send("bind", session="s2", appid="appid", side="side2")
+        c.send("bind", session="s2", appid="appid", side="side2")
+        err = yield c.next_non_ack()
+        self.assertEqual(err["type"], "error")
+        self.assertEqual(err["error"], "already bound")
+        self.assertEqual(err["session"], "s2")
+        c.send("list", session="s3")
+        err = yield c.next_non_ack()
+        self.assertEqual(err["error"], "must bind first")
+
+        c.send("claim", session="s1", nameplate="np1")
+        m = yield c.next_non_ack()
+        self.assertEqual((m["type"], m["session"]), ("claimed", "s1"))
+        mailbox_id = m["mailbox"]
+        c.send("claim", session="s2", nameplate="np1")
+        m = yield c.next_non_ack()
+        self.assertEqual((m["type"], m["session"]), ("claimed", "s2"))
+        self.assertEqual(m["mailbox"], mailbox_id)
+        np_row, side_rows = self._nameplate(app, "np1")
+        self.assertEqual(sorted([row["side"] for row in side_rows]),
+                         ["side1", "side2"])
+
+        c.send("open", session="s1", mailbox=mailbox_id)
+        c.send("open", session="s2", mailbox=mailbox_id)
+        c.send("add", session="s1", phase="1", body="")
+        m1 = yield c.next_non_ack()
+        m2 = yield c.next_non_ack()
+        # each session hears the message once
+        self.assertEqual(sorted([m1["session"], m2["session"]]),
+                         ["s1", "s2"])
+        self.assertEqual(m1["side"], "side1")
+        mb = app.open_mailbox(mailbox_id, "side1", 0)
+        self.assertEqual(len(mb._listeners), 2)
+
+        # unbinding one leaves the other alone
+        c.send("unbind", session="s1")
+        yield c.sync()
+        self.assertEqual(len(mb._listeners), 1)
+        c.send("add", session="s1", phase="2", body="")
+        err = yield c.next_non_ack()
+        self.assertEqual(err["error"], "must bind first")
+        c.send("add", session="s2", phase="2", body="")
+        m = yield c.next_non_ack()
+        self.assertEqual((m["type"], m["session"]), ("message", "s2"))
+
+        # a connection carries sessions, or a plain binding, not both
+        c.send("bind", appid="appid", side="side3")
+        err = yield c.next_non_ack()
+        self.assertEqual(err["error"], "this connection carries sessions")
+        c2 = yield self.make_client()
+        yield c2.next_non_ack()
+        c2.send("bind", appid="appid", side="side3")
+        c2.send("bind", session="s1", appid="appid", side="side3")
+        err = yield c2.next_non_ack()
+        self.assertEqual(err["error"], "this connection is already bound")
+
+        # losing the connection unbinds everything
+        yield c.close()
+        started = time.time()
+        while mb.has_listeners() and (time.time()-started < 5.0):
+            d = defer.Deferred()
+            reactor.callLater(0.01, d.callback, None)
+            yield d
+        self.assertFalse(mb.has_listeners())
+
+    @inlineCallbacks
+    def test_too_many_sessions(self):
+        self.patch(rendezvous_websocket, "MAX_SESSIONS", 2)
+        c = yield self.make_client()
+        yield c.next_non_ack()
+        for session in ["s1", "s2", "s3"]:
+            c.send("bind", session=session, appid="appid", side=session)
+        err = yield c.next_non_ack()
+        self.assertEqual(err["error"], "too many sessions")
+        self.assertEqual(err["session"], "s3")
+
+    @inlineCallbacks
+    def test_encodings(self):
+        c1 = yield self.make_client()
+        welcome = yield c1.next_non_ack()
+        self.assertEqual(welcome["encodings"], ["hex", "base64"])
+        c1.send("bind", appid="appid", side="side1", encoding="base64")
+        c2 = yield self.make_client()
+        yield c2.next_non_ack()
+        # an encoding we don't know about gets hex
+        c2.send("bind", appid="appid", side="side2", encoding="unknown")
+        app = self._rendezvous.get_app("appid")
+        c1.send("open", mailbox="mb1")
+        c2.send("open", mailbox="mb1")
+        yield c1.sync()
+        yield c2.sync()
+
+        c1.send("add", phase="1", body="/wA=", encoding="base64")
+        m1 = yield c1.next_non_ack()
+        m2 = yield c2.next_non_ack()
+        self.assertEqual((m1["body"], m1["encoding"]), ("/wA=", "base64"))
+        self.assertEqual(m2["body"], "ff00")
+        self.assertNotIn("encoding", m2)
+        # the mailbox always holds hex
+        mb1 = app.open_mailbox("mb1", "side1", 0)
+        self.assertEqual(mb1.get_messages()[0].body, "ff00")
+
+        c2.send("add", phase="2", body="0102")
+        m1 = yield c1.next_non_ack()
+        m2 = yield c2.next_non_ack()
+        self.assertEqual((m1["body"], m1["encoding"]), ("AQI=", "base64"))
+        self.assertEqual(m2["body"], "0102")
+
+        c1.send("add", phase="3", body="abc", encoding="base64")
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["error"], "bad body")
+        c1.send("add", phase="3", body="AQI=", encoding="rot13")
+        err = yield c1.next_non_ack()
+        self.assertEqual(err["error"], "unknown encoding")
+
+        stats = self._rendezvous.get_stats()["since_reboot"]["bytes"]
+        self.assertEqual(stats["base64"], {"rx": 4+3, "tx": 4+4})
+        self.assertEqual(stats["hex"], {"rx": 4, "tx": 4+4})
+        self.assertTrue(stats["websocket"]["rx"] > 0)
+        self.assertTrue(stats["websocket"]["tx"] > 0)
+
+
+class GroupCommitWebSocketAPI(WebSocketAPI):
+    # the same, with commits batched once per reactor turn
+    group_commit = 0
+
+    def test_commits(self):
+        db = self._relay_server._db
+        self.assertIsInstance(db, database.GroupCommitter)
+        app = self._rendezvous.get_app("appid")
+        app.claim_nameplate("np1", "side1", 0)
+        app.claim_nameplate("np1", "side2", 0)
+        self.assertEqual(db.commits, 0)
+        d = defer.Deferred()
+        reactor.callLater(0, d.callback, None)
+        def _check(_):
+            self.assertEqual(db.commits, 1)
+            self.assertTrue(db.commit_requests > 1)
+        d.addCallback(_check)
+        return d
+
 class Summary(unittest.TestCase):
     def test_mailbox(self):
         app = rendezvous.AppNamespace(None, None, False, None, True)
@@ -1,17 +1,24 @@
 from __future__ import print_function, unicode_literals
 import six
 import io
+import hashlib
+import threading
+import os
 import gc
 import mock
 from binascii import hexlify, unhexlify
 from collections import namedtuple
 from twisted.trial import unittest
-from twisted.internet import defer, task, endpoints, protocol, address, error
-from twisted.internet.defer import gatherResults, inlineCallbacks
+from zope.interface import implementer
+from twisted.internet import (reactor, defer, task, endpoints, protocol,
+                              address, error, interfaces)
+from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
 from twisted.python import log, failure
 from twisted.test import proto_helpers
+from twisted.protocols import basic
 from ..errors import InternalError
 from .. import transit
+from ..timing import DebugTiming
 from ..server import transit_server
 from .common import ServerBase
 from nacl.secret import SecretBox
@@ -217,6 +224,10 @@ class Hints(unittest.TestCase):
         self.assertEqual(h, transit.DirectTCPV1Hint("host", 1234, 0.0))
         self.assertEqual(stderr, "")
 
+        h,stderr = p("tcp:[2001:db8::1]:1234:priority=2.6")
+        self.assertEqual(h, transit.DirectTCPV1Hint("2001:db8::1", 1234, 2.6))
+        self.assertEqual(stderr, "")
+
         h,stderr = p("$!@#^")
         self.assertEqual(h, None)
         self.assertEqual(stderr, "unparseable hint '$!@#^'\n")
@@ -247,6 +258,8 @@ class Hints(unittest.TestCase):
                          "tcp:host:1234")
         self.assertEqual(d(transit.TorTCPV1Hint("host", 1234, 0.0)),
                          "tor:host:1234")
+        self.assertEqual(d(transit.DirectTCPV1Hint("2001:db8::1", 1234, 0.0)),
+                         "tcp:[2001:db8::1]:1234")
         self.assertEqual(d(UnknownHint("stuff")), str(UnknownHint("stuff")))
 
 # ipaddrs.py currently uses native strings: bytes on py2, unicode on
@@ -387,12 +400,50 @@ class Basic(unittest.TestCase):
 class Listener(unittest.TestCase):
     def test_listener(self):
         c = transit.Common("")
-        hints, ep = c._build_listener()
+        with mock.patch("wormhole.ipaddrs.find_addresses",
+                        return_value=[LOOPADDR, OTHERADDR]):
+            hints, ep = c._build_listener()
         self.assertIsInstance(hints, (list, set))
         if hints:
             self.assertIsInstance(hints[0], transit.DirectTCPV1Hint)
         self.assertIsInstance(ep, endpoints.TCP4ServerEndpoint)
 
+    def test_listener_ipv6(self):
+        c = transit.Common("")
+        with mock.patch("wormhole.ipaddrs.find_addresses",
+                        return_value=[LOOPADDR, OTHERADDR, str("::1"),
+                                      str("2001:db8::1")]):
+            hints, ep = c._build_listener()
+        self.assertEqual([h.hostname for h in hints],
+                         ["1.2.3.4", "2001:db8::1"])
+        self.assertIsInstance(ep, transit.DualStackServerEndpoint)
+
+    @inlineCallbacks
+    def test_dual_stack(self):
+        # whichever way this host does it, both families get through
+        port = transit.allocate_tcp_port()
+        ep = transit.DualStackServerEndpoint(reactor, port)
+        connected = []
+        class Accept(protocol.Protocol):
+            def connectionMade(self):
+                connected.append(self.transport.getPeer())
+                self.transport.loseConnection()
+        lp = yield ep.listen(protocol.Factory.forProtocol(Accept))
+        try:
+            for host in ["127.0.0.1", "::1"]:
+                try:
+                    p = yield endpoints.connectProtocol(
+                        endpoints.HostnameEndpoint(reactor, host, port),
+                        protocol.Protocol())
+                except error.ConnectError:
+                    if host == "::1":
+                        continue # no IPv6 here
+                    raise
+                p.transport.loseConnection()
+        finally:
+            yield lp.stopListening()
+        self.assertNotEqual(connected, [])
+
     def test_get_direct_hints(self):
         # this actually starts the listener
         c = transit.TransitSender("")
@@ -453,8 +504,13 @@ class FakeTransport:
         self._peeraddr = peeraddr
         self._buf = b""
         self._connected = True
+        self._writes = 0
     def write(self, data):
+        self._writes += 1
         self._buf += data
+    def writeSequence(self, data):
+        self._writes += 1
+        self._buf += b"".join(data)
     def loseConnection(self):
         self._connected = False
         if self.signalConnectionLost:
@@ -494,7 +550,7 @@ class InboundConnectionFactory(unittest.TestCase):
         addr4 = address.IPv4Address("TCP", "1.2.3.4", 1234)
         self.assertEqual(f._describePeer(addr4), "<-1.2.3.4:1234")
         addr6 = address.IPv6Address("TCP", "::1", 1234)
-        self.assertEqual(f._describePeer(addr6), "<-::1:1234")
+        self.assertEqual(f._describePeer(addr6), "<-[::1]:1234")
         addrU = address.UNIXAddress("/dev/unlikely")
         self.assertEqual(f._describePeer(addrU),
                          "<-UNIXAddress('/dev/unlikely')")
@@ -658,6 +714,9 @@ class MockOwner:
         return b"s"*32
     def _receiver_record_key(self):
         return b"r"*32
+    _crypto = None
+    def _record_crypto(self):
+        return self._crypto
 
 class MockFactory:
     _connectionWasMade_called = False
@@ -1124,6 +1183,119 @@ class Connection(unittest.TestCase):
         c.dataReceived(r5+r6)
         self.assertEqual(inbound_records, [RECORD5, RECORD6])
 
+    def test_records_single_write(self):
+        t, c, owner = self.make_connection()
+        t._writes = 0
+        c.send_record(b"record")
+        self.assertEqual(t._writes, 1)
+
+    def test_build_nonce(self):
+        for n in [0, 1, 255, 256, 2**32, 2**64-1, 2**64, 2**128+5,
+                  2**(8*24)-1]:
+            self.assertEqual(transit.build_nonce(n), unhexlify("%048x" % n))
+
+    def test_records_large_nonce(self):
+        # nonces are big-endian counters that can exceed 64 bits
+        t, c, owner = self.make_connection()
+        c.send_nonce = 2**64 + 3
+        c.send_record(b"record")
+        encrypted = t.read_buf()[4:]
+        self.assertEqual(encrypted[:SecretBox.NONCE_SIZE],
+                         unhexlify("%048x" % (2**64 + 3)))
+        self.assertEqual(c.send_nonce, 2**64 + 4)
+
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        c.next_receive_nonce = 2**70
+        send_box = SecretBox(owner._receiver_record_key())
+        encrypted = send_box.encrypt(b"record", unhexlify("%048x" % 2**70))
+        c.dataReceived(unhexlify("%08x" % len(encrypted)) + encrypted)
+        self.assertEqual(inbound_records, [b"record"])
+        self.assertEqual(c.next_receive_nonce, 2**70 + 1)
+
+    def test_records_chunked(self):
+        # the reassembly queue must deliver the same records no matter how
+        # the inbound stream is split up, from single bytes up to chunks
+        # that hold many records at once
+        send_box = SecretBox(MockOwner()._receiver_record_key())
+        records = [b"", b"r"] + [("%d." % i).encode("ascii") * (17*i)
+                                 for i in range(40)]
+        records.append(b"big" * 100000)
+        stream = []
+        for nonce, record in enumerate(records):
+            nonce_buf = unhexlify("%048x" % nonce)
+            encrypted = send_box.encrypt(record, nonce_buf)
+            stream.append(unhexlify("%08x" % len(encrypted)) + encrypted)
+        stream = b"".join(stream)
+
+        for chunksize in [1, 3, 4, 5, 1000, 16*1024, 64*1024, 1024*1024]:
+            t, c, owner = self.make_connection()
+            inbound_records = []
+            c.recordReceived = inbound_records.append
+            for i in range(0, len(stream), chunksize):
+                c.dataReceived(stream[i:i+chunksize])
+            self.assertEqual(inbound_records, records)
+            self.assertEqual(c._pending_length, 0)
+            self.assertEqual(len(c._pending), 0)
+
+    def test_records_split(self):
+        # a record that arrives in several pieces, the first of which also
+        # holds the end of the previous record, comes out as one bytestring
+        send_box = SecretBox(MockOwner()._receiver_record_key())
+        records = [b"first", b"second record" * 100]
+        framed = []
+        for nonce, record in enumerate(records):
+            encrypted = send_box.encrypt(record, unhexlify("%048x" % nonce))
+            framed.append(unhexlify("%08x" % len(encrypted)) + encrypted)
+        second = framed[1]
+        chunks = [framed[0] + second[:10], second[10:11], second[11:500],
+                  second[500:]]
+        for py2 in [False, True]:
+            self.patch(transit.six, "PY2", py2)
+            t, c, owner = self.make_connection()
+            pieces = []
+            consume = c._consume_pending
+            def _consume_pending(count):
+                pieces.append(list(c._pending))
+                data = consume(count)
+                self.assertIsInstance(data, bytes)
+                return data
+            c._consume_pending = _consume_pending
+            inbound_records = []
+            c.recordReceived = inbound_records.append
+            for chunk in chunks:
+                c.dataReceived(chunk)
+            self.assertEqual(inbound_records, records)
+            # the second record was reassembled from four pieces
+            self.assertEqual(len(pieces[-1]), 4)
+            self.assertEqual(c._pending_length, 0)
+
+    def test_records_after_handshake(self):
+        # records which arrive in the same chunk as the end of the handshake
+        # must not be lost
+        owner = MockOwner()
+        c = transit.Connection(owner, None, None, "description")
+        t = c.transport = FakeTransport(c, None)
+        c.factory = MockFactory()
+        c.connectionMade()
+        owner._state = "wait-for-decision"
+        c.startNegotiation()
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+
+        send_box = SecretBox(owner._receiver_record_key())
+        stream = b""
+        for nonce, record in enumerate([b"record1", b"record2"]):
+            nonce_buf = unhexlify("%048x" % nonce)
+            encrypted = send_box.encrypt(record, nonce_buf)
+            stream += unhexlify("%08x" % len(encrypted)) + encrypted
+        c.dataReceived(b"expect_this" + b"go\n" + stream[:-3])
+        self.assertEqual(c.state, "records")
+        self.assertEqual(inbound_records, [b"record1"])
+        c.dataReceived(stream[-3:])
+        self.assertEqual(inbound_records, [b"record1", b"record2"])
+        self.assertEqual(t._connected, True)
+
     def corrupt(self, orig):
         last_byte = orig[-1:]
         num = int(hexlify(last_byte).decode("ascii"), 16)
@@ -1151,6 +1323,41 @@ class Connection(unittest.TestCase):
         # and the connection should have been dropped
         self.assertEqual(t._connected, False)
 
+    def test_record_too_large(self):
+        t, c, owner = self.make_connection()
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        c.set_max_record_size(transit.DEFAULT_RECORD_SIZE)
+
+        # a record of the largest size we allow gets through
+        RECORD = b"r" * transit.DEFAULT_RECORD_SIZE
+        send_box = SecretBox(owner._receiver_record_key())
+        encrypted = send_box.encrypt(RECORD, unhexlify("%048x" % 0))
+        c.dataReceived(transit.RECORD_LENGTH.pack(len(encrypted)))
+        c.dataReceived(encrypted)
+        self.assertEqual(inbound_records, [RECORD])
+
+        # but we give up on a bigger one as soon as we see its length,
+        # rather than buffering it
+        length = transit.RECORD_LENGTH.pack(len(encrypted) + 1)
+        self.assertRaises(transit.RecordTooLarge, c.dataReceived, length)
+        self.assertEqual(t._connected, False)
+        c.dataReceived(b"more") # ignored
+        self.assertEqual(inbound_records, [RECORD])
+
+    def test_record_size_unlimited(self):
+        # without a limit, records can be as large as the length allows
+        t, c, owner = self.make_connection()
+        c.dataReceived(transit.RECORD_LENGTH.pack(2**32 - 1))
+        self.assertEqual(t._connected, True)
+
+    def test_record_size_floor(self):
+        t, c, owner = self.make_connection()
+        c.set_max_record_size(100)
+        c.dataReceived(transit.RECORD_LENGTH.pack(
+            transit.DEFAULT_RECORD_SIZE + transit.RECORD_OVERHEAD))
+        self.assertEqual(t._connected, True)
+
     def test_out_of_order_nonce(self):
         # an inbound out-of-order nonce should be rejected
         t, c, owner = self.make_connection()
@@ -1217,6 +1424,97 @@ class Connection(unittest.TestCase):
         self.assertIsInstance(f, failure.Failure)
         self.assertIsInstance(f.value, error.ConnectionClosed)
 
+    def await_result(self, awaitable):
+        # what 'await' does, for awaitables that are already done
+        if isinstance(awaitable, defer.Deferred):
+            return self.successResultOf(awaitable)
+        it = awaitable.__await__()
+        try:
+            next(it)
+        except StopIteration as e:
+            return e.args[0]
+        self.fail("not ready")
+
+    def test_records_iterator(self):
+        c = transit.Connection(None, None, None, "description")
+        c.transport = proto_helpers.StringTransport()
+        it = c.records()
+        self.assertIs(it.__aiter__(), it)
+        c.recordReceived(b"0")
+        c.recordReceived(b"1")
+        # records that are already here don't need a Deferred
+        a = it.__anext__()
+        self.assertNotIsInstance(a, defer.Deferred)
+        self.assertEqual(self.await_result(a), b"0")
+        self.assertEqual(self.await_result(it.__anext__()), b"1")
+        d = it.__anext__()
+        self.assertNoResult(d)
+        c.recordReceived(b"2")
+        self.assertEqual(self.successResultOf(d), b"2")
+        # and the iteration stops when the connection is closed
+        d = it.__anext__()
+        c._negotiation_d.addErrback(lambda f: None)
+        c.connectionLost()
+        self.failureResultOf(d, transit._StopAsyncIteration)
+        self.failureResultOf(it.__anext__(), transit._StopAsyncIteration)
+
+    def test_read_into(self):
+        c = transit.Connection(None, None, None, "description")
+        c.transport = proto_helpers.StringTransport()
+        buf = bytearray(5)
+        d = c.read_into(buf)
+        self.assertNoResult(d)
+        c.recordReceived(b"abc")
+        self.assertEqual(self.successResultOf(d), 3)
+        self.assertEqual(buf[:3], b"abc")
+
+        c.recordReceived(b"defg")
+        c.recordReceived(b"hijkl")
+        # several records (and part of the last one) in one go
+        self.assertEqual(self.successResultOf(c.read_into(buf)), 5)
+        self.assertEqual(buf, b"defgh")
+        # and whole-record reads pick up where that left off
+        self.assertEqual(self.successResultOf(c.receive_record()), b"ijkl")
+
+        c.recordReceived(b"mn")
+        view = memoryview(buf)[1:]
+        self.assertEqual(self.successResultOf(c.read_into(view)), 2)
+        self.assertEqual(buf, b"dmngh")
+
+        c.recordReceived(b"end")
+        c._negotiation_d.addErrback(lambda f: None)
+        c.connectionLost()
+        # what arrived before the connection was lost can still be read
+        self.assertEqual(self.successResultOf(c.read_into(buf)), 3)
+        self.assertEqual(self.successResultOf(c.read_into(buf)), 0)
+
+    def test_inbound_limit(self):
+        c = transit.Connection(None, None, None, "description")
+        c.transport = proto_helpers.StringTransport()
+        c.set_inbound_limit(10)
+        c.recordReceived(b"x"*6)
+        self.assertEqual(c.transport.producerState, "producing")
+        c.recordReceived(b"x"*6)
+        # more than 10 bytes are waiting
+        self.assertEqual(c.transport.producerState, "paused")
+        c.recordReceived(b"x"*6) # (what was already on its way)
+        self.successResultOf(c.receive_record())
+        # 12 bytes left: still more than half the limit
+        self.assertEqual(c.transport.producerState, "paused")
+        buf = bytearray(8)
+        self.successResultOf(c.read_into(buf))
+        self.assertEqual(c.transport.producerState, "producing")
+        self.successResultOf(c.receive_record())
+
+        # attaching a consumer drains the queue, and resumes us too
+        c.recordReceived(b"y"*20)
+        self.assertEqual(c.transport.producerState, "paused")
+        f = io.BytesIO()
+        results = []
+        c.writeToFile(f, 20).addBoth(results.append)
+        self.assertEqual(results, [20])
+        self.assertEqual(c.transport.producerState, "producing")
+
     def test_producer(self):
         # a Transit object (receiving data from the remote peer) produces
         # data and writes it into a local Consumer
@@ -1382,6 +1680,369 @@ class Connection(unittest.TestCase):
         c.unregisterProducer()
         self.assertEqual(c.transport.producer, None)
 
+class ManualCrypto:
+    # a RecordCrypto whose jobs only run when the test says so, in whatever
+    # order it likes
+    def __init__(self):
+        self.jobs = []
+    def run(self, f, *args):
+        d = defer.Deferred()
+        self.jobs.append((d, f, args))
+        return d
+    def finish(self, index=0):
+        (d, f, args) = self.jobs.pop(index)
+        try:
+            result = f(*args)
+        except Exception:
+            d.errback()
+        else:
+            d.callback(result)
+    def finish_all(self):
+        while self.jobs:
+            self.finish()
+
+@implementer(interfaces.IConsumer)
+class ProducingTransport(FakeTransport):
+    producer = None
+    producing = True
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        self.streaming = streaming
+    def unregisterProducer(self):
+        self.producer = None
+    def pauseProducing(self):
+        self.producing = False
+    def resumeProducing(self):
+        self.producing = True
+
+class PooledCrypto(unittest.TestCase):
+    def make_connection(self):
+        owner = MockOwner()
+        owner._crypto = crypto = ManualCrypto()
+        owner._state = "go"
+        c = transit.Connection(owner, None, None, "description")
+        t = c.transport = ProducingTransport(c, None)
+        c.factory = MockFactory()
+        c.connectionMade()
+        c.startNegotiation()
+        c.dataReceived(b"expect_this")
+        t.read_buf()
+        return t, c, crypto
+
+    def build_records(self, records):
+        box = SecretBox(MockOwner()._receiver_record_key())
+        out = []
+        for nonce, record in enumerate(records):
+            encrypted = box.encrypt(record, transit.build_nonce(nonce))
+            out.append(transit.RECORD_LENGTH.pack(len(encrypted)) + encrypted)
+        return out
+
+    def read_records(self, buf, nonce=0):
+        box = SecretBox(MockOwner()._sender_record_key())
+        records = []
+        while buf:
+            (length,) = transit.RECORD_LENGTH.unpack(buf[:4])
+            encrypted, buf = buf[4:4+length], buf[4+length:]
+            self.assertEqual(encrypted[:24], transit.build_nonce(nonce))
+            records.append(box.decrypt(encrypted))
+            nonce += 1
+        return records
+
+    def test_send_order(self):
+        t, c, crypto = self.make_connection()
+        c.send_record(b"r0")
+        c.send_record(b"r1")
+        c.send_record(b"r2")
+        self.assertEqual(t.read_buf(), b"")
+        crypto.finish(2)
+        self.assertEqual(t.read_buf(), b"")
+        crypto.finish(0)
+        self.assertEqual(self.read_records(t.read_buf()), [b"r0"])
+        crypto.finish(0)
+        # r1 and r2 must go out in nonce order
+        self.assertEqual(self.read_records(t.read_buf(), 1), [b"r1", b"r2"])
+
+    def test_receive_order(self):
+        t, c, crypto = self.make_connection()
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        c.dataReceived(b"".join(self.build_records([b"r0", b"r1", b"r2"])))
+        self.assertEqual(len(crypto.jobs), 3)
+        crypto.finish(1)
+        self.assertEqual(inbound_records, [])
+        crypto.finish(0)
+        self.assertEqual(inbound_records, [b"r0", b"r1"])
+        crypto.finish(0)
+        self.assertEqual(inbound_records, [b"r0", b"r1", b"r2"])
+
+    def test_receive_throttle(self):
+        t, c, crypto = self.make_connection()
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        records = [("r%d" % i).encode("ascii")
+                   for i in range(transit.CRYPTO_QUEUE_LIMIT)]
+        c.dataReceived(b"".join(self.build_records(records)))
+        self.assertEqual(t.producing, False)
+        # our own consumer pauses us too, so the transport must stay paused
+        # until both are happy
+        c.pauseProducing()
+        crypto.finish_all()
+        self.assertEqual(inbound_records, records)
+        self.assertEqual(t.producing, False)
+        c.resumeProducing()
+        self.assertEqual(t.producing, True)
+
+    def test_corrupt(self):
+        t, c, crypto = self.make_connection()
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        (r0, r1) = self.build_records([b"r0", b"r1"])
+        c.dataReceived(r0 + r1[:-1] + b"X")
+        crypto.finish(1)
+        self.assertEqual(t._connected, False)
+        self.assertEqual(len(self.flushLoggedErrors(CryptoError)), 1)
+        crypto.finish(0)
+        self.assertEqual(inbound_records, [])
+
+    def test_close_flushes(self):
+        t, c, crypto = self.make_connection()
+        c.send_record(b"r0")
+        c.close()
+        self.assertEqual(t._connected, True)
+        crypto.finish()
+        self.assertEqual(self.read_records(t.read_buf()), [b"r0"])
+        self.assertEqual(t._connected, False)
+
+    def test_lost_delivers_pending(self):
+        t, c, crypto = self.make_connection()
+        f = io.BytesIO()
+        d = c.writeToFile(f, 4)
+        c.dataReceived(b"".join(self.build_records([b"r0", b"r1"])))
+        c.connectionLost()
+        self.assertNoResult(d)
+        crypto.finish_all()
+        self.assertEqual(self.successResultOf(d), 4)
+        self.assertEqual(f.getvalue(), b"r0r1")
+
+    def test_lost_incomplete(self):
+        t, c, crypto = self.make_connection()
+        f = io.BytesIO()
+        d = c.writeToFile(f, 6)
+        c.dataReceived(b"".join(self.build_records([b"r0", b"r1"])))
+        closed = c.when_closed()
+        c.connectionLost()
+        self.assertNoResult(closed)
+        crypto.finish_all()
+        self.failureResultOf(d, error.ConnectionClosed)
+        self.assertEqual(self.successResultOf(closed), None)
+
+    def test_pull_producer(self):
+        t, c, crypto = self.make_connection()
+        count = transit.CRYPTO_QUEUE_LIMIT + 5
+        data = b"".join([("%02d" % i).encode("ascii") for i in range(count)])
+        fs = basic.FileSender()
+        fs.CHUNK_SIZE = 2
+        d = fs.beginFileTransfer(io.BytesIO(data), c)
+        self.assertIs(t.streaming, True)
+        # the queue fills up without waiting for the transport
+        self.assertEqual(len(crypto.jobs), transit.CRYPTO_QUEUE_LIMIT)
+        # and stops when the transport is full
+        t.producer.pauseProducing()
+        crypto.finish()
+        self.assertEqual(len(crypto.jobs), transit.CRYPTO_QUEUE_LIMIT - 1)
+        t.producer.resumeProducing()
+        self.assertEqual(len(crypto.jobs), transit.CRYPTO_QUEUE_LIMIT)
+        crypto.finish_all()
+        self.successResultOf(d)
+        self.assertEqual(b"".join(self.read_records(t.read_buf())), data)
+        self.assertEqual(t.producer, None)
+
+    def test_push_producer(self):
+        t, c, crypto = self.make_connection()
+        producer = proto_helpers.StringTransport()
+        c.registerProducer(producer, True)
+        for i in range(transit.CRYPTO_QUEUE_LIMIT):
+            c.write(("r%d" % i).encode("ascii"))
+        self.assertEqual(producer.producerState, "paused")
+        for i in range(transit.CRYPTO_QUEUE_LIMIT // 2 - 1):
+            crypto.finish()
+        self.assertEqual(producer.producerState, "paused")
+        crypto.finish()
+        self.assertEqual(producer.producerState, "producing")
+        # the transport can pause it too
+        t.producer.pauseProducing()
+        self.assertEqual(producer.producerState, "paused")
+        crypto.finish_all()
+        self.assertEqual(producer.producerState, "paused")
+        t.producer.resumeProducing()
+        self.assertEqual(producer.producerState, "producing")
+        c.unregisterProducer()
+        self.assertEqual(t.producer, None)
+
+class MockStripe:
+    def __init__(self, name):
+        self._name = name
+        self.sent = []
+        self.paused = False
+        self.producer = None
+        self.closed = False
+        self._closed_d = defer.Deferred()
+        self.transport = self
+    def describe(self):
+        return self._name
+    def set_max_record_size(self, size):
+        self.max_record_size = size
+    def send_record(self, record):
+        self.sent.append(record)
+    def connectConsumer(self, consumer):
+        self.consumer = consumer
+        consumer.registerProducer(self, True)
+    def when_closed(self):
+        return self._closed_d
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        self.streaming = streaming
+    def unregisterProducer(self):
+        self.producer = None
+    def pauseProducing(self):
+        self.paused = True
+    def resumeProducing(self):
+        self.paused = False
+    def close(self):
+        self.loseConnection()
+    def loseConnection(self):
+        if not self.closed:
+            self.closed = True
+            self._closed_d.callback(None)
+
+class StripedConnection(unittest.TestCase):
+    def make(self, count=3):
+        stripes = [MockStripe("s%d" % i) for i in range(count)]
+        return stripes, transit.StripedConnection(stripes)
+
+    def test_describe(self):
+        stripes, sc = self.make(2)
+        self.assertEqual(sc.describe(), "striped(s0, s1)")
+
+    def test_max_record_size(self):
+        stripes, sc = self.make(2)
+        sc.set_max_record_size(1000)
+        self.assertEqual([s.max_record_size for s in stripes], [1000, 1000])
+
+    def test_send_rotation(self):
+        stripes, sc = self.make(3)
+        for i in range(7):
+            sc.send_record(("r%d" % i).encode("ascii"))
+        self.assertEqual(stripes[0].sent, [b"r0", b"r3", b"r6"])
+        self.assertEqual(stripes[1].sent, [b"r1", b"r4"])
+        self.assertEqual(stripes[2].sent, [b"r2", b"r5"])
+
+    def test_receive_reorder(self):
+        stripes, sc = self.make(3)
+        results = []
+        for i in range(6):
+            sc.receive_record().addCallback(results.append)
+        # records arrive on each stream in order, but the streams run at
+        # different speeds
+        stripes[1].consumer.write(b"r1")
+        stripes[2].consumer.write(b"r2")
+        stripes[1].consumer.write(b"r4")
+        self.assertEqual(results, [])
+        stripes[0].consumer.write(b"r0")
+        self.assertEqual(results, [b"r0", b"r1", b"r2"])
+        stripes[0].consumer.write(b"r3")
+        self.assertEqual(results, [b"r0", b"r1", b"r2", b"r3", b"r4"])
+        stripes[2].consumer.write(b"r5")
+        self.assertEqual(results, [("r%d" % i).encode("ascii")
+                                   for i in range(6)])
+
+    def test_throttle(self):
+        stripes, sc = self.make(2)
+        f = io.BytesIO()
+        sc.writeToFile(f, 1000)
+        # stream 1 gets far ahead of stream 0
+        for i in range(transit.STRIPE_QUEUE_LIMIT + 1):
+            stripes[1].consumer.write(b"b")
+        self.assertEqual(stripes[1].paused, True)
+        self.assertEqual(stripes[0].paused, False)
+        self.assertEqual(f.getvalue(), b"")
+        for i in range(transit.STRIPE_QUEUE_LIMIT):
+            stripes[0].consumer.write(b"a")
+        self.assertEqual(f.getvalue(), b"ab" * transit.STRIPE_QUEUE_LIMIT)
+        self.assertEqual(stripes[1].paused, False)
+
+    def test_pause(self):
+        stripes, sc = self.make(2)
+        sc.pauseProducing()
+        self.assertEqual([s.paused for s in stripes], [True, True])
+        sc.resumeProducing()
+        self.assertEqual([s.paused for s in stripes], [False, False])
+
+    def test_pull_producer(self):
+        stripes, sc = self.make(2)
+        data = io.BytesIO(b"abcdefghij")
+        fs = basic.FileSender()
+        fs.CHUNK_SIZE = 2
+        d = fs.beginFileTransfer(data, sc)
+        for s in stripes:
+            self.assertIs(s.streaming, False)
+        # nothing is sent until the transports ask for data
+        self.assertEqual(stripes[0].sent + stripes[1].sent, [])
+        stripes[1].producer.resumeProducing()
+        self.assertEqual(stripes[0].sent + stripes[1].sent, [])
+        stripes[0].producer.resumeProducing()
+        self.assertEqual(stripes[0].sent, [b"ab"])
+        self.assertEqual(stripes[1].sent, [b"cd"])
+        stripes[0].producer.resumeProducing()
+        stripes[1].producer.resumeProducing()
+        stripes[0].producer.resumeProducing()
+        self.assertEqual(stripes[0].sent, [b"ab", b"ef", b"ij"])
+        self.assertEqual(stripes[1].sent, [b"cd", b"gh"])
+        self.assertNoResult(d)
+        stripes[1].producer.resumeProducing()
+        self.successResultOf(d)
+        self.assertEqual([s.producer for s in stripes], [None, None])
+
+    def test_push_producer(self):
+        stripes, sc = self.make(2)
+        producer = proto_helpers.StringTransport()
+        sc.registerProducer(producer, True)
+        stripes[0].producer.pauseProducing()
+        self.assertEqual(producer.producerState, "paused")
+        stripes[1].producer.pauseProducing()
+        stripes[0].producer.resumeProducing()
+        self.assertEqual(producer.producerState, "paused")
+        stripes[1].producer.resumeProducing()
+        self.assertEqual(producer.producerState, "producing")
+        sc.unregisterProducer()
+        self.assertEqual([s.producer for s in stripes], [None, None])
+
+    def test_connection_lost(self):
+        stripes, sc = self.make(3)
+        f = io.BytesIO()
+        d = sc.writeToFile(f, 1000)
+        r = sc.receive_record()
+        stripes[1].loseConnection()
+        self.assertEqual([s.closed for s in stripes], [True, True, True])
+        f = self.failureResultOf(d, error.ConnectionClosed)
+        self.assertEqual(str(f.value), "stripe 1 (s1) was lost")
+        f = self.failureResultOf(r, error.ConnectionClosed)
+        self.assertEqual(str(f.value), "stripe 1 (s1) was lost")
+
+    def test_close(self):
+        stripes, sc = self.make(2)
+        r = sc.receive_record()
+        sc.close()
+        self.assertEqual([s.closed for s in stripes], [True, True])
+        self.failureResultOf(r, error.ConnectionClosed)
+
+    def test_derive_stripe_key(self):
+        k1 = transit.derive_stripe_key(b"k"*32, 1)
+        k2 = transit.derive_stripe_key(b"k"*32, 2)
+        self.assertEqual(len(k1), 32)
+        self.assertNotEqual(k1, k2)
+        self.assertNotEqual(k1, b"k"*32)
+
 class FileConsumer(unittest.TestCase):
     def test_basic(self):
         f = io.BytesIO()
@@ -1413,6 +2074,155 @@ class FileConsumer(unittest.TestCase):
         self.assertEqual(f.getvalue(), b"."*99+b"!")
         self.assertEqual(hashee, [b"."*99, b"!"])
 
+class SlowFile:
+    # a file whose writes block until the test lets them through
+    def __init__(self):
+        self._f = io.BytesIO()
+        self.gate = threading.Event()
+    def write(self, data):
+        self.gate.wait()
+        self._f.write(data)
+    def getvalue(self):
+        return self._f.getvalue()
+
+class BrokenFile:
+    def write(self, data):
+        raise IOError("disk full")
+
+class MockProducer:
+    def __init__(self):
+        self.events = []
+    def pauseProducing(self):
+        self.events.append("pause")
+    def resumeProducing(self):
+        self.events.append("resume")
+    def stopProducing(self):
+        self.events.append("stop")
+
+class ShutdownReactor:
+    # the real reactor, except that shutdown triggers are only recorded
+    def __init__(self):
+        self.triggers = {}
+    def callFromThread(self, f, *args, **kwargs):
+        reactor.callFromThread(f, *args, **kwargs)
+    def addSystemEventTrigger(self, phase, event, f):
+        trigger = object()
+        self.triggers[trigger] = (phase, event, f)
+        return trigger
+    def removeSystemEventTrigger(self, trigger):
+        del self.triggers[trigger]
+
+class ThreadedFileConsumer(unittest.TestCase):
+    @inlineCallbacks
+    def test_basic(self):
+        f = io.BytesIO()
+        progress = []
+        hasher = hashlib.sha256()
+        fc = transit.ThreadedFileConsumer(f, progress.append, hasher.update)
+        fc.write(b"."* 99)
+        fc.write(b"!")
+        yield fc.finish()
+        self.assertEqual(f.getvalue(), b"."*99+b"!")
+        self.assertEqual(progress, [99, 1])
+        self.assertEqual(hasher.digest(),
+                         hashlib.sha256(b"."*99+b"!").digest())
+
+    @inlineCallbacks
+    def test_backpressure(self):
+        f = SlowFile()
+        p = MockProducer()
+        fc = transit.ThreadedFileConsumer(f)
+        fc.registerProducer(p, True)
+        chunk = b"." * (transit.WRITE_QUEUE_LIMIT // 4)
+        for i in range(4):
+            fc.write(chunk)
+        self.assertEqual(p.events, [])
+        fc.write(chunk)
+        self.assertEqual(p.events, ["pause"])
+        f.gate.set()
+        yield fc.finish()
+        self.assertEqual(p.events, ["pause", "resume"])
+        self.assertEqual(f.getvalue(), chunk * 5)
+
+    @inlineCallbacks
+    def test_unregister_while_paused(self):
+        f = SlowFile()
+        p = MockProducer()
+        fc = transit.ThreadedFileConsumer(f)
+        fc.registerProducer(p, True)
+        fc.write(b"." * (transit.WRITE_QUEUE_LIMIT + 1))
+        self.assertEqual(p.events, ["pause"])
+        fc.unregisterProducer()
+        self.assertEqual(p.events, ["pause", "resume"])
+        f.gate.set()
+        yield fc.finish()
+
+    @inlineCallbacks
+    def test_write_error(self):
+        p = MockProducer()
+        fc = transit.ThreadedFileConsumer(BrokenFile())
+        fc.registerProducer(p, True)
+        fc.write(b"data")
+        d = fc.finish()
+        yield self.assertFailure(d, IOError)
+        self.assertEqual(p.events, ["stop"])
+        self.assertEqual(fc._queued_bytes, 0)
+
+    @inlineCallbacks
+    def test_pool_lifetime(self):
+        r = ShutdownReactor()
+        f = io.BytesIO()
+        fc = transit.ThreadedFileConsumer(f, reactor=r)
+        # nothing is started until the first write
+        self.assertEqual(fc._pool, None)
+        self.assertEqual(r.triggers, {})
+        fc.write(b"data")
+        self.assertNotEqual(fc._pool, None)
+        self.assertEqual([t[:2] for t in r.triggers.values()],
+                         [("before", "shutdown")])
+        yield fc.finish()
+        self.assertEqual(fc._pool, None)
+        self.assertEqual(r.triggers, {})
+        self.assertEqual(f.getvalue(), b"data")
+
+    def test_shutdown_without_finish(self):
+        # if the transfer is abandoned before finish(), reactor shutdown
+        # still stops the writer thread
+        r = ShutdownReactor()
+        f = SlowFile()
+        fc = transit.ThreadedFileConsumer(f, reactor=r)
+        fc.write(b"data")
+        pool = fc._pool
+        [(phase, event, stop)] = r.triggers.values()
+        f.gate.set()
+        stop()
+        self.assertEqual(fc._pool, None)
+        self.assertEqual(r.triggers, {})
+        self.assertFalse(pool.started)
+
+    @inlineCallbacks
+    def test_write_to_file(self):
+        owner = MockOwner()
+        owner._state = "go"
+        c = transit.Connection(owner, None, None, "description")
+        c.transport = ProducingTransport(c, None)
+        c.factory = MockFactory()
+        c.connectionMade()
+        c.startNegotiation()
+        c.dataReceived(b"expect_this")
+        f = io.BytesIO()
+        hasher = hashlib.sha256()
+        d = c.writeToFile(f, 6, hasher=hasher.update, threaded=True)
+        box = SecretBox(owner._receiver_record_key())
+        for nonce, record in enumerate([b"abc", b"def"]):
+            encrypted = box.encrypt(record, transit.build_nonce(nonce))
+            c.dataReceived(transit.RECORD_LENGTH.pack(len(encrypted))
+                           + encrypted)
+        received = yield d
+        self.assertEqual(received, 6)
+        self.assertEqual(f.getvalue(), b"abcdef")
+        self.assertEqual(hasher.digest(), hashlib.sha256(b"abcdef").digest())
+
 
 DIRECT_HINT_JSON = {"type": "direct-tcp-v1",
                     "hostname": "direct", "port": 1234}
@@ -1596,6 +2406,133 @@ class Transit(unittest.TestCase):
         self._waiters[0].callback("winner")
         self.assertEqual(results, ["winner"])
 
+    def _direct_hint(self, hostname, priority=0.0):
+        return {"type": "direct-tcp-v1", "hostname": hostname,
+                "port": 1234, "priority": priority}
+
+    @inlineCallbacks
+    def test_staggered(self):
+        clock = task.Clock()
+        timing = DebugTiming()
+        s = transit.TransitSender("", reactor=clock, no_listen=True,
+                                  timing=timing)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints()
+        del hints
+        s.add_connection_hints([self._direct_hint("10.0.0.1"),
+                                self._direct_hint("10.0.0.2"),
+                                self._direct_hint("fd00::1"),
+                                self._direct_hint("10.0.0.3", 1.0),
+                                RELAY_HINT_JSON])
+        s._endpoint_from_hint_obj = self._endpoint_from_hint_obj
+        s._start_connector = self._start_connector
+
+        d = s.connect()
+        results = []
+        d.addBoth(results.append)
+        # one at a time, best first, alternating address families
+        self.assertEqual(self._connectors, ["10.0.0.3"])
+        clock.advance(s.ATTEMPT_DELAY)
+        self.assertEqual(self._connectors, ["10.0.0.3", "fd00::1"])
+        clock.advance(s.ATTEMPT_DELAY)
+        self.assertEqual(self._connectors, ["10.0.0.3", "fd00::1",
+                                            "10.0.0.1"])
+        clock.advance(s.ATTEMPT_DELAY)
+        self.assertEqual(self._connectors, ["10.0.0.3", "fd00::1",
+                                            "10.0.0.1", "10.0.0.2"])
+        # the relay still waits for RELAY_DELAY
+        clock.advance(s.RELAY_DELAY - 3*s.ATTEMPT_DELAY - 0.01)
+        self.assertEqual(len(self._connectors), 4)
+        clock.advance(0.01)
+        self.assertEqual(self._connectors[4:], ["relay"])
+
+        self._waiters[1].callback("winner")
+        self.assertEqual(results, ["winner"])
+        # the others were cancelled
+        for w in self._waiters:
+            self.assertTrue(w.called)
+        attempts = [e for e in timing._events
+                    if e._name == "transit attempt"]
+        self.assertEqual(len(attempts), 5)
+        self.assertEqual(attempts[1]._details,
+                         {"description": "->tcp:[fd00::1]:1234",
+                          "result": "connected"})
+        self.assertEqual(attempts[0]._details["result"], "cancelled")
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    @inlineCallbacks
+    def test_fast_failover(self):
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock, no_listen=True)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints()
+        del hints
+        s.add_connection_hints([self._direct_hint("10.0.0.1"),
+                                self._direct_hint("10.0.0.2"),
+                                RELAY_HINT_JSON])
+        s._endpoint_from_hint_obj = self._endpoint_from_hint_obj
+        s._start_connector = self._start_connector
+
+        d = s.connect()
+        results = []
+        d.addBoth(results.append)
+        self.assertEqual(self._connectors, ["10.0.0.1"])
+        # a refused connection starts the next attempt right away
+        self._waiters[0].errback(error.ConnectionRefusedError())
+        self.assertEqual(self._connectors, ["10.0.0.1", "10.0.0.2"])
+        # and when every direct hint has failed, so does the relay
+        self._waiters[1].errback(error.ConnectionRefusedError())
+        self.assertEqual(self._connectors, ["10.0.0.1", "10.0.0.2",
+                                            "relay"])
+        self.assertEqual(results, [])
+
+        self._waiters[2].callback("winner")
+        self.assertEqual(results, ["winner"])
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    @inlineCallbacks
+    def test_all_fail(self):
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock, no_listen=True)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints()
+        del hints
+        s.add_connection_hints([self._direct_hint("10.0.0.1"),
+                                RELAY_HINT_JSON])
+        s._endpoint_from_hint_obj = self._endpoint_from_hint_obj
+        s._start_connector = self._start_connector
+
+        d = s.connect()
+        self._waiters[0].errback(error.ConnectionRefusedError())
+        self._waiters[1].errback(error.ConnectionRefusedError())
+        self.failureResultOf(d, error.ConnectionRefusedError)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_order_same_network(self):
+        hints = [transit.DirectTCPV1Hint("10.0.0.1", 1, 0.0),
+                 transit.DirectTCPV1Hint("192.168.1.7", 1, 0.0),
+                 transit.DirectTCPV1Hint("2001:db8:1::1", 1, 0.0),
+                 transit.DirectTCPV1Hint("2001:db8:2::1", 1, 0.0),
+                 ]
+        ours = ["127.0.0.1", "192.168.1.3", "::1", "2001:db8:2::5"]
+        self.assertEqual([h.hostname for h in
+                          transit.order_direct_hints(hints, ours)],
+                         ["2001:db8:2::1", "192.168.1.7", "2001:db8:1::1",
+                          "10.0.0.1"])
+
+    def test_order_direct_hints(self):
+        hints = [transit.DirectTCPV1Hint("10.0.0.1", 1, 0.0),
+                 transit.DirectTCPV1Hint("10.0.0.2", 1, 0.0),
+                 transit.DirectTCPV1Hint("fd00::1", 1, 0.0),
+                 transit.DirectTCPV1Hint("fd00::2", 1, 0.0),
+                 transit.DirectTCPV1Hint("example.com", 1, 0.0),
+                 transit.DirectTCPV1Hint("10.0.0.3", 1, 2.0),
+                 ]
+        self.assertEqual([h.hostname for h in
+                          transit.order_direct_hints(hints)],
+                         ["10.0.0.3", "fd00::1", "10.0.0.1", "fd00::2",
+                          "10.0.0.2", "example.com"])
+
     @inlineCallbacks
     def test_no_direct_hints(self):
         clock = task.Clock()
@@ -1615,11 +2552,8 @@ class Transit(unittest.TestCase):
         results = []
         d.addBoth(results.append)
         self.assertEqual(results, [])
-        # since there are no usable direct hints, the relay connector will
-        # only be stalled for 0 seconds
-        self.assertEqual(self._connectors, [])
-
-        clock.advance(0)
+        # since there are no usable direct hints, the relay connector
+        # starts right away
         self.assertEqual(self._connectors, ["relay"])
 
         self._waiters[0].callback("winner")
@@ -1732,3 +2666,149 @@ class Full(ServerBase, unittest.TestCase):
 
         yield x.close()
         yield y.close()
+
+    @inlineCallbacks
+    def _do_striped(self, relay, streams, sender_streams=None,
+                    pooled_crypto=False, receiver_first=False):
+        KEY = b"k"*32
+        no_listen = bool(relay)
+        s = transit.TransitSender(relay, no_listen=no_listen,
+                                  streams=sender_streams or streams,
+                                  pooled_crypto=pooled_crypto)
+        r = transit.TransitReceiver(relay, no_listen=no_listen,
+                                    streams=streams,
+                                    pooled_crypto=pooled_crypto)
+
+        s.set_transit_key(KEY)
+        r.set_transit_key(KEY)
+
+        if receiver_first:
+            # the receiver offers all of its streams before it hears how
+            # many the sender wants
+            rhints = yield r.get_connection_hints()
+            s.add_connection_hints(rhints)
+            shints = yield s.get_connection_hints()
+            r.add_connection_hints(shints)
+        else:
+            shints = yield s.get_connection_hints()
+            r.add_connection_hints(shints)
+            rhints = yield r.get_connection_hints()
+            s.add_connection_hints(rhints)
+
+        (x,y) = yield self.doBoth(s.connect(), r.connect())
+        returnValue((x, y))
+
+    @inlineCallbacks
+    def test_striped_direct(self):
+        (x, y) = yield self._do_striped(None, 3)
+        self.assertIsInstance(x, transit.StripedConnection)
+        self.assertIsInstance(y, transit.StripedConnection)
+        self.assertEqual(len(x._connections), 3)
+        self.assertEqual(len(y._connections), 3)
+
+        records = [("record%d" % i).encode("ascii") for i in range(10)]
+        f = io.BytesIO()
+        d = y.writeToFile(f, sum([len(r) for r in records]))
+        for r in records:
+            x.send_record(r)
+        yield d
+        self.assertEqual(f.getvalue(), b"".join(records))
+
+        # and the other direction
+        d = x.receive_record()
+        y.send_record(b"ack")
+        ack = yield d
+        self.assertEqual(ack, b"ack")
+
+        yield x.close()
+        yield y.close()
+
+    @inlineCallbacks
+    def test_striped_relay(self):
+        (x, y) = yield self._do_striped(self.transit, 2)
+        self.assertIsInstance(x, transit.StripedConnection)
+        self.assertIsInstance(y, transit.StripedConnection)
+
+        d = y.receive_record()
+        x.send_record(b"record1")
+        r = yield d
+        self.assertEqual(r, b"record1")
+
+        yield x.close()
+        yield y.close()
+
+    @inlineCallbacks
+    def test_striped_declined(self):
+        # the receiver only offers a single stream, so we don't stripe
+        (x, y) = yield self._do_striped(None, 1, sender_streams=3)
+        self.assertIsInstance(x, transit.Connection)
+        self.assertIsInstance(y, transit.Connection)
+
+        d = y.receive_record()
+        x.send_record(b"record1")
+        r = yield d
+        self.assertEqual(r, b"record1")
+
+        yield x.close()
+        yield y.close()
+
+    @inlineCallbacks
+    def test_striped_mismatched(self):
+        # both offers cross: each side offers all it can, and they agree
+        # on the smaller number
+        (x, y) = yield self._do_striped(None, 4, sender_streams=2,
+                                        receiver_first=True)
+        self.assertEqual(len(x._connections), 2)
+        self.assertEqual(len(y._connections), 2)
+
+        d = y.receive_record()
+        x.send_record(b"record1")
+        r = yield d
+        self.assertEqual(r, b"record1")
+
+        yield x.close()
+        yield y.close()
+
+    @inlineCallbacks
+    def test_striped_mismatched_fewer_receiver_streams(self):
+        (x, y) = yield self._do_striped(None, 2, sender_streams=3,
+                                        receiver_first=True)
+        self.assertEqual(len(x._connections), 2)
+        self.assertEqual(len(y._connections), 2)
+        yield x.close()
+        yield y.close()
+
+    @inlineCallbacks
+    def test_pooled_crypto(self):
+        (x, y) = yield self._do_striped(None, 1, pooled_crypto=True)
+        data = os.urandom(1000*1000)
+        f = io.BytesIO()
+        d = y.writeToFile(f, len(data))
+        fs = basic.FileSender()
+        fs.CHUNK_SIZE = 10*1000
+        yield fs.beginFileTransfer(io.BytesIO(data), x)
+        yield d
+        self.assertEqual(f.getvalue(), data)
+
+        d = x.receive_record()
+        y.send_record(b"ack")
+        ack = yield d
+        self.assertEqual(ack, b"ack")
+
+        yield x.close()
+        yield y.close()
+
+    @inlineCallbacks
+    def test_pooled_crypto_striped(self):
+        (x, y) = yield self._do_striped(None, 2, pooled_crypto=True)
+        self.assertIsInstance(x, transit.StripedConnection)
+        records = [("record%d" % i).encode("ascii") for i in range(50)]
+        f = io.BytesIO()
+        d = y.writeToFile(f, sum([len(r) for r in records]))
+        for r in records:
+            x.send_record(r)
+        yield d
+        self.assertEqual(f.getvalue(), b"".join(records))
+
+        yield x.close()
+        yield y.close()
@@ -7,7 +7,7 @@ from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
 from twisted.internet.error import ConnectionRefusedError
 from .common import ServerBase, poll_until, pause_one_tick
 from .. import wormhole, _rendezvous
-from ..errors import (WrongPasswordError, ServerConnectionError,
+from ..errors import (WrongPasswordError, ServerConnectionError, ServerError,
                       KeyFormatError, WormholeClosed, LonelyError,
                       NoKeyError, OnlyOneCodeError)
 from ..transit import allocate_tcp_port
@@ -623,6 +623,100 @@ class Reconnection(ServerBase, unittest.TestCase):
         c2 = yield w2.close()
         self.assertEqual(c2, "happy")
 
+class Pooled(ServerBase, unittest.TestCase):
+    @inlineCallbacks
+    def test_shared(self):
+        pool = wormhole.create_pool(self.relayurl, reactor)
+        self.addCleanup(pool.close)
+        pairs = []
+        for i in range(3):
+            w1 = wormhole.create(APPID, self.relayurl, reactor, pool=pool)
+            w2 = wormhole.create(APPID, self.relayurl, reactor, pool=pool)
+            w1.allocate_code()
+            code = yield w1.get_code()
+            w2.set_code(code)
+            pairs.append((w1, w2))
+        self.assertEqual(pool.count_sessions(), 6)
+        # they all use the same WebSocket
+        connections = set([w._boss._RC._ws for pair in pairs for w in pair])
+        self.assertEqual(connections, set([pool._ws]))
+
+        for (i, (w1, w2)) in enumerate(pairs):
+            w1.send_message(("data%d" % i).encode("ascii"))
+        for (i, (w1, w2)) in enumerate(pairs):
+            data = yield w2.get_message()
+            self.assertEqual(data, ("data%d" % i).encode("ascii"))
+            w2.send_message(b"reply")
+            data = yield w1.get_message()
+            self.assertEqual(data, b"reply")
+        for (w1, w2) in pairs:
+            c1 = yield w1.close()
+            self.assertEqual(c1, "happy")
+            c2 = yield w2.close()
+            self.assertEqual(c2, "happy")
+        self.assertEqual(pool.count_sessions(), 0)
+
+        # the connection outlives them, for the next wormhole to use
+        ws = pool._ws
+        w1 = wormhole.create(APPID, self.relayurl, reactor, pool=pool)
+        w1.allocate_code()
+        yield w1.get_code()
+        self.assertIdentical(w1._boss._RC._ws, ws)
+        yield self.assertFailure(w1.close(), LonelyError)
+
+    @inlineCallbacks
+    def test_reconnect(self):
+        pool = wormhole.create_pool(self.relayurl, reactor)
+        self.addCleanup(pool.close)
+        w1 = wormhole.create(APPID, self.relayurl, reactor, pool=pool)
+        w1.allocate_code()
+        code = yield w1.get_code()
+        w1.send_message(b"data1")
+        yield poll_until(lambda: self._rendezvous.get_app(APPID)
+                         ._mailboxes)
+        # drop the shared connection: the sessions bind again
+        pool._ws.transport.loseConnection()
+        w2 = wormhole.create(APPID, self.relayurl, reactor, pool=pool)
+        w2.set_code(code)
+        data = yield w2.get_message()
+        self.assertEqual(data, b"data1")
+        c1 = yield w1.close()
+        self.assertEqual(c1, "happy")
+        c2 = yield w2.close()
+        self.assertEqual(c2, "happy")
+
+    def test_wrong_url(self):
+        pool = wormhole.create_pool(self.relayurl, reactor)
+        self.assertRaises(ValueError, wormhole.create, APPID,
+                          "ws://example.org/v1", reactor, pool=pool)
+
+    @inlineCallbacks
+    def test_old_server(self):
+        # a server that cannot multiplex does not say "sessions"
+        from ..server import rendezvous_websocket
+        def onOpen(proto):
+            proto.send("welcome", welcome={})
+        self.patch(rendezvous_websocket.WebSocketRendezvous, "onOpen",
+                   onOpen)
+        pool = wormhole.create_pool(self.relayurl, reactor)
+        self.addCleanup(pool.close)
+        w = wormhole.create(APPID, self.relayurl, reactor, pool=pool)
+        e = yield self.assertFailure(w.get_code(), ServerError)
+        self.assertIn("cannot share connections", str(e))
+
+    @inlineCallbacks
+    def test_no_connection(self):
+        port = allocate_tcp_port()
+        url = "ws://127.0.0.1:%d/v1" % port
+        pool = wormhole.create_pool(url, reactor)
+        w1 = wormhole.create(APPID, url, reactor, pool=pool)
+        e = yield self.assertFailure(w1.get_code(), ServerConnectionError)
+        self.assertIsInstance(e.reason, ConnectionRefusedError)
+        # later wormholes hear about it too
+        w2 = wormhole.create(APPID, url, reactor, pool=pool)
+        e = yield self.assertFailure(w2.get_code(), ServerConnectionError)
+        self.assertIsInstance(e.reason, ConnectionRefusedError)
+
 class InitialFailure(unittest.TestCase):
     def assertSCEResultOf(self, d, innerType):
         f = self.failureResultOf(d, ServerConnectionError)
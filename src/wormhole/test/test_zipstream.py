@@ -0,0 +1,330 @@
+from __future__ import print_function, unicode_literals
+import os, io, stat, struct, zipfile, errno
+import mock
+from twisted.trial import unittest
+from ..cli import zipstream, zipbuild, compress
+from ..cli.dirstream import BadStream
+
+class Unstreamable(io.RawIOBase):
+    # zipfile can't seek back to fill in the local headers, so it writes
+    # data descriptors instead
+    def __init__(self):
+        self.data = io.BytesIO()
+    def writable(self):
+        return True
+    def write(self, data):
+        return self.data.write(data)
+    def seekable(self):
+        return False
+    def tell(self):
+        raise IOError("not seekable")
+
+class BrokenFile(io.BytesIO):
+    # the first 'good' bytes can be read, then the disk goes away
+    def __init__(self, data, good):
+        io.BytesIO.__init__(self, data)
+        self.good = good
+    def read(self, size=-1):
+        if self.tell() >= self.good:
+            raise IOError(errno.EIO, "Input/output error")
+        return io.BytesIO.read(self, size)
+
+class Unpack(unittest.TestCase):
+    files = [("a", b"first file", 0o644),
+             ("empty", b"", 0o600),
+             ("sub/dir/b", b"x"*100000, 0o755),
+             ("sub/dir/c", os.urandom(10000), 0o640),
+             ]
+
+    def build(self, compression, stream=False):
+        f = Unstreamable() if stream else io.BytesIO()
+        with zipfile.ZipFile(f, "w", compression) as zf:
+            zf.writestr(zipfile.ZipInfo("sub/"), b"")
+            for name, data, mode in self.files:
+                zi = zipfile.ZipInfo(name)
+                zi.compress_type = compression
+                zi.external_attr = mode << 16
+                zf.writestr(zi, data)
+        if stream:
+            return f.data.getvalue()
+        return f.getvalue()
+
+    def unpack(self, data, chunksize):
+        outdir = self.mktemp()
+        os.mkdir(outdir)
+        u = zipstream.ZipUnpacker(outdir)
+        for i in range(0, len(data), chunksize):
+            u.write(data[i:i+chunksize])
+        u.close()
+        return outdir, u
+
+    def check(self, data):
+        for chunksize in [1, 7, 1000, 1024*1024]:
+            outdir, u = self.unpack(data, chunksize)
+            self.assertTrue(u.finished)
+            self.assertEqual(u.numfiles, len(self.files))
+            self.assertEqual(u.numbytes,
+                             sum([len(d) for (n, d, m) in self.files]))
+            for name, contents, mode in self.files:
+                fn = os.path.join(outdir, *name.split("/"))
+                with open(fn, "rb") as f:
+                    self.assertEqual(f.read(), contents)
+                self.assertEqual(stat.S_IMODE(os.stat(fn).st_mode), mode)
+
+    def test_stored(self):
+        self.check(self.build(zipfile.ZIP_STORED))
+
+    def test_deflated(self):
+        self.check(self.build(zipfile.ZIP_DEFLATED))
+
+    def test_deflated_descriptors(self):
+        data = self.build(zipfile.ZIP_DEFLATED, stream=True)
+        # make sure we really are exercising the data-descriptor path
+        (flags,) = struct.unpack("<H", data[6:8])
+        if not flags & zipstream.FLAG_DESCRIPTOR:
+            raise unittest.SkipTest("this zipfile module seeks anyway")
+        self.check(data)
+
+    def test_stored_descriptors(self):
+        data = self.build(zipfile.ZIP_STORED, stream=True)
+        (flags,) = struct.unpack("<H", data[6:8])
+        if not flags & zipstream.FLAG_DESCRIPTOR:
+            raise unittest.SkipTest("this zipfile module seeks anyway")
+        outdir = self.mktemp()
+        os.mkdir(outdir)
+        u = zipstream.ZipUnpacker(outdir)
+        e = self.assertRaises(BadStream, u.write, data)
+        self.assertIn("cannot unpack", str(e))
+
+    def test_escape(self):
+        f = io.BytesIO()
+        with zipfile.ZipFile(f, "w") as zf:
+            zf.writestr(zipfile.ZipInfo("../escaped"), b"data")
+        outdir = self.mktemp()
+        os.mkdir(outdir)
+        u = zipstream.ZipUnpacker(outdir)
+        e = self.assertRaises(BadStream, u.write, f.getvalue())
+        self.assertIn("malicious zipfile", str(e))
+        self.assertFalse(os.path.exists(os.path.join(outdir, "..",
+                                                     "escaped")))
+
+    def unpack_members(self, members):
+        f = io.BytesIO()
+        with zipfile.ZipFile(f, "w") as zf:
+            for name, mode in members:
+                zi = zipfile.ZipInfo(name)
+                zi.external_attr = mode << 16
+                zf.writestr(zi, b"")
+        outdir = self.mktemp()
+        os.mkdir(outdir)
+        u = zipstream.ZipUnpacker(outdir)
+        u.write(f.getvalue())
+        return outdir, u
+
+    def test_modes(self):
+        outdir, u = self.unpack_members([("suid", 0o6777),
+                                         ("unreadable", 0)])
+        self.assertTrue(u.finished)
+        for name, mode in [("suid", 0o775), ("unreadable", 0o600)]:
+            fn = os.path.join(outdir, name)
+            self.assertEqual(stat.S_IMODE(os.stat(fn).st_mode), mode)
+
+    def test_collision(self):
+        e = self.assertRaises(BadStream, self.unpack_members,
+                              [("a", 0o644), ("a/b", 0o644)])
+        self.assertIn("unable to create a/b", str(e))
+
+    def test_bad_crc(self):
+        data = bytearray(self.build(zipfile.ZIP_STORED))
+        # flip a byte of "first file"
+        offset = data.index(b"first file")
+        data[offset] ^= 0xff
+        e = self.assertRaises(BadStream, self.unpack, bytes(data), 1000)
+        self.assertIn("bad CRC", str(e))
+
+    def test_unknown_method(self):
+        data = bytearray(self.build(zipfile.ZIP_STORED))
+        struct.pack_into("<H", data, 8, 12) # bzip2
+        e = self.assertRaises(BadStream, self.unpack, bytes(data), 1000)
+        self.assertIn("unsupported compression method", str(e))
+
+    def test_garbage(self):
+        e = self.assertRaises(BadStream, self.unpack, b"not a zipfile", 1000)
+        self.assertIn("unrecognized zipfile record", str(e))
+
+    def test_data_after_end(self):
+        data = self.build(zipfile.ZIP_DEFLATED)
+        e = self.assertRaises(BadStream, self.unpack, data + b"more", 1000)
+        self.assertIn("data after the end", str(e))
+
+    def test_incomplete(self):
+        data = self.build(zipfile.ZIP_DEFLATED)
+        outdir, u = self.unpack(data[:-10], 1000)
+        self.assertFalse(u.finished)
+
+class Build(unittest.TestCase):
+    files = [("a", b"ponies\n" * 1000, 0o644),
+             ("empty", b"", 0o600),
+             ("sub/b", os.urandom(3000), 0o755),
+             ("sub/ë", b"unicorns\n" * 300000, 0o640),
+             ]
+
+    def build(self, compression, level=6):
+        return self.build_with_stats(compression, level)[1]
+
+    def build_with_stats(self, compression, level=6):
+        srcdir = self.mktemp()
+        zb_out = io.BytesIO()
+        zb = zipbuild.ZipBuilder(zb_out, compression, level, threads=3)
+        for name, data, mode in self.files:
+            fn = os.path.join(srcdir, *name.split("/"))
+            if not os.path.isdir(os.path.dirname(fn)):
+                os.makedirs(os.path.dirname(fn))
+            with open(fn, "wb") as f:
+                f.write(data)
+            os.chmod(fn, mode)
+            self.assertEqual(zb.add(fn, name), len(data))
+        zb.close()
+        return zb, zb_out.getvalue()
+
+    def check(self, data, compress_type):
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertEqual(zf.testzip(), None)
+            for name, contents, mode in self.files:
+                zi = zf.getinfo(name)
+                if name in ("empty", "sub/b"):
+                    # nothing to gain from deflating these
+                    self.assertEqual(zi.compress_type, zipfile.ZIP_STORED)
+                else:
+                    self.assertEqual(zi.compress_type, compress_type)
+                self.assertEqual(zf.read(name), contents)
+                self.assertEqual(stat.S_IMODE(zi.external_attr >> 16), mode)
+        outdir = self.mktemp()
+        os.mkdir(outdir)
+        u = zipstream.ZipUnpacker(outdir)
+        u.write(data)
+        self.assertTrue(u.finished)
+        self.assertEqual(u.numfiles, len(self.files))
+
+    def test_store(self):
+        self.check(self.build("store"), zipfile.ZIP_STORED)
+
+    def test_deflate(self):
+        for level in [1, 6, 9]:
+            self.check(self.build("deflate", level), zipfile.ZIP_DEFLATED)
+
+    def test_skip_incompressible(self):
+        zb, data = self.build_with_stats("deflate")
+        self.assertEqual(zb.stored_files, 2)
+        self.assertEqual(zb.numbytes,
+                         sum([len(d) for (n, d, m) in self.files]))
+        self.assertLess(zb.compressed_bytes, zb.numbytes)
+        self.assertLess(zb.compressed_bytes, len(data))
+
+        zb, data = self.build_with_stats("store")
+        self.assertEqual(zb.stored_files, 0)
+        self.assertEqual(zb.compressed_bytes, zb.numbytes)
+
+    def test_zip64(self):
+        # pretend everything is huge, to exercise the zip64 records
+        self.patch(zipbuild, "ZIP64_LIMIT", 100)
+        self.check(self.build("deflate"), zipfile.ZIP_DEFLATED)
+
+    def test_unknown_compression(self):
+        self.assertRaises(ValueError, zipbuild.ZipBuilder, io.BytesIO(),
+                          "bzip2")
+
+    def test_unreadable(self):
+        out = io.BytesIO()
+        zb = zipbuild.ZipBuilder(out, "deflate")
+        e = self.assertRaises(zipbuild.UnreadableFile, zb.add,
+                              os.path.join(self.mktemp(), "missing"), "missing")
+        self.assertFalse(e.partial)
+        # nothing of it went in, so the archive is still fine without it
+        self.assertEqual(out.getvalue(), b"")
+        zb.close()
+        with zipfile.ZipFile(out) as zf:
+            self.assertEqual(zf.namelist(), [])
+
+    def make_file(self, size):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(b"x" * size)
+        return fn
+
+    def test_read_error(self):
+        fn = self.make_file(3*compress.BLOCK_SIZE)
+        zb = zipbuild.ZipBuilder(io.BytesIO(), "store")
+        broken = BrokenFile(b"x" * (3*compress.BLOCK_SIZE),
+                            2*compress.BLOCK_SIZE)
+        with mock.patch("wormhole.cli.zipbuild.open", create=True,
+                        return_value=broken):
+            e = self.assertRaises(zipbuild.UnreadableFile, zb.add, fn, "f")
+        # the first block was handed on before the second read failed
+        self.assertTrue(e.partial)
+        self.assertEqual(e.reason, "Input/output error")
+
+    def test_unreadable_after_first_block(self):
+        # if the second read fails, nothing has been handed on yet
+        fn = self.make_file(compress.BLOCK_SIZE)
+        zb = zipbuild.ZipBuilder(io.BytesIO(), "store")
+        broken = BrokenFile(b"x" * (2*compress.BLOCK_SIZE),
+                            compress.BLOCK_SIZE)
+        with mock.patch("wormhole.cli.zipbuild.open", create=True,
+                        return_value=broken):
+            e = self.assertRaises(zipbuild.UnreadableFile, zb.add, fn, "f")
+        self.assertFalse(e.partial)
+
+    def test_grew_too_large(self):
+        fn = self.make_file(1000)
+        self.patch(zipbuild, "ZIP64_LIMIT", 100)
+        small = mock.Mock(st_size=10, st_mtime=0, st_mode=0o644)
+        zb = zipbuild.ZipBuilder(io.BytesIO(), "store")
+        with mock.patch("wormhole.cli.zipbuild.os.stat", return_value=small):
+            e = self.assertRaises(zipbuild.UnreadableFile, zb.add, fn, "f")
+        self.assertTrue(e.partial)
+        self.assertIn("grew too large", str(e))
+
+class Compress(unittest.TestCase):
+    def test_looks_compressible(self):
+        self.assertTrue(compress.looks_compressible(b"ponies\n" * 1000))
+        self.assertFalse(compress.looks_compressible(os.urandom(10000)))
+        self.assertFalse(compress.looks_compressible(b""))
+
+    def test_roundtrip(self):
+        for data in [b"", b"ponies\n" * 1000,
+                     (b"unicorns\n" * 100 + os.urandom(100)) * 3000]:
+            compressed = io.BytesIO()
+            size = compress.compress_file(io.BytesIO(data), compressed, 6,
+                                          threads=3)
+            self.assertEqual(size, len(data))
+            out = io.BytesIO()
+            out.name = "out"
+            f = compress.InflatingFile(out, len(data))
+            cdata = compressed.getvalue()
+            for i in range(0, len(cdata), 1000):
+                f.write(cdata[i:i+1000])
+            self.assertTrue(f.complete)
+            self.assertEqual(out.getvalue(), data)
+
+    def test_bad_data(self):
+        out = io.BytesIO()
+        out.name = "out"
+        compressed = io.BytesIO()
+        compress.compress_file(io.BytesIO(b"ponies\n" * 1000), compressed, 6)
+        cdata = compressed.getvalue()
+
+        f = compress.InflatingFile(out, 7000)
+        self.assertRaises(compress.BadCompressedData, f.write, cdata + b"x")
+
+        f = compress.InflatingFile(out, 10)
+        e = self.assertRaises(compress.BadCompressedData, f.write, cdata)
+        self.assertIn("too much data", str(e))
+
+        f = compress.InflatingFile(out, 7000)
+        f.write(cdata[:-5])
+        self.assertFalse(f.complete)
+
+        f = compress.InflatingFile(out, 7000)
+        self.assertRaises(compress.BadCompressedData, f.write,
+                          b"\xff" * 100)
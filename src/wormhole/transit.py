@@ -1,17 +1,18 @@
 # no unicode_literals, revisit after twisted patch
 from __future__ import print_function, absolute_import
-import os, re, sys, time, socket
+import os, re, sys, time, socket, struct, functools
 from collections import namedtuple, deque
-from binascii import hexlify, unhexlify
+from binascii import hexlify
 import six
 from zope.interface import implementer
-from twisted.python import log
+from twisted.python import log, threadpool, failure
 from twisted.python.runtime import platformType
 from twisted.internet import (reactor, interfaces, defer, protocol,
-                              endpoints, task, address, error)
+                              endpoints, address, error, threads)
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.protocols import policies
 from nacl.secret import SecretBox
+from nacl.bindings import crypto_secretbox
 from hkdf import Hkdf
 from .errors import InternalError
 from .timing import DebugTiming
@@ -33,6 +34,9 @@ class TransitClosed(TransitError):
 class BadNonce(TransitError):
     pass
 
+class RecordTooLarge(TransitError):
+    pass
+
 # The beginning of each TCP connection consists of the following handshake
 # messages. The sender transmits the same text regardless of whether it is on
 # the initiating/connecting end of the TCP connection, or on the
@@ -95,9 +99,14 @@ TorTCPV1Hint = namedtuple("TorTCPV1Hint", ["hostname", "port", "priority"])
 # rest of the V1 protocol. Only one hint per relay is useful.
 RelayV1Hint = namedtuple("RelayV1Hint", ["hints"])
 
+def _hostport(hostname, port):
+    if ":" in hostname: # IPv6
+        return u"[%s]:%d" % (hostname, port)
+    return u"%s:%d" % (hostname, port)
+
 def describe_hint_obj(hint):
     if isinstance(hint, DirectTCPV1Hint):
-        return u"tcp:%s:%d" % (hint.hostname, hint.port)
+        return u"tcp:%s" % _hostport(hint.hostname, hint.port)
     elif isinstance(hint, TorTCPV1Hint):
         return u"tor:%s:%d" % (hint.hostname, hint.port)
     else:
@@ -116,6 +125,12 @@ def parse_hint_argv(hint, stderr=sys.stderr):
         print("unknown hint type '%s' in '%s'" % (hint_type, hint), file=stderr)
         return None
     hint_value = mo.group(2)
+    hint_host = None
+    mo = re.search(r'^\[([0-9a-fA-F:.]+)\](:.*)$', hint_value)
+    if mo:
+        # an IPv6 address, like tcp:[2001:db8::1]:4001
+        hint_host = mo.group(1)
+        hint_value = "ipv6" + mo.group(2)
     pieces = hint_value.split(":")
     if len(pieces) < 2:
         print("unparseable TCP hint (need more colons) '%s'" % (hint,),
@@ -125,7 +140,7 @@ def parse_hint_argv(hint, stderr=sys.stderr):
     if not mo:
         print("non-numeric port in TCP hint '%s'" % (hint,), file=stderr)
         return None
-    hint_host = pieces[0]
+    hint_host = hint_host or pieces[0]
     hint_port = int(pieces[1])
     for more in pieces[2:]:
         if more.startswith("priority="):
@@ -140,23 +155,399 @@ def parse_hint_argv(hint, stderr=sys.stderr):
 
 TIMEOUT = 60 # seconds
 
+# A transfer may be striped across at most this many connections
+MAX_STREAMS = 8
+
+# Records can be up to 4GB, but the file-transfer protocol historically sent
+# one record per 16KiB FileSender chunk. A receiver that is happy to get
+# bigger records (which means fewer SecretBox calls and less per-record
+# overhead) says so with "max-record-size" in its answer. Peers which don't
+# say anything get DEFAULT_RECORD_SIZE. A receiver can enforce the size it
+# asked for with Connection.set_max_record_size(), but must always accept
+# DEFAULT_RECORD_SIZE.
+DEFAULT_RECORD_SIZE = 16*1024
+MAX_RECORD_SIZE = 4*1024*1024
+
+# Each record on the wire is a 4-byte big-endian length, followed by the
+# SecretBox output (24-byte nonce, then ciphertext). Nonces are big-endian
+# counters, packed here as three 64-bit words.
+RECORD_LENGTH = struct.Struct(">L")
+RECORD_NONCE = struct.Struct(">QQQ")
+RECORD_OVERHEAD = SecretBox.NONCE_SIZE + SecretBox.MACBYTES
+_WORD = 2**64 - 1
+
+def build_nonce(n):
+    return RECORD_NONCE.pack(n >> 128, (n >> 64) & _WORD, n & _WORD)
+
+# By default, records are encrypted and decrypted on the reactor thread, one
+# at a time. With a RecordCrypto, Connections hand that work to the
+# reactor's thread pool instead. libsodium releases the GIL, so on a
+# multi-core host the crypto for several records can run at once, and
+# overlap with socket I/O and with the FileConsumer. Results are put back
+# into nonce order before they reach the transport (or the application).
+
+CRYPTO_QUEUE_LIMIT = 16 # records in the thread pool, per direction
+
+class RecordCrypto:
+    def __init__(self, reactor):
+        self._reactor = reactor
+
+    def run(self, f, *args):
+        return threads.deferToThreadPool(self._reactor,
+                                         self._reactor.getThreadPool(),
+                                         f, *args)
+
+def seal_record(record, nonce, key):
+    ciphertext = crypto_secretbox(record, nonce, key)
+    length = RECORD_LENGTH.pack(len(nonce) + len(ciphertext))
+    return [length, nonce, ciphertext]
+
+class _OrderedJobs:
+    """I run jobs through a RecordCrypto, and pass their results to
+    'deliver' in the order the jobs were submitted, no matter which order
+    they finish in. If any job fails, 'failed' is called with the Failure."""
+
+    def __init__(self, crypto, deliver, failed):
+        self._crypto = crypto
+        self._deliver = deliver
+        self._failed = failed
+        self._jobs = deque() # [done, result]
+        self._delivering = False
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def submit(self, f, *args):
+        job = [False, None]
+        self._jobs.append(job)
+        d = self._crypto.run(f, *args)
+        d.addCallbacks(self._done, self._job_failed, callbackArgs=(job,))
+
+    def _done(self, result, job):
+        job[0], job[1] = True, result
+        if self._delivering:
+            return # the loop below will get to it
+        self._delivering = True
+        try:
+            while self._jobs and self._jobs[0][0]:
+                (done, result) = self._jobs.popleft()
+                self._deliver(result)
+        finally:
+            self._delivering = False
+
+    def _job_failed(self, f):
+        self.clear()
+        self._failed(f)
+
+    def clear(self):
+        # results of jobs still running will be dropped
+        self._jobs.clear()
+
+@implementer(interfaces.IPushProducer)
+class _CryptoProducer:
+    # registered with the transport of a pooled-crypto Connection, to tell
+    # it when the transport wants more outbound data
+    def __init__(self, connection):
+        self._connection = connection
+
+    def resumeProducing(self):
+        self._connection._transport_resumed()
+
+    def pauseProducing(self):
+        self._connection._transport_paused()
+
+    def stopProducing(self):
+        self._connection._transport_stopped()
+
+# Inbound records that nobody has read yet are queued, up to this many
+# bytes. Beyond that, we pause the transport until the reader has caught up
+# to half of it.
+INBOUND_QUEUE_LIMIT = 8*1024*1024
+
+try:
+    _StopAsyncIteration = StopAsyncIteration
+except NameError: # py2
+    class _StopAsyncIteration(Exception):
+        pass
+
+class _Ready(object):
+    # an awaitable for a value we already have, which (unlike a Deferred)
+    # costs next to nothing
+    def __init__(self, value):
+        self._value = value
+    def __await__(self):
+        return self
+    def __iter__(self):
+        return self
+    def __next__(self):
+        raise StopIteration(self._value)
+    next = __next__
+
+class _RecordIterator(object):
+    def __init__(self, inbound):
+        self._inbound = inbound
+    def __aiter__(self):
+        return self
+    def __anext__(self):
+        return self._inbound._next_record()
+
+class _InboundRecords:
+    """I deliver inbound records to my owner, either one at a time through
+    receive_record(), records() or read_into(), or as a stream of bytes to
+    an attached IConsumer. My subclass must call recordReceived() with each
+    record, in order, call _abandon_reads() when no more will arrive, and
+    implement the IProducer methods."""
+
+    def _init_inbound_records(self):
+        self._consumer = None
+        self._consumer_bytes_written = 0
+        self._consumer_bytes_expected = None
+        self._consumer_deferred = None
+        self._inbound_records = deque()
+        self._inbound_bytes = 0
+        self._inbound_offset = 0 # into the first record, used by read_into()
+        self._inbound_limit = INBOUND_QUEUE_LIMIT
+        self._inbound_throttled = False
+        self._inbound_closed = False
+        self._waiting_reads = deque() # (Deferred, buffer or None)
+
+    def recordReceived(self, record):
+        if self._consumer:
+            self._writeToConsumer(record)
+            return
+        self._inbound_records.append(record)
+        self._inbound_bytes += len(record)
+        self._deliverRecords()
+        if (self._inbound_bytes > self._inbound_limit
+            and not self._inbound_throttled):
+            self._inbound_throttled = True
+            self.pauseProducing()
+
+    def set_inbound_limit(self, limit):
+        """Queue up to 'limit' bytes of unread records before pausing the
+        transport."""
+        self._inbound_limit = limit
+        self._consumed(0)
+
+    def receive_record(self):
+        """Return a Deferred that fires with the next record."""
+        d = defer.Deferred()
+        self._waiting_reads.append((d, None))
+        self._deliverRecords()
+        return d
+
+    def records(self):
+        """Return an async iterator over the inbound records, which stops
+        when the connection is closed. Records that have already arrived
+        are handed over without allocating a Deferred:
+
+            async for record in connection.records():
+                ...
+        """
+        return _RecordIterator(self)
+
+    def read_into(self, buffer):
+        """Copy as many bytes of the inbound records as are available (and
+        fit) into 'buffer' (a bytearray or writable memoryview), treating
+        the records as one stream of bytes. Returns a Deferred that fires
+        with the number of bytes copied, waiting for a record to arrive if
+        none has. It fires with 0 once the connection is closed and every
+        record has been read."""
+        d = defer.Deferred()
+        self._waiting_reads.append((d, buffer))
+        self._deliverRecords()
+        return d
+
+    def _next_record(self):
+        if self._inbound_records and not self._waiting_reads:
+            return _Ready(self._take_record())
+        if self._inbound_closed and not self._inbound_records:
+            return defer.fail(_StopAsyncIteration())
+        def _closed(f):
+            f.trap(error.ConnectionClosed)
+            raise _StopAsyncIteration()
+        return self.receive_record().addErrback(_closed)
+
+    def _deliverRecords(self):
+        while self._waiting_reads:
+            d, buffer = self._waiting_reads[0]
+            if buffer is None:
+                if not self._inbound_records:
+                    return
+                self._waiting_reads.popleft()
+                d.callback(self._take_record())
+            else:
+                if not self._inbound_bytes and not self._inbound_closed:
+                    return
+                self._waiting_reads.popleft()
+                d.callback(self._fill(buffer))
+
+    def _take_record(self):
+        r = self._inbound_records.popleft()
+        if self._inbound_offset:
+            r = r[self._inbound_offset:]
+            self._inbound_offset = 0
+        self._consumed(len(r))
+        return r
+
+    def _fill(self, buffer):
+        view = memoryview(buffer)
+        filled = 0
+        while filled < len(view) and self._inbound_records:
+            head = self._inbound_records[0]
+            start = self._inbound_offset
+            n = min(len(head) - start, len(view) - filled)
+            view[filled:filled+n] = memoryview(head)[start:start+n]
+            filled += n
+            if start + n == len(head):
+                self._inbound_records.popleft()
+                self._inbound_offset = 0
+            else:
+                self._inbound_offset = start + n
+        self._consumed(filled)
+        return filled
+
+    def _consumed(self, count):
+        self._inbound_bytes -= count
+        if (self._inbound_throttled
+            and self._inbound_bytes <= self._inbound_limit // 2):
+            self._inbound_throttled = False
+            self.resumeProducing()
+
+    def connectConsumer(self, consumer, expected=None):
+        """Helper method to glue an instance of e.g. t.p.ftp.FileConsumer to
+        us. Inbound records will be written as bytes to the consumer.
+
+        Set 'expected' to an integer to automatically disconnect when at
+        least that number of bytes have been written. This function will then
+        return a Deferred (that fires with the number of bytes actually
+        received). If the connection is lost while this Deferred is
+        outstanding, it will errback. If 'expected' is 0, the Deferred will
+        fire right away.
+
+        If 'expected' is None, then this function returns None instead of a
+        Deferred, and you must call disconnectConsumer() when you are done."""
+
+        if self._consumer:
+            raise RuntimeError("A consumer is already attached: %r" %
+                               self._consumer)
+
+        # be aware of an ordering hazard: when we call the consumer's
+        # .registerProducer method, they are likely to immediately call
+        # self.resumeProducing, which we'll deliver to self.transport, which
+        # might call our .dataReceived, which may cause more records to be
+        # available. By waiting to set self._consumer until *after* we drain
+        # any pending records, we avoid delivering records out of order,
+        # which would be bad.
+        consumer.registerProducer(self, True)
+        # There might be enough data queued to exceed 'expected' before we
+        # leave this function. We must be sure to register the producer
+        # before it gets unregistered.
+
+        self._consumer = consumer
+        self._consumer_bytes_written = 0
+        self._consumer_bytes_expected = expected
+        d = None
+        if expected is not None:
+            d = defer.Deferred()
+        self._consumer_deferred = d
+        if expected == 0:
+            # write empty record to kick consumer into shutdown
+            self._writeToConsumer(b"")
+        # drain any pending records
+        while self._consumer and self._inbound_records:
+            r = self._take_record()
+            self._writeToConsumer(r)
+        return d
+
+    def _writeToConsumer(self, record):
+        self._consumer.write(record)
+        self._consumer_bytes_written += len(record)
+        if self._consumer_bytes_expected is not None:
+            if self._consumer_bytes_written >= self._consumer_bytes_expected:
+                d = self._consumer_deferred
+                self.disconnectConsumer()
+                d.callback(self._consumer_bytes_written)
+
+    def disconnectConsumer(self):
+        self._consumer.unregisterProducer()
+        self._consumer = None
+        self._consumer_bytes_expected = None
+        self._consumer_deferred = None
+
+    # Helper method to write a known number of bytes to a file. This has no
+    # flow control: the filehandle cannot push back. 'progress' is an
+    # optional callable which will be called on each write (with the number
+    # of bytes written). Returns a Deferred that fires (with the number of
+    # bytes written) when the count is reached or the RecordPipe is closed.
+    #
+    # With threaded=True, the writes (and the hasher) happen in a writer
+    # thread, which pauses us if the disk falls behind. The Deferred then
+    # waits for the last write to finish, and errbacks if any of them failed.
+
+    def writeToFile(self, f, expected, progress=None, hasher=None,
+                    threaded=False):
+        if not threaded:
+            fc = FileConsumer(f, progress, hasher)
+            return self.connectConsumer(fc, expected)
+        fc = ThreadedFileConsumer(f, progress, hasher)
+        d = self.connectConsumer(fc, expected)
+        def _flush(res):
+            d2 = fc.finish()
+            d2.addCallback(lambda _: res)
+            return d2
+        d.addBoth(_flush)
+        return d
+
+    def _abandon_reads(self, why=None):
+        self._inbound_closed = True
+        # (a read_into() can only be waiting if there's nothing left to
+        # read, so that gets 0)
+        while self._waiting_reads:
+            d, buffer = self._waiting_reads.popleft()
+            if buffer is None:
+                d.errback(_connection_closed(why))
+            else:
+                d.callback(0)
+
+
+def _connection_closed(why=None):
+    if why:
+        return error.ConnectionClosed(why)
+    return error.ConnectionClosed()
+
 @implementer(interfaces.IProducer, interfaces.IConsumer)
-class Connection(protocol.Protocol, policies.TimeoutMixin):
+class Connection(protocol.Protocol, policies.TimeoutMixin, _InboundRecords):
     def __init__(self, owner, relay_handshake, start, description):
         self.state = "too-early"
         self.buf = b""
+        # once negotiation finishes, inbound bytes are queued here (without
+        # copying) until a whole record is available
+        self._pending = deque()
+        self._pending_length = 0
+        self._record_length = None
+        self._max_record_length = None # on the wire, None means 4GB
         self.owner = owner
         self.relay_handshake = relay_handshake
         self.start = start
         self._description = description
         self._negotiation_d = defer.Deferred(self._cancel)
         self._error = None
-        self._consumer = None
-        self._consumer_bytes_written = 0
-        self._consumer_bytes_expected = None
-        self._consumer_deferred = None
-        self._inbound_records = deque()
-        self._waiting_reads = deque()
+        self._init_inbound_records()
+        self._close_observers = []
+        # with pooled crypto, records wait in these (in nonce order) while
+        # the thread pool works on them
+        self._inbound = None
+        self._outbound = None
+        self._consumer_paused = False # our consumer paused us
+        self._decrypt_throttled = False # too many records being decrypted
+        self._producer = None
+        self._streaming = None
+        self._producer_paused = False
+        self._transport_stalled = False
+        self._pumping = False
+        self._closing = False
+        self._lost_pending = False
 
     def connectionMade(self):
         self.setTimeout(TIMEOUT) # does timeoutConnection() when it expires
@@ -209,6 +600,8 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         #  wait for (receive|send)_handshake
         #  sender: decide, send "go" or hang up
         #  receiver: wait for "go"
+        if self.state == "records":
+            return self.dataReceivedRECORDS(data)
         self.buf += data
 
         assert self.state != "too-early"
@@ -242,7 +635,10 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             self.transport.write(b"nevermind\n")
             raise BadHandshake("abandoned")
         if self.state == "records":
-            return self.dataReceivedRECORDS()
+            # anything left over after the handshake is the start of the
+            # first record
+            leftover, self.buf = self.buf, b""
+            return self.dataReceivedRECORDS(leftover)
         if self.state == "hung up":
             return
         if isinstance(self.state, Exception): # for tests
@@ -252,76 +648,172 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
     def _negotiationSuccessful(self):
         self.state = "records"
         self.setTimeout(None)
-        send_key = self.owner._sender_record_key()
-        self.send_box = SecretBox(send_key)
+        self._send_key = self.owner._sender_record_key()
         self.send_nonce = 0
         receive_key = self.owner._receiver_record_key()
         self.receive_box = SecretBox(receive_key)
         self.next_receive_nonce = 0
+        crypto = self.owner._record_crypto()
+        if crypto:
+            self._inbound = _OrderedJobs(crypto, self._decrypted,
+                                         self._crypto_failed)
+            self._outbound = _OrderedJobs(crypto, self._encrypted,
+                                          self._crypto_failed)
         d, self._negotiation_d = self._negotiation_d, None
         d.callback(self)
 
-    def dataReceivedRECORDS(self):
+    def dataReceivedRECORDS(self, data):
+        # Each record is a 4-byte big-endian length, then the encrypted
+        # body. We queue inbound chunks as-is and only copy bytes out when a
+        # complete record is available, so each byte is copied once on its
+        # way to decryption, no matter how TCP happened to split the stream.
+        if data:
+            self._pending.append(data)
+            self._pending_length += len(data)
         while True:
-            if len(self.buf) < 4:
-                return
-            length = int(hexlify(self.buf[:4]), 16)
-            if len(self.buf) < 4+length:
+            if self._record_length is None:
+                if self._pending_length < 4:
+                    return
+                head = self._pending[0]
+                if len(head) >= 4:
+                    (length,) = RECORD_LENGTH.unpack_from(head)
+                    self._consume_pending(4)
+                else:
+                    (length,) = RECORD_LENGTH.unpack(self._consume_pending(4))
+                if (self._max_record_length is not None
+                    and length > self._max_record_length):
+                    raise RecordTooLarge("received a %d-byte record, limit"
+                                         " is %d" % (length,
+                                                     self._max_record_length))
+                self._record_length = length
+            if self._pending_length < self._record_length:
                 return
-            encrypted, self.buf = self.buf[4:4+length], self.buf[4+length:]
-
-            record = self._decrypt_record(encrypted)
-            self.recordReceived(record)
+            encrypted = self._consume_pending(self._record_length)
+            self._record_length = None
 
-    def _decrypt_record(self, encrypted):
+            if self._inbound is None:
+                record = self._decrypt_record(encrypted)
+                self.recordReceived(record)
+                continue
+            self._check_nonce(encrypted)
+            self._inbound.submit(self.receive_box.decrypt, encrypted)
+            if (len(self._inbound) >= CRYPTO_QUEUE_LIMIT
+                and not self._decrypt_throttled):
+                # stop reading until the thread pool catches up
+                self._decrypt_throttled = True
+                self.transport.pauseProducing()
+
+    def _consume_pending(self, count):
+        # remove 'count' bytes from the front of the reassembly queue, and
+        # return them as a single bytestring
+        self._pending_length -= count
+        size = count
+        pieces = []
+        while count:
+            chunk = self._pending.popleft()
+            if len(chunk) > count:
+                view = memoryview(chunk)
+                self._pending.appendleft(view[count:])
+                chunk = view[:count]
+            pieces.append(chunk)
+            count -= len(chunk)
+        if len(pieces) == 1:
+            piece = pieces[0]
+            return piece.tobytes() if isinstance(piece, memoryview) else piece
+        if six.PY2:
+            # py2's str.join() won't take memoryviews, so gather the pieces
+            # in a bytearray, at the cost of one more copy to make a str
+            buf = bytearray(size)
+            pos = 0
+            for piece in pieces:
+                buf[pos:pos+len(piece)] = piece
+                pos += len(piece)
+            return bytes(buf)
+        # py3 joins memoryviews directly, copying each byte once
+        return b"".join(pieces)
+
+    def _check_nonce(self, encrypted):
         nonce_buf = encrypted[:SecretBox.NONCE_SIZE] # assume it's prepended
-        nonce = int(hexlify(nonce_buf), 16)
-        if nonce != self.next_receive_nonce:
+        if nonce_buf != build_nonce(self.next_receive_nonce):
+            nonce = int(hexlify(nonce_buf), 16)
             raise BadNonce("received out-of-order record: got %d, expected %d"
                            % (nonce, self.next_receive_nonce))
         self.next_receive_nonce += 1
+
+    def _decrypt_record(self, encrypted):
+        self._check_nonce(encrypted)
         record = self.receive_box.decrypt(encrypted)
         return record
 
+    def _decrypted(self, record):
+        if (self._decrypt_throttled
+            and len(self._inbound) <= CRYPTO_QUEUE_LIMIT // 2):
+            self._decrypt_throttled = False
+            if not self._consumer_paused:
+                self.transport.resumeProducing()
+        self.recordReceived(record)
+        if self._lost_pending and not self._inbound:
+            self._lost_pending = False
+            self._finish_lost()
+
+    def _encrypted(self, pieces):
+        self.transport.writeSequence(pieces)
+        if self._closing and not self._outbound:
+            self.transport.loseConnection()
+            return
+        self._update_producer()
+
+    def _crypto_failed(self, f):
+        # most likely a corrupted inbound record
+        log.err(f, "transit record crypto failed")
+        self._inbound.clear()
+        self._outbound.clear()
+        self._error = f.value
+        self.state = "hung up"
+        self.transport.loseConnection()
+        if self._lost_pending:
+            self._lost_pending = False
+            self._finish_lost()
+
     def describe(self):
         return self._description
 
+    def set_max_record_size(self, size):
+        """Drop the connection if the other side sends a record of more than
+        'size' bytes (or DEFAULT_RECORD_SIZE, if that is bigger), rather
+        than buffering it."""
+        size = max(size, DEFAULT_RECORD_SIZE)
+        self._max_record_length = size + RECORD_OVERHEAD
+
     def send_record(self, record):
         if not isinstance(record, type(b"")): raise InternalError
         assert SecretBox.NONCE_SIZE == 24
         assert self.send_nonce < 2**(8*24)
         assert len(record) < 2**(8*4)
-        nonce = unhexlify("%048x" % self.send_nonce) # big-endian
+        nonce = build_nonce(self.send_nonce)
         self.send_nonce += 1
-        encrypted = self.send_box.encrypt(record, nonce)
-        length = unhexlify("%08x" % len(encrypted)) # always 4 bytes long
-        self.transport.write(length)
-        self.transport.write(encrypted)
-
-    def recordReceived(self, record):
-        if self._consumer:
-            self._writeToConsumer(record)
+        if self._outbound is not None:
+            self._outbound.submit(seal_record, record, nonce, self._send_key)
+            if (self._producer and self._streaming
+                and not self._producer_paused
+                and len(self._outbound) >= CRYPTO_QUEUE_LIMIT):
+                self._producer_paused = True
+                self._producer.pauseProducing()
             return
-        self._inbound_records.append(record)
-        self._deliverRecords()
-
-    def receive_record(self):
-        d = defer.Deferred()
-        self._waiting_reads.append(d)
-        self._deliverRecords()
-        return d
-
-    def _deliverRecords(self):
-        while self._inbound_records and self._waiting_reads:
-            r = self._inbound_records.popleft()
-            d = self._waiting_reads.popleft()
-            d.callback(r)
+        # seal_record() does the same as send_box.encrypt(), but hands us the
+        # nonce and ciphertext separately, so we can pass all three pieces to
+        # the transport in one call without concatenating (and thus
+        # copying) them
+        self.transport.writeSequence(seal_record(record, nonce,
+                                                 self._send_key))
 
     def close(self):
-        self.transport.loseConnection()
-        while self._waiting_reads:
-            d = self._waiting_reads.popleft()
-            d.errback(error.ConnectionClosed())
+        if self._outbound:
+            # let the records we've already accepted reach the wire first
+            self._closing = True
+        else:
+            self.transport.loseConnection()
+        self._abandon_reads()
 
     def timeoutConnection(self):
         self._error = BadHandshake("timeout")
@@ -345,100 +837,301 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             # timeout: BadHandshake("timeout")
 
             d.errback(self._error or BadHandshake("connection lost"))
+        if self._inbound:
+            # records that arrived before the connection was lost are still
+            # being decrypted: deliver them before we report the loss
+            self._lost_pending = True
+            return
+        self._finish_lost()
+
+    def _finish_lost(self):
         if self._consumer_deferred:
             self._consumer_deferred.errback(error.ConnectionClosed())
+        self._abandon_reads()
+        observers, self._close_observers = self._close_observers, []
+        for d in observers:
+            d.callback(None)
+
+    def when_closed(self):
+        """Return a Deferred that fires (with None) when this connection is
+        lost, for any reason."""
+        d = defer.Deferred()
+        self._close_observers.append(d)
+        return d
 
     # IConsumer methods, for outbound flow-control. We pass these through to
     # the transport. The 'producer' is something like a t.p.basic.FileSender
+    #
+    # With pooled crypto, records are still being encrypted when they leave
+    # send_record(), so the transport's buffer doesn't tell the whole story.
+    # We register a _CryptoProducer with the transport instead, and only ask
+    # our producer for more data when the transport has room and there's
+    # space in the thread pool queue.
     def registerProducer(self, producer, streaming):
         assert interfaces.IConsumer.providedBy(self.transport)
-        self.transport.registerProducer(producer, streaming)
+        if self._outbound is None:
+            self.transport.registerProducer(producer, streaming)
+            return
+        self._producer = producer
+        self._streaming = streaming
+        self._producer_paused = False
+        self._transport_stalled = False
+        self.transport.registerProducer(_CryptoProducer(self), True)
+        if not streaming:
+            self._pump()
     def unregisterProducer(self):
+        self._producer = None
         self.transport.unregisterProducer()
     def write(self, data):
         self.send_record(data)
 
+    def _transport_paused(self):
+        self._transport_stalled = True
+        if self._producer and self._streaming and not self._producer_paused:
+            self._producer_paused = True
+            self._producer.pauseProducing()
+
+    def _transport_resumed(self):
+        self._transport_stalled = False
+        self._update_producer()
+
+    def _transport_stopped(self):
+        if self._producer:
+            self._producer.stopProducing()
+
+    def _update_producer(self):
+        if not self._producer:
+            return
+        if not self._streaming:
+            self._pump()
+            return
+        if (self._producer_paused and not self._transport_stalled
+            and len(self._outbound) <= CRYPTO_QUEUE_LIMIT // 2):
+            self._producer_paused = False
+            self._producer.resumeProducing()
+
+    def _pump(self):
+        # pull producers give us one record per resumeProducing(), so keep
+        # asking until the queue is full
+        if self._pumping:
+            return
+        self._pumping = True
+        try:
+            while (self._producer and not self._transport_stalled
+                   and len(self._outbound) < CRYPTO_QUEUE_LIMIT):
+                sent = self.send_nonce
+                self._producer.resumeProducing()
+                if self.send_nonce == sent:
+                    break # it had nothing for us
+        finally:
+            self._pumping = False
+
     # IProducer methods, for inbound flow-control. We pass these through to
     # the transport.
     def stopProducing(self):
         self.transport.stopProducing()
     def pauseProducing(self):
+        self._consumer_paused = True
         self.transport.pauseProducing()
     def resumeProducing(self):
-        self.transport.resumeProducing()
+        self._consumer_paused = False
+        if not self._decrypt_throttled:
+            self.transport.resumeProducing()
 
-    # Helper methods
+# When both sides ask for it, a transfer can use several Connections at
+# once, to get more throughput out of links where a single TCP stream can't
+# fill the pipe. Each extra stream is negotiated by its own Common instance,
+# with a transit key derived from the main one, so each stream has its own
+# handshake, relay token, and record keys (and thus its own nonce space).
+# Records are dealt out to the streams in strict rotation, and the far end
+# collects them in the same rotation, so no extra framing is needed to put
+# them back in order.
 
-    def connectConsumer(self, consumer, expected=None):
-        """Helper method to glue an instance of e.g. t.p.ftp.FileConsumer to
-        us. Inbound records will be written as bytes to the consumer.
+STRIPE_QUEUE_LIMIT = 16 # records buffered per stream before we pause it
 
-        Set 'expected' to an integer to automatically disconnect when at
-        least that number of bytes have been written. This function will then
-        return a Deferred (that fires with the number of bytes actually
-        received). If the connection is lost while this Deferred is
-        outstanding, it will errback. If 'expected' is 0, the Deferred will
-        fire right away.
+def derive_stripe_key(key, stripe):
+    return HKDF(key, len(key),
+                CTXinfo=("transit_stripe_%d" % stripe).encode("ascii"))
 
-        If 'expected' is None, then this function returns None instead of a
-        Deferred, and you must call disconnectConsumer() when you are done."""
+@implementer(interfaces.IConsumer)
+class _StripeConsumer:
+    # receives the inbound records of a single stream
+    def __init__(self, owner, stripe):
+        self._owner = owner
+        self._stripe = stripe
+        self.producer = None
 
-        if self._consumer:
-            raise RuntimeError("A consumer is already attached: %r" %
-                               self._consumer)
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
 
-        # be aware of an ordering hazard: when we call the consumer's
-        # .registerProducer method, they are likely to immediately call
-        # self.resumeProducing, which we'll deliver to self.transport, which
-        # might call our .dataReceived, which may cause more records to be
-        # available. By waiting to set self._consumer until *after* we drain
-        # any pending records, we avoid delivering records out of order,
-        # which would be bad.
-        consumer.registerProducer(self, True)
-        # There might be enough data queued to exceed 'expected' before we
-        # leave this function. We must be sure to register the producer
-        # before it gets unregistered.
+    def unregisterProducer(self):
+        self.producer = None
 
-        self._consumer = consumer
-        self._consumer_bytes_written = 0
-        self._consumer_bytes_expected = expected
-        d = None
-        if expected is not None:
-            d = defer.Deferred()
-        self._consumer_deferred = d
-        if expected == 0:
-            # write empty record to kick consumer into shutdown
-            self._writeToConsumer(b"")
-        # drain any pending records
-        while self._consumer and self._inbound_records:
-            r = self._inbound_records.popleft()
-            self._writeToConsumer(r)
-        return d
+    def write(self, record):
+        self._owner._stripe_record_received(self._stripe, record)
 
-    def _writeToConsumer(self, record):
-        self._consumer.write(record)
-        self._consumer_bytes_written += len(record)
-        if self._consumer_bytes_expected is not None:
-            if self._consumer_bytes_written >= self._consumer_bytes_expected:
-                d = self._consumer_deferred
-                self.disconnectConsumer()
-                d.callback(self._consumer_bytes_written)
+@implementer(interfaces.IPushProducer, interfaces.IPullProducer)
+class _StripeProducer:
+    # registered with the transport of a single stream, to tell us when
+    # that stream wants more outbound data
+    def __init__(self, owner, stripe):
+        self._owner = owner
+        self._stripe = stripe
 
-    def disconnectConsumer(self):
-        self._consumer.unregisterProducer()
-        self._consumer = None
-        self._consumer_bytes_expected = None
-        self._consumer_deferred = None
+    def resumeProducing(self):
+        self._owner._stripe_resumed(self._stripe)
 
-    # Helper method to write a known number of bytes to a file. This has no
-    # flow control: the filehandle cannot push back. 'progress' is an
-    # optional callable which will be called on each write (with the number
-    # of bytes written). Returns a Deferred that fires (with the number of
-    # bytes written) when the count is reached or the RecordPipe is closed.
+    def pauseProducing(self):
+        self._owner._stripe_paused(self._stripe)
+
+    def stopProducing(self):
+        self._owner._stripe_stopped(self._stripe)
+
+@implementer(interfaces.IProducer, interfaces.IConsumer)
+class StripedConnection(_InboundRecords):
+    """I look like a single Connection (send_record, receive_record,
+    connectConsumer, etc), but spread my records across several
+    Connections."""
+
+    def __init__(self, connections):
+        assert len(connections) > 1
+        self._connections = connections
+        self._init_inbound_records()
+        self._send_stripe = 0
+        self._receive_stripe = 0
+        self._queues = [deque() for c in connections]
+        self._stripe_consumers = [_StripeConsumer(self, i)
+                                  for i in range(len(connections))]
+        self._stripe_producers = [_StripeProducer(self, i)
+                                  for i in range(len(connections))]
+        self._throttled = set() # stripes paused because their queue is full
+        self._paused = False # paused by our own consumer
+        self._producer = None
+        self._streaming = None
+        self._ready = set() # stripes that can take more outbound data
+        self._stalled = set() # stripes whose transport told us to pause
+        self._closed = False
+        for stripe, (c, sc) in enumerate(zip(connections,
+                                             self._stripe_consumers)):
+            c.connectConsumer(sc)
+            c.when_closed().addCallback(self._connection_lost, stripe)
+
+    def describe(self):
+        return "striped(%s)" % ", ".join([c.describe()
+                                          for c in self._connections])
+
+    def set_max_record_size(self, size):
+        for c in self._connections:
+            c.set_max_record_size(size)
+
+    def send_record(self, record):
+        c = self._connections[self._send_stripe]
+        self._ready.discard(self._send_stripe)
+        self._send_stripe = (self._send_stripe + 1) % len(self._connections)
+        c.send_record(record)
+
+    def _stripe_record_received(self, stripe, record):
+        self._queues[stripe].append(record)
+        if len(self._queues[stripe]) > STRIPE_QUEUE_LIMIT:
+            # this stream is running ahead of the one we're waiting on
+            self._throttled.add(stripe)
+            self._connections[stripe].pauseProducing()
+        self._deliver_stripes()
+
+    def _deliver_stripes(self):
+        while self._queues[self._receive_stripe]:
+            stripe = self._receive_stripe
+            record = self._queues[stripe].popleft()
+            self._receive_stripe = (stripe + 1) % len(self._connections)
+            if (stripe in self._throttled
+                and len(self._queues[stripe]) <= STRIPE_QUEUE_LIMIT // 2):
+                self._throttled.discard(stripe)
+                if not self._paused:
+                    self._connections[stripe].resumeProducing()
+            self.recordReceived(record)
 
-    def writeToFile(self, f, expected, progress=None, hasher=None):
-        fc = FileConsumer(f, progress, hasher)
-        return self.connectConsumer(fc, expected)
+    def close(self):
+        self._closed = True
+        for c in self._connections:
+            c.close()
+        self._abandon_reads()
+
+    def _connection_lost(self, _, stripe):
+        # losing any one stream leaves a hole in the sequence of records, so
+        # the whole set is finished. Records aren't acknowledged one at a
+        # time, so we can't tell whether the lost stream still had some in
+        # flight.
+        if self._closed:
+            return
+        self._closed = True
+        why = "stripe %d (%s) was lost" % (stripe,
+                                           self._connections[stripe].describe())
+        for c in self._connections:
+            c.transport.loseConnection()
+        self._abandon_reads(why)
+        if self._consumer_deferred:
+            d, self._consumer_deferred = self._consumer_deferred, None
+            d.errback(_connection_closed(why))
+
+    # IConsumer methods, for outbound flow-control. Each stream's transport
+    # gets its own _StripeProducer, and we only ask our producer for more
+    # data when the stream that gets the next record is ready for it.
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+        self._streaming = streaming
+        for c, sp in zip(self._connections, self._stripe_producers):
+            c.registerProducer(sp, streaming)
+        if not streaming:
+            self._pump()
+
+    def unregisterProducer(self):
+        self._producer = None
+        self._ready.clear()
+        self._stalled.clear()
+        for c in self._connections:
+            c.unregisterProducer()
+
+    def write(self, data):
+        self.send_record(data)
+
+    def _stripe_resumed(self, stripe):
+        if self._streaming:
+            self._stalled.discard(stripe)
+            if not self._stalled and self._producer:
+                self._producer.resumeProducing()
+        else:
+            self._ready.add(stripe)
+            self._pump()
+
+    def _stripe_paused(self, stripe):
+        if not self._stalled and self._producer:
+            self._producer.pauseProducing()
+        self._stalled.add(stripe)
+
+    def _stripe_stopped(self, stripe):
+        if self._producer:
+            self._producer.stopProducing()
+
+    def _pump(self):
+        while self._producer and self._send_stripe in self._ready:
+            stripe = self._send_stripe
+            self._producer.resumeProducing()
+            if self._send_stripe == stripe:
+                break # producer didn't write anything
+
+    # IProducer methods, for inbound flow-control
+    def stopProducing(self):
+        for c in self._connections:
+            c.stopProducing()
+    def pauseProducing(self):
+        self._paused = True
+        for c in self._connections:
+            c.pauseProducing()
+    def resumeProducing(self):
+        self._paused = False
+        for stripe, c in enumerate(self._connections):
+            if stripe not in self._throttled:
+                c.resumeProducing()
 
 class OutboundConnectionFactory(protocol.ClientFactory):
     protocol = Connection
@@ -484,7 +1177,7 @@ class InboundConnectionFactory(protocol.ClientFactory):
         if isinstance(addr, address.HostnameAddress):
             return "<-%s:%d" % (addr.hostname, addr.port)
         elif isinstance(addr, (address.IPv4Address, address.IPv6Address)):
-            return "<-%s:%d" % (addr.host, addr.port)
+            return "<-%s" % _hostport(addr.host, addr.port)
         return "<-%r" % addr
 
     def buildProtocol(self, addr):
@@ -528,6 +1221,43 @@ def allocate_tcp_port():
     s.close()
     return port
 
+class _Ports:
+    # looks enough like an IListeningPort for Common
+    def __init__(self, ports):
+        self._ports = ports
+
+    def stopListening(self):
+        return defer.DeferredList([p.stopListening() for p in self._ports])
+
+class DualStackServerEndpoint:
+    """I listen for IPv6 and IPv4 connections on the same port. Where the
+    IPv6 socket accepts IPv4 connections too (linux, by default), the IPv4
+    listen fails and the IPv6 port does both jobs. Where there's no IPv6 at
+    all, I only listen on IPv4."""
+
+    def __init__(self, reactor, port):
+        self._reactor = reactor
+        self._port = port
+
+    @inlineCallbacks
+    def listen(self, factory):
+        ports = []
+        try:
+            p = yield endpoints.TCP6ServerEndpoint(self._reactor, self._port,
+                                                   interface="::"
+                                                   ).listen(factory)
+            ports.append(p)
+        except error.CannotListenError:
+            pass
+        try:
+            p = yield endpoints.TCP4ServerEndpoint(self._reactor, self._port
+                                                   ).listen(factory)
+            ports.append(p)
+        except error.CannotListenError:
+            if not ports:
+                raise
+        returnValue(_Ports(ports))
+
 class _ThereCanBeOnlyOne:
     """Accept a list of contender Deferreds, and return a summary Deferred.
     When the first contender fires successfully, cancel the rest and fire the
@@ -585,13 +1315,146 @@ class _ThereCanBeOnlyOne:
 def there_can_be_only_one(contenders):
     return _ThereCanBeOnlyOne(contenders).run()
 
+def _is_ipv6(hint):
+    return ":" in hint.hostname
+
+def _network(address):
+    # the /64 of an IPv6 address, or the /24 of an IPv4 one, or None for a
+    # hostname
+    for family, length in [(socket.AF_INET6, 8), (socket.AF_INET, 3)]:
+        try:
+            return socket.inet_pton(family, address)[:length]
+        except (socket.error, ValueError, AttributeError):
+            pass
+    return None
+
+def order_direct_hints(hints, our_addresses=()):
+    """Sort direct hints by priority (highest first), and within each
+    priority alternate between IPv6 and IPv4 addresses (IPv6 first), so a
+    network that can't reach one family doesn't hold up the other for long.
+    Hostnames count as IPv4: HostnameEndpoint races their addresses itself.
+    Within each family, addresses on the same network as one of
+    our_addresses (the same IPv6 /64 or IPv4 /24) go first, since they're
+    the most likely to answer."""
+    our_networks = set([_network(a) for a in our_addresses]) - set([None])
+    def _remote(h):
+        return _network(h.hostname) not in our_networks
+    by_priority = {}
+    for h in hints:
+        by_priority.setdefault(h.priority, []).append(h)
+    ordered = []
+    for priority in sorted(by_priority, reverse=True):
+        # (sorted() is stable, so otherwise they stay in the order given)
+        v6 = sorted([h for h in by_priority[priority] if _is_ipv6(h)],
+                    key=_remote)
+        v4 = sorted([h for h in by_priority[priority] if not _is_ipv6(h)],
+                    key=_remote)
+        while v6 or v4:
+            if v6:
+                ordered.append(v6.pop(0))
+            if v4:
+                ordered.append(v4.pop(0))
+    return ordered
+
+class _Attempt:
+    # one connection attempt, which may not have started yet. .d fires with
+    # its result. Cancelling .d before the attempt starts means it never
+    # will.
+    def __init__(self, description, start):
+        self.description = description
+        self._start = start
+        self._running = None
+        self.d = defer.Deferred(self._cancel)
+
+    def _cancel(self, d):
+        if self._running:
+            self._running.cancel()
+
+    def start(self):
+        self._running = defer.maybeDeferred(self._start)
+        return self._running
+
+class _StaggeredAttempts:
+    """I start groups of connection attempts one group at a time, in the
+    style of Happy Eyeballs (RFC 8305). Each group starts a given delay
+    after the previous one, or right away if every attempt started so far
+    has failed, so dead addresses don't hold up the ones behind them. The
+    first group starts as soon as run() is called. Every attempt gets a
+    'transit attempt' timing event."""
+
+    def __init__(self, reactor, timing):
+        self._reactor = reactor
+        self._timing = timing
+        self._groups = deque() # (delay, [_Attempt])
+        self._in_flight = 0
+        self._timer = None
+        self._stopped = False
+
+    def add(self, delay, attempts):
+        # attempts is a list of (description, start) pairs, where start()
+        # returns a Deferred. Returns a Deferred for each one.
+        group = [_Attempt(description, start)
+                 for (description, start) in attempts]
+        self._groups.append((delay, group))
+        return [a.d for a in group]
+
+    def run(self):
+        self._start_next()
+
+    def stop(self):
+        self._stopped = True
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+    def _start_next(self):
+        self._timer = None
+        if self._stopped or not self._groups:
+            return
+        delay, group = self._groups.popleft()
+        if self._groups:
+            self._timer = self._reactor.callLater(self._groups[0][0],
+                                                  self._start_next)
+        # (skipping any that were cancelled before they started)
+        group = [a for a in group if not a.d.called]
+        self._in_flight += len(group)
+        for a in group:
+            ev = self._timing.add("transit attempt",
+                                  description=a.description)
+            d = a.start()
+            d.addBoth(self._finished, ev)
+            d.chainDeferred(a.d)
+        if not self._in_flight:
+            self._fail_over()
+
+    def _finished(self, res, ev):
+        self._in_flight -= 1
+        if not isinstance(res, failure.Failure):
+            ev.finish(result="connected")
+        elif res.check(defer.CancelledError):
+            ev.finish(result="cancelled")
+        else:
+            ev.finish(result="failed", error=str(res.value))
+            if not self._in_flight:
+                self._fail_over()
+        return res
+
+    def _fail_over(self):
+        # everything we've started has failed: don't wait for the timer
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+            self._start_next()
+
 class Common:
     RELAY_DELAY = 2.0
+    ATTEMPT_DELAY = 0.25
     TRANSIT_KEY_LENGTH = SecretBox.KEY_SIZE
 
     def __init__(self, transit_relay, no_listen=False, tor=None,
-                 reactor=reactor, timing=None):
+                 reactor=reactor, timing=None, streams=1,
+                 pooled_crypto=False):
         self._side = bytes_to_hexstr(os.urandom(8)) # unicode
+        self._transit_relay = transit_relay
         if transit_relay:
             if not isinstance(transit_relay, type(u"")):
                 raise InternalError
@@ -612,20 +1475,31 @@ class Common:
         self._reactor = reactor
         self._timing = timing or DebugTiming()
         self._timing.add("transit")
+        self._max_streams = max(1, min(streams, MAX_STREAMS))
+        self._stripes = [] # Common instances for the extra streams
+        self._their_stripe_hints = None # stripe number -> hint structs
+        self._crypto = RecordCrypto(reactor) if pooled_crypto else None
 
     def _build_listener(self):
         if self._no_listen or self._tor:
             return ([], None)
         portnum = allocate_tcp_port()
-        addresses = ipaddrs.find_addresses()
-        non_loopback_addresses = [a for a in addresses if a != "127.0.0.1"]
+        addresses = ipaddrs.find_addresses(ipv6=True)
+        non_loopback_addresses = [a for a in addresses
+                                  if a not in ("127.0.0.1", "::1")]
         if non_loopback_addresses:
             # some test hosts, including the appveyor VMs, *only* have
             # 127.0.0.1, and the tests will hang badly if we remove it.
             addresses = non_loopback_addresses
+        else:
+            addresses = [a for a in addresses if a != "::1"] or ["127.0.0.1"]
         direct_hints = [DirectTCPV1Hint(six.u(addr), portnum, 0.0)
                         for addr in addresses]
-        ep = endpoints.serverFromString(reactor, "tcp:%d" % portnum)
+        if [a for a in addresses if ":" in a]:
+            # we have IPv6 addresses to offer, so listen on both families
+            ep = DualStackServerEndpoint(reactor, portnum)
+        else:
+            ep = endpoints.serverFromString(reactor, "tcp:%d" % portnum)
         return direct_hints, ep
 
     def get_connection_abilities(self):
@@ -651,8 +1525,33 @@ class Common:
                                         u"hostname": rh.hostname,
                                         u"port": rh.port})
             hints.append(rhint)
+        for stripe, child in enumerate(self._get_stripes(), 1):
+            stripe_hints = yield child.get_connection_hints()
+            hints.append({u"type": u"stripe-v1",
+                          u"stripe": stripe,
+                          u"hints": stripe_hints,
+                          })
         returnValue(hints)
 
+    def _get_stripes(self):
+        # We offer one set of stripe hints for each extra stream we're
+        # willing to use. If we've already heard from the other side, we
+        # don't offer more than they did.
+        count = self._max_streams - 1
+        if self._their_stripe_hints is not None:
+            count = min(count, len(self._their_stripe_hints))
+        while len(self._stripes) < count:
+            child = self.__class__(self._transit_relay,
+                                   no_listen=self._no_listen, tor=self._tor,
+                                   reactor=self._reactor, timing=self._timing,
+                                   pooled_crypto=bool(self._crypto))
+            stripe = len(self._stripes) + 1
+            if self._transit_key:
+                child.set_transit_key(derive_stripe_key(self._transit_key,
+                                                        stripe))
+            self._stripes.append(child)
+        return self._stripes[:count]
+
     def _get_direct_hints(self):
         if self._listener:
             return defer.succeed(self._my_direct_hints)
@@ -715,6 +1614,8 @@ class Common:
             return TorTCPV1Hint(hint[u"hostname"], hint[u"port"], priority)
 
     def add_connection_hints(self, hints):
+        if self._their_stripe_hints is None:
+            self._their_stripe_hints = {}
         for h in hints: # hint structs
             hint_type = h.get(u"type", u"")
             if hint_type in [u"direct-tcp-v1", u"tor-tcp-v1"]:
@@ -734,6 +1635,15 @@ class Common:
                 if relay_hints:
                     rh = RelayV1Hint(hints=tuple(sorted(relay_hints)))
                     self._our_relay_hints.add(rh)
+            elif hint_type == u"stripe-v1":
+                stripe = h.get(u"stripe")
+                stripe_hints = h.get(u"hints")
+                if not (isinstance(stripe, six.integer_types) and stripe > 0
+                        and isinstance(stripe_hints, list)):
+                    log.msg("invalid stripe hint: %r" % (h,))
+                    continue
+                self._their_stripe_hints.setdefault(stripe, [])
+                self._their_stripe_hints[stripe].extend(stripe_hints)
             else:
                 log.msg("unknown hint type: %r" % (h,))
 
@@ -769,6 +1679,10 @@ class Common:
             return HKDF(self._transit_key, SecretBox.KEY_SIZE,
                         CTXinfo=b"transit_record_sender_key")
 
+    def _record_crypto(self):
+        # a RecordCrypto, or None to do the crypto on the reactor thread
+        return self._crypto
+
     def set_transit_key(self, key):
         assert isinstance(key, type(b"")), type(key)
         # We use pubsub to protect against the race where the sender knows
@@ -776,6 +1690,8 @@ class Common:
         # socket before the receiver gets the relay message (and thus the
         # key).
         self._transit_key = key
+        for stripe, child in enumerate(self._stripes, 1):
+            child.set_transit_key(derive_stripe_key(key, stripe))
         waiters = self._waiting_for_transit_key
         del self._waiting_for_transit_key
         for d in waiters:
@@ -798,23 +1714,72 @@ class Common:
             # we want to have the transit key before starting any outbound
             # connections, so those connections will know what to say when
             # they connect
-            winner = yield self._connect()
+            stripes = self._agreed_stripes()
+            if stripes:
+                winner = yield self._connect_striped(stripes)
+            else:
+                winner = yield self._connect()
         returnValue(winner)
 
+    def _agreed_stripes(self):
+        # Both sides must use the same number of streams. Each of us may
+        # have offered more than the other would accept (we can't wait for
+        # their hints before sending ours), so we both use the smaller
+        # offer.
+        their_stripes = self._their_stripe_hints or {}
+        offered = 0
+        while (offered+1) in their_stripes:
+            offered += 1
+        count = min(offered, len(self._stripes))
+        for child in self._stripes[count:]:
+            # we offered more than they did, so shut down the extras
+            if child._listener_d:
+                child._stop_listening()
+        stripes = self._stripes[:count]
+        for stripe, child in enumerate(stripes, 1):
+            child.add_connection_hints(their_stripes[stripe])
+        return stripes
+
+    def _connect_striped(self, stripes):
+        # every stream must connect: a missing one would leave a hole in the
+        # sequence of records
+        ds = [self._connect()] + [child._connect() for child in stripes]
+        d = defer.DeferredList(ds, consumeErrors=True)
+        def _connected(results):
+            connections = [res for (ok, res) in results if ok]
+            if len(connections) == len(results):
+                return StripedConnection(connections)
+            for c in connections:
+                c.close()
+            failures = [res for (ok, res) in results if not ok]
+            return failures[0]
+        d.addCallback(_connected)
+        return d
+
     def _connect(self):
-        # It might be nice to wire this so that a failure in the direct hints
-        # causes the relay hints to be used right away (fast failover). But
-        # none of our current use cases would take advantage of that: if we
-        # have any viable direct hints, then they're either going to succeed
-        # quickly or hang for a long time.
+        # Direct hints are tried one at a time, ATTEMPT_DELAY apart, best
+        # first. The relays start a few seconds after the first direct
+        # hint, one priority tier at a time. The idea is to prefer direct
+        # connections, but not be afraid of using a relay when we have
+        # direct hints that don't resolve quickly: many direct hints will be
+        # to unused local-network IP addresses, which won't answer, and
+        # would take the full TCP timeout (30s or more) to fail. And when
+        # every attempt we've started has failed (a refused connection, an
+        # unreachable network), the next one starts right away, relays
+        # included.
         contenders = []
         if self._listener_d:
             contenders.append(self._listener_d)
-        relay_delay = 0
-
-        for hint_obj in self._their_direct_hints:
+        schedule = [] # (when, [(description, start)])
+
+        our_addresses = []
+        if not self._tor:
+            our_addresses = ipaddrs.find_addresses(ipv6=True)
+        direct_hints = order_direct_hints(self._their_direct_hints,
+                                          our_addresses)
+        for hint_obj in direct_hints:
             # Check the hint type to see if we can support it (e.g. skip
-            # onion hints on a non-Tor client). Do not increase relay_delay
+            # onion hints on a non-Tor client). Do not delay the relays
             # unless we have at least one viable hint.
             ep = self._endpoint_from_hint_obj(hint_obj)
             if not ep:
@@ -822,16 +1787,10 @@ class Common:
             description = "->%s" % describe_hint_obj(hint_obj)
             if self._tor:
                 description = "tor" + description
-            d = self._start_connector(ep, description)
-            contenders.append(d)
-            relay_delay = self.RELAY_DELAY
-
-        # Start trying the relays a few seconds after we start to try the
-        # direct hints. The idea is to prefer direct connections, but not be
-        # afraid of using a relay when we have direct hints that don't
-        # resolve quickly. Many direct hints will be to unused local-network
-        # IP addresses, which won't answer, and would take the full TCP
-        # timeout (30s or more) to fail.
+            start = functools.partial(self._start_connector, ep, description)
+            schedule.append((len(schedule) * self.ATTEMPT_DELAY,
+                             [(description, start)]))
+        relay_delay = self.RELAY_DELAY if schedule else 0
 
         prioritized_relays = {}
         for rh in self._our_relay_hints:
@@ -842,6 +1801,7 @@ class Common:
                 prioritized_relays[priority].add(hint_obj)
 
         for priority in sorted(prioritized_relays, reverse=True):
+            tier = []
             for hint_obj in prioritized_relays[priority]:
                 ep = self._endpoint_from_hint_obj(hint_obj)
                 if not ep:
@@ -849,16 +1809,31 @@ class Common:
                 description = "->relay:%s" % describe_hint_obj(hint_obj)
                 if self._tor:
                     description = "tor" + description
-                d = task.deferLater(self._reactor, relay_delay,
-                                    self._start_connector, ep, description,
-                                    is_relay=True)
-                contenders.append(d)
+                start = functools.partial(self._start_connector, ep,
+                                          description, is_relay=True)
+                tier.append((description, start))
+            if tier:
+                schedule.append((relay_delay, tier))
             relay_delay += self.RELAY_DELAY
 
+        # (a stable sort, so direct hints go before relays due at the same
+        # time)
+        schedule.sort(key=lambda entry: entry[0])
+        attempts = _StaggeredAttempts(self._reactor, self._timing)
+        previous = 0
+        for (when, group) in schedule:
+            contenders.extend(attempts.add(when - previous, group))
+            previous = when
+
         if not contenders:
             raise TransitError("No contenders for connection")
 
         winner = there_can_be_only_one(contenders)
+        def _stop(res):
+            attempts.stop()
+            return res
+        winner.addBoth(_stop)
+        attempts.run()
         return self._not_forever(2*TIMEOUT, winner)
 
     def _not_forever(self, timeout, d):
@@ -951,6 +1926,128 @@ class FileConsumer:
         assert self._producer
         self._producer = None
 
+# ThreadedFileConsumer does the same job, but the file writes and the hasher
+# run in a dedicated writer thread, so a slow disk (or a slow hash) doesn't
+# hold up the reactor, and thus the socket reads. A single thread keeps the
+# writes in order. When more than WRITE_QUEUE_LIMIT bytes are waiting for
+# the disk, we pause our producer until the writer catches up. The progress
+# function is called on the reactor thread, as each write completes.
+
+WRITE_QUEUE_LIMIT = 16*1024*1024
+
+@implementer(interfaces.IConsumer)
+class ThreadedFileConsumer:
+    def __init__(self, f, progress=None, hasher=None, reactor=reactor):
+        self._f = f
+        self._progress = progress
+        self._hasher = hasher
+        self._reactor = reactor
+        self._producer = None
+        self._paused = False
+        self._queued_bytes = 0
+        self._queued_writes = 0
+        self._error = None # Failure from the first write that failed
+        self._finish_waiters = []
+        self._pool = None
+        self._shutdown_trigger = None
+
+    def _get_pool(self):
+        # the writer thread is only started by the first write, and (like
+        # reactor.getThreadPool) is stopped at reactor shutdown if finish()
+        # never got the chance, so it can't keep the process alive
+        if not self._pool:
+            self._pool = threadpool.ThreadPool(1, 1, "wormhole-file-writer")
+            self._pool.start()
+            self._shutdown_trigger = self._reactor.addSystemEventTrigger(
+                "before", "shutdown", self._stop_pool)
+        return self._pool
+
+    def _stop_pool(self):
+        if self._shutdown_trigger:
+            self._reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            self._shutdown_trigger = None
+        if self._pool:
+            pool, self._pool = self._pool, None
+            pool.stop()
+
+    def registerProducer(self, producer, streaming):
+        assert not self._producer
+        self._producer = producer
+        assert streaming
+
+    def write(self, bytes):
+        if self._error:
+            return # the transfer is being abandoned
+        self._queued_bytes += len(bytes)
+        self._queued_writes += 1
+        d = threads.deferToThreadPool(self._reactor, self._get_pool(),
+                                      self._write, bytes)
+        d.addCallbacks(self._written, self._write_failed,
+                       callbackArgs=(len(bytes),),
+                       errbackArgs=(len(bytes),))
+        if (self._queued_bytes > WRITE_QUEUE_LIMIT and not self._paused
+            and self._producer):
+            self._paused = True
+            self._producer.pauseProducing()
+
+    def _write(self, bytes):
+        # this runs in the writer thread
+        self._f.write(bytes)
+        if self._hasher:
+            self._hasher(bytes)
+
+    def _written(self, _, length):
+        self._dequeued(length)
+        if self._progress:
+            self._progress(length)
+        if self._paused and self._queued_bytes <= WRITE_QUEUE_LIMIT // 2:
+            self._paused = False
+            if self._producer:
+                self._producer.resumeProducing()
+        self._maybe_finished()
+
+    def _dequeued(self, length):
+        self._queued_bytes -= length
+        self._queued_writes -= 1
+
+    def _write_failed(self, f, length):
+        self._dequeued(length)
+        if not self._error:
+            self._error = f
+            if self._producer:
+                # we can't keep up our end, so abandon the transfer
+                self._producer.stopProducing()
+        self._maybe_finished()
+
+    def unregisterProducer(self):
+        assert self._producer
+        producer, self._producer = self._producer, None
+        if self._paused:
+            # don't leave the connection paused: anything else that arrives
+            # is none of our business
+            self._paused = False
+            producer.resumeProducing()
+
+    def finish(self):
+        """Return a Deferred that fires once everything written so far has
+        reached the file, and then stop the writer thread. The Deferred
+        errbacks if any of the writes failed."""
+        d = defer.Deferred()
+        self._finish_waiters.append(d)
+        self._maybe_finished()
+        return d
+
+    def _maybe_finished(self):
+        if self._queued_writes or not self._finish_waiters:
+            return
+        self._stop_pool()
+        waiters, self._finish_waiters = self._finish_waiters, []
+        for d in waiters:
+            if self._error:
+                d.errback(self._error)
+            else:
+                d.callback(None)
+
 # the TransitSender/Receiver.connect() yields a Connection, on which you can
 # do send_record(), but what should the receive API be? set a callback for
 # inbound records? get a Deferred for the next record? The producer/consumer
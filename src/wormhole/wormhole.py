@@ -9,6 +9,7 @@ from .util import bytes_to_hexstr
 from .timing import DebugTiming
 from .journal import ImmediateJournal
 from ._boss import Boss
+from ._rendezvous import RendezvousPool
 from ._key import derive_key
 from .errors import NoKeyError, WormholeClosed
 from .util import to_bytes
@@ -280,8 +281,13 @@ class _DeferredWormhole(object):
 def create(appid, relay_url, reactor, # use keyword args for everything else
            versions={},
            delegate=None, journal=None, tor=None,
-           timing=None,
+           timing=None, pool=None,
            stderr=sys.stderr):
+    # pool= is a RendezvousPool (from create_pool()) for relay_url, to share
+    # its connection instead of making one of our own
+    if pool and pool.get_url() != relay_url:
+        raise ValueError("pool is for %s, not %s"
+                         % (pool.get_url(), relay_url))
     timing = timing or DebugTiming()
     side = bytes_to_hexstr(os.urandom(5))
     journal = journal or ImmediateJournal()
@@ -292,11 +298,17 @@ def create(appid, relay_url, reactor, # use keyword args for everything else
     wormhole_versions = {} # will be used to indicate Wormhole capabilities
     wormhole_versions["app_versions"] = versions # app-specific capabilities
     b = Boss(w, side, relay_url, appid, wormhole_versions,
-             reactor, journal, tor, timing)
+             reactor, journal, tor, timing, pool)
     w._set_boss(b)
     b.start()
     return w
 
+def create_pool(relay_url, reactor, tor=None):
+    """Return a RendezvousPool: one connection to the rendezvous server at
+    relay_url, which many wormholes can share by passing it to create() as
+    pool=. Call its close() method when you are done with it."""
+    return RendezvousPool(relay_url, reactor, tor)
+
 ## def from_serialized(serialized, reactor, delegate,
 ##                     journal=None, tor=None,
 ##                     timing=None, stderr=sys.stderr):